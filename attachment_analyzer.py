@@ -21,6 +21,8 @@ from vertexai.generative_models import GenerativeModel, Part, SafetySetting, Har
 from google.oauth2 import service_account
 import requests
 
+import llm_ledger
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -179,7 +181,7 @@ class AttachmentAnalyzer:
 Отвечай подробно на русском языке.
 """
             
-            response = self.model.generate_content([prompt, image_part])
+            response = llm_ledger.generate(self.model, [prompt, image_part], "video_frame")
             return response.text
             
         except Exception as e:
@@ -241,7 +243,7 @@ class AttachmentAnalyzer:
                     part = self.load_file_as_part(file_path, attachment_type)
                     if part:
                         # Генерируем анализ
-                        response = self.model.generate_content([prompt, part])
+                        response = llm_ledger.generate(self.model, [prompt, part], f"attachment_{attachment_type}")
                         result['analysis'] = response.text
                     else:
                         result['error'] = "Не удалось загрузить файл для анализа"
@@ -0,0 +1,72 @@
+# --- Описание ---
+# Общие части пакетных LLM-задач (resummarize_profiles.py, strategy_agent/auto_strategy_agent.py):
+# глобальный лимит запросов к Gemini в минуту и отчет о ходе выполнения с ETA.
+# --- Конец описания ---
+
+import logging
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов (token bucket), общее для всех потоков процесса.
+    Емкость ведра — один запрос в минуту на единицу лимита, поэтому всплеск не превышает лимита за минуту.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1.0, float(requests_per_minute))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """Блокирует поток, пока не освободится count запросов в пределах лимита."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= count:
+                    self.tokens -= count
+                    return
+                wait_seconds = (count - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class ProgressReporter:
+    """Считает обработанные элементы и ошибки и раз в interval секунд пишет в лог скорость и ETA."""
+
+    def __init__(self, total, label, interval=15.0):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.errors = 0
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+        self.lock = threading.Lock()
+
+    def record(self, ok=True):
+        with self.lock:
+            self.done += 1
+            if not ok:
+                self.errors += 1
+            if time.monotonic() - self.reported_at >= self.interval:
+                self.reported_at = time.monotonic()
+                logging.info(self.summary())
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        per_minute = self.done / elapsed * 60 if elapsed > 0 else 0.0
+        remaining = max(0, self.total - self.done)
+        if per_minute > 0:
+            eta_minutes = remaining / per_minute
+            eta = f"{int(eta_minutes // 60)} ч {int(eta_minutes % 60)} мин"
+        else:
+            eta = "неизвестно"
+        return (f"{self.label}: {self.done}/{self.total}, ошибок {self.errors}, "
+                f"{per_minute:.1f} в минуту, осталось ~{eta}")
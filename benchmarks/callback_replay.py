@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воспроизведение сохраненного трафика ВКонтакте: события из callback_logs/
+(save_callback_payload в main.py) повторно отправляются в /callback.
+
+Источники (можно несколько):
+- каталог callback_logs/ с файлами callback_<UTC-время>.json (обходится рекурсивно);
+- архивы .tar, .tar.gz, .tgz и .zip с такими файлами;
+- файлы .jsonl и .jsonl.gz: по событию на строку — сам payload
+  или запись {"received_at": ..., "payload": {...}} (сегменты callback_sink.py).
+
+Время события берется из received_at, из имени файла или из object.message.date
+(с точностью до секунды). События сортируются по времени и воспроизводятся с той же
+скоростью (--speed 1), в N раз быстрее (--speed N) или без пауз (--speed max).
+Порядок событий одного диалога (peer_id / from_id) сохраняется: следующее событие
+диалога отправляется только после ответа /callback на предыдущее. Разные диалоги
+идут параллельно (--workers потоков).
+
+По умолчанию запускается приложение с фиктивными ВКонтакте и Vertex AI так же, как
+в load_test.py (--database-url или --docker, параметры фиктивной модели те же).
+Время до ответа бота — от последнего сообщения пользователя до messages.send
+этому пользователю; сообщения, на которые бот ответил одним ответом (буферизация),
+считаются отдельно. С --app-url события отправляются в уже запущенный экземпляр,
+и отчет содержит только время ответа /callback и пропускную способность.
+
+event_id каждого события заменяется уникальным (иначе повторный прогон в течение
+EVENT_ID_TTL отбрасывается как дубликат); --keep-event-ids оставляет исходные.
+
+Запуск:
+    python benchmarks/callback_replay.py callback_logs --docker --speed 10
+    python benchmarks/callback_replay.py callback_logs_2025-10.tar.gz --database-url postgresql://... --speed max
+    python benchmarks/callback_replay.py callback_logs --app-url http://127.0.0.1:5000 --speed 1
+"""
+
+import re
+import sys
+import json
+import gzip
+import heapq
+import time
+import tarfile
+import zipfile
+import argparse
+import threading
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+
+from load_test import (
+    StubbedApp, add_stub_arguments, git_revision, latency_summary, load_report,
+    print_metrics, report_config, save_report,
+)
+
+# Имя файла save_callback_payload: callback_%Y-%m-%d_%H-%M-%S_%f.json (UTC)
+CALLBACK_FILE_RE = re.compile(r"callback_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}_\d{6})\.json$")
+CALLBACK_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S_%f"
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".zip")
+SKIPPED_TYPES = ("confirmation",)
+
+ReplayEvent = namedtuple("ReplayEvent", "seq timestamp conversation payload")
+
+REPLAY_METRICS = [
+    ("Событий в секунду", ("events_per_second",), True),
+    ("Ответ /callback p50, мс", ("callback_ms", "p50"), False),
+    ("Ответ /callback p95, мс", ("callback_ms", "p95"), False),
+    ("Ответ /callback p99, мс", ("callback_ms", "p99"), False),
+    ("Отставание от графика p95, мс", ("schedule_lag_ms", "p95"), False),
+    ("Время до ответа p50, мс", ("reply_ms", "p50"), False),
+    ("Время до ответа p95, мс", ("reply_ms", "p95"), False),
+    ("Без ответа", ("no_reply",), False),
+    ("Ошибок /callback", ("callback_errors",), False),
+    ("Открыто соединений с БД", ("app", "db_connections_opened"), False),
+    ("Пик потоков", ("app", "peak_threads"), False),
+    ("Пик RSS, МБ", ("app", "peak_rss_kb"), False),
+]
+
+
+# =======================================================================================
+# ЧТЕНИЕ СОБЫТИЙ
+# =======================================================================================
+
+def _time_from_name(name):
+    match = CALLBACK_FILE_RE.search(name)
+    if not match:
+        return None
+    return datetime.strptime(match.group(1), CALLBACK_TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+
+def _parse_received_at(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def _message_of(payload):
+    """Сообщение события: object.message для message_new, сам object для message_reply/message_edit."""
+    obj = payload.get("object") or {}
+    message = obj.get("message")
+    return message if isinstance(message, dict) else obj
+
+
+def _records_from_json_text(name, text):
+    """(время, payload) из содержимого .json или .jsonl."""
+    if name.endswith(".jsonl"):
+        for line in text.splitlines():
+            if line.strip():
+                yield _unwrap(json.loads(line), None)
+    else:
+        yield _unwrap(json.loads(text), _time_from_name(name))
+
+
+def _unwrap(record, name_time):
+    if "payload" in record and "type" not in record:
+        return _parse_received_at(record.get("received_at")), record["payload"]
+    return name_time, record
+
+
+def _read_archive(path):
+    if path.name.endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if name.endswith((".json", ".jsonl")):
+                    yield from _records_from_json_text(name, archive.read(name).decode("utf-8"))
+    else:
+        with tarfile.open(path) as archive:
+            members = sorted((m for m in archive.getmembers() if m.isfile()), key=lambda m: m.name)
+            for member in members:
+                if member.name.endswith((".json", ".jsonl")):
+                    text = archive.extractfile(member).read().decode("utf-8")
+                    yield from _records_from_json_text(member.name, text)
+
+
+def _read_file(path):
+    name = path.name
+    if name.endswith(ARCHIVE_SUFFIXES):
+        yield from _read_archive(path)
+    elif name.endswith(".gz"):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            yield from _records_from_json_text(name[:-3], f.read())
+    elif name.endswith((".json", ".jsonl")):
+        yield from _records_from_json_text(name, path.read_text(encoding="utf-8"))
+
+
+def read_events(sources, types=None, limit=None):
+    """
+    Читает события из файлов, каталогов и архивов и упорядочивает их по времени.
+
+    Returns:
+        list[ReplayEvent]: события в порядке отправки; conversation — peer_id/from_id или None.
+    """
+    records = []
+    for source in sources:
+        source = Path(source)
+        files = sorted(p for p in source.rglob("*") if p.is_file()) if source.is_dir() else [source]
+        for path in files:
+            for timestamp, payload in _read_file(path):
+                if payload.get("type") in SKIPPED_TYPES or (types and payload.get("type") not in types):
+                    continue
+                message = _message_of(payload)
+                if timestamp is None and message.get("date"):
+                    timestamp = float(message["date"])
+                records.append((timestamp, payload, message))
+
+    # События без времени встают сразу за предыдущим по порядку файлов
+    events = []
+    previous = 0.0
+    for seq, (timestamp, payload, message) in enumerate(records):
+        previous = timestamp if timestamp is not None else previous
+        conversation = message.get("peer_id") or message.get("from_id") or message.get("user_id")
+        events.append(ReplayEvent(seq, previous, int(conversation) if conversation else None, payload))
+    events.sort(key=lambda event: (event.timestamp, event.seq))
+    return events[:limit] if limit else events
+
+
+# =======================================================================================
+# ВОСПРОИЗВЕДЕНИЕ
+# =======================================================================================
+
+def parse_speed(value):
+    """'max' — без пауз (0), иначе множитель скорости больше нуля."""
+    if value == "max":
+        return 0.0
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("скорость должна быть больше нуля или max")
+    return speed
+
+
+def replay(events, send, speed, workers):
+    """
+    Отправляет события по графику: событие с исходным смещением t от первого
+    уходит в момент t / speed (при speed=0 — сразу). Следующее событие диалога
+    ставится в график только после завершения send() для предыдущего.
+
+    Returns:
+        tuple: (отставание от графика каждого события в мс, длительность в секундах)
+    """
+    lanes = {}
+    for event in events:
+        # События вне диалога независимы друг от друга: у каждого своя очередь
+        lanes.setdefault(event.conversation if event.conversation is not None else ("event", event.seq), deque()).append(event)
+    if not events:
+        return [], 0.0
+
+    first_timestamp = events[0].timestamp
+    started = time.perf_counter()
+    condition = threading.Condition()
+    schedule = []
+    lag_ms = []
+    in_flight = 0
+
+    def due(event):
+        return started + ((event.timestamp - first_timestamp) / speed if speed else 0.0)
+
+    def push_next(lane):
+        queue = lanes[lane]
+        if queue:
+            event = queue.popleft()
+            heapq.heappush(schedule, (due(event), event.seq, lane, event))
+
+    def run_event(lane, event):
+        nonlocal in_flight
+        try:
+            send(event)
+        finally:
+            with condition:
+                in_flight -= 1
+                push_next(lane)
+                condition.notify()
+
+    with condition:
+        for lane in lanes:
+            push_next(lane)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Replay") as executor:
+        with condition:
+            while schedule or in_flight:
+                now = time.perf_counter()
+                if schedule and schedule[0][0] <= now:
+                    scheduled_at, _, lane, event = heapq.heappop(schedule)
+                    lag_ms.append((now - scheduled_at) * 1000)
+                    in_flight += 1
+                    executor.submit(run_event, lane, event)
+                else:
+                    condition.wait(schedule[0][0] - now if schedule else None)
+    return lag_ms, time.perf_counter() - started
+
+
+class ReplayClient:
+    """Отправляет события в /callback и собирает время ответа; при fake_vk — ждет ответы бота."""
+
+    def __init__(self, app_url, fake_vk=None, keep_event_ids=False):
+        self.app_url = app_url
+        self.fake_vk = fake_vk
+        self.keep_event_ids = keep_event_ids
+        self.run_tag = time.strftime("%Y%m%d%H%M%S")
+        self.callback_ms = []
+        self.callback_errors = 0
+        self.types = Counter()
+        self.superseded = 0
+        self._pending = {}  # conv_id -> (waiter, момент отправки последнего сообщения)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _expects_reply(self, event):
+        message = _message_of(event.payload)
+        return (self.fake_vk is not None and event.payload.get("type") == "message_new"
+                and not message.get("out") and event.conversation and event.conversation > 0)
+
+    def send(self, event):
+        payload = event.payload
+        if not self.keep_event_ids:
+            payload = dict(payload, event_id=f"{payload.get('event_id', 'event')}-replay-{self.run_tag}-{event.seq}")
+        waiter = self.fake_vk.expect_reply(event.conversation) if self._expects_reply(event) else None
+        started = time.perf_counter()
+        try:
+            response = self._session().post(f"{self.app_url}/callback", json=payload, timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.types[payload.get("type")] += 1
+            if ok:
+                self.callback_ms.append(elapsed_ms)
+            else:
+                self.callback_errors += 1
+            if waiter and ok:
+                # Новое сообщение до ответа бота: предыдущее будет отвечено вместе с ним
+                if event.conversation in self._pending and not self._pending[event.conversation][0].event.is_set():
+                    self.superseded += 1
+                self._pending[event.conversation] = (waiter, started)
+
+    def collect_replies(self, timeout):
+        """Ждет ответы на последние сообщения диалогов; возвращает (время до ответа в мс, без ответа)."""
+        deadline = time.monotonic() + timeout
+        reply_ms = []
+        no_reply = 0
+        for waiter, sent_at in self._pending.values():
+            if waiter.event.wait(max(0.0, deadline - time.monotonic())):
+                reply_ms.append((waiter.replied_at - sent_at) * 1000)
+            else:
+                no_reply += 1
+        return reply_ms, no_reply
+
+
+def run(args):
+    events = read_events(args.sources, set(args.types.split(",")) if args.types else None, args.limit)
+    if not events:
+        print("Нет событий для воспроизведения")
+        return 1
+    source_seconds = events[-1].timestamp - events[0].timestamp
+    conversations = len({event.conversation for event in events if event.conversation is not None})
+    print(f"Событий: {len(events)}, диалогов: {conversations}, исходная длительность {source_seconds:.0f} с, "
+          f"скорость {'max' if not args.speed else f'x{args.speed:g}'}")
+
+    def replay_into(app_url, fake_vk):
+        client = ReplayClient(app_url, fake_vk, args.keep_event_ids)
+        lag_ms, wall_seconds = replay(events, client.send, args.speed, args.workers)
+        reply_ms, no_reply = client.collect_replies(args.reply_timeout) if fake_vk else ([], None)
+        return client, lag_ms, wall_seconds, reply_ms, no_reply
+
+    server_stats = None
+    vk_calls = None
+    if args.app_url:
+        client, lag_ms, wall_seconds, reply_ms, no_reply = replay_into(args.app_url.rstrip("/"), None)
+    else:
+        try:
+            with StubbedApp(args) as stubbed_app:
+                client, lag_ms, wall_seconds, reply_ms, no_reply = replay_into(stubbed_app.url, stubbed_app.fake_vk)
+                server_stats = stubbed_app.stats()
+                vk_calls = dict(stubbed_app.fake_vk.calls)
+        except RuntimeError as e:
+            print(e)
+            return 1
+
+    commit, dirty = git_revision()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now().isoformat(timespec="seconds"),
+        'config': dict(report_config(args), events=len(events), conversations=conversations,
+                       source_seconds=round(source_seconds, 1)),
+        'results': {
+            'events_sent': sum(client.types.values()),
+            'events_by_type': dict(client.types),
+            'events_per_second': round(len(events) / wall_seconds, 3) if wall_seconds else None,
+            'callback_ms': latency_summary(client.callback_ms),
+            'callback_errors': client.callback_errors,
+            'schedule_lag_ms': latency_summary(lag_ms),
+            'reply_ms': latency_summary(reply_ms),
+            'replies': len(reply_ms),
+            'no_reply': no_reply,
+            'answered_together': client.superseded,
+            'wall_seconds': round(wall_seconds, 2),
+            'vk_calls': vk_calls,
+            'app': server_stats,
+        },
+    }
+    output_path = save_report(report, args.output_dir, prefix="callback_replay")
+    print(f"\nКоммит {commit}{' (есть незакоммиченные изменения)' if dirty else ''}: "
+          f"{len(events)} событий за {wall_seconds:.1f} с (в исходном трафике {source_seconds:.0f} с)")
+    print_metrics(report, REPLAY_METRICS, load_report(args.compare) if args.compare else None)
+    print(f"\nРезультат сохранен: {output_path}")
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Воспроизведение сохраненных событий /callback")
+    parser.add_argument("sources", nargs="+", help="Каталоги callback_logs, архивы .tar.gz/.zip, файлы .json/.jsonl[.gz]")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="Множитель скорости или max (по умолчанию 1)")
+    parser.add_argument("--workers", type=int, default=64, help="Одновременных запросов к /callback")
+    parser.add_argument("--types", help="Только эти типы событий через запятую (например, message_new)")
+    parser.add_argument("--limit", type=int, help="Воспроизвести только первые N событий")
+    parser.add_argument("--keep-event-ids", action="store_true", help="Не заменять event_id")
+    parser.add_argument("--reply-timeout", type=float, default=120.0, help="Сколько ждать ответов бота после отправки, с")
+    parser.add_argument("--app-url", help="Уже запущенный экземпляр (без фиктивных зависимостей и без ожидания ответов)")
+    parser.add_argument("--compare", help="Файл предыдущего результата для сравнения")
+    add_stub_arguments(parser, history_messages=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
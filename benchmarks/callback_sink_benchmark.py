@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Пропускная способность журнала событий /callback: прежняя запись (файл callback_*.json
+с indent=2 на каждое событие) против сегментов JSONL (callback_sink.CallbackSink).
+
+События — синтетические message_new с текстами реальных сообщений из filtered_dialogues.md.
+Прежний путь замеряется так, как он работал: задача на событие в пуле из CONTEXT_WORKERS
+потоков. Для журнала замеряются стоимость append() на пути /callback и время, за которое
+поток записи сбрасывает очередь на диск (с --processes > 1 — несколько процессов в один
+каталог, как воркеры gunicorn). Дополнительно: файлов и байт на диске после сжатия
+и время поиска события по event_id и по conv_id.
+
+Запуск: python benchmarks/callback_sink_benchmark.py --events 20000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Добавляем родительскую директорию в sys.path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import callback_sink
+from callback_sink import CallbackSink, find_events
+from dialogue_samples import load_messages
+
+CONTEXT_WORKERS = 10   # Потоки context_executor в main.py, где раньше выполнялась запись
+
+
+def make_events(count, seed=1):
+    rng = random.Random(seed)
+    messages = load_messages()
+    now = int(time.time())
+    return [
+        {
+            "type": "message_new", "event_id": f"bench{i:08x}", "v": "5.199", "group_id": 1,
+            "object": {
+                "message": {
+                    "date": now, "from_id": 100000 + i % 500, "peer_id": 100000 + i % 500, "id": i,
+                    "conversation_message_id": i, "text": rng.choice(messages), "attachments": [],
+                    "fwd_messages": [], "important": False, "is_hidden": False, "out": 0,
+                },
+                "client_info": {"button_actions": ["text", "vkpay", "open_app", "location", "open_link"],
+                                "keyboard": True, "inline_keyboard": True, "carousel": True, "lang_id": 0},
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def legacy_save(directory, payload):
+    """Прежний save_callback_payload."""
+    timestamp_str = datetime.utcnow().strftime("%Y-%m-%d_%H-%M-%S_%f")
+    with open(os.path.join(directory, f"callback_{timestamp_str}.json"), "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+
+
+def disk_usage(directory):
+    files = [path for path in Path(directory).iterdir() if path.is_file()]
+    return len(files), sum(path.stat().st_size for path in files)
+
+
+def bench_legacy(events, directory):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONTEXT_WORKERS) as pool:
+        for payload in events:
+            pool.submit(legacy_save, directory, payload)
+    return time.perf_counter() - started
+
+
+def sink_worker(directory, events, result_queue):
+    sink = CallbackSink(directory)
+    started = time.perf_counter()
+    for payload in events:
+        sink.append(payload)
+    enqueued = time.perf_counter() - started
+    sink.close(timeout=600)
+    result_queue.put((enqueued, time.perf_counter() - started, sink.stats()))
+
+
+def bench_sink(events, directory, processes):
+    result_queue = multiprocessing.Queue()
+    shares = [events[i::processes] for i in range(processes)]
+    workers = [multiprocessing.Process(target=sink_worker, args=(directory, share, result_queue)) for share in shares]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    results = [result_queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    wall = time.perf_counter() - started
+    append_us = max(enqueued / len(share) * 1_000_000 for (enqueued, _, _), share in zip(results, shares))
+    dropped = sum(stats['dropped'] for _, _, stats in results)
+    written = sum(stats['events_written'] for _, _, stats in results)
+    return wall, append_us, written, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность журнала событий /callback")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--processes", type=int, default=2, help="Процессов журнала (воркеры gunicorn)")
+    parser.add_argument("--dir", help="Каталог для файлов теста (по умолчанию временный)")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    # Очередь вмещает весь тест: замеряется запись, а не отбрасывание событий
+    callback_sink.MAX_QUEUED_EVENTS = max(callback_sink.MAX_QUEUED_EVENTS, args.events)
+    events = make_events(args.events)
+    root = Path(args.dir or tempfile.mkdtemp(prefix="callback_sink_bench_"))
+    legacy_dir, sink_dir = root / "legacy", root / "sink"
+    for directory in (legacy_dir, sink_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir(parents=True)
+
+    print(f"Событий: {args.events}, каталог: {root}\n")
+    legacy_time = bench_legacy(events, legacy_dir)
+    legacy_files, legacy_bytes = disk_usage(legacy_dir)
+    print(f"{f'Прежний (файл на событие, {CONTEXT_WORKERS} потоков)':<44}{args.events / legacy_time:8.0f} событий/с, "
+          f"файлов {legacy_files}, {legacy_bytes / 1024 / 1024:.1f} МиБ")
+
+    sink_time, append_us, written, dropped = bench_sink(events, sink_dir, args.processes)
+    files_before, bytes_before = disk_usage(sink_dir)
+    print(f"{f'Сегменты JSONL (процессов: {args.processes})':<44}{written / sink_time:8.0f} событий/с, "
+          f"append() {append_us:.1f} мкс, отброшено {dropped}, "
+          f"файлов {files_before}, {bytes_before / 1024 / 1024:.1f} МиБ")
+
+    # Закрытие интервала: сегменты сжимаются так же, как при обслуживании в работе
+    sink = CallbackSink(sink_dir, max_segment_seconds=1)
+    time.sleep(1)
+    started = time.perf_counter()
+    sink.maintain()
+    compress_time = time.perf_counter() - started
+    sink_files, sink_bytes = disk_usage(sink_dir)
+    print(f"{f'После сжатия ({compress_time:.2f} с)':<44}файлов {sink_files}, {sink_bytes / 1024 / 1024:.1f} МиБ "
+          f"(x{legacy_bytes / max(1, sink_bytes):.1f} меньше прежнего)")
+
+    sample = random.Random(2).sample(events, min(200, len(events)))
+    started = time.perf_counter()
+    for payload in sample:
+        assert find_events(sink_dir, event_id=payload["event_id"])[0]["payload"]["event_id"] == payload["event_id"]
+    by_event = (time.perf_counter() - started) / len(sample) * 1000
+    started = time.perf_counter()
+    found = find_events(sink_dir, conv_id=sample[0]["object"]["message"]["from_id"], limit=20)
+    by_conv = (time.perf_counter() - started) * 1000
+    print(f"Поиск по event_id: {by_event:.2f} мс, последние {len(found)} событий клиента по conv_id: {by_conv:.2f} мс")
+
+    if not args.dir:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
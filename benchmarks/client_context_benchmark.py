@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение прежнего и нового пути подготовки контекста для одного ответа бота.
+
+Было: build_context_sync сразу склеивал текст, generate_response искал в нем дату рождения
+регулярным выражением и дважды вызывал strip() для всего контекста.
+Стало: build_context_sync возвращает ClientContext, дата рождения берется из профиля,
+текст отрисовывается один раз.
+
+Строки таблиц синтетические, сообщения диалога — реальные из filtered_dialogues.md.
+Замеряется время на ответ и выделение памяти (tracemalloc).
+
+Запуск: python benchmarks/client_context_benchmark.py
+"""
+
+import logging
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# Добавляем родительскую директорию в sys.path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from client_context import (
+    ClientContext, DIALOGUES_LIMIT, format_active_reminders, format_user_profile,
+    format_client_purchases, format_purchased_products, format_dialogues
+)
+from text_processing import find_birthday
+from dialogue_samples import load_messages
+
+REPEATS = 5
+REPLIES = 500
+TABLE_ORDER = ['reminders', 'user_profiles', 'client_purchases', 'purchased_products', 'dialogues']
+
+
+def build_client_tables(messages, index, with_birthday):
+    """Строки таблиц одного клиента в том виде, в каком их возвращает fetch_data_from_table."""
+    start = (index * DIALOGUES_LIMIT) % max(1, len(messages) - DIALOGUES_LIMIT)
+    base_time = datetime(2025, 8, 1, 12, 0, 0)
+    dialogues = [
+        {
+            'id': index * 100 + i, 'conv_id': index, 'role': 'user' if i % 2 else 'bot',
+            'message': f"[{(base_time + timedelta(minutes=i)).strftime('%Y-%m-%d_%H-%M-%S')}] {text}",
+            'created_at': base_time + timedelta(minutes=i),
+        }
+        for i, text in enumerate(messages[start:start + DIALOGUES_LIMIT])
+    ]
+    profile = {
+        'conv_id': index, 'first_name': 'Анна', 'last_name': 'Иванова', 'screen_name': f'id{index}',
+        'city': 'Москва', 'birth_day': 1 + index % 28 if with_birthday else None,
+        'birth_month': 1 + index % 12 if with_birthday else None,
+        'lead_qualification': 'теплый', 'funnel_stage': 'интерес',
+        'client_level': ['начинающий'], 'learning_goals': ['аккомпанемент'],
+        'client_pains': ['нет времени'], 'dialogue_summary': 'Клиент интересуется курсом по аккомпанементу.',
+    }
+    return {
+        'reminders': [{'reminder_datetime': base_time + timedelta(days=2), 'reminder_context_summary': 'Уточнить решение по курсу'}],
+        'user_profiles': [profile],
+        'client_purchases': [{'product_name': 'Курс "Аккорды"', 'purchase_date': base_time - timedelta(days=90)}],
+        'purchased_products': [{'product_name': 'Самоучитель'}],
+        'dialogues': list(reversed(dialogues)),
+    }
+
+
+# --- Прежний путь ---
+
+LEGACY_FORMATTERS = {
+    'user_profiles': format_user_profile,
+    'client_purchases': format_client_purchases,
+    'purchased_products': format_purchased_products,
+    'dialogues': format_dialogues,
+    'reminders': format_active_reminders,
+}
+
+
+def legacy_reply_context(tables):
+    output_blocks = []
+    for table in TABLE_ORDER:
+        rows = tables[table]
+        if rows or table == 'reminders':
+            formatted_block = LEGACY_FORMATTERS[table](rows)
+            if formatted_block:
+                output_blocks.append(formatted_block)
+    context_text = "\n\n".join(output_blocks)
+
+    birth_day, birth_month = find_birthday(context_text)
+    if birth_day is None:
+        # Прежний extract_birthday_from_context логировал начало контекста при неудаче
+        _ = f"Поиск в контексте (первые 1000 символов): {context_text[:1000]}"
+    if context_text.strip():
+        prompt_context = f"Информация о клиенте и история диалога:\n{context_text.strip()}"
+    else:
+        prompt_context = ""
+    return birth_day, birth_month, prompt_context
+
+
+# --- Новый путь ---
+
+def client_context_reply(tables):
+    client_context = ClientContext(0)
+    for table in TABLE_ORDER:
+        client_context.add_table(table, tables[table])
+
+    birth_day, birth_month = client_context.birthday
+    # Прежний путь не сжимал контекст — сравнивается полный текст
+    context_text = client_context.render(token_budget=0).strip()
+    prompt_context = f"Информация о клиенте и история диалога:\n{context_text}" if context_text else ""
+    return birth_day, birth_month, prompt_context
+
+
+def measure_peak_memory(func, clients):
+    """Пиковое выделение памяти за серию ответов."""
+    tracemalloc.start()
+    for tables in clients:
+        func(tables)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    messages = load_messages()
+    clients = [build_client_tables(messages, i, with_birthday=i % 4 != 0) for i in range(REPLIES)]
+
+    mismatches = sum(1 for tables in clients if legacy_reply_context(tables) != client_context_reply(tables))
+    print(f"Ответов: {REPLIES}, расхождений в дате рождения и тексте контекста: {mismatches}\n")
+
+    results = {}
+    for name, func in (("прежний (текст + regex)", legacy_reply_context), ("ClientContext", client_context_reply)):
+        elapsed = min(timeit.repeat(lambda: [func(tables) for tables in clients], number=1, repeat=REPEATS))
+        peak = measure_peak_memory(func, clients)
+        results[name] = elapsed
+        print(f"{name:<26} {elapsed / REPLIES * 1_000_000:8.1f} мкс на ответ   пик памяти за {REPLIES} ответов: {peak / 1024:8.1f} КиБ")
+
+    legacy_time, new_time = results.values()
+    print(f"\nУскорение: x{legacy_time / new_time:.2f}")
+    print(f"Размер ClientContext (без строк таблиц): {sys.getsizeof(ClientContext(0))} байт, "
+          f"__dict__ отсутствует: {not hasattr(ClientContext(0), '__dict__')}")
+
+
+if __name__ == "__main__":
+    main()
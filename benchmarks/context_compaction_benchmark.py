@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Размер контекста клиента и промпта ответа до и после сжатия по бюджету токенов
+(ClientContext.render: полный контекст при token_budget=0 и с CONTEXT_TOKEN_BUDGET).
+
+Диалоги — реальные из filtered_dialogues.md (последние DIALOGUES_LIMIT сообщений на каждом
+шаге диалога), саммари — реальные из found_user_profiles.md. Водяной знак саммари,
+покупки и строки остальных таблиц с conv_id — синтетические, с разбросом по клиентам.
+
+Токены оцениваются как в client_context (символы / CHARS_PER_TOKEN). Промпт ответа —
+prompt.txt плюс контекст. Задержку ответа модели в окружении не измерить, поэтому
+она оценивается линейно: --model-base-ms + --model-ms-per-1k-tokens на 1000 токенов
+промпта (коэффициенты стоит взять из /llm_ledger, call_site "reply"). Сквозная проверка
+с задержкой, зависящей от размера промпта:
+    python benchmarks/load_test.py ... --model-ms-per-1k-tokens 40 --context-token-budget 0
+    python benchmarks/load_test.py ... --model-ms-per-1k-tokens 40 --compare <результат выше>
+
+Запуск: python benchmarks/context_compaction_benchmark.py
+"""
+
+import re
+import sys
+import random
+import timeit
+import logging
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# Добавляем родительскую директорию в sys.path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from client_context import ClientContext, DIALOGUES_LIMIT, CONTEXT_TOKEN_BUDGET, estimate_tokens
+from dialogue_samples import load_dialogues
+from metrics import percentile
+
+ROOT = Path(__file__).parent.parent
+PROMPT_PATH = ROOT / "prompt.txt"
+PROFILES_PATH = ROOT / "found_user_profiles.md"
+TABLE_ORDER = ['reminders', 'user_profiles', 'client_purchases', 'purchased_products', 'dialogues']
+PRODUCTS = ["Ноты прочь", "Блюз-мастер", "Аккомпанемент с нуля", "Импровизация", "Подбор по слуху", "Теория для практиков"]
+
+_SUMMARY_LINE = re.compile(r'^- \*\*dialogue_summary\*\*: (.+)$', re.MULTILINE)
+
+
+def load_summaries():
+    return [summary for summary in _SUMMARY_LINE.findall(PROFILES_PATH.read_text(encoding="utf-8")) if summary != "None"]
+
+
+def build_clients(dialogues, summaries, seed):
+    """Строки таблиц на каждом шаге каждого диалога, как их возвращает fetch_data_from_table."""
+    rng = random.Random(seed)
+    base_time = datetime(2025, 8, 1, 12, 0, 0)
+    clients = []
+    for index, (conv_id, messages) in enumerate(sorted(dialogues.items())):
+        rows = [
+            {'id': i, 'conv_id': conv_id, 'role': role, 'message': text, 'created_at': base_time + timedelta(minutes=30 * i)}
+            for i, (role, text) in enumerate(messages)
+        ]
+        purchases = [
+            {'id': i, 'conv_id': conv_id, 'email': f'client{conv_id}@example.com', 'product_name': rng.choice(PRODUCTS),
+             'purchase_date': base_time - timedelta(days=rng.randint(1, 900)), 'amount': rng.choice([990, 2990, 7900])}
+            for i in range(rng.choice([0, 0, 1, 3, 12]))
+        ]
+        # Остальные таблицы с conv_id: журнал рассылок и опросы
+        mailings = [
+            {'id': i, 'conv_id': conv_id, 'campaign': f'Рассылка {i}', 'status': rng.choice(['sent', 'opened', 'clicked']),
+             'error': None, 'payload': {'segment': 'тёплые', 'utm': f'mail_{i}'}, 'created_at': base_time - timedelta(days=i)}
+            for i in range(rng.choice([0, 5, 40]))
+        ]
+        surveys = [
+            {'id': i, 'conv_id': conv_id, 'question': 'Что вы хотите научиться играть?', 'answer': rng.choice(PRODUCTS),
+             'comment': '', 'created_at': base_time - timedelta(days=30 + i)}
+            for i in range(rng.choice([0, 1, 3]))
+        ]
+        for step in range(1, len(rows) + 1):
+            window = rows[max(0, step - DIALOGUES_LIMIT):step]
+            has_summary = step > 4 and rng.random() < 0.85
+            # Саммари отстает от диалога на 0-6 сообщений (обновляется после ответа бота)
+            watermark = rows[max(0, step - 1 - rng.randint(0, 6))] if has_summary else None
+            profile = {
+                'conv_id': conv_id, 'first_name': 'Анна', 'last_name': 'Иванова', 'screen_name': f'id{conv_id}',
+                'city': 'Москва', 'lead_qualification': ['тёплый'], 'funnel_stage': 'интерес',
+                'client_level': ['начинающий'], 'learning_goals': ['аккомпанемент'], 'client_pains': ['нет времени'],
+                'dialogue_summary': summaries[(index + step) % len(summaries)] if has_summary else None,
+                'summary_watermark': watermark['created_at'] if watermark else None,
+                'summary_watermark_id': watermark['id'] if watermark else None,
+            }
+            tables = {
+                'reminders': [],
+                'user_profiles': [profile],
+                'client_purchases': purchases,
+                'purchased_products': [{'id': 1, 'conv_id': conv_id, 'product_name': PRODUCTS[index % len(PRODUCTS)]}],
+                'dialogues': list(reversed(window)),
+                'mailing_log': mailings,
+                'survey_answers': surveys,
+            }
+            clients.append(tables)
+    return clients
+
+
+def make_context(tables):
+    client_context = ClientContext(0)
+    for table in TABLE_ORDER:
+        client_context.add_table(table, tables[table])
+    for table in ('mailing_log', 'survey_answers'):
+        client_context.add_table(table, tables[table])
+    return client_context
+
+
+def print_distribution(label, values, unit):
+    print(f"{label:<34}{percentile(values, 50):>9}{percentile(values, 95):>9}{percentile(values, 99):>9}{max(values):>9}  {unit}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Размер контекста и промпта ответа до и после сжатия")
+    parser.add_argument("--budget", type=int, default=CONTEXT_TOKEN_BUDGET or 6000, help="Потолок контекста в токенах")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--model-base-ms", type=float, default=800.0, help="Задержка модели без учета промпта, мс")
+    parser.add_argument("--model-ms-per-1k-tokens", type=float, default=40.0, help="Прирост задержки на 1000 токенов промпта, мс")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    clients = build_clients(load_dialogues(), load_summaries(), args.seed)
+    prompt_tokens = estimate_tokens(PROMPT_PATH.read_text(encoding="utf-8"))
+
+    before, after, stats = [], [], []
+    for tables in clients:
+        before.append(estimate_tokens(make_context(tables).render(token_budget=0)))
+        client_context = make_context(tables)
+        after.append(estimate_tokens(client_context.render(token_budget=args.budget)))
+        stats.append(client_context.compaction)
+
+    def latency(tokens):
+        return round(args.model_base_ms + args.model_ms_per_1k_tokens * (prompt_tokens + tokens) / 1000)
+
+    print(f"Ответов: {len(clients)}, потолок контекста {args.budget} токенов, prompt.txt ~{prompt_tokens} токенов\n")
+    print(f"{'':<34}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    print_distribution("Контекст до сжатия", before, "токенов")
+    print_distribution("Контекст после сжатия", after, "токенов")
+    print_distribution("Промпт ответа до сжатия", [prompt_tokens + tokens for tokens in before], "токенов")
+    print_distribution("Промпт ответа после сжатия", [prompt_tokens + tokens for tokens in after], "токенов")
+    print_distribution("Оценка задержки модели до", [latency(tokens) for tokens in before], "мс")
+    print_distribution("Оценка задержки модели после", [latency(tokens) for tokens in after], "мс")
+
+    compacted = sum(1 for full, compact in zip(before, after) if compact < full)
+    print(f"\nСжато контекстов: {compacted} из {len(clients)}, "
+          f"токенов всего: {sum(before)} -> {sum(after)} ({(sum(after) - sum(before)) / sum(before) * 100:+.1f}%)")
+    print(f"Реплик убрано как покрытых саммари: {sum(s['summarized_turns'] for s in stats)}, "
+          f"не поместилось: {sum(s['dropped_turns'] for s in stats)}, "
+          f"убрано таблиц: {sum(s['dropped_tables'] for s in stats)}, "
+          f"обрезано саммари: {sum(s['summary_truncated'] for s in stats)}, "
+          f"выше потолка: {sum(s['over_budget'] for s in stats)}")
+
+    sample = clients[:500]
+    for label, budget in (("полный", 0), ("со сжатием", args.budget)):
+        elapsed = min(timeit.repeat(lambda: [make_context(tables).render(token_budget=budget) for tables in sample],
+                                    number=1, repeat=3))
+        print(f"Отрисовка контекста ({label}): {elapsed / len(sample) * 1_000_000:.1f} мкс на ответ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Загрузка реальных сообщений из filtered_dialogues.md для бенчмарков.
+"""
+
+import re
+from pathlib import Path
+
+DIALOGUES_PATH = Path(__file__).parent.parent / "filtered_dialogues.md"
+
+_DIALOGUE_HEADER = re.compile(r'\n## Диалог: (\d+)\n')
+_MESSAGE_HEADER = re.compile(r'\n\*\*(user|bot|operator)\*\* \(([^)]*)\):\n')
+
+
+def load_dialogues(path=DIALOGUES_PATH):
+    """
+    Разбирает выгрузку диалогов в {conv_id: [(role, text), ...]} в хронологическом порядке.
+    Текст сохраняется как в таблице dialogues — вместе с временной меткой [ГГГГ-ММ-ДД_чч-мм-сс].
+    """
+    text = Path(path).read_text(encoding="utf-8")
+    parts = _DIALOGUE_HEADER.split(text)
+    dialogues = {}
+    for i in range(1, len(parts), 2):
+        conv_id = int(parts[i])
+        blocks = _MESSAGE_HEADER.split(parts[i + 1])
+        messages = []
+        for j in range(1, len(blocks), 3):
+            body = blocks[j + 2].split('\n\n**')[0]
+            body = body.split('\n---\n')[0].strip()
+            messages.append((blocks[j], body))
+        dialogues[conv_id] = messages
+    return dialogues
+
+
+def load_messages(path=DIALOGUES_PATH):
+    """Возвращает плоский список текстов всех сообщений."""
+    return [text for messages in load_dialogues(path).values() for _, text in messages]
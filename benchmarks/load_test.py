@@ -0,0 +1,766 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сквозной нагрузочный тест бота: время до ответа и пропускная способность /callback.
+
+Что запускается:
+1. PostgreSQL: готовая база (--database-url, тест работает в отдельной схеме loadtest)
+   или временный контейнер (--docker). Базовые таблицы создаются здесь же,
+   индексы и колонки — теми же миграциями, что и в рабочей базе (db_migrations.MIGRATIONS).
+2. Фиктивный сервер API: messages.send, users.get, groups.getById ВКонтакте
+   (а также Telegram и Яндекс.Диск — отвечает 200). Все HTTPS-запросы приложения
+   к этим хостам перенаправляются на него, так что сетевой обмен остается настоящим.
+3. Приложение main.py в отдельном процессе (сервер werkzeug с потоками) с фиктивной моделью
+   Vertex AI: задержка — логнормальное распределение (медиана, sigma), доля ошибок
+   и доля «медленных» ответов настраиваются. Ответы с response_mime_type=application/json
+   возвращают "{}" — недостающие поля дополняет structured_output.
+4. Виртуальные пользователи (--users) шлют в /callback события message_new и ждут ответа
+   бота (messages.send) перед следующим сообщением.
+
+Отчет: p50/p95/p99 времени до ответа, ответов в секунду, сколько соединений с БД открыто,
+пиковое число потоков и RSS процесса приложения. Результат сохраняется в JSON
+с хэшем коммита (--output-dir), --compare сравнивает с предыдущим результатом.
+
+Время до ответа включает задержку буферизации USER_MESSAGE_BUFFERING_DELAY,
+которая для теста заменяется на --buffer-delay (по умолчанию 0.5 с). В рабочей среде
+приложение запускает gunicorn (Procfile), здесь — многопоточный сервер werkzeug
+в одном процессе.
+
+Запуск:
+    python benchmarks/load_test.py --docker --users 20 --messages-per-user 5
+    python benchmarks/load_test.py --database-url postgresql://... --model-latency-ms 1500 \\
+        --model-error-rate 0.02 --compare load_test_results/load_test_<commit>_<ts>.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+import psycopg2
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from metrics import percentile
+
+LOADTEST_SCHEMA = "loadtest"
+DOCKER_IMAGE = "postgres:16-alpine"
+# Хосты, запросы к которым приложение отправляет на фиктивный сервер
+FAKE_API_HOSTS = ("api.vk.com", "api.telegram.org", "cloud-api.yandex.net")
+FIRST_CONV_ID = 900000000
+STATS_PATH = "/__loadtest__/stats"
+SAMPLE_INTERVAL = 0.2  # Как часто процесс приложения замеряет число потоков
+
+# Базовые таблицы, которые читает и пишет путь ответа на сообщение.
+# Остальные колонки и индексы добавляют миграции db_migrations.py.
+LOADTEST_TABLES = [
+    """
+    CREATE TABLE dialogues (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT NOT NULL,
+        role TEXT NOT NULL,
+        message TEXT,
+        client_info TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE user_profiles (
+        conv_id BIGINT PRIMARY KEY,
+        first_name TEXT,
+        last_name TEXT,
+        screen_name TEXT,
+        sex TEXT,
+        city TEXT,
+        birth_day INTEGER,
+        birth_month INTEGER,
+        can_write BOOLEAN,
+        last_updated TIMESTAMPTZ,
+        dialogue_summary TEXT,
+        lead_qualification TEXT[],
+        funnel_stage TEXT,
+        client_level TEXT[],
+        learning_goals TEXT[],
+        client_pains TEXT[],
+        email TEXT[],
+        client_activity TEXT
+    )
+    """,
+    """
+    CREATE TABLE reminders (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT NOT NULL,
+        reminder_datetime TIMESTAMPTZ NOT NULL,
+        reminder_context_summary TEXT,
+        status TEXT NOT NULL,
+        client_timezone TEXT,
+        created_by_conv_id BIGINT,
+        cancellation_reason TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE client_purchases (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT,
+        email TEXT,
+        product_name TEXT,
+        purchase_date TIMESTAMPTZ,
+        amount NUMERIC
+    )
+    """,
+    """
+    CREATE TABLE purchased_products (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT,
+        product_name TEXT
+    )
+    """,
+    """
+    CREATE TABLE operator_activity (
+        conv_id BIGINT PRIMARY KEY,
+        last_operator_activity_at TIMESTAMPTZ
+    )
+    """,
+]
+
+# Сообщения пользователей: без временных выражений, чтобы анализ напоминаний
+# отсекался локальным пре-фильтром, как у большинства реальных сообщений
+USER_MESSAGES = [
+    "Здравствуйте! Хочу научиться играть на пианино, с чего начать?",
+    "А сколько стоит курс для начинающих?",
+    "У меня нет синтезатора, можно заниматься без него?",
+    "Подойдет ли курс взрослому без музыкального образования?",
+    "Какие есть способы оплаты?",
+    "Спасибо, а есть ли обратная связь от преподавателя?",
+]
+
+FAKE_REPLY_TEXT = "Здравствуйте! Спасибо за вопрос, расскажу подробнее о курсах."
+
+
+# =======================================================================================
+# ОБЩЕЕ
+# =======================================================================================
+
+def latency_summary(values_ms):
+    if not values_ms:
+        return {'count': 0}
+    return {
+        'count': len(values_ms),
+        'p50': round(percentile(values_ms, 50), 1),
+        'p95': round(percentile(values_ms, 95), 1),
+        'p99': round(percentile(values_ms, 99), 1),
+        'mean': round(sum(values_ms) / len(values_ms), 1),
+        'max': round(max(values_ms), 1),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_revision():
+    """Хэш коммита и признак незакоммиченных изменений — чтобы сравнивать результаты между коммитами."""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+# =======================================================================================
+# ПРОЦЕСС ПРИЛОЖЕНИЯ (режим --serve)
+# =======================================================================================
+
+class FakeGenerativeModel:
+    """Замена vertexai GenerativeModel с настраиваемыми задержками и ошибками."""
+
+    def __init__(self, latency_ms, sigma, error_rate, slow_rate, slow_ms, counters, ms_per_1k_tokens=0.0):
+        self.latency_ms = latency_ms
+        self.ms_per_1k_tokens = ms_per_1k_tokens
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.counters = counters
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def _sample(self):
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+            slow = self._random.random() < self.slow_rate
+            latency_ms = self.slow_ms if slow else self.latency_ms * math.exp(self.sigma * self._random.gauss(0, 1))
+            self.counters['model_calls'] += 1
+            if failed:
+                self.counters['model_errors'] += 1
+        return latency_ms, failed
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        latency_ms, failed = self._sample()
+        prompt_chars = len(contents) if isinstance(contents, str) else len(str(contents))
+        # Обработка промпта: задержка растет с его размером
+        latency_ms += self.ms_per_1k_tokens * prompt_chars / 4 / 1000
+        time.sleep(latency_ms / 1000)
+        if failed:
+            raise RuntimeError("FakeGemini: 503 Service Unavailable")
+
+        config = generation_config.to_dict() if hasattr(generation_config, "to_dict") else (generation_config or {})
+        text = "{}" if config.get("response_mime_type") == "application/json" else FAKE_REPLY_TEXT
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(prompt_token_count=prompt_chars // 4, candidates_token_count=len(text) // 4),
+        )
+
+
+def install_http_redirect(fake_api_url):
+    """Перенаправляет запросы requests (в том числе vk_api) к FAKE_API_HOSTS на фиктивный сервер."""
+    from requests.adapters import HTTPAdapter
+
+    fake = urlsplit(fake_api_url)
+    original_send = HTTPAdapter.send
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.hostname in FAKE_API_HOSTS:
+            request.url = urlunsplit((fake.scheme, fake.netloc, f"/{parts.hostname}{parts.path}", parts.query, ""))
+        return original_send(self, request, **kwargs)
+
+    HTTPAdapter.send = send
+
+
+def install_connection_counter(counters):
+    """Считает соединения с БД, открытые приложением (psycopg2.connect, в том числе из пулов)."""
+    original_connect = psycopg2.connect
+
+    def connect(*args, **kwargs):
+        counters['db_connections_opened'] += 1
+        return original_connect(*args, **kwargs)
+
+    psycopg2.connect = connect
+
+
+def current_rss_kb():
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def serve(args):
+    """Запускает main.py с фиктивными зависимостями и отдает метрики процесса по STATS_PATH."""
+    counters = {'db_connections_opened': 0, 'model_calls': 0, 'model_errors': 0, 'peak_threads': 0}
+    install_http_redirect(args.fake_api_url)
+    install_connection_counter(counters)
+
+    # Без учетных данных main.py пропускает инициализацию Vertex AI, планировщиков
+    # напоминаний и архивации: модели подставляются ниже, фоновые задачи в тесте не нужны
+    os.environ.pop("GOOGLE_APPLICATION_CREDENTIALS", None)
+    import main
+    from metrics import stage_stats
+    from llm_ledger import ledger_stats
+    from werkzeug.serving import make_server
+
+    model_args = (args.model_latency_ms, args.model_latency_sigma, args.model_error_rate,
+                  args.model_slow_rate, args.model_slow_ms, counters, args.model_ms_per_1k_tokens)
+    main.app.model = FakeGenerativeModel(*model_args)
+    main.app.search_model = FakeGenerativeModel(*model_args)
+    main.init_summary_worker_pool(FakeGenerativeModel(*model_args))
+    main.USER_MESSAGE_BUFFERING_DELAY = args.buffer_delay
+
+    def sample_threads():
+        while True:
+            counters['peak_threads'] = max(counters['peak_threads'], threading.active_count())
+            time.sleep(SAMPLE_INTERVAL)
+
+    threading.Thread(target=sample_threads, name="LoadTestSampler", daemon=True).start()
+
+    def stats():
+        return main.jsonify(dict(
+            counters,
+            threads=threading.active_count(),
+            rss_kb=current_rss_kb(),
+            peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            stages=stage_stats(),
+            llm=ledger_stats(),
+        ))
+
+    main.app.add_url_rule(STATS_PATH, "loadtest_stats", stats)
+    make_server("127.0.0.1", args.port, main.app, threaded=True).serve_forever()
+
+
+# =======================================================================================
+# ФИКТИВНЫЙ API ВКОНТАКТЕ
+# =======================================================================================
+
+class FakeVkApi:
+    """Отвечает на методы VK API и фиксирует момент отправки ответа каждому пользователю."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self.calls = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="FakeVkApi", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def expect_reply(self, conv_id):
+        """Регистрирует ожидание ответа пользователю; вернет событие, которое сработает на messages.send."""
+        waiter = SimpleNamespace(event=threading.Event(), replied_at=None)
+        with self._lock:
+            self._waiters[conv_id] = waiter
+        return waiter
+
+    def _record(self, method, params):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method == "messages.send":
+                waiter = self._waiters.pop(int(params.get("user_id") or params.get("peer_id") or 0), None)
+                if waiter:
+                    waiter.replied_at = time.perf_counter()
+                    waiter.event.set()
+
+    def _response(self, method, params):
+        if method == "messages.send":
+            return {"response": int(time.time() * 1000) % 10 ** 9}
+        if method == "users.get":
+            ids = str(params.get("user_ids", "0")).split(",")
+            return {"response": [
+                {"id": int(user_id), "first_name": "Тест", "last_name": f"Пользователь{user_id}",
+                 "screen_name": f"id{user_id}", "sex": 1, "city": {"id": 1, "title": "Москва"}}
+                for user_id in ids if user_id
+            ]}
+        if method == "groups.getById":
+            return {"response": [{"id": abs(int(params.get("group_id", 1))), "name": "Тестовое сообщество"}]}
+        return {"response": 1}
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                parts = urlsplit(self.path)
+                params = {k: v[0] for k, v in parse_qs(parts.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length).decode("utf-8", "replace")
+                    params.update({k: v[0] for k, v in parse_qs(body).items()})
+                host, _, path = parts.path.lstrip("/").partition("/")
+                method = path.rsplit("/", 1)[-1] if host == "api.vk.com" else f"{host}:{path}"
+                api._record(method, params)
+                payload = api._response(method, params) if host == "api.vk.com" else {"ok": True, "result": {}}
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+# =======================================================================================
+# БАЗА ДАННЫХ
+# =======================================================================================
+
+def start_docker_postgres():
+    """Запускает временный контейнер PostgreSQL. Returns: (container_id, database_url)."""
+    container_id = subprocess.check_output([
+        "docker", "run", "-d", "--rm", "-e", "POSTGRES_PASSWORD=loadtest",
+        "-p", "127.0.0.1::5432", DOCKER_IMAGE,
+    ], text=True).strip()
+    address = subprocess.check_output(["docker", "port", container_id, "5432/tcp"], text=True).splitlines()[0].strip()
+    host, port = address.rsplit(":", 1)
+    database_url = f"postgresql://postgres:loadtest@{host}:{port}/postgres"
+
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            psycopg2.connect(database_url).close()
+            return container_id, database_url
+        except psycopg2.OperationalError:
+            if time.monotonic() > deadline:
+                subprocess.run(["docker", "stop", container_id], check=False)
+                raise
+            time.sleep(0.5)
+
+
+def with_search_path(database_url, schema):
+    """Добавляет в URL подключения search_path, чтобы все соединения приложения работали в схеме теста."""
+    separator = "&" if "?" in database_url else "?"
+    return f"{database_url}{separator}options=-csearch_path%3D{schema}"
+
+
+def prepare_database(database_url, users, history_messages):
+    """Пересоздает схему теста, применяет миграции и заполняет историю диалогов."""
+    from db_migrations import MIGRATIONS
+
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {LOADTEST_SCHEMA} CASCADE")
+            cur.execute(f"CREATE SCHEMA {LOADTEST_SCHEMA}")
+            cur.execute(f"SET search_path TO {LOADTEST_SCHEMA}")
+            for statement in LOADTEST_TABLES:
+                cur.execute(statement)
+            for migration in sorted(MIGRATIONS, key=lambda m: m["version"]):
+                for statement in migration["statements"]:
+                    cur.execute(statement)
+            if history_messages:
+                cur.execute("""
+                    INSERT INTO dialogues (conv_id, role, message, created_at)
+                    SELECT %s + u, CASE WHEN m %% 2 = 0 THEN 'user' ELSE 'bot' END,
+                           'Сообщение из истории ' || m,
+                           NOW() - make_interval(mins => (%s - m) * 30)
+                    FROM generate_series(0, %s - 1) AS u, generate_series(1, %s) AS m
+                """, (FIRST_CONV_ID, history_messages, users, history_messages))
+            cur.execute("ANALYZE")
+    finally:
+        conn.close()
+
+
+# =======================================================================================
+# НАГРУЗКА
+# =======================================================================================
+
+def callback_payload(conv_id, message_id, text):
+    return {
+        "type": "message_new",
+        "event_id": f"loadtest-{conv_id}-{message_id}-{time.time_ns()}",
+        "group_id": 48116621,
+        "object": {
+            "message": {
+                "id": message_id,
+                "date": int(time.time()),
+                "from_id": conv_id,
+                "peer_id": conv_id,
+                "text": text,
+                "out": 0,
+                "attachments": [],
+            },
+            "client_info": {"button_actions": ["text"], "keyboard": True, "inline_keyboard": True},
+        },
+    }
+
+
+def virtual_user(index, args, app_url, fake_vk, results, results_lock):
+    """Один пользователь: сообщение -> ожидание ответа бота -> пауза -> следующее сообщение."""
+    conv_id = FIRST_CONV_ID + index
+    session = requests.Session()
+    rng = random.Random(index)
+    for message_index in range(args.messages_per_user):
+        waiter = fake_vk.expect_reply(conv_id)
+        text = USER_MESSAGES[(index + message_index) % len(USER_MESSAGES)]
+        started = time.perf_counter()
+        try:
+            response = session.post(f"{app_url}/callback", json=callback_payload(conv_id, message_index + 1, text), timeout=30)
+            callback_ms = (time.perf_counter() - started) * 1000
+            callback_ok = response.status_code == 200
+        except requests.RequestException:
+            callback_ms, callback_ok = None, False
+
+        replied = callback_ok and waiter.event.wait(args.reply_timeout)
+        with results_lock:
+            if callback_ms is not None:
+                results['callback_ms'].append(callback_ms)
+            if not callback_ok:
+                results['callback_errors'] += 1
+            elif replied:
+                results['reply_ms'].append((waiter.replied_at - started) * 1000)
+            else:
+                results['reply_timeouts'] += 1
+        if args.think_time:
+            time.sleep(rng.uniform(0, 2 * args.think_time))
+
+
+def wait_for_app(app_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Процесс приложения завершился с кодом {process.returncode}")
+        try:
+            if requests.get(f"{app_url}/ping_main_bot", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.3)
+    raise RuntimeError("Приложение не ответило на /ping_main_bot")
+
+
+class StubbedApp:
+    """
+    Приложение с фиктивными зависимостями: схема БД, фиктивный API ВКонтакте
+    и процесс main.py. Контекстный менеджер: при выходе процесс и контейнер останавливаются.
+    Используется также воспроизведением трафика (callback_replay.py).
+    """
+
+    def __init__(self, args, seed_users=0):
+        self.args = args
+        self.seed_users = seed_users
+        self.fake_vk = FakeVkApi()
+        self.workdir = tempfile.mkdtemp(prefix="loadtest_")
+        self.server_log_path = Path(self.workdir) / "app.log"
+        self.url = None
+        self._container_id = None
+        self._process = None
+        self._server_log = None
+
+    def __enter__(self):
+        args = self.args
+        database_url = args.database_url or os.environ.get("LOADTEST_DATABASE_URL")
+        try:
+            if args.docker:
+                print(f"Запуск контейнера {DOCKER_IMAGE}...")
+                self._container_id, database_url = start_docker_postgres()
+            if not database_url:
+                raise RuntimeError("Укажите --database-url (или LOADTEST_DATABASE_URL) либо --docker")
+
+            prepare_database(database_url, self.seed_users, args.history_messages)
+            self.fake_vk.start()
+
+            # Рабочий каталог приложения: промпт и база знаний из репозитория, логи — во временной папке
+            for name in ("prompt.txt", "knowledge_base.json"):
+                os.symlink(ROOT / name, Path(self.workdir) / name)
+            port = free_port()
+            self.url = f"http://127.0.0.1:{port}"
+            env = dict(
+                os.environ,
+                DATABASE_URL=with_search_path(database_url, LOADTEST_SCHEMA),
+                VK_COMMUNITY_TOKEN="loadtest", VK_CONFIRMATION_TOKEN="loadtest",
+                TELEGRAM_TOKEN="", YANDEX_DISK_TOKEN="",
+            )
+            if args.context_token_budget is not None:
+                env["CONTEXT_TOKEN_BUDGET"] = str(args.context_token_budget)
+            server_args = [
+                sys.executable, str(Path(__file__).resolve()), "--serve", "--port", str(port),
+                "--fake-api-url", self.fake_vk.url, "--buffer-delay", str(args.buffer_delay),
+                "--model-latency-ms", str(args.model_latency_ms), "--model-latency-sigma", str(args.model_latency_sigma),
+                "--model-error-rate", str(args.model_error_rate), "--model-slow-rate", str(args.model_slow_rate),
+                "--model-slow-ms", str(args.model_slow_ms), "--model-ms-per-1k-tokens", str(args.model_ms_per_1k_tokens),
+            ]
+            self._server_log = open(self.server_log_path, "w", encoding="utf-8")
+            self._process = subprocess.Popen(
+                server_args, cwd=self.workdir, env=env, stdout=self._server_log, stderr=subprocess.STDOUT
+            )
+            wait_for_app(self.url, self._process)
+            print(f"Приложение запущено ({self.url}), лог: {self.server_log_path}")
+            return self
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+
+    def stats(self):
+        """Метрики процесса приложения (соединения с БД, потоки, RSS, вызовы модели)."""
+        return requests.get(f"{self.url}{STATS_PATH}", timeout=10).json()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        if self._server_log:
+            self._server_log.close()
+        self.fake_vk.stop()
+        if self._container_id:
+            subprocess.run(["docker", "stop", self._container_id], check=False, stdout=subprocess.DEVNULL)
+        return False
+
+
+def run(args):
+    try:
+        with StubbedApp(args, seed_users=args.users) as stubbed_app:
+            fake_vk = stubbed_app.fake_vk
+            results = {'reply_ms': [], 'callback_ms': [], 'reply_timeouts': 0, 'callback_errors': 0}
+            results_lock = threading.Lock()
+            users = [threading.Thread(
+                target=virtual_user, args=(i, args, stubbed_app.url, fake_vk, results, results_lock), name=f"VirtualUser-{i}"
+            ) for i in range(args.users)]
+            started = time.perf_counter()
+            for thread in users:
+                thread.start()
+            for thread in users:
+                thread.join()
+            wall_seconds = time.perf_counter() - started
+            server_stats = stubbed_app.stats()
+    except RuntimeError as e:
+        print(e)
+        return 1
+
+    commit, dirty = git_revision()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now().isoformat(timespec="seconds"),
+        'config': report_config(args),
+        'results': {
+            'reply_ms': latency_summary(results['reply_ms']),
+            'callback_ms': latency_summary(results['callback_ms']),
+            'replies': len(results['reply_ms']),
+            'replies_per_second': round(len(results['reply_ms']) / wall_seconds, 3),
+            'reply_timeouts': results['reply_timeouts'],
+            'callback_errors': results['callback_errors'],
+            'wall_seconds': round(wall_seconds, 2),
+            'vk_calls': dict(fake_vk.calls),
+            'app': server_stats,
+        },
+    }
+    output_path = save_report(report, args.output_dir)
+    print_report(report, load_report(args.compare) if args.compare else None)
+    print(f"\nРезультат сохранен: {output_path}")
+    return 0
+
+
+# =======================================================================================
+# ОТЧЕТ
+# =======================================================================================
+
+# Метрики для сравнения: (подпись, путь в results, больше — лучше)
+REPORT_METRICS = [
+    ("Время до ответа p50, мс", ("reply_ms", "p50"), False),
+    ("Время до ответа p95, мс", ("reply_ms", "p95"), False),
+    ("Время до ответа p99, мс", ("reply_ms", "p99"), False),
+    ("Ответ /callback p95, мс", ("callback_ms", "p95"), False),
+    ("Промпт ответа p50, символов", ("app", "llm", "reply", "prompt_chars", "p50"), False),
+    ("Промпт ответа p95, символов", ("app", "llm", "reply", "prompt_chars", "p95"), False),
+    ("Вызов модели (ответ) p95, мс", ("app", "llm", "reply", "latency_ms", "p95"), False),
+    ("Ответов в секунду", ("replies_per_second",), True),
+    ("Без ответа", ("reply_timeouts",), False),
+    ("Ошибок /callback", ("callback_errors",), False),
+    ("Открыто соединений с БД", ("app", "db_connections_opened"), False),
+    ("Пик потоков", ("app", "peak_threads"), False),
+    ("Пик RSS, МБ", ("app", "peak_rss_kb"), False),
+]
+
+
+def _metric(report, path):
+    value = report['results']
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    if value is not None and path[-1] == "peak_rss_kb":
+        value = round(value / 1024, 1)
+    return value
+
+
+# Аргументы, которые не описывают условия теста и не попадают в отчет
+_NON_CONFIG_ARGS = ("database_url", "output_dir", "compare", "serve", "fake_api_url", "port")
+
+
+def report_config(args):
+    return {key: value for key, value in vars(args).items() if key not in _NON_CONFIG_ARGS}
+
+
+def save_report(report, output_dir, prefix="load_test"):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = output_dir / f"{prefix}_{report['commit']}{'-dirty' if report['dirty'] else ''}_{stamp}.json"
+    path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return path
+
+
+def load_report(path):
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+def print_report(report, baseline=None):
+    config = report['config']
+    print(f"\nКоммит {report['commit']}{' (есть незакоммиченные изменения)' if report['dirty'] else ''}: "
+          f"{config['users']} пользователей x {config['messages_per_user']} сообщений, "
+          f"модель {config['model_latency_ms']} мс (sigma {config['model_latency_sigma']}), "
+          f"ошибок {config['model_error_rate']:.0%}, буфер {config['buffer_delay']} с")
+    print_metrics(report, REPORT_METRICS, baseline)
+
+
+def print_metrics(report, metrics, baseline=None):
+    """Таблица метрик (метка, путь в results, больше — лучше) и изменение относительно baseline."""
+    header = f"{'Метрика':<28}{'Значение':>12}"
+    if baseline:
+        header += f"{baseline['commit']:>12}{'Изменение':>12}"
+    print(header)
+    for label, path, higher_is_better in metrics:
+        value = _metric(report, path)
+        line = f"{label:<28}{'-' if value is None else value:>12}"
+        if baseline:
+            base = _metric(baseline, path)
+            line += f"{'-' if base is None else base:>12}"
+            if value is not None and base:
+                change = (value - base) / base * 100
+                better = change > 0 if higher_is_better else change < 0
+                line += f"{change:>+11.1f}%{'' if change == 0 else (' ✓' if better else ' ✗')}"
+        print(line)
+
+
+def add_stub_arguments(parser, history_messages=20):
+    """Аргументы StubbedApp: база данных, фиктивная модель, буферизация сообщений."""
+    parser.add_argument("--database-url", help="PostgreSQL для теста (данные — в схеме loadtest)")
+    parser.add_argument("--docker", action="store_true", help=f"Запустить временный контейнер {DOCKER_IMAGE}")
+    parser.add_argument("--history-messages", type=int, default=history_messages, help="Сообщений в истории каждого пользователя")
+    parser.add_argument("--buffer-delay", type=float, default=0.5, help="USER_MESSAGE_BUFFERING_DELAY на время теста, с")
+    parser.add_argument("--model-latency-ms", type=float, default=800.0, help="Медиана задержки фиктивной модели")
+    parser.add_argument("--model-latency-sigma", type=float, default=0.4, help="Разброс задержки (sigma логнормального)")
+    parser.add_argument("--model-error-rate", type=float, default=0.0, help="Доля вызовов модели, завершающихся ошибкой")
+    parser.add_argument("--model-slow-rate", type=float, default=0.0, help="Доля очень медленных ответов модели")
+    parser.add_argument("--model-slow-ms", type=float, default=30000.0, help="Задержка медленного ответа, мс")
+    parser.add_argument("--model-ms-per-1k-tokens", type=float, default=0.0,
+                        help="Прирост задержки модели на 1000 токенов промпта (символы / 4), мс")
+    parser.add_argument("--context-token-budget", type=int,
+                        help="CONTEXT_TOKEN_BUDGET приложения (0 — контекст без сжатия); по умолчанию как в client_context")
+    parser.add_argument("--output-dir", default="load_test_results", help="Куда сохранять результаты")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сквозной нагрузочный тест /callback")
+    add_stub_arguments(parser)
+    parser.add_argument("--users", type=int, default=10, help="Одновременных пользователей")
+    parser.add_argument("--messages-per-user", type=int, default=5)
+    parser.add_argument("--think-time", type=float, default=1.0, help="Средняя пауза пользователя между сообщениями, с")
+    parser.add_argument("--reply-timeout", type=float, default=120.0, help="Сколько ждать ответа бота, с")
+    parser.add_argument("--compare", help="Файл предыдущего результата для сравнения")
+    # Внутренний режим: процесс приложения
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--fake-api-url", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.serve:
+        serve(arguments)
+    else:
+        sys.exit(run(arguments))
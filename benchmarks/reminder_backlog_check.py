@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Проверка разбора очереди созревших напоминаний больше CLAIM_BATCH_SIZE.
+
+В схеме loadtest (как в load_test.py: базовые таблицы + миграции db_migrations.py)
+создается --reminders созревших напоминаний, по одному на клиента. Проверки
+reminder_service.check_and_activate_reminders запускаются подряд, пока созревших
+не останется; эндпоинт /activate_reminder заменен локальным сервером, который
+запоминает, каким клиентам ушло напоминание.
+
+Проверка не пройдена, если какое-то напоминание завершено ('done'), а активация
+по нему не отправлялась, или если очередь не разобрана за отведенное число проверок.
+
+Запуск:
+    python benchmarks/reminder_backlog_check.py --docker --reminders 500
+    python benchmarks/reminder_backlog_check.py --database-url postgresql://... --reminders 1000
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import psycopg2
+
+from load_test import (
+    DOCKER_IMAGE, FIRST_CONV_ID, LOADTEST_SCHEMA, free_port, prepare_database,
+    start_docker_postgres, with_search_path,
+)
+
+SETTLE_TIMEOUT = 60  # Сколько ждать завершения потоков активации одной проверки, с
+
+
+class ActivationRecorder(ThreadingHTTPServer):
+    """Локальный /activate_reminder: отвечает 200 и запоминает conv_id каждой активации."""
+
+    daemon_threads = True
+
+    def __init__(self, port):
+        self.activated = []
+        self.lock = threading.Lock()
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with recorder.lock:
+                    recorder.activated.append(payload["conv_id"])
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(("127.0.0.1", port), Handler)
+
+
+def seed_due_reminders(conn, count):
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO reminders (conv_id, reminder_datetime, reminder_context_summary, status, client_timezone)
+            SELECT %s + r, NOW() - make_interval(mins => r), 'Напомнить о занятии ' || r, 'active', 'UTC'
+            FROM generate_series(1, %s) AS r
+        """, (FIRST_CONV_ID, count))
+    conn.commit()
+
+
+def status_counts(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT status, COUNT(*) FROM reminders
+            WHERE reminder_datetime <= NOW()
+            GROUP BY status
+        """)
+        return dict(cur.fetchall())
+
+
+def wait_settled(conn):
+    """Ждет, пока потоки активации завершат захваченные напоминания."""
+    deadline = time.monotonic() + SETTLE_TIMEOUT
+    while status_counts(conn).get("in_progress") and time.monotonic() < deadline:
+        time.sleep(0.2)
+
+
+def run(args, database_url):
+    prepare_database(database_url, 0, 0)
+    app_url = with_search_path(database_url, LOADTEST_SCHEMA)
+
+    port = free_port()
+    recorder = ActivationRecorder(port)
+    threading.Thread(target=recorder.serve_forever, daemon=True).start()
+
+    # reminder_service читает DATABASE_URL при импорте, а PORT — при каждой активации
+    os.environ["DATABASE_URL"] = app_url
+    os.environ["PORT"] = str(port)
+    import reminder_service
+
+    conn = psycopg2.connect(app_url)
+    try:
+        seed_due_reminders(conn, args.reminders)
+        print(f"Созревших напоминаний: {args.reminders}, CLAIM_BATCH_SIZE={reminder_service.CLAIM_BATCH_SIZE}")
+
+        checks = 0
+        while status_counts(conn).get("active") and checks < args.max_checks:
+            reminder_service.check_and_activate_reminders()
+            checks += 1
+            wait_settled(conn)
+            counts = status_counts(conn)
+            print(f"Проверка {checks}: active={counts.get('active', 0)}, done={counts.get('done', 0)}, "
+                  f"активаций отправлено {len(recorder.activated)}")
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT conv_id FROM reminders WHERE status = 'done'")
+            done = {row[0] for row in cur.fetchall()}
+    finally:
+        conn.close()
+        reminder_service.release_dispatcher_lock()
+        recorder.shutdown()
+
+    activated = set(recorder.activated)
+    silently_done = done - activated
+    left = args.reminders - len(done)
+    print(f"\nЗавершено {len(done)}, активаций {len(recorder.activated)} (клиентов {len(activated)}), "
+          f"завершено без отправки: {len(silently_done)}, не разобрано: {left}")
+    return not silently_done and not left
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Разбор очереди созревших напоминаний больше CLAIM_BATCH_SIZE")
+    parser.add_argument("--database-url", help="PostgreSQL для проверки (данные — в схеме loadtest)")
+    parser.add_argument("--docker", action="store_true", help=f"Запустить временный контейнер {DOCKER_IMAGE}")
+    parser.add_argument("--reminders", type=int, default=500, help="Созревших напоминаний")
+    parser.add_argument("--max-checks", type=int, default=20, help="Предел числа проверок")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    container_id = None
+    database_url = args.database_url or os.environ.get("LOADTEST_DATABASE_URL")
+    try:
+        if args.docker:
+            print(f"Запуск контейнера {DOCKER_IMAGE}...")
+            container_id, database_url = start_docker_postgres()
+        if not database_url:
+            raise RuntimeError("Укажите --database-url (или LOADTEST_DATABASE_URL) либо --docker")
+        ok = run(args, database_url)
+    finally:
+        if container_id:
+            subprocess.run(["docker", "stop", container_id], check=False, capture_output=True)
+
+    print("OK" if ok else "ПРОВАЛ")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
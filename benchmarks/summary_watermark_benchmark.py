@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воспроизведение нагрузки summary_updater на диалогах из filtered_dialogues.md:
+сравнение прежнего режима (всегда последние NUM_MESSAGES_TO_FETCH сообщений)
+и режима с водяным знаком (только сообщения после последнего учтенного).
+
+Обновление саммари запускается после каждого ответа бота на сообщение клиента
+(generate_and_send_response). Рассылки бота без ответа клиента обновление не запускают,
+но попадают в следующий прогон. Каждый прогон — два вызова Gemini (саммари + факты).
+
+Токены оцениваются как символы / 4 (токенизатора Gemini в окружении нет), считается
+только блок сообщений: существующее саммари и инструкции одинаковы в обоих режимах.
+
+Запуск: python benchmarks/summary_watermark_benchmark.py
+"""
+
+import re
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+# Добавляем родительскую директорию в sys.path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from text_processing import strip_timestamp
+from dialogue_samples import load_dialogues
+
+# Должны совпадать с summary_updater.py
+NUM_MESSAGES_TO_FETCH = 15
+GEMINI_CALLS_PER_RUN = 2
+
+CHARS_PER_TOKEN = 4
+_DATE = re.compile(r'^\[(\d{4}-\d{2}-\d{2})')
+
+
+def format_messages(messages):
+    """Та же разметка, что и summary_updater.format_messages_for_prompt."""
+    role_map = {'bot': 'ассистент', 'user': 'клиент', 'operator': 'оператор'}
+    return "\n".join(f"{role_map.get(role, role).capitalize()}: {strip_timestamp(text)}" for role, text in messages)
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+
+def replay(dialogues):
+    """Возвращает статистику по дням: {дата: {метрика: значение}}."""
+    per_day = defaultdict(lambda: defaultdict(int))
+    for messages in dialogues.values():
+        watermark = 0  # индекс первого сообщения, еще не учтенного в саммари
+        for index, (role, text) in enumerate(messages):
+            is_reply = role == 'bot' and index > 0 and messages[index - 1][0] == 'user'
+            if not is_reply:
+                continue
+            match = _DATE.match(text)
+            day = match.group(1) if match else 'неизвестно'
+            stats = per_day[day]
+            stats['runs'] += 1
+
+            history = messages[:index + 1]
+            legacy_block = format_messages(history[-NUM_MESSAGES_TO_FETCH:])
+            stats['legacy_tokens'] += estimate_tokens(legacy_block)
+            stats['legacy_calls'] += GEMINI_CALLS_PER_RUN
+
+            new_messages = history[watermark:][-NUM_MESSAGES_TO_FETCH:]
+            if new_messages:
+                stats['watermark_tokens'] += estimate_tokens(format_messages(new_messages))
+                stats['watermark_calls'] += GEMINI_CALLS_PER_RUN
+            else:
+                stats['skipped_runs'] += 1
+            watermark = index + 1
+    return per_day
+
+
+def main():
+    per_day = replay(load_dialogues())
+    totals = defaultdict(int)
+    for stats in per_day.values():
+        for key, value in stats.items():
+            totals[key] += value
+    days = len(per_day)
+
+    print(f"Дней с активностью: {days}, запусков после ответов бота: {totals['runs']}, "
+          f"из них без новых сообщений (Gemini не вызывается): {totals['skipped_runs']}")
+    print(f"Токены блока сообщений: было {totals['legacy_tokens']:,}, стало {totals['watermark_tokens']:,} "
+          f"(-{1 - totals['watermark_tokens'] / totals['legacy_tokens']:.1%})")
+    print(f"Вызовы Gemini: было {totals['legacy_calls']:,}, стало {totals['watermark_calls']:,} "
+          f"(-{1 - totals['watermark_calls'] / totals['legacy_calls']:.1%})")
+    print(f"В среднем за день: токенов {totals['legacy_tokens'] / days:,.0f} -> {totals['watermark_tokens'] / days:,.0f}, "
+          f"сэкономлено вызовов Gemini: {(totals['legacy_calls'] - totals['watermark_calls']) / days:.1f}")
+
+
+if __name__ == "__main__":
+    main()
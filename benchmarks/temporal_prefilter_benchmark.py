@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Оценка локального пред-фильтра напоминаний (temporal_detector.py).
+
+1. Точность/полнота на размеченном корпусе temporal_prefilter_corpus.json
+   (сообщения взяты из filtered_dialogues.md, разметка: нужен ли анализ договоренностей).
+2. Доля сэкономленных вызовов Gemini: для каждого ответа ассистента в filtered_dialogues.md
+   проверяем окно из последних PREFILTER_MESSAGES_TO_SCAN сообщений, как это делает
+   reminder_service.needs_reminder_analysis (без активных напоминаний).
+3. Скорость детектора.
+
+Запуск: python benchmarks/temporal_prefilter_benchmark.py
+"""
+
+import json
+import sys
+import time
+from pathlib import Path
+
+# Добавляем родительскую директорию в sys.path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from temporal_detector import has_temporal_signal, detect_temporal_signals, should_analyze_for_reminders
+from dialogue_samples import load_dialogues
+
+CORPUS_PATH = Path(__file__).parent / "temporal_prefilter_corpus.json"
+
+# Должно совпадать с PREFILTER_MESSAGES_TO_SCAN в reminder_service.py
+PREFILTER_MESSAGES_TO_SCAN = 4
+
+
+def evaluate_corpus():
+    """Считает precision/recall детектора на размеченном корпусе."""
+    corpus = json.loads(CORPUS_PATH.read_text(encoding="utf-8"))
+    tp = fp = fn = tn = 0
+    mistakes = []
+    for item in corpus:
+        predicted = has_temporal_signal(item["text"])
+        expected = item["expected"]
+        if predicted and expected:
+            tp += 1
+        elif predicted and not expected:
+            fp += 1
+            mistakes.append(("FP", item, detect_temporal_signals(item["text"])))
+        elif not predicted and expected:
+            fn += 1
+            mistakes.append(("FN", item, {}))
+        else:
+            tn += 1
+
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    print(f"Корпус: {len(corpus)} сообщений ({tp + fn} положительных)")
+    print(f"  TP={tp} FP={fp} FN={fn} TN={tn}")
+    print(f"  Precision: {precision:.2%}   Recall: {recall:.2%}")
+    for kind, item, signals in mistakes:
+        snippet = item["text"].replace("\n", " ")[:90]
+        print(f"  {kind}: {snippet!r} {signals if signals else ''}")
+
+
+def evaluate_call_reduction(dialogues):
+    """Считает, какая доля вызовов анализа напоминаний была бы пропущена пред-фильтром."""
+    total_calls = 0
+    skipped_calls = 0
+    for messages in dialogues.values():
+        for index, (role, _) in enumerate(messages):
+            # process_new_message вызывается после каждого ответа ассистента
+            if role != "bot":
+                continue
+            window = [text for _, text in messages[max(0, index + 1 - PREFILTER_MESSAGES_TO_SCAN):index + 1]]
+            total_calls += 1
+            if not should_analyze_for_reminders(window, active_reminders_count=0):
+                skipped_calls += 1
+
+    rate = skipped_calls / total_calls if total_calls else 0.0
+    print(f"Вызовы анализа напоминаний: {total_calls}, пропущено пред-фильтром: {skipped_calls} ({rate:.1%})")
+
+
+def measure_speed(dialogues, repeats=20):
+    """Измеряет среднее время проверки одного сообщения."""
+    texts = [text for messages in dialogues.values() for _, text in messages]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text in texts:
+            has_temporal_signal(text)
+    elapsed = time.perf_counter() - start
+    per_message_us = elapsed / (repeats * len(texts)) * 1_000_000
+    print(f"Скорость: {len(texts)} сообщений x {repeats}, {per_message_us:.1f} мкс на сообщение")
+
+
+def main():
+    evaluate_corpus()
+    print()
+    dialogues = load_dialogues()
+    evaluate_call_reduction(dialogues)
+    measure_speed(dialogues)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Микро-бенчмарк text_processing.py против прежних реализаций на реальных сообщениях
+из filtered_dialogues.md. Перед замером проверяет, что результаты совпадают.
+
+Запуск: python benchmarks/text_processing_benchmark.py
+"""
+
+import re
+import sys
+import timeit
+from pathlib import Path
+
+# Добавляем родительскую директорию в sys.path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import text_processing
+from dialogue_samples import load_messages
+
+REPEATS = 5
+
+RUSSIAN_MONTHS_REVERSE = text_processing.RUSSIAN_MONTHS_GENITIVE
+
+
+# --- Прежние реализации (как они были в main.py / reminder_service.py / summary_updater.py) ---
+
+def legacy_strip_timestamp(message_text):
+    return re.sub(r'^\[.*?\]\s*', '', message_text)
+
+
+def legacy_remove_internal_tags(message):
+    message = re.sub(r'<internal>.*?</internal>', '', message, flags=re.DOTALL | re.IGNORECASE)
+    message = re.sub(r'<internal_analysis>.*?</internal_analysis>', '', message, flags=re.DOTALL | re.IGNORECASE)
+    message = re.sub(r'\n\s*\n', '\n', message)
+    return message.strip()
+
+
+def legacy_vkvideo_add(message_text):
+    message_text = message_text.replace('**', '')
+    video_pattern = r'\b(\d+_\d+)\b'
+    matches = re.findall(video_pattern, message_text)
+    if matches:
+        return re.sub(video_pattern, '', message_text), matches
+    return message_text, []
+
+
+def legacy_find_birthday(context_text):
+    new_pattern = r'Дата рождения: (\d+) (января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)'
+    match = re.search(new_pattern, context_text)
+    if match:
+        return int(match.group(1)), RUSSIAN_MONTHS_REVERSE.get(match.group(2))
+    match = re.search(r'Дата рождения: (\d+)\.(\d+)', context_text)
+    if match:
+        return int(match.group(1)), int(match.group(2))
+    return None, None
+
+
+def legacy_detect_timezone(message_text):
+    message_lower = message_text.lower()
+    timezone_patterns = [
+        (r'по\s+москве|московское\s+время|мск', 'Europe/Moscow'),
+        (r'по\s+питеру|по\s+спб|питерское\s+время', 'Europe/Moscow'),
+        (r'по\s+екатеринбургу|екатеринбургское\s+время', 'Asia/Yekaterinburg'),
+        (r'по\s+новосибирску|новосибирское\s+время', 'Asia/Novosibirsk'),
+        (r'по\s+владивостоку|владивостокское\s+время', 'Asia/Vladivostok'),
+        (r'utc|гринвич', 'UTC'),
+        (r'по\s+киеву|киевское\s+время', 'Europe/Kiev'),
+        (r'по\s+минску|минское\s+время', 'Europe/Minsk'),
+        (r'по\s+алматы', 'Asia/Almaty'),
+    ]
+    for pattern, timezone in timezone_patterns:
+        if re.search(pattern, message_lower):
+            return timezone
+    return None
+
+
+def measure(name, legacy_func, new_func, samples):
+    """Сверяет результаты и печатает время обеих реализаций."""
+    mismatches = sum(1 for sample in samples if legacy_func(sample) != new_func(sample))
+    legacy_time = min(timeit.repeat(lambda: [legacy_func(s) for s in samples], number=1, repeat=REPEATS))
+    new_time = min(timeit.repeat(lambda: [new_func(s) for s in samples], number=1, repeat=REPEATS))
+    per_item_legacy = legacy_time / len(samples) * 1_000_000
+    per_item_new = new_time / len(samples) * 1_000_000
+    print(f"{name:<22} {len(samples):>6} шт.  было {per_item_legacy:7.2f} мкс  стало {per_item_new:7.2f} мкс  "
+          f"x{legacy_time / new_time:5.1f}  расхождений: {mismatches}")
+
+
+def main():
+    messages = load_messages()
+    # Ответы бота в реальном формате: часть с внутренними размышлениями и видео
+    bot_replies = [
+        (f"<internal>Анализ: клиент {i}</internal>\n\n{text}\n\n{456239017 + i}_{i}" if i % 3 == 0 else text)
+        for i, text in enumerate(messages)
+    ]
+    history = "\n".join(messages[:30])
+    contexts = [
+        f"--- ПРОФИЛЬ ---\nИмя: Клиент\n{history}\nДата рождения: {1 + i % 28} августа" if i % 3 == 0 else
+        f"--- ПРОФИЛЬ ---\nИмя: Клиент\n{history}\nДата рождения: {1 + i % 28}.{1 + i % 12}" if i % 3 == 1 else
+        f"--- ПРОФИЛЬ ---\nИмя: Клиент\n{history}"
+        for i in range(300)
+    ]
+    # В реальной таблице у всех сообщений есть метка в новом формате
+    stored_messages = [f"[2025-08-{1 + i % 28:02d}_12-00-00] {text}" for i, text in enumerate(messages)]
+
+    print(f"Сообщений из filtered_dialogues.md: {len(messages)}\n")
+    measure("strip_timestamp", legacy_strip_timestamp, text_processing.strip_timestamp, stored_messages)
+    measure("remove_internal_tags", legacy_remove_internal_tags, text_processing.remove_internal_tags, bot_replies)
+    measure("vkvideo_add", legacy_vkvideo_add, text_processing.vkvideo_add, bot_replies)
+    measure("find_birthday", legacy_find_birthday, text_processing.find_birthday, contexts)
+    measure("detect_timezone", legacy_detect_timezone, text_processing.detect_timezone, messages)
+
+
+if __name__ == "__main__":
+    main()
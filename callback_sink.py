@@ -0,0 +1,545 @@
+# --- Описание ---
+# Журнал событий ВКонтакте (/callback) в сегментах JSONL вместо файла на каждое событие.
+#
+# - append(payload) только кладет событие в очередь процесса: ответ VK не ждет диска.
+#   Поток записи собирает события пачками (до FLUSH_MAX_EVENTS или FLUSH_INTERVAL_SECONDS)
+#   и дописывает их одной записью в активный сегмент — по строке
+#   {"received_at": ..., "payload": {...}} на событие, без отступов и без fsync на событие.
+# - Сегмент callbacks_<начало интервала>_<часть>.jsonl общий для воркеров gunicorn:
+#   файл открыт с O_APPEND, каждая пачка пишется под flock. Новый сегмент начинается
+#   каждые SEGMENT_MAX_SECONDS или когда текущий больше SEGMENT_MAX_BYTES.
+# - Закрытые сегменты сжимаются в .jsonl.gz блоками по COMPRESSED_BLOCK_BYTES (каждый
+#   блок — отдельный gzip-член, файл читается обычным gzip). Рядом лежат:
+#   .idx — event_id, conv_id, смещение и длина строки в несжатом сегменте;
+#   .blk — смещения блоков в несжатом и сжатом файле, чтобы прочитать одно событие,
+#   распаковав только его блок (find_events).
+# - Хранение: сегменты старше RETENTION_DAYS и самые старые сверх RETENTION_MAX_BYTES
+#   удаляются; старые файлы callback_*.json прежнего формата — по тому же сроку.
+#
+# Сегменты читает benchmarks/callback_replay.py (каталог callback_logs целиком).
+#
+# Запуск вручную:
+#    python callback_sink.py find --event-id <event_id>
+#    python callback_sink.py find --conv-id 123456 --limit 20
+#    python callback_sink.py maintain            # сжать закрытые сегменты и применить хранение
+#    python callback_sink.py migrate [--delete]  # упаковать файлы callback_*.json в сегменты
+# --- Конец описания ---
+
+import os
+import sys
+import json
+import gzip
+import time
+import queue
+import fcntl
+import atexit
+import bisect
+import logging
+import argparse
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+from metrics import register_gauge
+
+# --- НАСТРОЙКИ ---
+CALLBACK_LOGS_DIR = "callback_logs"
+SEGMENT_PREFIX = "callbacks_"
+SEGMENT_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+SEGMENT_MAX_BYTES = int(os.environ.get("CALLBACK_SEGMENT_MAX_BYTES", 16 * 1024 * 1024))
+SEGMENT_MAX_SECONDS = int(os.environ.get("CALLBACK_SEGMENT_MAX_SECONDS", 3600))
+FLUSH_INTERVAL_SECONDS = 1.0
+FLUSH_MAX_EVENTS = 500
+MAX_QUEUED_EVENTS = 10000          # При переполнении события отбрасываются, а не задерживают /callback
+MAINTENANCE_INTERVAL_SECONDS = 60
+COMPRESSED_BLOCK_BYTES = 256 * 1024
+RETENTION_DAYS = int(os.environ.get("CALLBACK_LOG_RETENTION_DAYS", 30))
+RETENTION_MAX_BYTES = int(os.environ.get("CALLBACK_LOG_MAX_BYTES", 2 * 1024 ** 3))
+LEGACY_FILE_GLOB = "callback_*.json"
+LEGACY_TIME_FORMAT = "callback_%Y-%m-%d_%H-%M-%S_%f.json"
+
+_GAUGE_STATS = ('queued',)
+_COUNTER_STATS = ('events_written', 'bytes_written', 'batches', 'dropped', 'write_errors',
+                  'segments_compressed', 'files_deleted')
+
+
+def segment_base(bucket_start, part):
+    """Имя сегмента без расширения: callbacks_<UTC-начало интервала>_<часть>."""
+    stamp = datetime.fromtimestamp(bucket_start, timezone.utc).strftime(SEGMENT_TIME_FORMAT)
+    return f"{SEGMENT_PREFIX}{stamp}_{part:03d}"
+
+
+def bucket_of(name):
+    """UTC-начало интервала сегмента по имени файла (epoch) или None."""
+    stamp = name[len(SEGMENT_PREFIX):len(SEGMENT_PREFIX) + 19]
+    try:
+        return datetime.strptime(stamp, SEGMENT_TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def _base_of(path):
+    name = path.name
+    for suffix in (".jsonl.gz", ".jsonl", ".idx", ".blk"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _index_field(value):
+    return "" if value is None else str(value).replace("\t", " ").replace("\n", " ")
+
+
+def event_keys(payload):
+    """(event_id, conv_id) события: conv_id — peer_id/from_id сообщения или user_id объекта."""
+    obj = payload.get("object") if isinstance(payload, dict) else None
+    if not isinstance(obj, dict):
+        return payload.get("event_id") if isinstance(payload, dict) else None, None
+    message = obj.get("message") if isinstance(obj.get("message"), dict) else obj
+    conv_id = message.get("peer_id") or message.get("from_id") or obj.get("user_id")
+    return payload.get("event_id"), conv_id
+
+
+class _Segment:
+    __slots__ = ("base", "bucket", "fd", "index_fd")
+
+    def __init__(self, base, bucket, fd, index_fd):
+        self.base = base
+        self.bucket = bucket
+        self.fd = fd
+        self.index_fd = index_fd
+
+
+class CallbackSink:
+    """
+    Буферизованная запись событий VK в сегменты JSONL (см. описание модуля).
+    Поток записи запускается при первом append() в каждом процессе (gunicorn --preload
+    создает объект до fork), при выходе процесса очередь дописывается (atexit).
+    """
+
+    def __init__(self, directory=CALLBACK_LOGS_DIR, max_segment_bytes=SEGMENT_MAX_BYTES,
+                 max_segment_seconds=SEGMENT_MAX_SECONDS, retention_days=RETENTION_DAYS,
+                 retention_max_bytes=RETENTION_MAX_BYTES, flush_interval=FLUSH_INTERVAL_SECONDS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self.retention_days = retention_days
+        self.retention_max_bytes = retention_max_bytes
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._segment = None
+        self._last_maintenance = 0.0
+        self._counters = dict.fromkeys(_COUNTER_STATS, 0)
+
+    # --- Прием событий ---
+
+    def append(self, payload, received_at=None):
+        """Ставит событие в очередь записи. Не блокирует: при переполнении очереди событие теряется."""
+        self._ensure_writer()
+        if received_at is None:
+            received_at = time.time()
+        try:
+            self._queue.put_nowait((received_at, payload))
+        except queue.Full:
+            with self._lock:
+                self._counters['dropped'] += 1
+                dropped = self._counters['dropped']
+            if dropped % 1000 == 1:
+                logging.warning(f"Журнал callback: очередь записи заполнена, отброшено событий: {dropped}")
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # После fork состояние родителя (очередь, поток, открытые сегменты) не используется
+            self._pid = os.getpid()
+            self._segment = None
+            self._queue = queue.Queue(maxsize=MAX_QUEUED_EVENTS)
+            self._thread = threading.Thread(target=self._run, name="CallbackSinkWriter", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self, timeout=10):
+        """Дописывает очередь и закрывает сегмент. Вызывается при выходе процесса."""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+        self._pid = None
+        self._close_segment()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self.write_batch(batch)
+            if time.monotonic() - self._last_maintenance >= MAINTENANCE_INTERVAL_SECONDS:
+                self._last_maintenance = time.monotonic()
+                try:
+                    self.maintain()
+                except Exception as e:
+                    logging.error(f"Журнал callback: ошибка обслуживания сегментов: {e}", exc_info=True)
+
+    def _next_batch(self):
+        """Пачка событий: первое ждем до MAINTENANCE_INTERVAL_SECONDS, остальные — до flush_interval."""
+        try:
+            first = self._queue.get(timeout=MAINTENANCE_INTERVAL_SECONDS)
+        except queue.Empty:
+            return [], False
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < FLUSH_MAX_EVENTS:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    # --- Запись сегментов ---
+
+    def write_batch(self, records):
+        """Дописывает [(received_at epoch, payload)] в сегменты их интервалов."""
+        by_bucket = {}
+        for received_at, payload in records:
+            try:
+                line = json.dumps(
+                    {"received_at": datetime.fromtimestamp(received_at, timezone.utc).isoformat(), "payload": payload},
+                    ensure_ascii=False, separators=(",", ":"), default=str,
+                ).encode("utf-8") + b"\n"
+            except (TypeError, ValueError) as e:
+                logging.error(f"Журнал callback: событие не сериализуется в JSON: {e}")
+                continue
+            bucket = int(received_at // self.max_segment_seconds) * self.max_segment_seconds
+            by_bucket.setdefault(bucket, []).append((line, event_keys(payload)))
+
+        for bucket, lines in sorted(by_bucket.items()):
+            try:
+                self._append_lines(bucket, lines)
+            except OSError as e:
+                with self._lock:
+                    self._counters['write_errors'] += len(lines)
+                logging.error(f"Журнал callback: не удалось записать {len(lines)} событий: {e}")
+
+    def _append_lines(self, bucket, lines):
+        data = b"".join(line for line, _ in lines)
+        for _ in range(3):
+            segment = self._open_segment(bucket)
+            fcntl.flock(segment.fd, fcntl.LOCK_EX)
+            closed = False
+            try:
+                stat = os.fstat(segment.fd)
+                # Сегмент сжат другим процессом или заполнен — переходим к следующей части.
+                # .jsonl.gz проверяется под блокировкой: если сегмент сжали между проверкой
+                # в _open_segment и открытием, O_CREAT создал пустой файл с тем же именем
+                compressed = (self.directory / f"{segment.base}.jsonl.gz").exists()
+                closed = compressed or stat.st_nlink == 0 or stat.st_size >= self.max_segment_bytes
+                if closed:
+                    if compressed and stat.st_nlink > 0:
+                        os.unlink(self.directory / f"{segment.base}.jsonl")
+                    continue
+                # O_APPEND: пачка целиком ложится в конец, позиция после записи — ее конец
+                written = os.write(segment.fd, data)
+                if written != len(data):
+                    raise OSError(f"записано {written} из {len(data)} байт")
+                offset = os.lseek(segment.fd, 0, os.SEEK_CUR) - len(data)
+                index_lines = []
+                for line, (event_id, conv_id) in lines:
+                    index_lines.append(f"{_index_field(event_id)}\t{_index_field(conv_id)}\t{offset}\t{len(line)}\n")
+                    offset += len(line)
+                os.write(segment.index_fd, "".join(index_lines).encode("utf-8"))
+            finally:
+                fcntl.flock(segment.fd, fcntl.LOCK_UN)
+                if closed:
+                    self._close_segment()
+            with self._lock:
+                self._counters['events_written'] += len(lines)
+                self._counters['bytes_written'] += len(data)
+                self._counters['batches'] += 1
+            return
+        raise OSError("не удалось выбрать сегмент для записи")
+
+    def _open_segment(self, bucket):
+        if self._segment is not None and self._segment.bucket == bucket:
+            return self._segment
+        self._close_segment()
+        part = 0
+        while True:
+            base = segment_base(bucket, part)
+            if not (self.directory / f"{base}.jsonl.gz").exists():
+                try:
+                    size = (self.directory / f"{base}.jsonl").stat().st_size
+                except FileNotFoundError:
+                    size = 0
+                if size < self.max_segment_bytes:
+                    break
+            part += 1
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        fd = os.open(self.directory / f"{base}.jsonl", flags, 0o644)
+        index_fd = os.open(self.directory / f"{base}.idx", flags, 0o644)
+        self._segment = _Segment(base, bucket, fd, index_fd)
+        return self._segment
+
+    def _close_segment(self):
+        if self._segment is not None:
+            os.close(self._segment.fd)
+            os.close(self._segment.index_fd)
+            self._segment = None
+
+    # --- Сжатие и хранение ---
+
+    def maintain(self):
+        """Сжимает закрытые сегменты, удаляет устаревшие по сроку и объему."""
+        current = int(time.time() // self.max_segment_seconds) * self.max_segment_seconds
+        for path in sorted(self.directory.glob(f"{SEGMENT_PREFIX}*.jsonl")):
+            bucket = bucket_of(path.name)
+            try:
+                full = path.stat().st_size >= self.max_segment_bytes
+            except FileNotFoundError:
+                continue
+            if bucket is not None and (bucket < current or full):
+                self.compress_segment(path)
+        self.apply_retention()
+
+    def compress_segment(self, path):
+        """
+        Сжимает сегмент в .jsonl.gz и пишет карту блоков .blk. Сегмент блокируется flock:
+        процесс, который ждал блокировку для записи, увидит удаленный файл и откроет новую часть.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if os.fstat(fd).st_nlink == 0:
+                return False
+            base = _base_of(path)
+            gz_path = self.directory / f"{base}.jsonl.gz"
+            tmp_path = self.directory / f"{base}.jsonl.gz.tmp"
+            if gz_path.exists():
+                # Сжатая часть уже есть: замена потеряла бы ее события, сегмент остается как есть
+                logging.warning(f"Журнал callback: {gz_path.name} уже существует, {path.name} не сжимается")
+                return False
+            blocks = []
+            with os.fdopen(os.dup(fd), "rb") as src, open(tmp_path, "wb") as dst:
+                raw_offset = 0
+                chunk = []
+                chunk_size = 0
+                for line in src:
+                    chunk.append(line)
+                    chunk_size += len(line)
+                    if chunk_size >= COMPRESSED_BLOCK_BYTES:
+                        blocks.append((raw_offset, dst.tell()))
+                        dst.write(gzip.compress(b"".join(chunk)))
+                        raw_offset += chunk_size
+                        chunk, chunk_size = [], 0
+                if chunk:
+                    blocks.append((raw_offset, dst.tell()))
+                    dst.write(gzip.compress(b"".join(chunk)))
+                dst.flush()
+                os.fsync(dst.fileno())
+            (self.directory / f"{base}.blk").write_text(
+                "".join(f"{raw}\t{compressed}\n" for raw, compressed in blocks), encoding="utf-8"
+            )
+            os.replace(tmp_path, gz_path)
+            os.unlink(path)
+            with self._lock:
+                self._counters['segments_compressed'] += 1
+            return True
+        finally:
+            os.close(fd)
+
+    def apply_retention(self):
+        """Удаляет сегменты старше retention_days и самые старые сверх retention_max_bytes."""
+        cutoff = time.time() - self.retention_days * 86400
+        closed = sorted(self.directory.glob(f"{SEGMENT_PREFIX}*.jsonl.gz"))
+        keep = []
+        for path in closed:
+            bucket = bucket_of(path.name)
+            if bucket is not None and bucket + self.max_segment_seconds < cutoff:
+                self._delete_segment(_base_of(path))
+            else:
+                keep.append(path)
+
+        sizes = []
+        for path in keep:
+            base = _base_of(path)
+            size = 0
+            for suffix in (".jsonl.gz", ".idx", ".blk"):
+                try:
+                    size += (self.directory / f"{base}{suffix}").stat().st_size
+                except FileNotFoundError:
+                    pass
+            sizes.append((base, size))
+        total = sum(size for _, size in sizes)
+        for base, size in sizes:
+            if total <= self.retention_max_bytes:
+                break
+            self._delete_segment(base)
+            total -= size
+
+        # Файлы прежнего формата (по файлу на событие) — тот же срок хранения
+        for path in self.directory.glob(LEGACY_FILE_GLOB):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    with self._lock:
+                        self._counters['files_deleted'] += 1
+            except FileNotFoundError:
+                pass
+
+    def _delete_segment(self, base):
+        for suffix in (".jsonl.gz", ".idx", ".blk"):
+            try:
+                (self.directory / f"{base}{suffix}").unlink()
+                with self._lock:
+                    self._counters['files_deleted'] += 1
+            except FileNotFoundError:
+                pass
+        logging.info(f"Журнал callback: удален сегмент {base}")
+
+    # --- Статистика ---
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['queued'] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+    def register_metrics(self):
+        """Публикует stats() в /metrics (metrics.py)."""
+        for key in _GAUGE_STATS:
+            register_gauge(f"callback_sink_{key}", f"Журнал callback: {key}", lambda key=key: self.stats()[key])
+        for key in _COUNTER_STATS:
+            register_gauge(f"callback_sink_{key}_total", f"Журнал callback: {key}",
+                           lambda key=key: self.stats()[key], kind="counter")
+
+
+# =======================================================================================
+# ПОИСК
+# =======================================================================================
+
+def read_record(directory, base, offset, length):
+    """Читает запись сегмента по смещению в несжатом файле (активный .jsonl или .jsonl.gz с .blk)."""
+    directory = Path(directory)
+    try:
+        with open(directory / f"{base}.jsonl", "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+    except FileNotFoundError:
+        pass
+    blocks = []
+    with open(directory / f"{base}.blk", encoding="utf-8") as f:
+        for line in f:
+            raw, compressed = line.split("\t")
+            blocks.append((int(raw), int(compressed)))
+    raw_start, compressed_start = blocks[bisect.bisect_right([raw for raw, _ in blocks], offset) - 1]
+    with open(directory / f"{base}.jsonl.gz", "rb") as f:
+        f.seek(compressed_start)
+        with gzip.GzipFile(fileobj=f) as block:
+            block.read(offset - raw_start)
+            return json.loads(block.read(length))
+
+
+def find_events(directory=CALLBACK_LOGS_DIR, event_id=None, conv_id=None, limit=100):
+    """
+    Ищет события по event_id или conv_id в индексах сегментов, от новых к старым.
+
+    Returns:
+        list[dict]: Записи {"received_at": ..., "payload": {...}}.
+    """
+    directory = Path(directory)
+    results = []
+    for index_path in sorted(directory.glob(f"{SEGMENT_PREFIX}*.idx"), reverse=True):
+        base = _base_of(index_path)
+        matches = []
+        with open(index_path, encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 4:
+                    continue  # Строка дописывается прямо сейчас
+                if (event_id is not None and fields[0] == str(event_id)) or \
+                        (conv_id is not None and fields[1] == str(conv_id)):
+                    matches.append((int(fields[2]), int(fields[3])))
+        for offset, length in reversed(matches):
+            results.append(read_record(directory, base, offset, length))
+            if len(results) >= limit:
+                return results
+        if event_id is not None and results:
+            return results
+    return results
+
+
+def migrate_legacy(directory=CALLBACK_LOGS_DIR, delete=False):
+    """Упаковывает файлы callback_*.json в сегменты по времени из имени файла."""
+    sink = CallbackSink(directory)
+    paths = sorted(Path(directory).glob(LEGACY_FILE_GLOB))
+    batch = []
+    migrated = 0
+    for path in paths:
+        try:
+            received_at = datetime.strptime(path.name, LEGACY_TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+            batch.append((received_at, json.loads(path.read_text(encoding="utf-8"))))
+        except (ValueError, OSError) as e:
+            logging.warning(f"Пропущен файл {path.name}: {e}")
+            continue
+        if len(batch) >= FLUSH_MAX_EVENTS:
+            sink.write_batch(batch)
+            migrated += len(batch)
+            batch = []
+    if batch:
+        sink.write_batch(batch)
+        migrated += len(batch)
+    sink._close_segment()
+    sink.maintain()
+    if delete and not sink.stats()['write_errors']:
+        for path in paths:
+            path.unlink(missing_ok=True)
+    return migrated
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Журнал событий VK в сегментах JSONL")
+    parser.add_argument("command", choices=["find", "maintain", "migrate"])
+    parser.add_argument("--dir", default=CALLBACK_LOGS_DIR, help="Каталог журнала")
+    parser.add_argument("--event-id", help="find: event_id события")
+    parser.add_argument("--conv-id", help="find: conv_id (peer_id/from_id) клиента")
+    parser.add_argument("--limit", type=int, default=20, help="find: сколько последних событий вывести")
+    parser.add_argument("--delete", action="store_true", help="migrate: удалить упакованные файлы callback_*.json")
+    args = parser.parse_args()
+
+    if args.command == "find":
+        if not args.event_id and not args.conv_id:
+            parser.error("для find нужен --event-id или --conv-id")
+        for record in find_events(args.dir, args.event_id, args.conv_id, args.limit):
+            print(json.dumps(record, ensure_ascii=False))
+    elif args.command == "maintain":
+        sink = CallbackSink(args.dir)
+        sink.maintain()
+        print(sink.stats())
+    else:
+        print(f"Упаковано событий: {migrate_legacy(args.dir, args.delete)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
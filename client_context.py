@@ -0,0 +1,477 @@
+# --- Описание ---
+# Структурированный контекст клиента для агента-коммуникатора (main.py).
+# build_context_sync собирает строки из БД в объект ClientContext, а не в готовый текст:
+# дата рождения, имя и другие производные поля берутся прямо из данных профиля,
+# без повторного разбора отрисованного текста регулярными выражениями.
+# Текст для промпта отрисовывается лениво и один раз (render()).
+#
+# Бюджет контекста: render() укладывает блоки в BLOCK_TOKEN_BUDGETS и общий потолок
+# CONTEXT_TOKEN_BUDGET (токены оцениваются по числу символов, CHARS_PER_TOKEN).
+# - Диалог: реплики, которые уже покрыты саммари ((created_at, id) не позже водяного
+#   знака профиля summary_watermark, summary_watermark_id), убираются первыми, от старых
+#   к новым. Последние MIN_DIALOGUE_TURNS реплик остаются всегда, слишком длинная реплика
+#   обрезается до MAX_TURN_TOKENS.
+# - Остальные таблицы с conv_id сворачиваются: без пустых и служебных колонок,
+#   не больше MAX_GENERIC_ROWS последних записей.
+# - Если сумма все равно больше потолка: сначала убираются остальные таблицы,
+#   затем старые непокрытые реплики, затем обрезается саммари. Напоминания и
+#   системное уведомление не сжимаются.
+# CONTEXT_TOKEN_BUDGET=0 (или render(token_budget=0)) — прежний полный контекст.
+# --- Конец описания ---
+
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+
+from text_processing import strip_timestamp, RUSSIAN_MONTHS_GENITIVE
+
+# Лимит на количество последних сообщений для истории диалога
+DIALOGUES_LIMIT = 30
+
+# Номер месяца -> название в родительном падеже ("30 августа")
+RUSSIAN_MONTHS = {number: name for name, number in RUSSIAN_MONTHS_GENITIVE.items()}
+
+ROLE_NAMES = {'user': 'Пользователь', 'bot': 'Модель', 'operator': 'Оператор'}
+
+# --- БЮДЖЕТ КОНТЕКСТА ---
+# Оценка без токенайзера: русский текст у Gemini — около 3 символов на токен
+CHARS_PER_TOKEN = 3
+# Общий потолок контекста клиента в токенах; 0 — без сжатия
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "6000"))
+BLOCK_TOKEN_BUDGETS = {
+    'profile': 1500,            # Карточка клиента вместе с саммари диалога
+    'client_purchases': 300,
+    'purchased_products': 150,
+    'dialogues': 3000,          # Сжимаются только реплики, покрытые саммари
+    'other_tables': 600,        # На каждую остальную таблицу
+}
+MIN_DIALOGUE_TURNS = 6          # Последние реплики остаются при любом бюджете
+MAX_TURN_TOKENS = 500           # Длинная реплика (вставленный текст) обрезается
+MAX_GENERIC_ROWS = 5            # Записей на таблицу в свернутом виде
+GENERIC_SKIP_COLUMNS = ('id', 'conv_id')
+MIN_SUMMARY_TOKENS = 150        # Саммари не обрезается короче этого
+
+DIALOGUES_HEADER = f"--- ПОСЛЕДНЯЯ ИСТОРИЯ ДИАЛОГА (до {DIALOGUES_LIMIT} сообщений) ---"
+
+_compaction_lock = threading.Lock()
+_compaction_totals = {
+    'renders': 0, 'compacted': 0, 'tokens_full': 0, 'tokens': 0, 'summarized_turns': 0,
+    'dropped_turns': 0, 'dropped_tables': 0, 'summary_truncated': 0, 'over_budget': 0,
+}
+
+
+def estimate_tokens(text):
+    """Оценка числа токенов по длине текста."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Обрезает текст до max_tokens (по оценке) с многоточием в конце."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(0, max_tokens * CHARS_PER_TOKEN - 2)].rstrip() + " …"
+
+
+def fit_lines(header, lines, max_tokens=None, total=None):
+    """
+    Заголовок и строки, которые помещаются в max_tokens; остальные — одной строкой "… еще N".
+    total — сколько всего записей, если lines уже ограничены заранее.
+    """
+    total = len(lines) if total is None else total
+    if max_tokens is None:
+        return "\n".join([header] + lines)
+    kept = [header]
+    used = estimate_tokens(header)
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost > max_tokens and len(kept) > 1:
+            break
+        kept.append(line)
+        used += cost
+    if len(kept) - 1 < total:
+        kept.append(f"- … еще {total - len(kept) + 1}")
+    return "\n".join(kept)
+
+
+def _timestamp(value):
+    return value.timestamp() if isinstance(value, datetime) else 0
+
+
+def compaction_stats():
+    """Накопительные счетчики сжатия контекста с запуска процесса."""
+    with _compaction_lock:
+        return dict(_compaction_totals)
+
+
+def context_default_serializer(obj):
+    """Сериализатор для JSON, обрабатывающий datetime."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Тип {type(obj)} не сериализуется в JSON")
+
+
+def format_user_profile(rows, summary_max_tokens=None):
+    if not rows: return ""
+    profile = rows[0]
+    lines = [f"--- КАРТОЧКА КЛИЕНТА ---"]
+    if profile.get('first_name') or profile.get('last_name'):
+        lines.append(f"Имя: {profile.get('first_name', '')} {profile.get('last_name', '')}".strip())
+    # Добавлены новые поля из VK
+    if profile.get('screen_name'):
+        lines.append(f"Профиль VK: https://vk.com/{profile['screen_name']}")
+    if profile.get('city'):
+        lines.append(f"Город: {profile['city']}")
+    if profile.get('birth_day') and profile.get('birth_month'):
+        birth_day = profile['birth_day']
+        birth_month = profile['birth_month']
+        month_name = RUSSIAN_MONTHS.get(birth_month, str(birth_month))
+        lines.append(f"Дата рождения: {birth_day} {month_name}")
+        logging.info(f"Добавлена дата рождения в карточку: {birth_day} {month_name}")
+    else:
+        logging.info(f"Дата рождения отсутствует: birth_day={profile.get('birth_day')}, birth_month={profile.get('birth_month')}")
+
+    if profile.get('lead_qualification'):
+        lines.append(f"Квалификация лида: {profile['lead_qualification']}")
+    if profile.get('funnel_stage'):
+        lines.append(f"Этап воронки: {profile['funnel_stage']}")
+    if profile.get('client_level'):
+        lines.append(f"Уровень клиента: {', '.join(profile['client_level'])}")
+    if profile.get('learning_goals'):
+        lines.append(f"Цели обучения: {', '.join(profile['learning_goals'])}")
+    if profile.get('client_pains'):
+        lines.append(f"Боли клиента: {', '.join(profile['client_pains'])}")
+    if profile.get('dialogue_summary'):
+        summary = profile['dialogue_summary']
+        if summary_max_tokens is not None:
+            summary = truncate_to_tokens(summary, summary_max_tokens)
+        lines.append(f"\nКраткое саммари диалога:\n{summary}")
+    return "\n".join(lines)
+
+
+def format_client_purchases(rows, max_tokens=None):
+    if not rows: return ""
+    if max_tokens is not None:
+        # В бюджет попадают последние покупки
+        rows = sorted(rows, key=lambda row: _timestamp(row.get('purchase_date')), reverse=True)
+    lines = []
+    for row in rows:
+        purchase_date = row.get('purchase_date').strftime('%Y-%m-%d') if row.get('purchase_date') else 'неизвестно'
+        lines.append(f"- Продукт: {row.get('product_name')}, Дата: {purchase_date}")
+    return fit_lines("--- ПОДТВЕРЖДЕННЫЕ ПОКУПКИ (из платежной системы) ---", lines, max_tokens)
+
+
+def format_purchased_products(rows, max_tokens=None):
+    if not rows: return ""
+    lines = [f"- {row.get('product_name')}" for row in rows]
+    return fit_lines("--- УПОМЯНУТЫЕ ПОКУПКИ (со слов клиента) ---", lines, max_tokens)
+
+
+def format_dialogue_turn(row, max_tokens=None):
+    role = ROLE_NAMES.get(row.get('role', 'unknown'), 'Неизвестно')
+    clean_message = strip_timestamp(row.get('message', ''))
+    if max_tokens is not None:
+        clean_message = truncate_to_tokens(clean_message, max_tokens)
+    return f"{role}: {clean_message}"
+
+
+def format_dialogues(rows, summarized=0, dropped=0, max_turn_tokens=None):
+    """
+    История диалога (rows — от новых к старым).
+
+    Args:
+        summarized (int): Сколько ранних реплик убрано, потому что они покрыты саммари.
+        dropped (int): Сколько ранних реплик не поместилось в бюджет.
+    """
+    if not rows: return ""
+    lines = [DIALOGUES_HEADER]
+    if dropped:
+        lines.append(f"(еще {dropped} более ранних сообщений не поместились в контекст)")
+    if summarized:
+        lines.append(f"(ранние сообщения: {summarized} — их суть в кратком саммари диалога выше)")
+    for row in reversed(rows):
+        lines.append(format_dialogue_turn(row, max_turn_tokens))
+    return "\n".join(lines)
+
+
+def format_active_reminders(rows):
+    """Форматтер для активных напоминаний агента-коммуникатора."""
+    if not rows:
+        return "--- АКТИВНЫЕ НАПОМИНАНИЯ ---\nНет активных напоминаний"
+
+    lines = ["--- АКТИВНЫЕ НАПОМИНАНИЯ ---"]
+    for reminder in rows:
+        reminder_time = reminder.get('reminder_datetime', 'неизвестно')
+        reminder_context = reminder.get('reminder_context_summary', 'без описания')
+
+        # Форматируем время для удобочитаемости
+        if reminder_time != 'неизвестно':
+            try:
+                if hasattr(reminder_time, 'strftime'):
+                    time_str = reminder_time.strftime('%Y-%m-%d %H:%M')
+                else:
+                    time_str = str(reminder_time)
+            except:
+                time_str = str(reminder_time)
+        else:
+            time_str = 'неизвестно'
+
+        lines.append(f"📅 {time_str}: {reminder_context}")
+
+    return "\n".join(lines)
+
+
+def _newest_first(rows):
+    """Строки по убыванию первой найденной колонки времени; без такой колонки — как есть."""
+    for column in ('created_at', 'updated_at', 'last_updated'):
+        if all(isinstance(row.get(column), datetime) for row in rows):
+            return sorted(rows, key=lambda row: _timestamp(row[column]), reverse=True)
+    return rows
+
+
+def format_generic(rows, table_name, max_tokens=None):
+    """
+    Выгрузка строк таблицы в JSON. С max_tokens — свернутая: без пустых и служебных
+    колонок, не больше MAX_GENERIC_ROWS последних записей в пределах бюджета.
+    """
+    if not rows: return ""
+    if max_tokens is None:
+        lines = [f'--- ДАННЫЕ ИЗ ТАБЛИЦЫ "{table_name}" ---']
+        for i, row in enumerate(rows):
+            row_str = json.dumps(row, ensure_ascii=False, indent=None, default=context_default_serializer)
+            lines.append(f"- Запись {i+1}: {row_str}")
+        return "\n".join(lines)
+
+    lines = []
+    for row in _newest_first(rows)[:MAX_GENERIC_ROWS]:
+        compact = {
+            column: value for column, value in row.items()
+            if column not in GENERIC_SKIP_COLUMNS and value not in (None, "", [], {})
+        }
+        row_str = json.dumps(compact, ensure_ascii=False, separators=(",", ":"), default=context_default_serializer)
+        lines.append(truncate_to_tokens(f"- {row_str}", max_tokens // 2))
+    return fit_lines(f'--- ДАННЫЕ ИЗ ТАБЛИЦЫ "{table_name}" (последние записи) ---', lines, max_tokens, total=len(rows))
+
+
+class ClientContext:
+    """
+    Данные клиента, собранные context builder'ом: профиль, покупки, напоминания и диалог.
+    Строки таблиц хранятся как есть; текст для промпта строится при первом обращении к render().
+    """
+
+    __slots__ = (
+        'conv_id', 'profile', 'reminders', 'client_purchases', 'purchased_products',
+        'dialogues', 'other_tables', 'system_notice', 'compaction', '_rendered'
+    )
+
+    def __init__(self, conv_id):
+        self.conv_id = conv_id
+        self.profile = None          # Строка user_profiles (dict) или None
+        self.reminders = None        # Активные напоминания; None — таблицы reminders нет
+        self.client_purchases = []   # Подтвержденные покупки
+        self.purchased_products = [] # Покупки со слов клиента
+        self.dialogues = []          # Последние сообщения, от новых к старым
+        self.other_tables = []       # [(имя_таблицы, строки)] для остальных таблиц с conv_id
+        self.system_notice = None    # Уведомление, которое ставится перед контекстом (напоминание)
+        self.compaction = None       # Что сделало сжатие при последней отрисовке render()
+        self._rendered = None
+
+    def add_table(self, table_name, rows):
+        """Раскладывает строки таблицы по полям контекста."""
+        if table_name == 'user_profiles':
+            self.profile = rows[0] if rows else None
+        elif table_name == 'reminders':
+            self.reminders = rows
+        elif table_name == 'client_purchases':
+            self.client_purchases = rows
+        elif table_name == 'purchased_products':
+            self.purchased_products = rows
+        elif table_name == 'dialogues':
+            self.dialogues = rows
+        elif rows:
+            self.other_tables.append((table_name, rows))
+        self._rendered = None
+
+    def set_system_notice(self, notice):
+        """Добавляет системное уведомление перед контекстом (например, о сработавшем напоминании)."""
+        self.system_notice = notice
+        self._rendered = None
+
+    @property
+    def birthday(self):
+        """(birth_day, birth_month) из профиля или (None, None)."""
+        if self.profile and self.profile.get('birth_day') and self.profile.get('birth_month'):
+            return int(self.profile['birth_day']), int(self.profile['birth_month'])
+        return None, None
+
+    @property
+    def first_name(self):
+        return self.profile.get('first_name') if self.profile else None
+
+    @property
+    def last_name(self):
+        return self.profile.get('last_name') if self.profile else None
+
+    def render(self, token_budget=None):
+        """
+        Отрисовывает контекст в текст для промпта. Результат кешируется.
+
+        Порядок блоков прежний: напоминания, карточка клиента, покупки, диалог,
+        затем остальные таблицы.
+
+        Args:
+            token_budget (int): Потолок в токенах вместо CONTEXT_TOKEN_BUDGET (без кеша);
+                0 — полный контекст без сжатия.
+        """
+        if token_budget is None and self._rendered is not None:
+            return self._rendered
+
+        budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+        text = self._render_compact(budget) if budget else self._render_full()
+        if token_budget is None:
+            self._rendered = text
+        return text
+
+    def _render_full(self):
+        blocks = []
+        if self.system_notice:
+            blocks.append(self.system_notice)
+        # Блок напоминаний выводится всегда, даже если активных напоминаний нет
+        if self.reminders is not None:
+            blocks.append(format_active_reminders(self.reminders))
+        if self.profile:
+            blocks.append(format_user_profile([self.profile]))
+        blocks.append(format_client_purchases(self.client_purchases))
+        blocks.append(format_purchased_products(self.purchased_products))
+        blocks.append(format_dialogues(self.dialogues))
+        for table_name, rows in self.other_tables:
+            blocks.append(format_generic(rows, table_name))
+        return "\n\n".join(block for block in blocks if block)
+
+    def _summary_covers(self, row):
+        """Реплика уже учтена в саммари профиля: (created_at, id) не позже (summary_watermark, summary_watermark_id)."""
+        watermark = self.profile.get('summary_watermark') if self.profile and self.profile.get('dialogue_summary') else None
+        created_at = row.get('created_at')
+        if watermark is None or created_at is None or created_at > watermark:
+            return False
+        if created_at < watermark:
+            return True
+        # Тот же created_at: решает id (водяной знак без id таких реплик не покрывает)
+        watermark_id = self.profile.get('summary_watermark_id')
+        return watermark_id is not None and row.get('id') is not None and row['id'] <= watermark_id
+
+    def _render_compact(self, budget):
+        """Отрисовка в пределах BLOCK_TOKEN_BUDGETS и общего потолка budget (см. описание модуля)."""
+        fixed = []
+        if self.system_notice:
+            fixed.append(self.system_notice)
+        if self.reminders is not None:
+            fixed.append(format_active_reminders(self.reminders))
+        purchases = [
+            format_client_purchases(self.client_purchases, BLOCK_TOKEN_BUDGETS['client_purchases']),
+            format_purchased_products(self.purchased_products, BLOCK_TOKEN_BUDGETS['purchased_products']),
+        ]
+        tables = [format_generic(rows, name, BLOCK_TOKEN_BUDGETS['other_tables']) for name, rows in self.other_tables]
+
+        # Реплики от старых к новым; keep_from — индекс самой старой оставленной.
+        # Стоимость реплики без обрезки нужна только для оценки полного контекста
+        turns = list(reversed(self.dialogues))
+        costs, full_costs = [], []
+        for row in turns:
+            turn = format_dialogue_turn(row)
+            full_costs.append(estimate_tokens(turn) + 1)
+            if full_costs[-1] - 1 > MAX_TURN_TOKENS:
+                turn = format_dialogue_turn(row, MAX_TURN_TOKENS)
+            costs.append(estimate_tokens(turn) + 1)
+        min_keep_from = max(0, len(turns) - MIN_DIALOGUE_TURNS)
+        keep_from = 0
+        dialogue_tokens = sum(costs)
+        while (keep_from < min_keep_from and dialogue_tokens > BLOCK_TOKEN_BUDGETS['dialogues']
+               and self._summary_covers(turns[keep_from])):
+            dialogue_tokens -= costs[keep_from]
+            keep_from += 1
+        summarized = keep_from
+
+        def profile_block(summary_max_tokens):
+            return format_user_profile([self.profile], summary_max_tokens) if self.profile else ""
+
+        summary_max_tokens = BLOCK_TOKEN_BUDGETS['profile']
+        profile = profile_block(summary_max_tokens)
+        base_tokens = sum(estimate_tokens(block) + 2 for block in fixed + purchases + [profile] if block)
+        tokens_full = self._estimate_full_tokens(fixed, profile, full_costs)
+
+        def total_tokens():
+            return base_tokens + dialogue_tokens + sum(estimate_tokens(block) + 2 for block in tables)
+
+        # Потолок: остальные таблицы, затем старые реплики, затем саммари
+        dropped_tables = 0
+        while tables and total_tokens() > budget:
+            tables.pop()
+            dropped_tables += 1
+        while keep_from < min_keep_from and total_tokens() > budget:
+            dialogue_tokens -= costs[keep_from]
+            keep_from += 1
+        summary_truncated = False
+        overflow = total_tokens() - budget
+        if overflow > 0 and self.profile and self.profile.get('dialogue_summary'):
+            summary_max_tokens = max(MIN_SUMMARY_TOKENS, estimate_tokens(self.profile['dialogue_summary']) - overflow)
+            profile = profile_block(summary_max_tokens)
+            summary_truncated = True
+
+        kept_rows = list(reversed(turns[keep_from:]))
+        blocks = fixed + [profile] + purchases + [
+            format_dialogues(kept_rows, summarized, keep_from - summarized, MAX_TURN_TOKENS)
+        ] + tables
+        text = "\n\n".join(block for block in blocks if block)
+
+        tokens = estimate_tokens(text)
+        self.compaction = {
+            'tokens_full': tokens_full, 'tokens': tokens, 'summarized_turns': summarized,
+            'dropped_turns': keep_from - summarized, 'dropped_tables': dropped_tables,
+            'summary_truncated': summary_truncated, 'over_budget': tokens > budget,
+        }
+        if tokens > budget:
+            logging.warning(f"Контекст клиента {self.conv_id}: {tokens} токенов после сжатия, потолок {budget}")
+        return text
+
+    def _estimate_full_tokens(self, fixed, profile, full_costs):
+        """
+        Оценка размера полного контекста (render(token_budget=0)) по уже посчитанным блокам,
+        без второй отрисовки: саммари без обрезки, все реплики целиком, в остальных
+        таблицах — все строки по средней стоимости первых MAX_GENERIC_ROWS.
+        """
+        tokens = sum(estimate_tokens(block) + 2 for block in fixed if block)
+        if profile:
+            summary = self.profile.get('dialogue_summary') or ""
+            tokens += estimate_tokens(profile) + 2 + max(0, estimate_tokens(summary) - BLOCK_TOKEN_BUDGETS['profile'])
+        tokens += sum(
+            estimate_tokens(block) + 2
+            for block in (format_client_purchases(self.client_purchases), format_purchased_products(self.purchased_products))
+            if block
+        )
+        if full_costs:
+            tokens += estimate_tokens(DIALOGUES_HEADER) + 2 + sum(full_costs)
+        for table_name, rows in self.other_tables:
+            sample = rows[:MAX_GENERIC_ROWS]
+            tokens += estimate_tokens(format_generic(sample, table_name)) * len(rows) // len(sample) + 2
+        return tokens
+
+    def record_compaction(self):
+        """Добавляет итоги сжатия последней отрисовки в счетчики compaction_stats() — один раз на промпт."""
+        if not self.compaction:
+            return
+        stats = self.compaction
+        with _compaction_lock:
+            _compaction_totals['renders'] += 1
+            _compaction_totals['compacted'] += 1 if stats['tokens'] < stats['tokens_full'] else 0
+            _compaction_totals['tokens_full'] += stats['tokens_full']
+            _compaction_totals['tokens'] += stats['tokens']
+            _compaction_totals['summarized_turns'] += stats['summarized_turns']
+            _compaction_totals['dropped_turns'] += stats['dropped_turns']
+            _compaction_totals['dropped_tables'] += stats['dropped_tables']
+            _compaction_totals['summary_truncated'] += 1 if stats['summary_truncated'] else 0
+            _compaction_totals['over_budget'] += 1 if stats['over_budget'] else 0
+
+    def __str__(self):
+        return self.render()
@@ -54,6 +54,9 @@ import vertexai
 from vertexai.generative_models import GenerativeModel
 from tqdm import tqdm
 
+from dialogue_retention import get_full_history
+import llm_ledger
+
 # --- НАСТРОЙКИ ---
 LOG_FILE_NAME = "create_missing_profiles_errors.log"
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "hardy-technique-470816-f2")
@@ -230,12 +233,8 @@ def get_vk_user_info(conv_id: int, token: str) -> Optional[Dict]:
         return None
 
 def get_dialogue_history(conn, conv_id: int) -> List[Dict]:
-    with conn.cursor(cursor_factory=DictCursor) as cur:
-        cur.execute(
-            "SELECT role, message FROM dialogues WHERE conv_id = %s ORDER BY created_at ASC",
-            (conv_id,)
-        )
-        return [dict(row) for row in cur.fetchall()]
+    # Полная история: рабочая таблица хранит только последние сообщения, остальное — в архиве
+    return get_full_history(conn, conv_id, columns="role, message")
 
 def preprocess_dialogue(dialogue_history: List[Dict]) -> str:
     if not dialogue_history:
@@ -252,7 +251,7 @@ def call_gemini_with_retry(prompt, credentials):
     model = GenerativeModel(MODEL_NAME)
     for attempt in range(API_RETRY_COUNT):
         try:
-            response = model.generate_content(prompt)
+            response = llm_ledger.generate(model, prompt, "profile_summary", attempt=attempt)
             cleaned_response = response.text.strip().lstrip("```json").rstrip("```").strip()
             return json.loads(cleaned_response)
         except Exception as e:
@@ -267,7 +266,7 @@ def call_gemini_for_text_with_retry(prompt, credentials):
     model = GenerativeModel(MODEL_NAME)
     for attempt in range(API_RETRY_COUNT):
         try:
-            response = model.generate_content(prompt)
+            response = llm_ledger.generate(model, prompt, "profile_summary_merge", attempt=attempt)
             return response.text.strip()
         except Exception as e:
             logging.warning(f"Ошибка слияния саммари (попытка {attempt + 1}/{API_RETRY_COUNT}): {e}")
@@ -459,6 +458,9 @@ def main():
             print(f"  Подробности об ошибках смотрите в файле: {LOG_FILE_NAME}")
         print("="*30)
 
+        # Вызовы Gemini этого запуска — в llm_call_stats вместе с ботом
+        llm_ledger.flush_aggregates(include_current=True)
+
     except Exception as e:
         logger.critical(f"Произошла глобальная ошибка в main: {e}", exc_info=True)
     finally:
@@ -0,0 +1,887 @@
+# =======================================================================================
+#               ВЕРСИОНИРОВАННЫЕ МИГРАЦИИ СХЕМЫ БД И ПРОВЕРКА ИНДЕКСОВ
+# =======================================================================================
+#
+# ЧТО ДЕЛАЕТ ЭТОТ СКРИПТ:
+#
+# 1. MIGRATE: Применяет по порядку миграции из списка MIGRATIONS, которые еще не
+#    записаны в таблицу schema_migrations. Индексы создаются через
+#    CREATE INDEX CONCURRENTLY, чтобы не блокировать запись в рабочие таблицы.
+#
+#    Запускается при каждом деплое перед gunicorn (Procfile); параллельные запуски
+#    нескольких экземпляров выполняются по очереди под advisory lock.
+#
+# 2. STATUS: Показывает, какие миграции применены, а какие ожидают.
+#
+# 3. VERIFY: Проверяет, что все индексы горячих запросов существуют и валидны
+#    (CONCURRENTLY при ошибке оставляет индекс в состоянии INVALID).
+#
+# 4. EXPLAIN: Создает отдельную схему с синтетическими данными, применяет к ней те же
+#    миграции и сохраняет планы EXPLAIN (ANALYZE, BUFFERS) для каждого горячего запроса.
+#    Сравнивая файлы планов между запусками, легко заметить регрессию (Seq Scan вместо Index Scan).
+#
+# КАК ЗАПУСКАТЬ:
+#    python db_migrations.py migrate
+#    python db_migrations.py status
+#    python db_migrations.py verify
+#    python db_migrations.py explain --users 5000 --messages-per-user 40
+#
+# Строка подключения берется из DATABASE_URL (или POSTGRES_DSN).
+#
+# =======================================================================================
+
+import os
+import sys
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- НАСТРОЙКИ ---
+MIGRATIONS_TABLE = "schema_migrations"
+MIGRATIONS_LOCK_KEY = 48116621001  # Advisory lock: миграции применяет один процесс за раз
+SYNTHETIC_SCHEMA = "migration_bench"
+EXPLAIN_OUTPUT_DIR = Path(__file__).parent / "explain_plans"
+
+# --- МИГРАЦИИ ---
+# Каждая миграция: версия, имя, список SQL-выражений и признак транзакционности.
+# Нетранзакционные миграции (CREATE INDEX CONCURRENTLY) выполняются в autocommit,
+# поэтому каждое выражение в них должно быть идемпотентным (IF NOT EXISTS).
+MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "reminders_lease_columns",
+        "transactional": True,
+        "statements": [
+            """
+            ALTER TABLE reminders
+                ADD COLUMN IF NOT EXISTS lease_owner TEXT,
+                ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ
+            """,
+        ],
+    },
+    {
+        "version": 2,
+        "name": "reminders_minhash_columns",
+        "transactional": True,
+        "statements": [
+            """
+            ALTER TABLE reminders
+                ADD COLUMN IF NOT EXISTS minhash_signature BIGINT[],
+                ADD COLUMN IF NOT EXISTS lsh_bands BIGINT[]
+            """,
+        ],
+    },
+    {
+        # get_last_n_messages, analyze_dialogue_for_reminders, summary_updater:
+        # WHERE conv_id = ? ORDER BY created_at DESC LIMIT N.
+        # Индекс также обслуживает DISTINCT conv_id в анти-join get_orphan_conv_ids (Index Only Scan).
+        "version": 3,
+        "name": "dialogues_conv_id_created_at",
+        "transactional": False,
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_dialogues_conv_id_created_at
+            ON dialogues (conv_id, created_at DESC)
+            """,
+        ],
+    },
+    {
+        # check_and_activate_reminders / claim_due_reminders: status = 'active' AND reminder_datetime <= NOW().
+        # Частичный индекс содержит только активные напоминания и не растет вместе с историей 'done'.
+        "version": 4,
+        "name": "reminders_active_partial",
+        "transactional": False,
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reminders_active_due
+            ON reminders (reminder_datetime)
+            WHERE status = 'active'
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reminders_active_conv_id
+            ON reminders (conv_id)
+            WHERE status = 'active'
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reminders_lsh_bands
+            ON reminders USING GIN (lsh_bands)
+            WHERE status = 'active'
+            """,
+        ],
+    },
+    {
+        # update_conv_id_by_email, ClientCardAnalyzer._find_purchases_by_email: WHERE lower(email) = ?
+        "version": 5,
+        "name": "client_purchases_lower_email",
+        "transactional": False,
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_client_purchases_lower_email
+            ON client_purchases (lower(email))
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_client_purchases_conv_id
+            ON client_purchases (conv_id)
+            """,
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_purchased_products_conv_id
+            ON purchased_products (conv_id)
+            """,
+        ],
+    },
+    {
+        # search_people: фильтрация по квалификации лида. GIN обслуживает операторы @> и &&;
+        # выражение `%s = ANY(lead_qualification)` индекс не использует — план EXPLAIN это показывает.
+        "version": 6,
+        "name": "user_profiles_lead_qualification_gin",
+        "transactional": False,
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_profiles_lead_qualification
+            ON user_profiles USING GIN (lead_qualification)
+            """,
+        ],
+    },
+    {
+        # summary_updater: created_at последнего сообщения, уже учтенного в dialogue_summary.
+        # Новые сообщения выбираются через idx_dialogues_conv_id_created_at (created_at >= watermark).
+        "version": 7,
+        "name": "user_profiles_summary_watermark",
+        "transactional": True,
+        "statements": [
+            """
+            ALTER TABLE user_profiles
+                ADD COLUMN IF NOT EXISTS summary_watermark TIMESTAMPTZ
+            """,
+        ],
+    },
+    {
+        # dialogue_retention: архив старых сообщений, секционированный по месяцам.
+        # Месячные секции создает задача переноса; DEFAULT-секция — страховка.
+        "version": 8,
+        "name": "dialogues_archive_partitioned",
+        "transactional": True,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS dialogues_archive (
+                conv_id BIGINT NOT NULL,
+                role TEXT,
+                message TEXT,
+                client_info TEXT,
+                created_at TIMESTAMPTZ NOT NULL,
+                archived_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            ) PARTITION BY RANGE (created_at)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS dialogues_archive_default
+            PARTITION OF dialogues_archive DEFAULT
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_dialogues_archive_conv_id_created_at
+            ON dialogues_archive (conv_id, created_at)
+            """,
+        ],
+    },
+    {
+        # resummarize_profiles: контрольные точки пакетного пересоздания саммари.
+        # Повторный запуск с тем же run_name пропускает профили со статусом done.
+        "version": 9,
+        "name": "resummarize_checkpoints",
+        "transactional": True,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS resummarize_checkpoints (
+                run_name TEXT NOT NULL,
+                conv_id BIGINT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                processed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (run_name, conv_id)
+            )
+            """,
+        ],
+    },
+    {
+        # strategy_agent: манифест пакетного запуска auto_strategy_agent.
+        # Повторный запуск с тем же run_name пропускает клиентов со статусом done/fallback.
+        "version": 10,
+        "name": "strategy_run_manifest",
+        "transactional": True,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS strategy_run_manifest (
+                run_name TEXT NOT NULL,
+                conv_id BIGINT NOT NULL,
+                status TEXT NOT NULL,
+                reminder_created BOOLEAN NOT NULL DEFAULT FALSE,
+                error TEXT,
+                processed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (run_name, conv_id)
+            )
+            """,
+        ],
+    },
+    {
+        # strategy_agent/search_people: материализованное множество покупателей премиум-наборов.
+        # Название продукта нормализуется один раз при записи (генерируемая колонка),
+        # триггеры дополняют premium_buyers при вставке и привязке покупок к conv_id,
+        # поэтому поиск исключает покупателей поиском по первичному ключу, а не LIKE-сканами.
+        # Множество только пополняется: после удаления покупок или смены фраз его
+        # пересобирают вручную (TRUNCATE premium_buyers и повтор INSERT ... SELECT ниже).
+        "version": 11,
+        "name": "premium_buyers_materialized",
+        "transactional": True,
+        "statements": [
+            r"""
+            ALTER TABLE client_purchases ADD COLUMN IF NOT EXISTS product_name_normalized TEXT
+                GENERATED ALWAYS AS (btrim(regexp_replace(replace(lower(product_name), 'ё', 'е'), '\s+', ' ', 'g'))) STORED
+            """,
+            r"""
+            ALTER TABLE purchased_products ADD COLUMN IF NOT EXISTS product_name_normalized TEXT
+                GENERATED ALWAYS AS (btrim(regexp_replace(replace(lower(product_name), 'ё', 'е'), '\s+', ' ', 'g'))) STORED
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS premium_buyers (
+                conv_id BIGINT PRIMARY KEY,
+                product_name TEXT,
+                source TEXT NOT NULL,
+                detected_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+            """,
+            """
+            CREATE OR REPLACE FUNCTION is_premium_product(product_name_normalized TEXT) RETURNS BOOLEAN
+            LANGUAGE sql IMMUTABLE AS $$
+                SELECT product_name_normalized LIKE '%все включено%'
+                    OR product_name_normalized LIKE '%6 шагов%'
+            $$
+            """,
+            """
+            CREATE OR REPLACE FUNCTION mark_premium_buyer() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF NEW.conv_id IS NOT NULL AND is_premium_product(NEW.product_name_normalized) THEN
+                    INSERT INTO premium_buyers (conv_id, product_name, source)
+                    VALUES (NEW.conv_id, NEW.product_name, TG_TABLE_NAME)
+                    ON CONFLICT (conv_id) DO NOTHING;
+                END IF;
+                RETURN NULL;
+            END
+            $$
+            """,
+            "DROP TRIGGER IF EXISTS trg_client_purchases_premium_buyers ON client_purchases",
+            """
+            CREATE TRIGGER trg_client_purchases_premium_buyers
+                AFTER INSERT OR UPDATE OF conv_id, product_name ON client_purchases
+                FOR EACH ROW EXECUTE FUNCTION mark_premium_buyer()
+            """,
+            "DROP TRIGGER IF EXISTS trg_purchased_products_premium_buyers ON purchased_products",
+            """
+            CREATE TRIGGER trg_purchased_products_premium_buyers
+                AFTER INSERT OR UPDATE OF conv_id, product_name ON purchased_products
+                FOR EACH ROW EXECUTE FUNCTION mark_premium_buyer()
+            """,
+            """
+            INSERT INTO premium_buyers (conv_id, product_name, source)
+            SELECT DISTINCT ON (conv_id) conv_id, product_name, source
+            FROM (
+                SELECT conv_id, product_name, 'purchased_products' AS source
+                FROM purchased_products
+                WHERE conv_id IS NOT NULL AND is_premium_product(product_name_normalized)
+                UNION ALL
+                SELECT conv_id, product_name, 'client_purchases' AS source
+                FROM client_purchases
+                WHERE conv_id IS NOT NULL AND is_premium_product(product_name_normalized)
+            ) premium
+            ORDER BY conv_id
+            ON CONFLICT (conv_id) DO NOTHING
+            """,
+            # Баллы приоритета поиска (те же, что WARMTH_SCORES и FUNNEL_SCORES в search_people.py).
+            # IMMUTABLE-функции позволяют построить по их сумме индекс (миграция 12).
+            """
+            CREATE OR REPLACE FUNCTION prospect_warmth_score(lead_qualification TEXT[]) RETURNS INTEGER
+            LANGUAGE sql IMMUTABLE AS $$
+                SELECT CASE
+                    WHEN 'горячий' = ANY(lead_qualification) THEN 4
+                    WHEN 'клиент' = ANY(lead_qualification) THEN 3
+                    WHEN 'тёплый' = ANY(lead_qualification) THEN 2
+                    ELSE 1
+                END
+            $$
+            """,
+            """
+            CREATE OR REPLACE FUNCTION prospect_funnel_score(funnel_stage TEXT) RETURNS INTEGER
+            LANGUAGE sql IMMUTABLE AS $$
+                SELECT CASE funnel_stage
+                    WHEN 'решение принято (ожидаем оплату)' THEN 6
+                    WHEN 'клиент думает' THEN 5
+                    WHEN 'у клиента есть возражения' THEN 4
+                    WHEN 'сделано предложение по продуктам' THEN 3
+                    WHEN 'сделано новое предложение' THEN 2
+                    WHEN 'предложение по продуктам ещё не сделано, покупка совершена' THEN 1
+                    ELSE 0
+                END
+            $$
+            """,
+        ],
+    },
+    {
+        # search_people: топ-K по приоритету читается из индекса по убыванию суммы баллов,
+        # анти-join'ы с premium_buyers и активными напоминаниями — точечные поиски по индексам.
+        "version": 12,
+        "name": "user_profiles_prospect_priority",
+        "transactional": False,
+        "statements": [
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_profiles_prospect_priority
+            ON user_profiles ((prospect_warmth_score(lead_qualification) + prospect_funnel_score(funnel_stage)) DESC)
+            WHERE conv_id IS NOT NULL
+            """,
+        ],
+    },
+    {
+        # llm_ledger: агрегаты вызовов LLM за 5-минутные интервалы по экземплярам,
+        # точкам вызова и моделям. Перцентили считаются в процессе, таблица хранит итог.
+        "version": 13,
+        "name": "llm_call_stats",
+        "transactional": True,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS llm_call_stats (
+                bucket_start TIMESTAMPTZ NOT NULL,
+                instance TEXT NOT NULL,
+                call_site TEXT NOT NULL,
+                model TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                errors INTEGER NOT NULL,
+                retries INTEGER NOT NULL,
+                prompt_chars_p50 INTEGER,
+                prompt_chars_p95 INTEGER,
+                prompt_chars_max INTEGER,
+                prompt_tokens BIGINT NOT NULL,
+                output_tokens BIGINT NOT NULL,
+                latency_ms_p50 REAL,
+                latency_ms_p95 REAL,
+                latency_ms_max REAL,
+                PRIMARY KEY (bucket_start, instance, call_site, model)
+            )
+            """,
+        ],
+    },
+    {
+        # dialogue_retention: id сообщения из dialogues переносится в архив вместе с остальными
+        # колонками (строки, перенесенные раньше, остаются с NULL).
+        "version": 14,
+        "name": "dialogues_archive_id",
+        "transactional": True,
+        "statements": [
+            """
+            ALTER TABLE dialogues_archive
+                ADD COLUMN IF NOT EXISTS id BIGINT
+            """,
+        ],
+    },
+    {
+        # summary_updater: водяной знак саммари — пара (created_at, id) последнего учтенного
+        # сообщения; id различает сообщения с одинаковым created_at.
+        "version": 15,
+        "name": "user_profiles_summary_watermark_id",
+        "transactional": True,
+        "statements": [
+            """
+            ALTER TABLE user_profiles
+                ADD COLUMN IF NOT EXISTS summary_watermark_id BIGINT
+            """,
+        ],
+    },
+]
+
+# Индексы, которые проверяет команда verify: имя индекса -> таблица
+EXPECTED_INDEXES = {
+    "idx_dialogues_conv_id_created_at": "dialogues",
+    "idx_reminders_active_due": "reminders",
+    "idx_reminders_active_conv_id": "reminders",
+    "idx_reminders_lsh_bands": "reminders",
+    "idx_client_purchases_lower_email": "client_purchases",
+    "idx_client_purchases_conv_id": "client_purchases",
+    "idx_purchased_products_conv_id": "purchased_products",
+    "idx_user_profiles_lead_qualification": "user_profiles",
+    "idx_dialogues_archive_conv_id_created_at": "dialogues_archive",
+    "idx_user_profiles_prospect_priority": "user_profiles",
+}
+
+# Горячие запросы для EXPLAIN: имя -> (SQL, параметры для синтетических данных)
+HOT_QUERIES = {
+    "dialogues_last_messages": (
+        """
+        SELECT role, message, created_at
+        FROM dialogues
+        WHERE conv_id = %s
+        ORDER BY created_at DESC
+        LIMIT 10
+        """,
+        (42,),
+    ),
+    "dialogues_after_summary_watermark": (
+        """
+        SELECT * FROM dialogues
+        WHERE conv_id = %(conv_id)s
+          AND created_at >= %(watermark)s
+          AND (created_at > %(watermark)s OR id > COALESCE(%(watermark_id)s::bigint, 0))
+        ORDER BY created_at DESC, id DESC
+        LIMIT 15
+        """,
+        # Синтетические сообщения датируются от NOW() с шагом 7 минут: знак двухчасовой давности
+        # оставляет после себя часть истории клиента, как у саммари, отстающего на несколько реплик
+        {"conv_id": 42, "watermark": datetime.now(timezone.utc) - timedelta(hours=2), "watermark_id": 0},
+    ),
+    "reminders_due": (
+        """
+        SELECT id, conv_id, reminder_datetime
+        FROM reminders
+        WHERE status = 'active' AND reminder_datetime <= NOW()
+        ORDER BY reminder_datetime
+        LIMIT 200
+        """,
+        (),
+    ),
+    "reminders_active_for_conv": (
+        """
+        SELECT id, reminder_datetime, reminder_context_summary
+        FROM reminders
+        WHERE conv_id = %s AND status = 'active'
+        ORDER BY reminder_datetime
+        """,
+        (42,),
+    ),
+    "client_purchases_by_email": (
+        """
+        SELECT product_name, purchase_date, amount, email, conv_id
+        FROM client_purchases
+        WHERE lower(email) = lower(%s)
+        ORDER BY purchase_date DESC
+        """,
+        ("User42@example.com",),
+    ),
+    "lead_qualification_any": (
+        """
+        SELECT conv_id FROM user_profiles
+        WHERE %s = ANY(lead_qualification)
+        """,
+        ("горячий",),
+    ),
+    "lead_qualification_contains": (
+        """
+        SELECT conv_id FROM user_profiles
+        WHERE lead_qualification @> ARRAY[%s]::text[]
+        """,
+        ("горячий",),
+    ),
+    "full_history_with_archive": (
+        """
+        SELECT role, message, created_at FROM (
+            SELECT role, message, created_at FROM dialogues_archive WHERE conv_id = %s
+            UNION ALL
+            SELECT role, message, created_at FROM dialogues WHERE conv_id = %s
+        ) history
+        ORDER BY created_at
+        """,
+        (42, 42),
+    ),
+    "prospect_top_k": (
+        """
+        SELECT up.conv_id
+        FROM user_profiles up
+        WHERE up.conv_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM reminders r WHERE r.conv_id = up.conv_id AND r.status = 'active')
+          AND NOT EXISTS (SELECT 1 FROM premium_buyers pb WHERE pb.conv_id = up.conv_id)
+        ORDER BY prospect_warmth_score(up.lead_qualification) + prospect_funnel_score(up.funnel_stage) DESC
+        LIMIT 500
+        """,
+        (),
+    ),
+    "orphan_conv_ids": (
+        """
+        SELECT DISTINCT d.conv_id
+        FROM dialogues d
+        LEFT JOIN user_profiles up ON d.conv_id = up.conv_id
+        WHERE up.conv_id IS NULL
+        """,
+        (),
+    ),
+}
+
+# Минимальная схема таблиц для синтетического набора (только колонки, которые используют запросы)
+SYNTHETIC_TABLES = [
+    """
+    CREATE TABLE dialogues (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT NOT NULL,
+        role TEXT NOT NULL,
+        message TEXT,
+        client_info TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE user_profiles (
+        conv_id BIGINT PRIMARY KEY,
+        first_name TEXT,
+        last_name TEXT,
+        lead_qualification TEXT[],
+        funnel_stage TEXT,
+        dialogue_summary TEXT
+    )
+    """,
+    """
+    CREATE TABLE reminders (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT NOT NULL,
+        reminder_datetime TIMESTAMPTZ NOT NULL,
+        reminder_context_summary TEXT,
+        status TEXT NOT NULL,
+        client_timezone TEXT,
+        created_by_conv_id BIGINT,
+        cancellation_reason TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    )
+    """,
+    """
+    CREATE TABLE client_purchases (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT,
+        email TEXT,
+        product_name TEXT,
+        purchase_date TIMESTAMPTZ,
+        amount NUMERIC
+    )
+    """,
+    """
+    CREATE TABLE purchased_products (
+        id BIGSERIAL PRIMARY KEY,
+        conv_id BIGINT,
+        product_name TEXT
+    )
+    """,
+]
+
+
+def setup_logging():
+    """Настраивает логирование в консоль."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def get_db_connection():
+    """Устанавливает соединение с БД."""
+    dsn = os.environ.get("DATABASE_URL") or os.environ.get("POSTGRES_DSN")
+    if not dsn:
+        raise ConnectionError("Переменная окружения DATABASE_URL (или POSTGRES_DSN) не установлена!")
+    return psycopg2.connect(dsn)
+
+
+def ensure_migrations_table(conn):
+    """Создает таблицу учета примененных миграций, если ее нет."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """)
+    conn.commit()
+
+
+def get_applied_versions(conn):
+    """Возвращает множество версий уже примененных миграций."""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT version FROM {MIGRATIONS_TABLE}")
+        return {row[0] for row in cur.fetchall()}
+
+
+def apply_migration(conn, migration):
+    """
+    Применяет одну миграцию и записывает ее версию в schema_migrations.
+
+    Args:
+        conn: Соединение с БД.
+        migration (dict): Описание миграции из MIGRATIONS.
+    """
+    version, name = migration["version"], migration["name"]
+    logging.info(f"МИГРАЦИЯ {version:04d}_{name}: применяется...")
+
+    if migration["transactional"]:
+        with conn.cursor() as cur:
+            for statement in migration["statements"]:
+                cur.execute(statement)
+            cur.execute(
+                f"INSERT INTO {MIGRATIONS_TABLE} (version, name) VALUES (%s, %s)",
+                (version, name)
+            )
+        conn.commit()
+    else:
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                for statement in migration["statements"]:
+                    cur.execute(statement)
+                cur.execute(
+                    f"INSERT INTO {MIGRATIONS_TABLE} (version, name) VALUES (%s, %s)",
+                    (version, name)
+                )
+        finally:
+            conn.autocommit = False
+
+    logging.info(f"МИГРАЦИЯ {version:04d}_{name}: применена.")
+
+
+def get_pending_migrations(conn):
+    """
+    Возвращает еще не примененные миграции по возрастанию версии, ничего не создавая в БД.
+
+    Returns:
+        list: Описания миграций из MIGRATIONS.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (MIGRATIONS_TABLE,))
+        table_exists = cur.fetchone()[0] is not None
+    applied = get_applied_versions(conn) if table_exists else set()
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m["version"]) if m["version"] not in applied]
+
+
+def require_current_schema():
+    """
+    Проверяет при старте приложения, что все миграции применены.
+
+    Raises:
+        RuntimeError: Схема отстает от MIGRATIONS (не выполнен python db_migrations.py migrate).
+    """
+    conn = get_db_connection()
+    try:
+        pending = get_pending_migrations(conn)
+    finally:
+        conn.close()
+    if pending:
+        names = ", ".join(f"{m['version']:04d}_{m['name']}" for m in pending)
+        raise RuntimeError(f"Схема БД отстает: не применены миграции {names}. Выполните: python db_migrations.py migrate")
+
+
+def migrate(conn):
+    """
+    Применяет все еще не примененные миграции по возрастанию версии.
+    Сессионный advisory lock не дает двум экземплярам, стартующим одновременно,
+    применять одну и ту же миграцию параллельно.
+
+    Returns:
+        int: Количество примененных миграций.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+    conn.commit()
+    try:
+        ensure_migrations_table(conn)
+        pending = get_pending_migrations(conn)
+
+        if not pending:
+            logging.info("Все миграции уже применены.")
+            return 0
+
+        for migration in pending:
+            try:
+                apply_migration(conn, migration)
+            except Exception as e:
+                if not conn.autocommit:
+                    conn.rollback()
+                logging.error(f"МИГРАЦИЯ {migration['version']:04d}_{migration['name']}: ошибка: {e}")
+                raise
+        return len(pending)
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+        conn.commit()
+
+
+def print_status(conn):
+    """Выводит список миграций с отметкой о применении."""
+    ensure_migrations_table(conn)
+    applied = get_applied_versions(conn)
+    for migration in sorted(MIGRATIONS, key=lambda m: m["version"]):
+        mark = "применена" if migration["version"] in applied else "ОЖИДАЕТ"
+        print(f"{migration['version']:04d}_{migration['name']}: {mark}")
+
+
+def verify_indexes(conn):
+    """
+    Проверяет, что все ожидаемые индексы существуют и валидны.
+
+    Returns:
+        bool: True, если все индексы на месте.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname, t.relname, i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_class t ON t.oid = i.indrelid
+            WHERE c.relname = ANY(%s) AND pg_table_is_visible(c.oid)
+        """, (list(EXPECTED_INDEXES),))
+        found = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+    all_ok = True
+    for index_name, table_name in EXPECTED_INDEXES.items():
+        if index_name not in found:
+            print(f"ОТСУТСТВУЕТ: {index_name} ON {table_name}")
+            all_ok = False
+        elif not found[index_name][1]:
+            print(f"INVALID:     {index_name} ON {table_name} (пересоздайте: DROP INDEX CONCURRENTLY и migrate)")
+            all_ok = False
+        else:
+            print(f"OK:          {index_name} ON {table_name}")
+    return all_ok
+
+
+def create_synthetic_dataset(conn, users, messages_per_user):
+    """
+    Создает схему SYNTHETIC_SCHEMA с синтетическими данными и переключает на нее search_path.
+    Распределения грубо повторяют рабочую базу: много диалогов, мало активных напоминаний,
+    часть пользователей без профиля (для анти-join).
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {SYNTHETIC_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {SYNTHETIC_SCHEMA}")
+        cur.execute(f"SET search_path TO {SYNTHETIC_SCHEMA}")
+        for statement in SYNTHETIC_TABLES:
+            cur.execute(statement)
+
+        cur.execute("""
+            INSERT INTO dialogues (conv_id, role, message, created_at)
+            SELECT u, CASE WHEN m %% 2 = 0 THEN 'user' ELSE 'bot' END,
+                   'Синтетическое сообщение ' || m,
+                   NOW() - make_interval(mins => (%s - m) * 7 + u %% 60)
+            FROM generate_series(1, %s) AS u, generate_series(1, %s) AS m
+        """, (messages_per_user, users, messages_per_user))
+
+        # Каждый двадцатый пользователь — без профиля
+        cur.execute("""
+            INSERT INTO user_profiles (conv_id, first_name, lead_qualification, funnel_stage)
+            SELECT u, 'Имя' || u,
+                   ARRAY[(ARRAY['горячий', 'тёплый', 'холодный', 'клиент'])[1 + u %% 4]],
+                   (ARRAY['клиент думает', 'сделано предложение по продуктам', 'первичный контакт'])[1 + u %% 3]
+            FROM generate_series(1, %s) AS u
+            WHERE u %% 20 <> 0
+        """, (users,))
+
+        # Около 10% напоминаний активны, остальные — история
+        cur.execute("""
+            INSERT INTO reminders (conv_id, reminder_datetime, reminder_context_summary, status, client_timezone)
+            SELECT 1 + (r * 7919) %% %s,
+                   NOW() + make_interval(hours => (r %% 240) - 120),
+                   'Напомнить о курсе ' || r,
+                   CASE WHEN r %% 10 = 0 THEN 'active' ELSE 'done' END,
+                   'Europe/Moscow'
+            FROM generate_series(1, %s) AS r
+        """, (users, users * 3))
+
+        cur.execute("""
+            INSERT INTO client_purchases (conv_id, email, product_name, purchase_date, amount)
+            SELECT CASE WHEN p %% 3 = 0 THEN NULL ELSE 1 + p %% %s END,
+                   'User' || (p %% %s) || '@Example.com',
+                   CASE WHEN p %% 40 = 0 THEN 'Набор «Всё включено»' ELSE 'Курс ' || (p %% 25) END,
+                   NOW() - make_interval(days => p %% 700),
+                   990 + p %% 5000
+            FROM generate_series(1, %s) AS p
+        """, (users, users, users * 2))
+
+        cur.execute("""
+            INSERT INTO purchased_products (conv_id, product_name)
+            SELECT 1 + p %% %s, 'Курс ' || (p %% 25)
+            FROM generate_series(1, %s) AS p
+        """, (users, users))
+    conn.commit()
+
+
+def explain_hot_queries(conn, users, messages_per_user):
+    """
+    Сохраняет планы EXPLAIN (ANALYZE, BUFFERS) горячих запросов на синтетических данных.
+
+    Returns:
+        Path: Путь к файлу с планами.
+    """
+    logging.info(f"EXPLAIN: Создаем синтетический набор ({users} пользователей x {messages_per_user} сообщений)...")
+    create_synthetic_dataset(conn, users, messages_per_user)
+
+    # Те же миграции, что и в рабочей базе, но внутри синтетической схемы
+    for migration in sorted(MIGRATIONS, key=lambda m: m["version"]):
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SET search_path TO {SYNTHETIC_SCHEMA}")
+                for statement in migration["statements"]:
+                    cur.execute(statement)
+        finally:
+            conn.autocommit = False
+
+    with conn.cursor() as cur:
+        cur.execute(f"SET search_path TO {SYNTHETIC_SCHEMA}")
+        for table_name in set(EXPECTED_INDEXES.values()) | {"user_profiles"}:
+            cur.execute(f"ANALYZE {table_name}")
+
+        EXPLAIN_OUTPUT_DIR.mkdir(exist_ok=True)
+        output_path = EXPLAIN_OUTPUT_DIR / f"explain_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(f"# Синтетический набор: {users} пользователей x {messages_per_user} сообщений\n\n")
+            for name, (query, params) in HOT_QUERIES.items():
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, params or None)
+                plan = "\n".join(row[0] for row in cur.fetchall())
+                f.write(f"=== {name} ===\n{plan}\n\n")
+                logging.info(f"EXPLAIN {name}: {plan.splitlines()[0]}")
+
+        cur.execute(f"DROP SCHEMA IF EXISTS {SYNTHETIC_SCHEMA} CASCADE")
+    conn.commit()
+
+    logging.info(f"EXPLAIN: Планы сохранены в {output_path}")
+    return output_path
+
+
+def main():
+    setup_logging()
+
+    parser = argparse.ArgumentParser(description="Версионированные миграции схемы БД и проверка индексов.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="Применить новые миграции.")
+    subparsers.add_parser("status", help="Показать статус миграций.")
+    subparsers.add_parser("verify", help="Проверить индексы горячих запросов.")
+    explain_parser = subparsers.add_parser("explain", help="Снять планы горячих запросов на синтетических данных.")
+    explain_parser.add_argument("--users", type=int, default=5000, help="Количество синтетических пользователей.")
+    explain_parser.add_argument("--messages-per-user", type=int, default=40, help="Сообщений на пользователя.")
+    args = parser.parse_args()
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        if args.command == "migrate":
+            applied_count = migrate(conn)
+            logging.info(f"Применено миграций: {applied_count}")
+        elif args.command == "status":
+            print_status(conn)
+        elif args.command == "verify":
+            if not verify_indexes(conn):
+                sys.exit(1)
+        elif args.command == "explain":
+            explain_hot_queries(conn, args.users, args.messages_per_user)
+    except Exception as e:
+        logging.critical(f"Ошибка выполнения команды {args.command}: {e}")
+        sys.exit(1)
+    finally:
+        if conn:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+# =======================================================================================
+#               МНОГОУРОВНЕВОЕ ХРАНЕНИЕ ИСТОРИИ ДИАЛОГОВ
+# =======================================================================================
+#
+# ЧТО ДЕЛАЕТ ЭТОТ МОДУЛЬ:
+#
+# Рабочая таблица dialogues хранит только последние HOT_MESSAGES_PER_CONV сообщений
+# каждого диалога — их читают бот, саммари и напоминания. Более старые сообщения
+# не удаляются, а пакетами переносятся в dialogues_archive, секционированную
+# по месяцам (RANGE по created_at).
+#
+# Перенос выполняет фоновая задача (start_retention_scheduler) небольшими пакетами,
+# поэтому горячий путь (ответ бота, транзакция summary_updater) больше не тратит
+# время на очистку. Одновременно работает только один экземпляр задачи
+# (pg_try_advisory_lock на весь запуск).
+#
+# Граница переноса для каждого диалога — (created_at, id) его HOT_MESSAGES_PER_CONV-го
+# сообщения с конца — считается один раз за запуск. Пакеты — группы диалогов, у которых
+# вместе набирается около RETENTION_BATCH_SIZE лишних строк; каждый пакет удаляет строки
+# по индексу (conv_id, created_at), без повторного просмотра всей таблицы.
+#
+# Таблицу архива создают миграции 8 и 14 (db_migrations.py); месячные секции —
+# задача переноса.
+#
+# Полную историю диалога для пакетных задач (create_missing_profiles и т.п.)
+# возвращает get_full_history: архив + рабочая таблица по порядку.
+#
+# КАК ЗАПУСКАТЬ ВРУЧНУЮ:
+#    python dialogue_retention.py report          # размер таблиц и статистика VACUUM
+#    python dialogue_retention.py run             # перенос всех накопившихся строк + отчет до/после
+#    python dialogue_retention.py run --vacuum    # то же и VACUUM (ANALYZE) dialogues после переноса
+#
+# =======================================================================================
+
+import os
+import sys
+import logging
+import argparse
+from datetime import date
+
+import psycopg2
+import psycopg2.extras
+from apscheduler.schedulers.background import BackgroundScheduler
+
+DATABASE_URL = os.environ.get("DATABASE_URL") or os.environ.get("POSTGRES_DSN")
+
+# --- НАСТРОЙКИ ---
+ARCHIVE_TABLE = "dialogues_archive"
+HOT_MESSAGES_PER_CONV = 30          # Столько последних сообщений диалога остается в dialogues
+ARCHIVE_MIN_AGE = "1 day"           # Свежие сообщения не трогаем, даже если их больше лимита
+RETENTION_BATCH_SIZE = 5000         # Строк за одну транзакцию переноса
+RETENTION_MAX_BATCHES = 20          # Пакетов за один запуск фоновой задачи
+RETENTION_INTERVAL_MINUTES = 30
+RETENTION_LOCK_KEY = 781_204_336    # Ключ advisory-блокировки задачи переноса
+
+# Колонки, которые переносятся в архив (created_at — ключ секционирования)
+ARCHIVED_COLUMNS = "id, conv_id, role, message, client_info, created_at"
+
+
+def get_db_connection():
+    """Устанавливает соединение с БД."""
+    if not DATABASE_URL:
+        raise ConnectionError("Переменная окружения DATABASE_URL (или POSTGRES_DSN) не установлена!")
+    return psycopg2.connect(DATABASE_URL)
+
+
+def _partition_name(month_start):
+    return f"{ARCHIVE_TABLE}_{month_start.year:04d}_{month_start.month:02d}"
+
+
+def _next_month(month_start):
+    if month_start.month == 12:
+        return date(month_start.year + 1, 1, 1)
+    return date(month_start.year, month_start.month + 1, 1)
+
+
+def ensure_archive_partitions(cur):
+    """
+    Создает месячные секции архива от самого старого сообщения в dialogues до следующего месяца.
+    Секции создаются заранее: строка, попавшая в DEFAULT-секцию, не дала бы потом создать секцию ее месяца.
+    """
+    cur.execute("SELECT min(created_at) FROM dialogues")
+    oldest = cur.fetchone()[0]
+    today = date.today()
+    month_start = date(oldest.year, oldest.month, 1) if oldest else date(today.year, today.month, 1)
+    last_month = _next_month(date(today.year, today.month, 1))
+
+    while month_start <= last_month:
+        month_end = _next_month(month_start)
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {_partition_name(month_start)}
+            PARTITION OF {ARCHIVE_TABLE}
+            FOR VALUES FROM (%s) TO (%s)
+        """, (month_start, month_end))
+        month_start = month_end
+
+
+def load_cutoffs(cur):
+    """
+    Граница переноса для диалогов, в которых больше HOT_MESSAGES_PER_CONV сообщений:
+    (created_at, id) последнего сообщения, которое остается в dialogues, и сколько строк старше нее.
+    Один просмотр таблицы на запуск задачи.
+
+    Returns:
+        list: [(conv_id, cutoff_created_at, cutoff_id, excess)].
+    """
+    cur.execute("""
+        SELECT conv_id, created_at, id, total - position AS excess
+        FROM (
+            SELECT conv_id, created_at, id,
+                   row_number() OVER (PARTITION BY conv_id ORDER BY created_at DESC, id DESC) AS position,
+                   count(*) OVER (PARTITION BY conv_id) AS total
+            FROM dialogues
+        ) ranked
+        WHERE position = %s AND total > position
+    """, (HOT_MESSAGES_PER_CONV,))
+    return cur.fetchall()
+
+
+def batch_cutoffs(cutoffs, batch_size=RETENTION_BATCH_SIZE):
+    """Делит границы на пакеты, в каждом — около batch_size строк к переносу."""
+    batch, rows = [], 0
+    for cutoff in cutoffs:
+        batch.append(cutoff)
+        rows += cutoff[3]
+        if rows >= batch_size:
+            yield batch
+            batch, rows = [], 0
+    if batch:
+        yield batch
+
+
+def archive_batch(conn, cutoffs):
+    """
+    Переносит в архив сообщения пакета диалогов старше их границы (и старше ARCHIVE_MIN_AGE).
+    DELETE ... RETURNING и INSERT выполняются одним выражением в одной транзакции;
+    строки находятся по индексу (conv_id, created_at).
+
+    Args:
+        cutoffs (list): [(conv_id, cutoff_created_at, cutoff_id, excess)] из load_cutoffs.
+
+    Returns:
+        int: Количество перенесенных строк.
+    """
+    conv_ids, cutoff_times, cutoff_ids, _ = zip(*cutoffs)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            WITH cutoffs AS (
+                SELECT * FROM unnest(%s::bigint[], %s::timestamptz[], %s::bigint[])
+                    AS c(cutoff_conv_id, cutoff_created_at, cutoff_id)
+            ), moved AS (
+                DELETE FROM dialogues
+                USING cutoffs
+                WHERE conv_id = cutoff_conv_id
+                  AND created_at <= cutoff_created_at
+                  AND (created_at, id) < (cutoff_created_at, cutoff_id)
+                  AND created_at < NOW() - %s::interval
+                RETURNING {ARCHIVED_COLUMNS}
+            )
+            INSERT INTO {ARCHIVE_TABLE} ({ARCHIVED_COLUMNS})
+            SELECT {ARCHIVED_COLUMNS} FROM moved
+        """, (list(conv_ids), list(cutoff_times), list(cutoff_ids), ARCHIVE_MIN_AGE))
+        moved = cur.rowcount
+    conn.commit()
+    return moved
+
+
+def run_retention_cycle(max_batches=RETENTION_MAX_BATCHES):
+    """
+    Переносит старые сообщения в архив пакетами (не больше max_batches пакетов за запуск).
+
+    Returns:
+        int: Сколько строк перенесено за запуск.
+    """
+    conn = None
+    locked = False
+    total_moved = 0
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (RETENTION_LOCK_KEY,))
+            locked = cur.fetchone()[0]
+            if not locked:
+                conn.rollback()
+                logging.info("АРХИВ ДИАЛОГОВ: Перенос уже выполняет другой экземпляр, пропускаем.")
+                return 0
+            ensure_archive_partitions(cur)
+            cutoffs = load_cutoffs(cur)
+        conn.commit()
+
+        for index, batch in enumerate(batch_cutoffs(cutoffs)):
+            if index >= max_batches:
+                break
+            total_moved += archive_batch(conn, batch)
+        if total_moved:
+            logging.info(f"АРХИВ ДИАЛОГОВ: Перенесено в {ARCHIVE_TABLE} {total_moved} сообщений.")
+    except Exception as e:
+        logging.error(f"АРХИВ ДИАЛОГОВ: Ошибка переноса: {e}", exc_info=True)
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            if locked:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_advisory_unlock(%s)", (RETENTION_LOCK_KEY,))
+                    conn.commit()
+                except Exception as e:
+                    logging.error(f"АРХИВ ДИАЛОГОВ: Не удалось снять блокировку переноса: {e}")
+            conn.close()
+    return total_moved
+
+
+def get_full_history(conn, conv_id, columns="role, message, created_at"):
+    """
+    Возвращает всю историю диалога (архив + рабочая таблица) в хронологическом порядке.
+
+    Args:
+        conn: Соединение с БД.
+        conv_id (int): ID диалога.
+        columns (str): Колонки из ARCHIVED_COLUMNS.
+
+    Returns:
+        list: Сообщения в виде словарей.
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute(f"""
+            SELECT {columns} FROM (
+                SELECT {ARCHIVED_COLUMNS} FROM {ARCHIVE_TABLE} WHERE conv_id = %s
+                UNION ALL
+                SELECT {ARCHIVED_COLUMNS} FROM dialogues WHERE conv_id = %s
+            ) history
+            ORDER BY created_at ASC, id ASC
+        """, (conv_id, conv_id))
+        return [dict(row) for row in cur.fetchall()]
+
+
+def table_report(conn):
+    """
+    Размер рабочей таблицы и архива и статистика VACUUM по dialogues.
+
+    Returns:
+        dict: Метрики для сравнения до/после переноса.
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute("""
+            SELECT pg_total_relation_size('dialogues') AS hot_bytes,
+                   n_live_tup, n_dead_tup, vacuum_count, autovacuum_count,
+                   last_vacuum, last_autovacuum
+            FROM pg_stat_user_tables
+            WHERE relname = 'dialogues'
+        """)
+        report = dict(cur.fetchone() or {})
+        cur.execute("""
+            SELECT COALESCE(sum(pg_total_relation_size(inhrelid)), 0) AS archive_bytes
+            FROM pg_inherits
+            WHERE inhparent = %s::regclass
+        """, (ARCHIVE_TABLE,))
+        report['archive_bytes'] = cur.fetchone()['archive_bytes']
+    return report
+
+
+def print_report(title, report):
+    print(f"--- {title} ---")
+    print(f"dialogues: {report.get('hot_bytes', 0) / 1024 / 1024:.1f} МБ, "
+          f"живых строк {report.get('n_live_tup')}, мертвых строк {report.get('n_dead_tup')}")
+    print(f"VACUUM: ручных {report.get('vacuum_count')}, автоматических {report.get('autovacuum_count')}, "
+          f"последний autovacuum {report.get('last_autovacuum')}")
+    print(f"{ARCHIVE_TABLE}: {report.get('archive_bytes', 0) / 1024 / 1024:.1f} МБ")
+
+
+retention_scheduler = None
+
+
+def start_retention_scheduler():
+    """Запускает фоновый перенос старых сообщений в архив каждые RETENTION_INTERVAL_MINUTES минут."""
+    global retention_scheduler
+    if retention_scheduler is not None:
+        return
+    retention_scheduler = BackgroundScheduler(timezone='UTC')
+    retention_scheduler.add_job(
+        func=run_retention_cycle,
+        trigger="interval",
+        minutes=RETENTION_INTERVAL_MINUTES,
+        id='archive_dialogues',
+        replace_existing=True
+    )
+    retention_scheduler.start()
+    logging.info(f"АРХИВ ДИАЛОГОВ: Фоновый перенос запущен, каждые {RETENTION_INTERVAL_MINUTES} минут.")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Перенос старых сообщений dialogues в архив.")
+    parser.add_argument("command", choices=["report", "run"])
+    parser.add_argument("--vacuum", action="store_true", help="После переноса выполнить VACUUM (ANALYZE) dialogues.")
+    args = parser.parse_args()
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        print_report("До" if args.command == "run" else "Сейчас", table_report(conn))
+        if args.command == "run":
+            moved = run_retention_cycle(max_batches=sys.maxsize)
+            print(f"\nПеренесено строк: {moved}\n")
+            print_report("После переноса", table_report(conn))
+            if args.vacuum:
+                # VACUUM нельзя выполнять внутри транзакции
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("VACUUM (ANALYZE) dialogues")
+                print()
+                print_report("После VACUUM", table_report(conn))
+    finally:
+        if conn:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# --- Описание ---
+# Общий исполнитель блокирующих вызовов LLM со сроками выполнения (deadline).
+# Заменяет декоратор with_timeout, который запускал новый поток на каждый вызов Gemini
+# и при тайм-ауте бросал его работать дальше: повторные попытки копили такие потоки.
+#
+# - Фиксированное число рабочих потоков: зависшие вызовы не могут занять больше потоков,
+#   чем задано, новые запросы ждут в очереди.
+# - У каждого запроса есть срок. Запрос, срок которого истек еще в очереди, не выполняется вовсе.
+# - Вызов, который не уложился в срок и продолжает работать (SDK Gemini не принимает тайм-аут
+#   запроса), считается брошенным (abandoned). На место занятого им потока запускается
+#   замена, чтобы несколько зависших вызовов не остановили очередь; поток с брошенным вызовом
+#   завершается, когда вызов вернется. Замен не больше max_workers: если зависло больше,
+#   очередь снова ждет, и метрика abandoned это показывает.
+# --- Конец описания ---
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from metrics import register_gauge
+
+# Показатели stats(), которые публикуются в /metrics: мгновенные значения и накопительные счетчики
+_GAUGE_STATS = ('workers', 'queued', 'in_flight', 'abandoned')
+_COUNTER_STATS = ('submitted', 'completed', 'failed', 'expired_in_queue', 'timed_out', 'replaced')
+
+
+class DeadlineExceeded(TimeoutError):
+    """Запрос к LLM не уложился в срок (в очереди или во время выполнения)."""
+
+
+class LLMExecutor:
+    """Пул из max_workers потоков для блокирующих вызовов LLM с учетом сроков запросов."""
+
+    def __init__(self, max_workers, name="LLM"):
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = queue.Queue()
+        self._started = 0   # Потоков запущено за все время (для имен)
+        self._workers = 0   # Живых рабочих потоков, включая занятые брошенными вызовами
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._abandoned = 0
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'expired_in_queue': 0, 'timed_out': 0,
+                          'replaced': 0}
+
+    def _start_worker(self):
+        # Вызывается под self._lock
+        self._started += 1
+        self._workers += 1
+        threading.Thread(target=self._worker, name=f"{self.name}-{self._started}", daemon=True).start()
+
+    def _ensure_workers(self):
+        # Потоки запускаются при первом запросе: модуль можно импортировать без побочных эффектов
+        with self._lock:
+            while self._workers < self.max_workers:
+                self._start_worker()
+
+    def _retire_if_surplus(self):
+        """Завершает поток, если после возврата брошенного вызова свободных потоков больше max_workers."""
+        with self._lock:
+            if self._workers - self._abandoned > self.max_workers:
+                self._workers -= 1
+                return True
+            return False
+
+    def _worker(self):
+        while True:
+            future, deadline, fn, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            if deadline is not None and deadline <= time.monotonic():
+                with self._lock:
+                    self._counters['expired_in_queue'] += 1
+                future.set_exception(DeadlineExceeded(f"{self.name}: срок запроса истек в очереди"))
+                continue
+
+            with self._lock:
+                self._in_flight += 1
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self._counters['failed'] += 1
+                future.set_exception(e)
+            else:
+                with self._lock:
+                    self._counters['completed'] += 1
+                future.set_result(result)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+            if self._retire_if_surplus():
+                return
+
+    def submit(self, fn, *args, **kwargs):
+        """Ставит вызов в очередь без срока (как ThreadPoolExecutor.submit)."""
+        return self.submit_with_deadline(None, fn, *args, **kwargs)
+
+    def submit_with_deadline(self, deadline, fn, *args, **kwargs):
+        """
+        Ставит вызов в очередь со сроком.
+
+        Args:
+            deadline (float): Срок по time.monotonic() или None.
+            fn: Блокирующая функция (например, model.generate_content).
+
+        Returns:
+            Future: Результат вызова; DeadlineExceeded, если срок истек в очереди.
+        """
+        self._ensure_workers()
+        future = Future()
+        with self._lock:
+            self._counters['submitted'] += 1
+        self._queue.put((future, deadline, fn, args, kwargs))
+        return future
+
+    def call(self, timeout, fn, *args, **kwargs):
+        """
+        Выполняет вызов в пуле и ждет результат не дольше timeout секунд.
+
+        Raises:
+            DeadlineExceeded: Срок истек. Если вызов еще ждал в очереди, он отменяется;
+                если уже выполнялся — продолжает работать, учитывается как брошенный
+                и его поток заменяется новым.
+        """
+        deadline = time.monotonic() + timeout
+        future = self.submit_with_deadline(deadline, fn, *args, **kwargs)
+        return self.result(future, deadline)
+
+    def result(self, future, deadline):
+        """Ждет результат future до срока deadline (по time.monotonic())."""
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            pass
+
+        if future.cancel():
+            with self._lock:
+                self._counters['timed_out'] += 1
+            raise DeadlineExceeded(f"{self.name}: срок запроса истек в очереди, запрос отменен")
+        if future.done():
+            # Вызов успел завершиться между тайм-аутом ожидания и отменой
+            return future.result()
+
+        with self._lock:
+            self._counters['timed_out'] += 1
+            self._abandoned += 1
+            # Замена потоку, занятому брошенным вызовом; всего потоков не больше 2 * max_workers
+            replaced = self._workers < 2 * self.max_workers
+            if replaced:
+                self._counters['replaced'] += 1
+                self._start_worker()
+        future.add_done_callback(self._release_abandoned)
+        logging.error(f"[TIMEOUT] {self.name}: вызов не уложился в срок и брошен, брошенных сейчас: {self._abandoned}"
+                      f"{', поток заменен' if replaced else ', лимит замен исчерпан, очередь ждет свободный поток'}")
+        raise DeadlineExceeded(f"{self.name}: вызов не уложился в срок")
+
+    def _release_abandoned(self, _future):
+        with self._lock:
+            self._abandoned -= 1
+
+    def stats(self):
+        """Метрики пула: очередь, выполняемые и брошенные вызовы, счетчики исходов."""
+        with self._lock:
+            return {
+                'workers': self._workers,
+                'queued': self._queue.qsize(),
+                'in_flight': self._in_flight,
+                'abandoned': self._abandoned,
+                **self._counters,
+            }
+
+    def register_metrics(self):
+        """Публикует stats() пула в /metrics (metrics.py) с меткой executor=<name>."""
+        for key in _GAUGE_STATS:
+            register_gauge(f"llm_executor_{key}", f"LLMExecutor: {key}",
+                           lambda key=key: {self.name: self.stats()[key]}, label="executor")
+        for key in _COUNTER_STATS:
+            register_gauge(f"llm_executor_{key}_total", f"LLMExecutor: {key}",
+                           lambda key=key: {self.name: self.stats()[key]}, label="executor", kind="counter")
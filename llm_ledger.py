@@ -0,0 +1,419 @@
+# --- Описание ---
+# Журнал вызовов LLM: размер промпта, токены, задержка, повторы и ошибки по точкам вызова.
+#
+# Каждый вызов модели идет через generate(model, prompt, call_site, ...), который:
+# - до запроса проверяет бюджет размера промпта точки вызова (в символах).
+#   Мягкий бюджет только пишет предупреждение и считается в статистике; жесткий
+#   отклоняет запрос исключением PromptBudgetExceeded — модель не вызывается.
+#   Бюджеты задаются set_prompt_budget() или переменной окружения LLM_PROMPT_BUDGETS
+#   ("reply=120000:200000,reminder_analysis=30000" — мягкий[:жесткий]);
+# - после ответа берет prompt_token_count и candidates_token_count из usage_metadata
+#   и добавляет запись в кольцевой буфер на LEDGER_CAPACITY последних вызовов.
+#
+# ledger_stats() — перцентили задержки, размера промпта и токенов по точкам вызова
+# из буфера (эндпоинт /llm_ledger в main.py); длительность вызовов попадает и в
+# гистограмму metrics ("llm_call"), накопительные счетчики токенов — в /metrics.
+#
+# Агрегаты за интервалы по LEDGER_BUCKET_SECONDS копятся отдельно от буфера и
+# раз в LEDGER_FLUSH_INTERVAL_MINUTES записываются в таблицу llm_call_stats
+# (миграция 13 в db_migrations.py, start_ledger_flusher): по строке на интервал, экземпляр, точку вызова и модель.
+#
+# Отчет по таблице:
+#    python llm_ledger.py report --hours 24
+# --- Конец описания ---
+
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import threading
+from collections import deque, namedtuple
+
+import psycopg2
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from metrics import observe, percentile, register_gauge
+
+DATABASE_URL = os.environ.get("DATABASE_URL") or os.environ.get("POSTGRES_DSN")
+
+# --- НАСТРОЙКИ ---
+LEDGER_TABLE = "llm_call_stats"
+LEDGER_CAPACITY = 5000              # Столько последних вызовов хранит кольцевой буфер
+LEDGER_BUCKET_SECONDS = 300         # Интервал агрегации для таблицы
+LEDGER_FLUSH_INTERVAL_MINUTES = 5
+PROMPT_BUDGETS_ENV = "LLM_PROMPT_BUDGETS"
+
+LedgerEntry = namedtuple(
+    "LedgerEntry",
+    "at call_site model prompt_chars prompt_tokens output_tokens latency_ms attempt error",
+)
+
+
+class PromptBudgetExceeded(ValueError):
+    """Промпт больше жесткого бюджета точки вызова; запрос к модели не отправлялся."""
+
+
+_lock = threading.Lock()
+_entries = deque(maxlen=LEDGER_CAPACITY)
+_budgets = {}        # call_site -> (мягкий, жесткий) в символах
+_totals = {}         # call_site -> накопительные счетчики с запуска процесса
+_buckets = {}        # (начало интервала, call_site, model) -> агрегат для таблицы
+_flush_scheduler = None
+
+
+# =======================================================================================
+# БЮДЖЕТЫ
+# =======================================================================================
+
+def set_prompt_budget(call_site, soft_chars=None, hard_chars=None):
+    """Задает бюджет размера промпта точки вызова (None — без ограничения)."""
+    with _lock:
+        _budgets[call_site] = (soft_chars, hard_chars)
+
+
+def load_budgets_from_env(value=None):
+    """Читает бюджеты из LLM_PROMPT_BUDGETS: "точка=мягкий[:жесткий],..."."""
+    value = os.environ.get(PROMPT_BUDGETS_ENV, "") if value is None else value
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        call_site, _, limits = item.partition("=")
+        soft, _, hard = limits.partition(":")
+        try:
+            set_prompt_budget(call_site.strip(), int(soft) if soft else None, int(hard) if hard else None)
+        except ValueError:
+            logging.error(f"ЖУРНАЛ LLM: Некорректный бюджет промпта '{item}' в {PROMPT_BUDGETS_ENV}")
+
+
+def _site_totals(call_site):
+    return _totals.setdefault(call_site, {
+        'calls': 0, 'errors': 0, 'retries': 0, 'prompt_chars': 0, 'prompt_tokens': 0,
+        'output_tokens': 0, 'over_soft_budget': 0, 'rejected_by_budget': 0,
+    })
+
+
+def check_prompt_budget(call_site, prompt_chars):
+    """
+    Проверяет размер промпта по бюджету точки вызова.
+
+    Raises:
+        PromptBudgetExceeded: Промпт больше жесткого бюджета.
+    """
+    with _lock:
+        soft, hard = _budgets.get(call_site, (None, None))
+        if hard is not None and prompt_chars > hard:
+            _site_totals(call_site)['rejected_by_budget'] += 1
+        elif soft is not None and prompt_chars > soft:
+            _site_totals(call_site)['over_soft_budget'] += 1
+    if hard is not None and prompt_chars > hard:
+        logging.error(f"ЖУРНАЛ LLM: {call_site}: промпт {prompt_chars} символов больше жесткого бюджета {hard}, запрос отклонен")
+        raise PromptBudgetExceeded(f"{call_site}: промпт {prompt_chars} символов, жесткий бюджет {hard}")
+    if soft is not None and prompt_chars > soft:
+        logging.warning(f"ЖУРНАЛ LLM: {call_site}: промпт {prompt_chars} символов больше мягкого бюджета {soft}")
+
+
+# =======================================================================================
+# ЗАПИСЬ ВЫЗОВОВ
+# =======================================================================================
+
+def _model_name(model):
+    # У vertexai GenerativeModel полное имя ресурса: projects/.../models/gemini-2.5-pro
+    name = getattr(model, "_model_name", None) or type(model).__name__
+    return str(name).rsplit("/", 1)[-1]
+
+
+def _prompt_chars(prompt):
+    """Символы текстовых частей промпта (у мультимодальных запросов — только текст)."""
+    if isinstance(prompt, str):
+        return len(prompt)
+    if isinstance(prompt, (list, tuple)):
+        return sum(len(part) for part in prompt if isinstance(part, str))
+    return 0
+
+
+def record(call_site, model_name, prompt_chars, latency_ms, response=None, attempt=0, error=None):
+    """Добавляет вызов в буфер, накопительные счетчики и агрегат текущего интервала."""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None) if usage is not None else None
+    output_tokens = getattr(usage, "candidates_token_count", None) if usage is not None else None
+    now = time.time()
+    entry = LedgerEntry(now, call_site, model_name, prompt_chars, prompt_tokens, output_tokens,
+                        round(latency_ms, 1), attempt, error)
+    bucket_key = (int(now // LEDGER_BUCKET_SECONDS) * LEDGER_BUCKET_SECONDS, call_site, model_name)
+    with _lock:
+        _entries.append(entry)
+        totals = _site_totals(call_site)
+        totals['calls'] += 1
+        totals['errors'] += 1 if error else 0
+        totals['retries'] += 1 if attempt else 0
+        totals['prompt_chars'] += prompt_chars
+        totals['prompt_tokens'] += prompt_tokens or 0
+        totals['output_tokens'] += output_tokens or 0
+        bucket = _buckets.setdefault(bucket_key, {
+            'calls': 0, 'errors': 0, 'retries': 0, 'prompt_tokens': 0, 'output_tokens': 0,
+            'prompt_chars': [], 'latency_ms': [],
+        })
+        bucket['calls'] += 1
+        bucket['errors'] += 1 if error else 0
+        bucket['retries'] += 1 if attempt else 0
+        bucket['prompt_tokens'] += prompt_tokens or 0
+        bucket['output_tokens'] += output_tokens or 0
+        bucket['prompt_chars'].append(prompt_chars)
+        bucket['latency_ms'].append(latency_ms)
+    observe("llm_call", latency_ms / 1000, call_site=call_site)
+    return entry
+
+
+def generate(model, prompt, call_site, attempt=0, **kwargs):
+    """
+    Вызывает model.generate_content(prompt, **kwargs) и записывает вызов в журнал.
+
+    Args:
+        call_site (str): Точка вызова (reply, kb_titles, reminder_analysis, ...).
+        attempt (int): Номер попытки; попытки после первой считаются повторами.
+
+    Raises:
+        PromptBudgetExceeded: Промпт больше жесткого бюджета call_site.
+        Exception: Ошибки модели пробрасываются после записи в журнал.
+    """
+    prompt_chars = _prompt_chars(prompt)
+    check_prompt_budget(call_site, prompt_chars)
+    model_name = _model_name(model)
+    started = time.perf_counter()
+    try:
+        response = model.generate_content(prompt, **kwargs)
+    except Exception as e:
+        record(call_site, model_name, prompt_chars, (time.perf_counter() - started) * 1000,
+               attempt=attempt, error=type(e).__name__)
+        raise
+    record(call_site, model_name, prompt_chars, (time.perf_counter() - started) * 1000,
+           response=response, attempt=attempt)
+    return response
+
+
+# =======================================================================================
+# СТАТИСТИКА
+# =======================================================================================
+
+def _summary(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+            'p99': percentile(values, 99), 'max': max(values)}
+
+
+def ledger_stats(window_seconds=None):
+    """
+    Перцентили по точкам вызова из кольцевого буфера.
+
+    Args:
+        window_seconds (float): Только вызовы за последние window_seconds секунд.
+
+    Returns:
+        dict: call_site -> вызовы, ошибки, повторы, перцентили задержки, размера промпта
+        и токенов, бюджет и счетчики его превышений с запуска процесса.
+    """
+    since = time.time() - window_seconds if window_seconds else 0
+    with _lock:
+        entries = [entry for entry in _entries if entry.at >= since]
+        budgets = dict(_budgets)
+        totals = {site: dict(counters) for site, counters in _totals.items()}
+
+    by_site = {}
+    for entry in entries:
+        by_site.setdefault(entry.call_site, []).append(entry)
+    report = {}
+    for call_site, site_entries in sorted(by_site.items()):
+        soft, hard = budgets.get(call_site, (None, None))
+        report[call_site] = {
+            'calls': len(site_entries),
+            'errors': sum(1 for entry in site_entries if entry.error),
+            'retries': sum(1 for entry in site_entries if entry.attempt),
+            'models': sorted({entry.model for entry in site_entries}),
+            'latency_ms': _summary([entry.latency_ms for entry in site_entries]),
+            'prompt_chars': _summary([entry.prompt_chars for entry in site_entries]),
+            'prompt_tokens': _summary([entry.prompt_tokens for entry in site_entries]),
+            'output_tokens': _summary([entry.output_tokens for entry in site_entries]),
+            'budget': {'soft_chars': soft, 'hard_chars': hard},
+            'over_soft_budget': totals.get(call_site, {}).get('over_soft_budget', 0),
+            'rejected_by_budget': totals.get(call_site, {}).get('rejected_by_budget', 0),
+        }
+    return report
+
+
+def recent_calls(limit=50):
+    """Последние limit вызовов из буфера (новые в конце)."""
+    with _lock:
+        return [entry._asdict() for entry in list(_entries)[-limit:]]
+
+
+def _totals_by_site(counter):
+    with _lock:
+        return {site: counters[counter] for site, counters in _totals.items()}
+
+
+for _counter in ('calls', 'errors', 'retries', 'prompt_chars', 'prompt_tokens', 'output_tokens',
+                 'over_soft_budget', 'rejected_by_budget'):
+    register_gauge(f"llm_{_counter}_total", f"Вызовы LLM по точкам вызова: {_counter}",
+                   lambda counter=_counter: _totals_by_site(counter), label="call_site", kind="counter")
+
+
+# =======================================================================================
+# АГРЕГАЦИЯ В ТАБЛИЦУ
+# =======================================================================================
+
+def get_db_connection():
+    """Устанавливает соединение с БД."""
+    if not DATABASE_URL:
+        raise ConnectionError("Переменная окружения DATABASE_URL (или POSTGRES_DSN) не установлена!")
+    return psycopg2.connect(DATABASE_URL)
+
+
+def _take_buckets(include_current):
+    """Забирает агрегаты завершенных интервалов (и текущего, если include_current)."""
+    current = int(time.time() // LEDGER_BUCKET_SECONDS) * LEDGER_BUCKET_SECONDS
+    with _lock:
+        keys = [key for key in _buckets if include_current or key[0] < current]
+        return {key: _buckets.pop(key) for key in keys}
+
+
+def flush_aggregates(include_current=False):
+    """
+    Записывает агрегаты интервалов в llm_call_stats.
+
+    Повторная запись того же интервала (после include_current) складывает счетчики;
+    перцентили берутся наибольшие из двух частей — это оценка сверху.
+
+    Returns:
+        int: Сколько строк записано.
+    """
+    buckets = _take_buckets(include_current)
+    if not buckets:
+        return 0
+    instance = f"{socket.gethostname()}:{os.getpid()}"
+    rows = []
+    for (bucket_start, call_site, model_name), bucket in sorted(buckets.items()):
+        rows.append((
+            bucket_start, instance, call_site, model_name, bucket['calls'], bucket['errors'], bucket['retries'],
+            percentile(bucket['prompt_chars'], 50), percentile(bucket['prompt_chars'], 95), max(bucket['prompt_chars']),
+            bucket['prompt_tokens'], bucket['output_tokens'],
+            percentile(bucket['latency_ms'], 50), percentile(bucket['latency_ms'], 95), max(bucket['latency_ms']),
+        ))
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cur:
+            cur.executemany(f"""
+                INSERT INTO {LEDGER_TABLE} (
+                    bucket_start, instance, call_site, model, calls, errors, retries,
+                    prompt_chars_p50, prompt_chars_p95, prompt_chars_max, prompt_tokens, output_tokens,
+                    latency_ms_p50, latency_ms_p95, latency_ms_max
+                ) VALUES (to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (bucket_start, instance, call_site, model) DO UPDATE SET
+                    calls = {LEDGER_TABLE}.calls + EXCLUDED.calls,
+                    errors = {LEDGER_TABLE}.errors + EXCLUDED.errors,
+                    retries = {LEDGER_TABLE}.retries + EXCLUDED.retries,
+                    prompt_chars_p50 = GREATEST({LEDGER_TABLE}.prompt_chars_p50, EXCLUDED.prompt_chars_p50),
+                    prompt_chars_p95 = GREATEST({LEDGER_TABLE}.prompt_chars_p95, EXCLUDED.prompt_chars_p95),
+                    prompt_chars_max = GREATEST({LEDGER_TABLE}.prompt_chars_max, EXCLUDED.prompt_chars_max),
+                    prompt_tokens = {LEDGER_TABLE}.prompt_tokens + EXCLUDED.prompt_tokens,
+                    output_tokens = {LEDGER_TABLE}.output_tokens + EXCLUDED.output_tokens,
+                    latency_ms_p50 = GREATEST({LEDGER_TABLE}.latency_ms_p50, EXCLUDED.latency_ms_p50),
+                    latency_ms_p95 = GREATEST({LEDGER_TABLE}.latency_ms_p95, EXCLUDED.latency_ms_p95),
+                    latency_ms_max = GREATEST({LEDGER_TABLE}.latency_ms_max, EXCLUDED.latency_ms_max)
+            """, rows)
+        conn.commit()
+        logging.info(f"ЖУРНАЛ LLM: Записано агрегатов: {len(rows)}")
+        return len(rows)
+    except Exception as e:
+        logging.error(f"ЖУРНАЛ LLM: Не удалось записать агрегаты ({len(rows)} строк): {e}")
+        if conn:
+            conn.rollback()
+        # Возвращаем агрегаты, чтобы записать их при следующей попытке
+        with _lock:
+            for key, bucket in buckets.items():
+                if key in _buckets:
+                    merged = _buckets[key]
+                    for field in ('calls', 'errors', 'retries', 'prompt_tokens', 'output_tokens'):
+                        merged[field] += bucket[field]
+                    merged['prompt_chars'].extend(bucket['prompt_chars'])
+                    merged['latency_ms'].extend(bucket['latency_ms'])
+                else:
+                    _buckets[key] = bucket
+        return 0
+    finally:
+        if conn:
+            conn.close()
+
+
+def start_ledger_flusher():
+    """Запускает запись агрегатов в llm_call_stats каждые LEDGER_FLUSH_INTERVAL_MINUTES минут."""
+    global _flush_scheduler
+    if _flush_scheduler is not None:
+        return
+    _flush_scheduler = BackgroundScheduler(timezone='UTC')
+    _flush_scheduler.add_job(
+        func=flush_aggregates,
+        trigger="interval",
+        minutes=LEDGER_FLUSH_INTERVAL_MINUTES,
+        id='flush_llm_ledger',
+        replace_existing=True
+    )
+    _flush_scheduler.start()
+    logging.info(f"ЖУРНАЛ LLM: Запись агрегатов в {LEDGER_TABLE} каждые {LEDGER_FLUSH_INTERVAL_MINUTES} минут.")
+
+
+load_budgets_from_env()
+
+
+# =======================================================================================
+# ОТЧЕТ
+# =======================================================================================
+
+REPORT_QUERY = f"""
+    SELECT call_site, model, SUM(calls), SUM(errors), SUM(retries),
+           MAX(prompt_chars_p95), MAX(prompt_chars_max),
+           SUM(prompt_tokens), SUM(output_tokens),
+           SUM(latency_ms_p50 * calls) / NULLIF(SUM(calls), 0), MAX(latency_ms_p95), MAX(latency_ms_max)
+    FROM {LEDGER_TABLE}
+    WHERE bucket_start >= NOW() - make_interval(hours => %s)
+    GROUP BY call_site, model
+    ORDER BY SUM(prompt_tokens) DESC
+"""
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Отчет по журналу вызовов LLM (таблица llm_call_stats).")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("--hours", type=int, default=24, help="За сколько последних часов")
+    args = parser.parse_args()
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor() as cur:
+            cur.execute(REPORT_QUERY, (args.hours,))
+            rows = cur.fetchall()
+    except Exception as e:
+        logging.error(f"Ошибка отчета журнала LLM: {e}")
+        return 1
+    finally:
+        if conn:
+            conn.close()
+
+    print(f"Вызовы LLM за {args.hours} ч")
+    print(f"{'Точка вызова':<22}{'Модель':<24}{'Вызовов':>9}{'Ошибок':>8}{'Повторов':>10}"
+          f"{'Промпт p95':>12}{'Промпт max':>12}{'Токены вход':>13}{'Выход':>10}{'~p50 мс':>10}{'p95 мс':>10}")
+    for (call_site, model_name, calls, errors, retries, chars_p95, chars_max,
+         prompt_tokens, output_tokens, latency_p50, latency_p95, latency_max) in rows:
+        print(f"{call_site:<22}{model_name:<24}{calls:>9}{errors:>8}{retries:>10}"
+              f"{chars_p95 or 0:>12}{chars_max or 0:>12}{prompt_tokens:>13}{output_tokens:>10}"
+              f"{latency_p50 or 0:>10.0f}{latency_p95 or 0:>10.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,7 +5,6 @@ import json
 import requests
 import psycopg2
 import psycopg2.extras
-import subprocess
 import tempfile  # Для работы с временными файлами при анализе вложений
 from datetime import datetime, timedelta, timezone
 import threading
@@ -13,14 +12,14 @@ from concurrent.futures import ThreadPoolExecutor, TimeoutError  # Для аси
 import vk_api
 from vk_api.longpoll import VkLongPoll, VkEventType
 from vk_api.utils import get_random_id
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from urllib.parse import quote
 import openpyxl
 import logging
 from apscheduler.schedulers.background import BackgroundScheduler
 from google.cloud import aiplatform
 import vertexai
-from vertexai.generative_models import GenerativeModel
+from vertexai.generative_models import GenerativeModel, GenerationConfig
 from google.oauth2 import service_account
 
 # Импорт сервиса напоминаний
@@ -28,6 +27,16 @@ from reminder_service import process_new_message as process_reminder_message, in
 
 # Импорт анализатора вложений
 from attachment_analyzer import AttachmentAnalyzer
+from text_processing import strip_timestamp, remove_internal_tags, vkvideo_add
+from client_context import ClientContext, DIALOGUES_LIMIT, compaction_stats
+from summary_updater import init_worker_pool as init_summary_worker_pool, submit_summary_update, MODEL_NAME as SUMMARY_MODEL_NAME
+from dialogue_retention import start_retention_scheduler
+from structured_output import json_generation_params, parse_json_response, StructuredOutputError, structured_output_stats
+from metrics import span, timed, observe, register_gauge, render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import llm_ledger
+from llm_ledger import PromptBudgetExceeded
+from db_migrations import require_current_schema
+from callback_sink import CallbackSink, CALLBACK_LOGS_DIR
 
 # ====
 # Читаем переменные окружения (секретные данные)
@@ -50,6 +59,12 @@ PROJECT_ID = "hardy-technique-470816-f2"
 LOCATION = "us-central1"
 MODEL_NAME = "gemini-2.5-pro"
 SEARCH_MODEL_NAME = "gemini-2.0-flash-exp"  # Быстрая модель для поиска в базе знаний
+# Схема ответа поиска заголовков базы знаний
+KB_TITLES_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"titles": {"type": "ARRAY", "items": {"type": "STRING"}}},
+    "required": ["titles"],
+}
 
 # Настройка логгера
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -90,7 +105,7 @@ PROMPT_PATH = "prompt.txt"
 LOGS_DIRECTORY = "dialog_logs"
 
 # CONTEXT_BUILDER_PATH = "context_builder.py"  # БОЛЬШЕ НЕ ИСПОЛЬЗУЕТСЯ - логика перенесена в main.py
-SUMMARY_UPDATER_PATH = "summary_updater.py"
+# SUMMARY_UPDATER_PATH = "summary_updater.py"  # БОЛЬШЕ НЕ ЗАПУСКАЕТСЯ ПРОЦЕССОМ - см. summary_updater.SummaryWorkerPool
 
 # ====
 # Прочитаем базу знаний и промпт
@@ -131,12 +146,6 @@ RUSSIAN_MONTHS = {
     9: "сентября", 10: "октября", 11: "ноября", 12: "декабря"
 }
 
-RUSSIAN_MONTHS_REVERSE = {
-    "января": 1, "февраля": 2, "марта": 3, "апреля": 4,
-    "мая": 5, "июня": 6, "июля": 7, "августа": 8,
-    "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12
-}
-
 # ====
 # ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ПОДКЛЮЧЕНИЯ К БД
 # ====
@@ -398,53 +407,10 @@ def calculate_birthday_discount_status(birth_day, birth_month):
             'birthday_formatted': ''
         }
 
-def extract_birthday_from_context(context_text):
-    """
-    Извлекает данные о дне рождения из контекста клиента.
-    Поддерживает как старый формат (30.8), так и новый (30 августа).
-    
-    Args:
-        context_text (str): Текст контекста от context builder
-        
-    Returns:
-        tuple: (birth_day, birth_month) или (None, None) если не найдено
-    """
-    try:
-        import re
-        
-        # Новый формат: "Дата рождения: 30 августа" (приоритетный)
-        new_pattern = r'Дата рождения: (\d+) (января|февраля|марта|апреля|мая|июня|июля|августа|сентября|октября|ноября|декабря)'
-        match = re.search(new_pattern, context_text)
-        
-        if match:
-            birth_day = int(match.group(1))
-            month_name = match.group(2)
-            birth_month = RUSSIAN_MONTHS_REVERSE.get(month_name)
-            if birth_month:
-                logging.info(f"Найдена дата рождения (новый формат): {birth_day} {month_name} -> {birth_day}.{birth_month}")
-                return birth_day, birth_month
-        
-        # Старый формат: "Дата рождения: 30.8" (для обратной совместимости)
-        old_pattern = r'Дата рождения: (\d+)\.(\d+)'
-        match = re.search(old_pattern, context_text)
-        
-        if match:
-            birth_day = int(match.group(1))
-            birth_month = int(match.group(2))
-            logging.info(f"Найдена дата рождения (старый формат): {birth_day}.{birth_month}")
-            return birth_day, birth_month
-        
-        logging.info("Данные о дне рождения не найдены в контексте")
-        logging.info(f"Поиск в контексте (первые 1000 символов): {context_text[:1000]}")
-        return None, None
-            
-    except Exception as e:
-        logging.error(f"Ошибка при извлечении данных о дне рождения: {e}")
-        return None, None
-
 # ====
 # 3. РАБОТА С ЯНДЕКС.ДИСКОМ: ЗАГРУЗКА ЛОГ-ФАЙЛОВ
 # ====
+@timed("yandex_disk_upload")
 def upload_log_to_yandex_disk(log_file_path_to_upload):
     """
     Загружает файл log_file_path_to_upload на Яндекс.Диск, если YANDEX_DISK_TOKEN задан.
@@ -509,31 +475,23 @@ def upload_log_to_yandex_disk(log_file_path_to_upload):
         logging.error(f"Непредвиденная ошибка при загрузке файла '{file_name_to_upload}' на Яндекс.Диск: {e}")
 
 # ====
-# 4. ФУНКЦИЯ ЗАПИСИ ДАННЫХ CALLBACK ОТ VK В JSON-файл
+# 4. ЖУРНАЛ ДАННЫХ CALLBACK ОТ VK (сегменты JSONL, callback_sink.py)
 # ====
-CALLBACK_LOGS_DIR = "callback_logs"
-if not os.path.exists(CALLBACK_LOGS_DIR):
-    os.makedirs(CALLBACK_LOGS_DIR, exist_ok=True)
+callback_sink = CallbackSink(CALLBACK_LOGS_DIR)
+callback_sink.register_metrics()
 
 def save_callback_payload(data_payload):
     """
-    Сохраняет весь JSON, полученный от ВКонтакте, в локальный файл для отладки.
+    Сохраняет весь JSON, полученный от ВКонтакте, в журнал callback_logs для отладки.
+    Только ставит событие в очередь: запись пачками идет в потоке журнала.
     """
-    timestamp_str = datetime.utcnow().strftime("%Y-%m-%d_%H-%M-%S_%f")
-    file_name = f"callback_{timestamp_str}.json"
-    file_path = os.path.join(CALLBACK_LOGS_DIR, file_name)
-
-    try:
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(data_payload, f, ensure_ascii=False, indent=2)
-        logging.info(f"Сохранён callback JSON: {file_name}")
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении callback payload в файл '{file_path}': {e}")
+    callback_sink.append(data_payload)
 
 
 # ====
 # 5. СОХРАНЕНИЕ ДИАЛОГОВ В POSTGRES
 # ====
+@timed("db_store_dialog")
 def store_dialog_in_db(conv_id, role, message_text_with_timestamp, client_info=""):
     """
     Сохраняет одно сообщение в базу данных.
@@ -584,33 +542,11 @@ def call_context_builder(vk_callback_data):
 
 def call_summary_updater_async(conv_id):
     """
-    Асинхронно вызывает внешний сервис summary_updater.py для обновления саммари диалога.
+    Ставит обновление саммари диалога в очередь пула summary_updater.SummaryWorkerPool.
+    Повторные вызовы для того же conv_id объединяются с уже выполняющимся обновлением.
     """
-    def run_summary_updater():
-        try:
-            process = subprocess.run(
-                ["python", SUMMARY_UPDATER_PATH],
-                input=str(conv_id),
-                capture_output=True,
-                text=True,
-                encoding='utf-8',
-                timeout=180
-            )
-
-            if process.returncode != 0:
-                logging.error(f"Summary Updater завершился с кодом ошибки {process.returncode} для conv_id {conv_id}. stderr: {process.stderr}. stdout: {process.stdout}")
-            else:
-                logging.info(f"Summary Updater успешно обработал conv_id {conv_id}")
-
-        except subprocess.TimeoutExpired:
-            logging.error(f"Summary Updater превысил таймаут выполнения для conv_id {conv_id}")
-        except FileNotFoundError:
-            logging.error(f"Файл {SUMMARY_UPDATER_PATH} не найден")
-        except Exception as e:
-            logging.error(f"Ошибка при асинхронном вызове Summary Updater для conv_id {conv_id}: {e}")
-
-    threading.Thread(target=run_summary_updater, daemon=True).start()
-    logging.info(f"Summary Updater запущен асинхронно для conv_id {conv_id}")
+    if submit_summary_update(conv_id):
+        logging.info(f"Summary Updater запущен асинхронно для conv_id {conv_id}")
 
 
 # ====
@@ -618,6 +554,18 @@ def call_summary_updater_async(conv_id):
 # ====
 app = Flask(__name__)
 
+# ====
+# Проверка схемы БД: без примененных миграций (колонки аренды напоминаний, водяной знак
+# саммари, архив диалогов, llm_call_stats) фоновые задачи и путь ответа падают с ошибками
+# ====
+try:
+    require_current_schema()
+except RuntimeError as e:
+    logging.critical(f"КРИТИЧЕСКАЯ ОШИБКА: {e}")
+    raise
+except Exception as e:
+    logging.error(f"Не удалось проверить версию схемы БД при старте: {e}")
+
 # ====
 # Инициализация Vertex AI при старте приложения
 # ====
@@ -639,6 +587,21 @@ try:
     app.search_model = GenerativeModel(SEARCH_MODEL_NAME)
     logging.info(f"Модель поиска {SEARCH_MODEL_NAME} инициализирована.")
     
+    # Пул обновления саммари: модель создается один раз, Vertex AI уже инициализирован выше
+    init_summary_worker_pool(GenerativeModel(SUMMARY_MODEL_NAME))
+
+    # Фоновый перенос старых сообщений dialogues в архив (вместо очистки в транзакции саммари)
+    try:
+        start_retention_scheduler()
+    except Exception as e:
+        logging.error(f"Ошибка запуска архивации диалогов: {e}")
+
+    # Агрегаты журнала вызовов LLM в llm_call_stats
+    try:
+        llm_ledger.start_ledger_flusher()
+    except Exception as e:
+        logging.error(f"Ошибка запуска записи журнала LLM: {e}")
+
     # Инициализация сервиса напоминаний
     try:
         initialize_reminder_service()
@@ -670,6 +633,50 @@ except Exception as e:
 def ping_main_bot():
     return "Pong from Main Bot!", 200
 
+# ====
+# Метрики процесса для Prometheus (гистограммы этапов — metrics.span в коде ниже)
+# ====
+register_gauge("client_timers", "Живые таймеры буферизации сообщений клиентов", lambda: len(client_timers))
+register_gauge("operator_timers", "Живые таймеры паузы после ответа оператора", lambda: len(operator_timers))
+register_gauge("buffered_messages", "Сообщения в буферах, ожидающие ответа бота",
+               lambda: sum(len(messages) for messages in list(user_buffers.values())))
+register_gauge("cache_entries", "Записей во внутрипроцессных кэшах", lambda: {
+    'recent_event_ids': len(recent_event_ids),
+    'dialog_history': len(dialog_history_dict),
+    'user_names': len(user_names),
+    'user_log_files': len(user_log_files),
+    'user_buffers': len(user_buffers),
+    'attachment_analysis_results': len(attachment_analysis_results),
+    'active_analysis_tasks': len(active_analysis_tasks),
+}, label="cache")
+# Очередь и потоки ThreadPoolExecutor доступны только через внутренние атрибуты
+register_gauge("context_executor_queued", "Задачи в очереди пула ContextBuilder", lambda: context_executor._work_queue.qsize())
+register_gauge("context_executor_threads", "Запущенные потоки пула ContextBuilder", lambda: len(context_executor._threads))
+register_gauge("threads", "Живые потоки процесса", threading.active_count)
+for _counter in ('renders', 'compacted', 'tokens_full', 'tokens', 'summarized_turns', 'dropped_turns',
+                 'dropped_tables', 'summary_truncated', 'over_budget'):
+    register_gauge(f"context_compaction_{_counter}_total", f"Сжатие контекста клиента: {_counter}",
+                   lambda counter=_counter: compaction_stats()[counter], kind="counter")
+for _counter in ('calls', 'clean', 'repaired', 'schema_mismatch', 'failed', 'retries'):
+    register_gauge(f"structured_output_{_counter}_total", f"Структурированные ответы LLM: {_counter}",
+                   lambda counter=_counter: {site: stats[counter] for site, stats in structured_output_stats().items()},
+                   label="call_site", kind="counter")
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/llm_ledger', methods=['GET'])
+def llm_ledger_endpoint():
+    """Перцентили вызовов LLM по точкам вызова (?window=секунды, ?recent=N — последние вызовы)."""
+    window = request.args.get('window', type=float)
+    recent = request.args.get('recent', default=0, type=int)
+    report = {'call_sites': llm_ledger.ledger_stats(window)}
+    if recent:
+        report['recent'] = llm_ledger.recent_calls(recent)
+    return jsonify(report), 200
+
 @app.route("/activate_reminder", methods=["POST"])
 def activate_reminder():
     """
@@ -1143,7 +1150,7 @@ def get_last_n_messages(conv_id, n=2):
             rows = cur.fetchall()
             # Убираем временные метки из сообщений для чистоты
             messages = list(reversed([
-                {"role": row["role"], "message": re.sub(r'^\\[.*?\\]\\s*', '', row["message"])}
+                {"role": row["role"], "message": strip_timestamp(row["message"])}
                 for row in rows
             ]))
     except psycopg2.Error as e:
@@ -1201,18 +1208,15 @@ def find_relevant_titles_with_gemini(dialog_snippet, model=None):
 """
     try:
         logging.info(f"Запрос к {SEARCH_MODEL_NAME} для поиска релевантных заголовков по диалогу: {formatted_dialog}")
-        response = search_model_to_use.generate_content(prompt)
+        response = llm_ledger.generate(
+            search_model_to_use, prompt, "kb_titles",
+            generation_config=GenerationConfig(**json_generation_params(KB_TITLES_RESPONSE_SCHEMA))
+        )
         
         logging.debug(f"Получен сырой ответ от модели поиска: {response.text}")
         
-        # Улучшенный парсинг JSON из ответа модели
-        match = re.search(r'\{.*\}', response.text, re.DOTALL)
-        if not match:
-            logging.warning(f"Модель поиска вернула невалидный JSON (не найдена структура {{}}). Ответ: {response.text}")
-            return []
-            
-        json_response = json.loads(match.group(0))
-        relevant_titles = json_response.get("titles", [])
+        json_response = parse_json_response(response.text, KB_TITLES_RESPONSE_SCHEMA, "kb_titles")
+        relevant_titles = json_response.get("titles", []) if isinstance(json_response, dict) else None
 
         if not isinstance(relevant_titles, list):
             logging.warning(f"Поле 'titles' в JSON-ответе не является списком. Ответ: {response.text}")
@@ -1226,7 +1230,7 @@ def find_relevant_titles_with_gemini(dialog_snippet, model=None):
         
         return final_titles
 
-    except json.JSONDecodeError:
+    except StructuredOutputError:
         logging.error(f"Ошибка декодирования JSON ответа от модели поиска. Ответ: {response.text}")
         return []
     except Exception as e:
@@ -1234,10 +1238,14 @@ def find_relevant_titles_with_gemini(dialog_snippet, model=None):
         return []
 
 
-def generate_response(user_question_text, context_from_builder, current_custom_prompt, user_first_name, model, relevant_kb_titles=None):
+def generate_response(user_question_text, client_context, current_custom_prompt, user_first_name, model, relevant_kb_titles=None):
     """
     Генерирует ответ от модели Gemini с учётом контекста от Context Builder и подсказок из базы знаний.
+
+    Args:
+        client_context (ClientContext): Структурированный контекст клиента от build_context_sync.
     """
+    assembly_started = time.perf_counter()
     knowledge_hint_text = ""
     if relevant_kb_titles and knowledge_base:
         kb_lines = []
@@ -1248,8 +1256,8 @@ def generate_response(user_question_text, context_from_builder, current_custom_p
         if kb_lines:
             knowledge_hint_text = "Контекст из базы знаний:\n" + "\n".join(kb_lines)
 
-    # Извлекаем данные о дне рождения из контекста и рассчитываем сообщение
-    birth_day, birth_month = extract_birthday_from_context(context_from_builder)
+    # Дата рождения берется прямо из профиля, без разбора отрисованного текста
+    birth_day, birth_month = client_context.birthday
     birthday_status = calculate_birthday_discount_status(birth_day, birth_month)
     birthday_discount_message = birthday_status.get('message', '')
     
@@ -1264,8 +1272,12 @@ def generate_response(user_question_text, context_from_builder, current_custom_p
     formatted_prompt = current_custom_prompt.format(birthday_discount_message=birthday_discount_message)
 
     prompt_parts = [formatted_prompt]
-    if context_from_builder.strip():
-        prompt_parts.append(f"Информация о клиенте и история диалога:\n{context_from_builder.strip()}")
+    context_text = client_context.render().strip()
+    if client_context.compaction:
+        logging.info(f"Контекст клиента: {client_context.compaction}")
+        client_context.record_compaction()
+    if context_text:
+        prompt_parts.append(f"Информация о клиенте и история диалога:\n{context_text}")
     if knowledge_hint_text:
         prompt_parts.append(knowledge_hint_text)
 
@@ -1275,6 +1287,7 @@ def generate_response(user_question_text, context_from_builder, current_custom_p
     prompt_parts.append("Твой ответ (Модель):")
 
     full_prompt_text = "\n\n".join(prompt_parts)
+    observe("prompt_assembly", time.perf_counter() - assembly_started)
 
     prompt_log_filename = f"prompt_gemini_{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S_%f')}.txt"
     prompt_log_filepath = os.path.join(LOGS_DIRECTORY, prompt_log_filename)
@@ -1288,11 +1301,17 @@ def generate_response(user_question_text, context_from_builder, current_custom_p
 
     for attempt in range(3):
         try:
-            response = model.generate_content(full_prompt_text)
+            with span("gemini_generate"):
+                response = llm_ledger.generate(model, full_prompt_text, "reply", attempt=attempt)
             model_response_text = response.text.strip()
             logging.info(f"Ответ от Gemini (Vertex AI) получен: '{model_response_text[:200]}...'")
             return model_response_text
-        
+
+        except PromptBudgetExceeded as e:
+            # Повтор с тем же промптом бессмыслен
+            logging.error(f"Промпт ответа не отправлен в Vertex AI: {e}")
+            return "Извините, я сейчас не могу ответить. Пожалуйста, попробуйте позже или напишите 'оператор', если вопрос срочный."
+
         except Exception as e:
             logging.error(f"Ошибка Vertex AI при генерации ответа (попытка {attempt + 1}): {e}")
             if attempt < 2:
@@ -1344,7 +1363,7 @@ def generate_summary_and_reason(dialog_history_list_for_summary, model):
 
     for attempt in range(2):
         try:
-            response = model.generate_content(prompt_text)
+            response = llm_ledger.generate(model, prompt_text, "operator_summary", attempt=attempt)
             output_text = response.text.strip()
             parts = output_text.split("\n", 1)
             dialog_summary_text = parts[0].strip() if len(parts) > 0 else "Сводка не сформирована"
@@ -1362,6 +1381,7 @@ def generate_summary_and_reason(dialog_history_list_for_summary, model):
 # ====
 # 8. ПРОВЕРКА АКТИВНОСТИ ОПЕРАТОРА
 # ====
+@timed("operator_check")
 def check_operator_activity_and_cleanup(conv_id):
     """
     Проверяет, был ли оператор недавно активен для данного conv_id.
@@ -1422,6 +1442,7 @@ def check_operator_activity_and_cleanup(conv_id):
 # ====
 # 9. ОБРАБОТКА ПОСТУПИВШЕГО СООБЩЕНИЯ ИЗ VK CALLBACK
 # ====
+@timed("handle_message")
 def handle_new_message(user_id_from_vk, message_text_from_vk, vk_api_object, vk_callback_data, is_outgoing_message=False, conversation_id=None):
     """
     Обрабатывает новое сообщение, полученное через VK Callback API.
@@ -1497,6 +1518,7 @@ def handle_new_message(user_id_from_vk, message_text_from_vk, vk_api_object, vk_
 # ====
 # 10. ФОРМИРОВАНИЕ И ОТПРАВКА ОТВЕТА БОТА ПОСЛЕ ЗАДЕРЖКИ
 # ====
+@timed("reply_total")
 def generate_and_send_response(conv_id_to_respond, vk_api_for_sending, vk_callback_data, model, reminder_context=None):
     """
     Вызывается по истечении USER_MESSAGE_BUFFERING_DELAY или при активации напоминания.
@@ -1532,7 +1554,8 @@ def generate_and_send_response(conv_id_to_respond, vk_api_for_sending, vk_callba
         user_buffers[conv_id_to_respond] = []
         
         # ДОБАВИТЬ: Ожидание завершения анализа вложений
-        attachment_analysis = wait_for_attachment_analysis(conv_id_to_respond)
+        with span("attachment_wait"):
+            attachment_analysis = wait_for_attachment_analysis(conv_id_to_respond)
         if attachment_analysis:
             combined_user_text = f"{combined_user_text}\n\n[АНАЛИЗ ВЛОЖЕНИЙ]\n{attachment_analysis}"
             logging.info(f"Анализ вложений добавлен к сообщению для conv_id {conv_id_to_respond}")
@@ -1546,22 +1569,27 @@ def generate_and_send_response(conv_id_to_respond, vk_api_for_sending, vk_callba
         del client_timers[conv_id_to_respond]
         logging.debug(f"Клиентский таймер для conv_id {conv_id_to_respond} удален после выполнения.")
 
-    first_name, last_name = get_user_name_from_db(conv_id_to_respond)
-    user_display_name = f"{first_name} {last_name}".strip() if first_name or last_name else f"User_{conv_id_to_respond}"
-
     try:
-        context_from_builder = call_context_builder_async(vk_callback_data)
+        with span("context_build"):
+            client_context = call_context_builder_async(vk_callback_data)
         logging.info(f"Асинхронный Context Builder успешно вернул контекст для conv_id {conv_id_to_respond}")
 
         # Если это вызов от напоминания, добавляем контекст в начало промпта
         if reminder_context:
-            context_from_builder = f"[СИСТЕМНОЕ УВЕДОМЛЕНИЕ] Сработало напоминание. Причина: '{reminder_context}'. Проанализируй весь диалог и реши, уместно ли сейчас возобновлять общение. Если да — напиши релевантное сообщение клиенту. Если нет — верни ПУСТУЮ СТРОКУ.\\n\\n{context_from_builder}"
+            client_context.set_system_notice(f"[СИСТЕМНОЕ УВЕДОМЛЕНИЕ] Сработало напоминание. Причина: '{reminder_context}'. Проанализируй весь диалог и реши, уместно ли сейчас возобновлять общение. Если да — напиши релевантное сообщение клиенту. Если нет — верни ПУСТУЮ СТРОКУ.")
 
     except Exception as e:
         logging.error(f"Ошибка вызова Context Builder для conv_id {conv_id_to_respond}: {e}")
         logging.error(f"Обработка запроса для conv_id {conv_id_to_respond} прекращена из-за ошибки Context Builder")
         return
 
+    # Имя берем из только что обновленного профиля; запрос к БД — только если профиля еще нет
+    if client_context.profile:
+        first_name, last_name = client_context.first_name or "", client_context.last_name or ""
+    else:
+        first_name, last_name = get_user_name_from_db(conv_id_to_respond)
+    user_display_name = f"{first_name} {last_name}".strip() if first_name or last_name else f"User_{conv_id_to_respond}"
+
     # 1. Получаем последнее сообщение из БД (это должен быть ответ бота)
     last_messages_from_db = get_last_n_messages(conv_id_to_respond, n=1)
     
@@ -1575,11 +1603,12 @@ def generate_and_send_response(conv_id_to_respond, vk_api_for_sending, vk_callba
 
     logging.info(f"Сформирован dialog_snippet для поиска заголовков: {dialog_snippet}")
 
-    relevant_titles_from_kb = find_relevant_titles_with_gemini(dialog_snippet)
+    with span("kb_title_search"):
+        relevant_titles_from_kb = find_relevant_titles_with_gemini(dialog_snippet)
 
     bot_response_text = generate_response(
         user_question_text=combined_user_text,
-        context_from_builder=context_from_builder,
+        client_context=client_context,
         current_custom_prompt=custom_prompt,
         user_first_name=first_name,
         model=model,
@@ -1654,7 +1683,8 @@ def generate_and_send_response(conv_id_to_respond, vk_api_for_sending, vk_callba
                 logging.info(f"К сообщению будут прикреплены видео: {video_attachments}")
             
             # Отправляем сообщение с возможными вложениями
-            vk_api_for_sending.messages.send(**send_params)
+            with span("vk_send"):
+                vk_api_for_sending.messages.send(**send_params)
             logging.info(f"Ответ бота успешно отправлен пользователю {conv_id_to_respond}.")
         except vk_api.ApiError as e:
             logging.error(f"VK API Ошибка при отправке сообщения пользователю {conv_id_to_respond}: {e}")
@@ -1664,13 +1694,15 @@ def generate_and_send_response(conv_id_to_respond, vk_api_for_sending, vk_callba
         logging.warning(f"Объект VK API не передан в generate_and_send_response для conv_id {conv_id_to_respond}. Сообщение не отправлено.")
 
     try:
-        call_summary_updater_async(conv_id_to_respond)
+        with span("summary_dispatch"):
+            call_summary_updater_async(conv_id_to_respond)
     except Exception as e:
         logging.error(f"Ошибка при запуске Summary Updater для conv_id {conv_id_to_respond}: {e}")
     
     # Обработка напоминаний
     try:
-        process_reminder_message(conv_id_to_respond)
+        with span("reminder_analysis"):
+            process_reminder_message(conv_id_to_respond)
         logging.info(f"Сервис напоминаний обработал сообщение для conv_id {conv_id_to_respond}")
     except Exception as e:
         logging.error(f"Ошибка при обработке напоминаний для conv_id {conv_id_to_respond}: {e}")
@@ -1680,6 +1712,7 @@ def generate_and_send_response(conv_id_to_respond, vk_api_for_sending, vk_callba
 # 11. ОБРАБОТЧИК CALLBACK ОТ VK И ЗАПУСК ПРИЛОЖЕНИЯ
 # ====
 @app.route("/callback", methods=["POST"])
+@timed("callback")
 def callback_handler():
     try:
         data = request.json
@@ -1700,9 +1733,9 @@ def callback_handler():
         # 2. Логирование всего payload от VK
         # logging.info(f"Получен callback от VK: {json.dumps(data, indent=2, ensure_ascii=False)}")
         
-        # 3. Сохранение всего payload в БД
-        # Запускаем сохранение в фоновом потоке, чтобы не задерживать ответ VK
-        context_executor.submit(save_callback_payload, data)
+        # 3. Сохранение всего payload в журнал callback_logs
+        # Событие только ставится в очередь журнала, ответ VK не ждет записи на диск
+        save_callback_payload(data)
 
         # 4. Обработка callback в зависимости от типа события
         if data["type"] == "confirmation":
@@ -1759,65 +1792,9 @@ def callback_handler():
 
 # Таблицы, которые нужно исключить из автоматического поиска
 EXCLUDED_TABLES = ['operator_activity']
-# Лимит на количество последних сообщений для истории диалога
-DIALOGUES_LIMIT = 30
 # Регулярное выражение для поиска email
 EMAIL_REGEX = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
 
-def remove_internal_tags(message):
-    """
-    Удаляет внутренние размышления бота, ограниченные тегами <internal> и <internal_analysis>.
-    """
-    import re
-    
-    # Удаляем теги <internal> и </internal>
-    message = re.sub(r'<internal>.*?</internal>', '', message, flags=re.DOTALL | re.IGNORECASE)
-    
-    # Удаляем теги <internal_analysis> и </internal_analysis>
-    message = re.sub(r'<internal_analysis>.*?</internal_analysis>', '', message, flags=re.DOTALL | re.IGNORECASE)
-    
-    # Убираем лишние пробелы и переносы строк
-    message = re.sub(r'\n\s*\n', '\n', message)  # Убираем множественные переносы
-    message = message.strip()  # Убираем пробелы в начале и конце
-    
-    return message
-
-def vkvideo_add(message_text):
-    """
-    Проверяет сообщение на наличие идентификаторов видео VK и вырезает их.
-    Также удаляет двойные звездочки, которые не отображаются как жирный текст в VK.
-    
-    Args:
-        message_text (str): Текст сообщения
-        
-    Returns:
-        tuple: (очищенный_текст_сообщения, список_идентификаторов_видео)
-    """
-    import re
-    
-    # Удаляем двойные звездочки, которые не преобразуются в жирный шрифт в ВК
-    message_text = message_text.replace('**', '')
-    
-    # Регулярное выражение для поиска идентификаторов видео в формате цифры_цифры
-    video_pattern = r'\b(\d+_\d+)\b'
-    matches = re.findall(video_pattern, message_text)
-    
-    if matches:
-        # Удаляем все найденные идентификаторы видео из текста сообщения
-        # НЕ ИЗМЕНЯЕМ форматирование текста
-        cleaned_message = re.sub(video_pattern, '', message_text)
-        return cleaned_message, matches
-    else:
-        # Даже если видео не найдены, все равно удаляем двойные звездочки
-        # НЕ ИЗМЕНЯЕМ форматирование текста
-        return message_text, []
-
-def context_default_serializer(obj):
-    """Сериализатор для JSON, обрабатывающий datetime."""
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    raise TypeError(f"Тип {type(obj)} не сериализуется в JSON")
-
 def fetch_and_update_vk_profile(conn, conv_id):
     """
     Получает данные из VK API и обновляет/создает профиль пользователя в БД.
@@ -1974,103 +1951,13 @@ def fetch_data_from_table(conn, table_name, conv_id):
         logging.error(f"Ошибка при извлечении данных из таблицы '{table_name}': {e}")
         return []
 
-def format_user_profile(rows):
-    if not rows: return ""
-    profile = rows[0]
-    lines = [f"--- КАРТОЧКА КЛИЕНТА ---"]
-    if profile.get('first_name') or profile.get('last_name'):
-        lines.append(f"Имя: {profile.get('first_name', '')} {profile.get('last_name', '')}".strip())
-    # Добавлены новые поля из VK
-    if profile.get('screen_name'):
-        lines.append(f"Профиль VK: https://vk.com/{profile['screen_name']}")
-    if profile.get('city'):
-        lines.append(f"Город: {profile['city']}")
-    if profile.get('birth_day') and profile.get('birth_month'):
-        birth_day = profile['birth_day']
-        birth_month = profile['birth_month']
-        month_name = RUSSIAN_MONTHS.get(birth_month, str(birth_month))
-        lines.append(f"Дата рождения: {birth_day} {month_name}")
-        logging.info(f"Добавлена дата рождения в карточку: {birth_day} {month_name}")
-    else:
-        logging.info(f"Дата рождения отсутствует: birth_day={profile.get('birth_day')}, birth_month={profile.get('birth_month')}")
-    
-    if profile.get('lead_qualification'):
-        lines.append(f"Квалификация лида: {profile['lead_qualification']}")
-    if profile.get('funnel_stage'):
-        lines.append(f"Этап воронки: {profile['funnel_stage']}")
-    if profile.get('client_level'):
-        lines.append(f"Уровень клиента: {', '.join(profile['client_level'])}")
-    if profile.get('learning_goals'):
-        lines.append(f"Цели обучения: {', '.join(profile['learning_goals'])}")
-    if profile.get('client_pains'):
-        lines.append(f"Боли клиента: {', '.join(profile['client_pains'])}")
-    if profile.get('dialogue_summary'):
-        lines.append(f"\nКраткое саммари диалога:\n{profile['dialogue_summary']}")
-    return "\n".join(lines)
-
-def format_client_purchases(rows):
-    if not rows: return ""
-    lines = ["--- ПОДТВЕРЖДЕННЫЕ ПОКУПКИ (из платежной системы) ---"]
-    for row in rows:
-        purchase_date = row.get('purchase_date').strftime('%Y-%m-%d') if row.get('purchase_date') else 'неизвестно'
-        lines.append(f"- Продукт: {row.get('product_name')}, Дата: {purchase_date}")
-    return "\n".join(lines)
-
-def format_purchased_products(rows):
-    if not rows: return ""
-    lines = ["--- УПОМЯНУТЫЕ ПОКУПКИ (со слов клиента) ---"]
-    for row in rows:
-        lines.append(f"- {row.get('product_name')}")
-    return "\n".join(lines)
-
-def format_dialogues(rows):
-    if not rows: return ""
-    lines = [f"--- ПОСЛЕДНЯЯ ИСТОРИЯ ДИАЛОГА (до {DIALOGUES_LIMIT} сообщений) ---"]
-    for row in reversed(rows):
-        role_map = {'user': 'Пользователь', 'bot': 'Модель', 'operator': 'Оператор'}
-        role = role_map.get(row.get('role', 'unknown'), 'Неизвестно')
-        message_text = row.get('message', '')
-        clean_message = re.sub(r'^\[\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}\]\s*', '', message_text)
-        lines.append(f"{role}: {clean_message}")
-    return "\n".join(lines)
-
-def format_active_reminders(rows):
-    """Форматтер для активных напоминаний агента-коммуникатора."""
-    if not rows: 
-        return "--- АКТИВНЫЕ НАПОМИНАНИЯ ---\nНет активных напоминаний"
-    
-    lines = ["--- АКТИВНЫЕ НАПОМИНАНИЯ ---"]
-    for reminder in rows:
-        reminder_time = reminder.get('reminder_datetime', 'неизвестно')
-        reminder_context = reminder.get('reminder_context_summary', 'без описания')
-        
-        # Форматируем время для удобочитаемости
-        if reminder_time != 'неизвестно':
-            try:
-                if hasattr(reminder_time, 'strftime'):
-                    time_str = reminder_time.strftime('%Y-%m-%d %H:%M')
-                else:
-                    time_str = str(reminder_time)
-            except:
-                time_str = str(reminder_time)
-        else:
-            time_str = 'неизвестно'
-            
-        lines.append(f"📅 {time_str}: {reminder_context}")
-    
-    return "\n".join(lines)
-
-def format_generic(rows, table_name):
-    if not rows: return ""
-    lines = [f'--- ДАННЫЕ ИЗ ТАБЛИЦЫ "{table_name}" ---']
-    for i, row in enumerate(rows):
-        row_str = json.dumps(row, ensure_ascii=False, indent=None, default=context_default_serializer)
-        lines.append(f"- Запись {i+1}: {row_str}")
-    return "\n".join(lines)
-
 def build_context_sync(vk_callback_data):
     """
     Синхронная версия context builder - перенесенная логика из context_builder.py
+
+    Returns:
+        ClientContext: Строки профиля, покупок, напоминаний и диалога; текст для промпта
+        отрисовывается один раз при вызове render().
     """
     try:
         # Извлекаем ID пользователя (from_id) из структуры VK
@@ -2084,48 +1971,33 @@ def build_context_sync(vk_callback_data):
             if not conv_id:
                 raise ValueError("Не найден 'from_id' или 'conv_id' во входных данных.")
 
-        output_blocks = []
+        client_context = ClientContext(conv_id)
 
         # Работа с базой данных
         with get_main_db_connection() as conn:
             # === ШАГ 1: ОБНОВИТЬ ПРОФИЛЬ ИЗ VK API ===
-            fetch_and_update_vk_profile(conn, conv_id)
+            with span("context_vk_profile"):
+                fetch_and_update_vk_profile(conn, conv_id)
             
             # === ШАГ 2: Связать покупки по email (side-effect) ===
-            update_conv_id_by_email(conn, conv_id, message_text)
+            with span("context_email_link"):
+                update_conv_id_by_email(conn, conv_id, message_text)
 
             # === ШАГ 3: Собрать все данные для контекста ===
-            tables_to_scan = find_user_data_tables(conn)
+            with span("context_table_discovery"):
+                tables_to_scan = find_user_data_tables(conn)
 
             preferred_order = ['reminders', 'user_profiles', 'client_purchases', 'purchased_products', 'dialogues']
             ordered_tables = [t for t in preferred_order if t in tables_to_scan]
             ordered_tables.extend([t for t in tables_to_scan if t not in preferred_order])
 
-            formatters = {
-                'user_profiles': format_user_profile,
-                'client_purchases': format_client_purchases,
-                'purchased_products': format_purchased_products,
-                'dialogues': format_dialogues,
-                'reminders': format_active_reminders
-            }
-
             for table in ordered_tables:
-                rows = fetch_data_from_table(conn, table, conv_id)
-                
-                # КРИТИЧЕСКИ ВАЖНО: Для таблицы reminders вызываем форматтер всегда, даже если нет данных
-                if rows or table == 'reminders':
-                    formatter_func = formatters.get(table, format_generic)
-                    if formatter_func == format_generic:
-                        formatted_block = formatter_func(rows, table)
-                    else:
-                        formatted_block = formatter_func(rows)
-
-                    if formatted_block:
-                        output_blocks.append(formatted_block)
+                # КРИТИЧЕСКИ ВАЖНО: таблица reminders попадает в контекст всегда, даже если нет данных
+                with span("context_table", table=table):
+                    rows = fetch_data_from_table(conn, table, conv_id)
+                client_context.add_table(table, rows)
 
-        # Формирование итогового результата
-        final_context = "\n\n".join(output_blocks)
-        return final_context
+        return client_context
 
     except Exception as e:
         logging.error(f"FATAL ERROR in build_context_sync: {e}")
@@ -2140,7 +2012,10 @@ def call_context_builder_async(vk_callback_data):
         # Ждем результат, но это не блокирует других пользователей
         # так как каждый пользователь обрабатывается в своем потоке
         context_result = future.result(timeout=45)
-        logging.info(f"Context Builder успешно вернул контекст (длина: {len(context_result)} символов)")
+        # Без render(): текст отрисовывается один раз при сборке промпта, после set_system_notice
+        logging.info(f"Context Builder успешно вернул контекст (профиль: {'есть' if context_result.profile else 'нет'}, "
+                     f"сообщений: {len(context_result.dialogues)}, покупок: {len(context_result.client_purchases)}, "
+                     f"других таблиц: {len(context_result.other_tables)})")
         return context_result
     except Exception as e:
         logging.error(f"Ошибка при асинхронном вызове Context Builder: {e}")
@@ -0,0 +1,194 @@
+# --- Описание ---
+# Легковесные замеры этапов обработки и эндпоинт /metrics в формате Prometheus.
+#
+# - span("этап", метка=значение) — контекстный менеджер, замеряет длительность блока
+#   (time.perf_counter) и добавляет ее в гистограмму этапа. Исключение внутри блока
+#   тоже учитывается: длительность попадает в гистограмму, а счетчик ошибок этапа растет.
+# - timed("этап") — то же для функции целиком (декоратор).
+# - register_gauge(...) — значение, которое вычисляется при каждом запросе /metrics
+#   (глубина очередей, число таймеров, размеры кэшей, занятость пулов). Модули
+#   регистрируют свои показатели сами, metrics.py ничего о них не знает.
+#
+# Гистограммы — фиксированные корзины (STAGE_BUCKETS), на каждый замер одна блокировка
+# и несколько сравнений, поэтому замеры можно ставить и в горячий путь ответа.
+# Все метрики хранятся в памяти процесса: при нескольких воркерах gunicorn каждый
+# воркер отдает свои значения (Prometheus различает их по instance/перезапускам).
+# --- Конец описания ---
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+METRICS_PREFIX = "bot"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Верхние границы корзин в секундах: от запросов к БД до ответа Gemini с повторами
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_lock = threading.Lock()
+_histograms = {}   # (этап, метки) -> [счетчики корзин..., +Inf], сумма
+_errors = {}       # (этап, метки) -> число исключений
+_gauges = []       # (имя, описание, тип, метка, функция)
+_started_at = time.time()
+
+
+class _Histogram:
+    __slots__ = ("counts", "total")
+
+    def __init__(self):
+        self.counts = [0] * (len(STAGE_BUCKETS) + 1)
+        self.total = 0.0
+
+
+def _key(stage, labels):
+    return stage, tuple(sorted(labels.items()))
+
+
+def observe(stage, seconds, **labels):
+    """Добавляет длительность этапа stage (в секундах) в его гистограмму."""
+    index = len(STAGE_BUCKETS)
+    for position, bound in enumerate(STAGE_BUCKETS):
+        if seconds <= bound:
+            index = position
+            break
+    key = _key(stage, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram()
+        histogram.counts[index] += 1
+        histogram.total += seconds
+
+
+@contextmanager
+def span(stage, **labels):
+    """Замеряет длительность блока with как этап stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        with _lock:
+            key = _key(stage, labels)
+            _errors[key] = _errors.get(key, 0) + 1
+        raise
+    finally:
+        observe(stage, time.perf_counter() - started, **labels)
+
+
+def timed(stage):
+    """Декоратор: каждый вызов функции замеряется как этап stage."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_gauge(name, help_text, fn, label=None, kind="gauge"):
+    """
+    Регистрирует показатель, вычисляемый при запросе /metrics.
+
+    Args:
+        name (str): Имя без префикса (например, "client_timers").
+        fn: Функция без аргументов. Возвращает число либо, если задана label,
+            словарь {значение метки: число}.
+        label (str): Имя метки для словаря значений.
+        kind (str): "gauge" или "counter" (для накопительных счетчиков, имя должно оканчиваться на _total).
+    """
+    with _lock:
+        _gauges.append((name, help_text, kind, label, fn))
+
+
+def percentile(values, p):
+    """Перцентиль методом ближайшего ранга (values не обязаны быть отсортированы)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(1, -(-p * len(ordered) // 100)) - 1]
+
+
+def stage_stats():
+    """Сводка по этапам для отладки: число замеров, сумма и среднее в миллисекундах."""
+    with _lock:
+        return {
+            stage + "".join(f"[{k}={v}]" for k, v in labels): {
+                'count': sum(histogram.counts),
+                'total_ms': round(histogram.total * 1000, 1),
+                'mean_ms': round(histogram.total * 1000 / max(1, sum(histogram.counts)), 1),
+                'errors': _errors.get((stage, labels), 0),
+            }
+            for (stage, labels), histogram in sorted(_histograms.items())
+        }
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels_text(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus 0.0.4."""
+    with _lock:
+        histograms = [(key, list(h.counts), h.total) for key, h in sorted(_histograms.items())]
+        errors = sorted(_errors.items())
+        gauges = list(_gauges)
+
+    lines = []
+    name = f"{METRICS_PREFIX}_stage_duration_seconds"
+    lines.append(f"# HELP {name} Длительность этапов обработки сообщений и фоновых задач")
+    lines.append(f"# TYPE {name} histogram")
+    for (stage, labels), counts, total in histograms:
+        base = (("stage", stage),) + labels
+        cumulative = 0
+        for bound, count in zip(STAGE_BUCKETS + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels_text(base + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{_labels_text(base)} {_format_value(total)}")
+        lines.append(f"{name}_count{_labels_text(base)} {cumulative}")
+
+    name = f"{METRICS_PREFIX}_stage_errors_total"
+    lines.append(f"# HELP {name} Исключения внутри замеряемых этапов")
+    lines.append(f"# TYPE {name} counter")
+    for (stage, labels), count in errors:
+        lines.append(f"{name}{_labels_text((('stage', stage),) + labels)} {count}")
+
+    name = f"{METRICS_PREFIX}_process_start_time_seconds"
+    lines.append(f"# TYPE {name} gauge")
+    lines.append(f"{name} {_format_value(_started_at)}")
+
+    # Показатели с одним именем (например, по пулу на каждый LLMExecutor) выводятся одним семейством
+    families = {}
+    for gauge_name, help_text, kind, label, fn in gauges:
+        try:
+            value = fn()
+        except Exception as e:
+            # Показатель не должен ломать весь ответ /metrics
+            logging.warning(f"Метрика {gauge_name} не вычислена: {e}")
+            continue
+        full_name = f"{METRICS_PREFIX}_{gauge_name}"
+        family = families.setdefault(full_name, [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} {kind}"])
+        if label:
+            for label_value, sample in sorted((value or {}).items(), key=lambda item: str(item[0])):
+                family.append(f"{full_name}{_labels_text(((label, label_value),))} {_format_value(sample)}")
+        else:
+            family.append(f"{full_name} {_format_value(value)}")
+    for family in families.values():
+        lines.extend(family)
+    return "\n".join(lines) + "\n"
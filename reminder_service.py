@@ -29,7 +29,7 @@ import os
 import sys
 import json
 import logging
-import re
+import socket
 import psycopg2
 import psycopg2.extras
 from datetime import datetime, timedelta, timezone
@@ -39,17 +39,29 @@ import pytz
 import requests
 from itertools import groupby
 from operator import itemgetter
+from temporal_detector import should_analyze_for_reminders
+from text_processing import detect_timezone, strip_timestamp
+from reminder_similarity import (
+    compute_signature, compute_lsh_bands, estimate_similarity, is_duplicate, EXHAUSTIVE_COMPARE_LIMIT
+)
+from structured_output import json_generation_params, parse_json_response, StructuredOutputError
+from metrics import timed, register_gauge
+import llm_ledger
 
 # Словарь блокировок для предотвращения конкурентного создания напоминаний
 reminder_creation_locks = {}
 
+# Соединение, удерживающее advisory lock диспетчера (живет, пока процесс - диспетчер)
+# Формат: {"conn": connection, "pid": pid процесса-владельца}
+dispatcher_lock_state = {"conn": None, "pid": None}
+
 # Словарь для отслеживания неудачных попыток активации напоминаний
 # Формат: {reminder_id: {"attempts": count, "last_error": "error_message", "first_attempt": datetime}}
 failed_activation_attempts = {}
 
 try:
     import vertexai
-    from vertexai.generative_models import GenerativeModel
+    from vertexai.generative_models import GenerativeModel, GenerationConfig
     from google.oauth2 import service_account
     VERTEXAI_AVAILABLE = True
 except ImportError:
@@ -72,6 +84,20 @@ CHECK_INTERVAL_MINUTES = 5
 # Увеличенный таймаут для активации напоминаний
 ACTIVATION_TIMEOUT = 120  # 2 минуты
 
+# Аренда (lease) напоминаний: захваченное напоминание принадлежит одному экземпляру
+# сервиса до истечения аренды. Если экземпляр упал, reaper вернет его в 'active'.
+# Перед отправкой активации аренда продлевается, а статус меняет только ее владелец.
+REMINDER_LEASE_SECONDS = ACTIVATION_TIMEOUT * 3  # С запасом на активацию и повторную попытку
+# Максимум напоминаний, захватываемых за одну проверку. Созревшие сверх лимита остаются
+# в 'active' и захватываются следующими проверками, поэтому массово завершать их нельзя.
+CLAIM_BATCH_SIZE = 200
+# Ключ advisory lock для выбора единственного диспетчера напоминаний на весь деплой
+DISPATCHER_LOCK_KEY = 48116621026
+
+# Пред-фильтр: сколько последних сообщений проверять локальным детектором перед вызовом Gemini.
+# Более старые сообщения уже были проанализированы при предыдущих вызовах.
+PREFILTER_MESSAGES_TO_SCAN = 4
+
 # Настройки логирования
 LOG_FILE_NAME = "reminder_service.log"
 
@@ -276,28 +302,33 @@ def get_timezone_by_city(city):
 
 def detect_timezone_from_message(message_text):
     """Определяет, указан ли в сообщении конкретный часовой пояс."""
-    message_lower = message_text.lower()
-    
-    # Проверяем упоминания конкретных часовых поясов
-    timezone_patterns = [
-        (r'по\s+москве|московское\s+время|мск', 'Europe/Moscow'),
-        (r'по\s+питеру|по\s+спб|питерское\s+время', 'Europe/Moscow'),
-        (r'по\s+екатеринбургу|екатеринбургское\s+время', 'Asia/Yekaterinburg'),
-        (r'по\s+новосибирску|новосибирское\s+время', 'Asia/Novosibirsk'),
-        (r'по\s+владивостоку|владивостокское\s+время', 'Asia/Vladivostok'),
-        (r'utc|гринвич', 'UTC'),
-        (r'по\s+киеву|киевское\s+время', 'Europe/Kiev'),
-        (r'по\s+минску|минское\s+время', 'Europe/Minsk'),
-        (r'по\s+алматы', 'Asia/Almaty'),
-    ]
-    
-    for pattern, timezone in timezone_patterns:
-        if re.search(pattern, message_lower):
-            return timezone
-    
-    return None
+    # Все известные часовые пояса проверяются одной предкомпилированной альтернативой
+    return detect_timezone(message_text)
 
 # --- ПРОМПТЫ ДЛЯ AI ---
+# Схема ответа анализа диалога (подмножество OpenAPI, которое принимает Vertex AI)
+REMINDER_ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "reminders": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "action": {"type": "STRING", "enum": ["create", "update", "cancel", "none"]},
+                    "target_conv_id": {"type": "INTEGER"},
+                    "proposed_datetime": {"type": "STRING"},
+                    "reminder_context_summary": {"type": "STRING"},
+                    "cancellation_reason": {"type": "STRING"},
+                    "none_reason": {"type": "STRING"},
+                },
+                "required": ["action"],
+            },
+        },
+    },
+    "required": ["reminders"],
+}
+
 PROMPT_ANALYZE_DIALOGUE = """
 Ты — AI-ассистент, анализирующий диалоги онлайн-школы музыки для выявления договоренностей о будущем контакте.
 
@@ -616,45 +647,77 @@ def get_db_connection():
         raise ConnectionError("Переменная окружения DATABASE_URL не установлена!")
     return psycopg2.connect(DATABASE_URL)
 
-def call_gemini_api(model, prompt, expect_json=True):
-    """Вызывает модель Gemini через Vertex AI SDK."""
+def get_instance_id():
+    """
+    Возвращает идентификатор текущего экземпляра сервиса (хост:PID).
+    Вычисляется при каждом вызове, т.к. при gunicorn --preload модуль импортируется до fork.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def find_similar_active_reminders(cur, conv_id, text, around_datetime=None):
+    """
+    Ищет активные напоминания клиента, похожие на текст, через LSH-ключи (индекс GIN).
+    Если активных напоминаний у клиента не больше EXHAUSTIVE_COMPARE_LIMIT, сравниваются все:
+    LSH отбирает лишь ~89% пар на пороге схожести. Напоминания без сигнатуры (созданные
+    другими скриптами) проверяются по тексту.
+
+    Args:
+        cur: Курсор БД.
+        conv_id (int): ID клиента.
+        text (str): Описание, с которым сравниваем.
+        around_datetime (datetime, optional): Если задано, ищем только напоминания в пределах часа от этого времени.
+
+    Returns:
+        list: Кортежи (id, reminder_context_summary, схожесть) для напоминаний со схожестью выше порога.
+    """
+    signature = compute_signature(text)
+    if not signature:
+        return []
+
+    query = """
+        SELECT id, reminder_context_summary, minhash_signature
+        FROM reminders
+        WHERE conv_id = %s AND status = 'active'
+          AND (lsh_bands && %s::bigint[] OR lsh_bands IS NULL
+               OR (SELECT COUNT(*) FROM reminders WHERE conv_id = %s AND status = 'active') <= %s)
+    """
+    params = [conv_id, compute_lsh_bands(signature), conv_id, EXHAUSTIVE_COMPARE_LIMIT]
+    if around_datetime is not None:
+        query += " AND ABS(EXTRACT(EPOCH FROM (reminder_datetime - %s))) < 3600"
+        params.append(around_datetime)
+
+    cur.execute(query, params)
+
+    similar = []
+    for row in cur.fetchall():
+        candidate_signature = row[2] or compute_signature(row[1])
+        similarity = estimate_similarity(signature, candidate_signature)
+        logging.info(f"ДЕДУПЛИКАЦИЯ: Сравнение '{text}' vs '{row[1]}' - схожесть {similarity:.2f}")
+        if is_duplicate(similarity):
+            similar.append((row[0], row[1], similarity))
+    return similar
+
+def call_gemini_api(model, prompt, expect_json=True, response_schema=None, call_site="reminder_analysis"):
+    """
+    Вызывает модель Gemini через Vertex AI SDK.
+    Со схемой ответа запрос идет с response_mime_type="application/json", а ответ
+    разбирается structured_output.parse_json_response (с восстановлением обрезанного JSON).
+    """
     try:
-        # logging.info(f"Отправляем запрос в Gemini. Промпт (первые 200 символов): {prompt[:200]}...")
-        
-        response = model.generate_content(prompt)
+        if response_schema is not None:
+            response = llm_ledger.generate(
+                model, prompt, call_site, generation_config=GenerationConfig(**json_generation_params(response_schema))
+            )
+        else:
+            response = llm_ledger.generate(model, prompt, call_site)
         raw_response = response.text
         
-        # logging.info(f"Получен ответ от Gemini (длина: {len(raw_response)} символов)")
-        # logging.info(f"Сырой ответ от Gemini: {raw_response}")
-        
         if expect_json:
-            # Улучшенная логика для извлечения JSON из ответа
-            # Сначала ищем JSON в markdown-блоке
-            match = re.search(r"```(json)?\s*([\s\S]*?)\s*```", raw_response)
-            if match:
-                json_str = match.group(2)
-            else:
-                # Если markdown-блока нет, ищем первый символ '{' или '['
-                start_index = -1
-                for i, char in enumerate(raw_response):
-                    if char in ('{', '['):
-                        start_index = i
-                        break
-                if start_index != -1:
-                    json_str = raw_response[start_index:]
-                else:
-                    json_str = raw_response
-            
-            # Удаляем управляющие символы в начале строки, если они есть
-            json_str = json_str.strip()
-
-            parsed_response = json.loads(json_str)
-            # logging.info(f"JSON успешно распарсен: {parsed_response}")
-            return parsed_response
+            return parse_json_response(raw_response, response_schema, call_site)
         else:
             return raw_response.strip()
 
-    except json.JSONDecodeError as je:
+    except StructuredOutputError as je:
         logging.error(f"Ошибка парсинга JSON от Gemini: {je}. Сырой ответ: {raw_response}")
         raise
     except Exception as e:
@@ -777,6 +840,7 @@ def parse_datetime_with_timezone(datetime_str, client_timezone='Europe/Moscow'):
 
 # --- ОСНОВНЫЕ ФУНКЦИИ ---
 
+@timed("reminder_dialogue_analysis")
 def analyze_dialogue_for_reminders(conn, conv_id, model):
     """
     Анализирует последние сообщения диалога для выявления договоренностей о напоминании.
@@ -829,7 +893,7 @@ def analyze_dialogue_for_reminders(conn, conv_id, model):
             for msg in reversed(messages):
                 role_map = {'user': 'Клиент', 'bot': 'Ассистент', 'operator': 'Оператор'}
                 role = role_map.get(msg['role'], msg['role'])
-                message_text = re.sub(r'^\[.*?\]\s*', '', msg['message'])
+                message_text = strip_timestamp(msg['message'])
                 
                 # КРИТИЧЕСКИ ВАЖНО: Добавляем временные метки для понимания хронологии (синхронизация с агентом активации)
                 timestamp = msg['created_at'].strftime('%Y-%m-%d %H:%M:%S') if msg['created_at'] else 'неизвестно'
@@ -948,13 +1012,12 @@ def analyze_dialogue_for_reminders(conn, conv_id, model):
                 client_timezone_offset=client_timezone_offset
             )
             
-            # Логируем полный промпт для диагностики
-            logging.info(f"=== ПОЛНЫЙ ПРОМПТ ДЛЯ АНАЛИЗА ДИАЛОГА {conv_id} ===")
-            logging.info(prompt)
-            logging.info("=== КОНЕЦ ПРОМПТА ===")
+            # Полный промпт — только в DEBUG: на INFO он раздувает логи на каждый анализ
+            logging.info(f"Промпт анализа диалога {conv_id}: {len(prompt)} символов")
+            logging.debug(f"=== ПОЛНЫЙ ПРОМПТ ДЛЯ АНАЛИЗА ДИАЛОГА {conv_id} ===\n{prompt}\n=== КОНЕЦ ПРОМПТА ===")
             
             # Вызываем AI для анализа
-            result = call_gemini_api(model, prompt, expect_json=True)
+            result = call_gemini_api(model, prompt, expect_json=True, response_schema=REMINDER_ANALYSIS_RESPONSE_SCHEMA)
             
             # ===== ДОБАВЛЯЕМ ДЕТАЛЬНОЕ ЛОГИРОВАНИЕ =====
             logging.info(f"=== ПОЛНЫЙ ОТВЕТ AI ДЛЯ ДИАЛОГА {conv_id} ===")
@@ -1091,53 +1154,12 @@ def create_or_update_reminder(conn, conv_id, reminder_data, created_by_conv_id=N
                         reminder_data.get('client_timezone', 'Europe/Moscow')
                     )
                     
-                    cur.execute("""
-                        SELECT id, reminder_context_summary, reminder_datetime
-                        FROM reminders 
-                        WHERE conv_id = %s AND status = 'active'
-                        AND ABS(EXTRACT(EPOCH FROM (reminder_datetime - %s))) < 3600
-                        ORDER BY created_at DESC
-                        LIMIT 5
-                    """, (target_conv_id, proposed_time))
-                    
-                    similar_by_time = cur.fetchall()
-                    if similar_by_time:
-                        for existing in similar_by_time:
-                            existing_summary = existing[1].lower().strip()
-                            new_summary = summary.lower().strip()
-                            
-                            # Проверяем схожесть по ключевым словам
-                            new_words = set(new_summary.split())
-                            existing_words = set(existing_summary.split())
-                            intersection = new_words & existing_words
-                            
-                            if new_words and existing_words:
-                                similarity = len(intersection) / len(new_words | existing_words)  # Жаккар индекс
-                                logging.info(f"ДЕДУПЛИКАЦИЯ: Сравнение '{new_summary}' vs '{existing_summary}' - схожесть {similarity:.2f}")
-                                
-                                # Более строгая проверка: блокируем при схожести > 60%
-                                if similarity > 0.6:
-                                    logging.warning(f"ДУБЛИРУЮЩЕЕ НАПОМИНАНИЕ ЗАБЛОКИРОВАНО: '{new_summary}' слишком похоже на существующее '{existing_summary}' (схожесть {similarity:.2f})")
-                                    return
-                    # ВРЕМЕННО ОТКЛЮЧЕНО ИЗ-ЗА ОШИБКИ ОТСУТСТВИЯ РАСШИРЕНИЯ pg_trgm
-                    # cur.execute("""
-                    #     SELECT id, reminder_context_summary, reminder_datetime
-                    #     FROM reminders 
-                    #     WHERE conv_id = %s AND status = 'active'
-                    #     AND similarity(reminder_context_summary, %s) > 0.6
-                    #     ORDER BY created_at DESC
-                    #     LIMIT 3
-                    # """, (target_conv_id, summary))
-                    
-                    # similar_reminders = cur.fetchall()
-                    # if similar_reminders:
-                    #     logging.warning(f"ПРЕДУПРЕЖДЕНИЕ {conv_id}: Найдены похожие активные напоминания для target_conv_id={target_conv_id}:")
-                    #     for similar in similar_reminders:
-                    #         logging.warning(f"  - ID={similar[0]}: '{similar[1]}' на {similar[2]}")
-                        
-                    # Можно добавить более строгую проверку, если нужно
-                    # return  # Раскомментировать для блокировки создания похожих напоминаний
-                    pass # Установлена заглушка после комментирования
+                    # Похожие по описанию (MinHash + LSH) активные напоминания в пределах часа
+                    similar_reminders = find_similar_active_reminders(cur, target_conv_id, summary, proposed_time)
+                    if similar_reminders:
+                        existing_id, existing_summary, similarity = similar_reminders[0]
+                        logging.warning(f"ДУБЛИРУЮЩЕЕ НАПОМИНАНИЕ ЗАБЛОКИРОВАНО: '{summary}' слишком похоже на существующее ID={existing_id} '{existing_summary}' (схожесть {similarity:.2f})")
+                        return
                 
                 # Парсим дату/время с учетом часового пояса
                 reminder_dt = parse_datetime_with_timezone(
@@ -1150,19 +1172,23 @@ def create_or_update_reminder(conn, conv_id, reminder_data, created_by_conv_id=N
                     logging.warning(f"Попытка создать напоминание на прошедшее время ({reminder_dt}) для conv_id={target_conv_id}. Напоминание не будет создано.")
                     return
                 
-                # Создаем новое напоминание
+                # Создаем новое напоминание (вместе с сигнатурой для дедупликации)
+                signature = compute_signature(reminder_data['reminder_context_summary'])
                 cur.execute("""
                     INSERT INTO reminders (
                         conv_id, reminder_datetime, reminder_context_summary,
-                        created_by_conv_id, client_timezone, status
-                    ) VALUES (%s, %s, %s, %s, %s, 'active')
+                        created_by_conv_id, client_timezone, status,
+                        minhash_signature, lsh_bands
+                    ) VALUES (%s, %s, %s, %s, %s, 'active', %s, %s)
                     RETURNING id
                 """, (
                     target_conv_id,
                     reminder_dt,
                     reminder_data['reminder_context_summary'],
                     created_by_conv_id or conv_id,
-                    reminder_data.get('client_timezone', 'Europe/Moscow')
+                    reminder_data.get('client_timezone', 'Europe/Moscow'),
+                    signature,
+                    compute_lsh_bands(signature)
                 ))
                 
                 reminder_id = cur.fetchone()[0]
@@ -1213,9 +1239,11 @@ def create_or_update_reminder(conn, conv_id, reminder_data, created_by_conv_id=N
                     logging.warning(f"Попытка обновить напоминание на прошедшее время ({reminder_dt}) для conv_id={target_conv_id}. Напоминание не будет обновлено.")
                     return
                 
+                signature = compute_signature(reminder_data['reminder_context_summary'])
                 cur.execute("""
                     UPDATE reminders 
-                    SET reminder_datetime = %s, reminder_context_summary = %s
+                    SET reminder_datetime = %s, reminder_context_summary = %s,
+                        minhash_signature = %s, lsh_bands = %s
                     WHERE id = (
                         SELECT id FROM reminders
                         WHERE conv_id = %s AND status = 'active'
@@ -1225,6 +1253,8 @@ def create_or_update_reminder(conn, conv_id, reminder_data, created_by_conv_id=N
                 """, (
                     reminder_dt,
                     reminder_data['reminder_context_summary'],
+                    signature,
+                    compute_lsh_bands(signature),
                     target_conv_id
                 ))
                 
@@ -1274,11 +1304,19 @@ def _activate_reminders_async(conv_id, activated_contexts, activated_ids):
     conn = None
     try:
         conn = get_db_connection()
+
+        # Отправляем только напоминания, аренду которых удалось продлить
+        owned_ids = renew_reminder_leases(conn, activated_ids)
+        if not owned_ids:
+            return
+        activated_contexts = [
+            context for reminder_id, context in zip(activated_ids, activated_contexts) if reminder_id in owned_ids
+        ]
+        activated_ids = owned_ids
         
         # === УМНАЯ ДЕДУПЛИКАЦИЯ: Отменяем все похожие напоминания ===
         additional_cancelled_ids = _cancel_similar_reminders(conn, conv_id, activated_contexts)
         if additional_cancelled_ids:
-            activated_ids.extend(additional_cancelled_ids)
             logging.info(f"ДЕДУПЛИКАЦИЯ ПРИ АКТИВАЦИИ: Дополнительно отменено {len(additional_cancelled_ids)} похожих напоминаний для conv_id={conv_id}")
         
         combined_context = f"У вас несколько сработавших напоминаний:\n\n" + "\n".join([f"- {ctx}" for ctx in activated_contexts])
@@ -1298,18 +1336,23 @@ def _activate_reminders_async(conv_id, activated_contexts, activated_ids):
 
         with conn.cursor() as cur:
             logging.info(f"АСИНХРОННАЯ АКТИВАЦИЯ для conv_id={conv_id} (ID: {activated_ids}): Обновляю статусы в БД на 'done'.")
-            cur.execute("UPDATE reminders SET status = 'done' WHERE id = ANY(%s::int[])", (activated_ids,))
+            cur.execute(
+                """
+                UPDATE reminders SET status = 'done', lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = ANY(%s::int[]) AND status = 'in_progress' AND lease_owner = %s
+                """,
+                (activated_ids, get_instance_id())
+            )
+            updated = cur.rowcount
             conn.commit()
-            logging.info(f"АСИНХРОННАЯ АКТИВАЦИЯ для conv_id={conv_id}: Успешно обновлены статусы для {len(activated_ids)} напоминаний.")
+            if updated < len(activated_ids):
+                logging.warning(f"АСИНХРОННАЯ АКТИВАЦИЯ для conv_id={conv_id}: Аренда {len(activated_ids) - updated} из {len(activated_ids)} напоминаний потеряна во время активации, их статус не изменен.")
+            logging.info(f"АСИНХРОННАЯ АКТИВАЦИЯ для conv_id={conv_id}: Успешно обновлены статусы для {updated} напоминаний.")
             
             # Очищаем счетчики ошибок при успешной активации
             for reminder_id in activated_ids:
                 clear_activation_success(reminder_id)
             
-        # ВАЖНО: После успешной активации очищаем все просроченные напоминания
-        logging.info(f"АСИНХРОННАЯ АКТИВАЦИЯ для conv_id={conv_id}: Запускаю очистку просроченных напоминаний...")
-        cleanup_expired_reminders()
-            
     except requests.exceptions.Timeout as e:
         error_message = f"Таймаут HTTP запроса: {e}"
         logging.error(f"АСИНХРОННАЯ АКТИВАЦИЯ для conv_id={conv_id}: ТАЙМАУТ. Напоминания {activated_ids} будут возвращены в 'active'. Ошибка: {e}")
@@ -1351,44 +1394,24 @@ def _cancel_similar_reminders(conn, conv_id, activated_contexts):
     """
     cancelled_ids = []
     try:
-        # Получаем все активные напоминания для этого пользователя
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("""
-                SELECT id, reminder_context_summary, reminder_datetime
-                FROM reminders 
-                WHERE conv_id = %s AND status = 'active'
-                ORDER BY reminder_datetime
-            """, (conv_id,))
-            
-            active_reminders = cur.fetchall()
-            
-            # Для каждого активированного контекста ищем похожие
+        with conn.cursor() as cur:
+            # Для каждого активированного контекста ищем похожие через LSH-индекс (тот же алгоритм, что и при создании)
             for activated_context in activated_contexts:
-                activated_words = set(activated_context.lower().split())
-                
-                for reminder in active_reminders:
-                    if reminder['id'] in cancelled_ids:
+                for reminder_id, _, similarity in find_similar_active_reminders(cur, conv_id, activated_context):
+                    if reminder_id in cancelled_ids:
                         continue  # Уже отменено
                     
-                    reminder_words = set(reminder['reminder_context_summary'].lower().split())
-                    
-                    # Проверяем схожесть (используем тот же алгоритм, что и при создании)
-                    if activated_words and reminder_words:
-                        similarity = len(activated_words & reminder_words) / len(activated_words | reminder_words)
-                        
-                        if similarity > 0.6:  # Если схожесть > 60%
-                            # Отменяем похожее напоминание
-                            cur.execute("""
-                                UPDATE reminders 
-                                SET status = 'cancelled_by_deduplication', 
-                                    cancellation_reason = %s
-                                WHERE id = %s
-                            """, (
-                                f"Автоотмена похожего напоминания при активации. Схожесть: {similarity:.2f}",
-                                reminder['id']
-                            ))
-                            cancelled_ids.append(reminder['id'])
-                            logging.info(f"ДЕДУПЛИКАЦИЯ: Отменено похожее напоминание ID={reminder['id']} (схожесть {similarity:.2f})")
+                    cur.execute("""
+                        UPDATE reminders 
+                        SET status = 'cancelled_by_deduplication', 
+                            cancellation_reason = %s
+                        WHERE id = %s
+                    """, (
+                        f"Автоотмена похожего напоминания при активации. Схожесть: {similarity:.2f}",
+                        reminder_id
+                    ))
+                    cancelled_ids.append(reminder_id)
+                    logging.info(f"ДЕДУПЛИКАЦИЯ: Отменено похожее напоминание ID={reminder_id} (схожесть {similarity:.2f})")
             
             conn.commit()
             
@@ -1410,10 +1433,12 @@ def _revert_reminder_statuses(reminder_ids, reason):
                 """
                 UPDATE reminders 
                 SET status = 'active', 
-                    cancellation_reason = %s 
-                WHERE id = ANY(%s::int[]) AND status = 'in_progress'
+                    cancellation_reason = %s,
+                    lease_owner = NULL,
+                    lease_expires_at = NULL
+                WHERE id = ANY(%s::int[]) AND status = 'in_progress' AND lease_owner = %s
                 """,
-                (f"Активация не удалась: {reason}", reminder_ids)
+                (f"Активация не удалась: {reason}", reminder_ids, get_instance_id())
             )
             affected = cur.rowcount
             conn.commit()
@@ -1424,68 +1449,215 @@ def _revert_reminder_statuses(reminder_ids, reason):
         if conn:
             conn.close()
 
+def acquire_dispatcher_lock():
+    """
+    Выбирает единственного диспетчера напоминаний на весь деплой через advisory lock PostgreSQL.
+
+    Блокировка уровня сессии удерживается на отдельном долгоживущем соединении: пока процесс жив
+    и соединение открыто, он остается диспетчером. При падении процесса PostgreSQL снимает
+    блокировку сам, и на следующей проверке диспетчером становится другой экземпляр.
+
+    Returns:
+        bool: True, если текущий процесс является диспетчером.
+    """
+    current_pid = os.getpid()
+    lock_conn = dispatcher_lock_state["conn"]
+
+    # Соединение, унаследованное после fork (gunicorn --preload), принадлежит родителю - не трогаем его
+    if lock_conn is not None and dispatcher_lock_state["pid"] != current_pid:
+        lock_conn = None
+        dispatcher_lock_state["conn"] = None
+
+    if lock_conn is not None:
+        try:
+            with lock_conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except Exception as e:
+            logging.warning(f"ДИСПЕТЧЕР: Соединение с advisory lock потеряно ({e}). Пробуем захватить блокировку заново.")
+            try:
+                lock_conn.close()
+            except Exception:
+                pass
+            dispatcher_lock_state["conn"] = None
+
+    lock_conn = None
+    try:
+        lock_conn = get_db_connection()
+        lock_conn.autocommit = True
+        with lock_conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (DISPATCHER_LOCK_KEY,))
+            acquired = cur.fetchone()[0]
+    except Exception as e:
+        logging.error(f"ДИСПЕТЧЕР: Ошибка при захвате advisory lock: {e}")
+        if lock_conn:
+            lock_conn.close()
+        return False
+
+    if not acquired:
+        lock_conn.close()
+        logging.debug(f"ДИСПЕТЧЕР: Экземпляр {get_instance_id()} не является диспетчером, проверка пропущена.")
+        return False
+
+    dispatcher_lock_state["conn"] = lock_conn
+    dispatcher_lock_state["pid"] = current_pid
+    logging.info(f"ДИСПЕТЧЕР: Экземпляр {get_instance_id()} выбран диспетчером напоминаний.")
+    return True
+
+def release_dispatcher_lock():
+    """Освобождает advisory lock диспетчера, закрывая удерживающее его соединение."""
+    lock_conn = dispatcher_lock_state["conn"]
+    if lock_conn is not None and dispatcher_lock_state["pid"] == os.getpid():
+        try:
+            lock_conn.close()
+            logging.info("ДИСПЕТЧЕР: Advisory lock освобожден.")
+        except Exception as e:
+            logging.error(f"ДИСПЕТЧЕР: Ошибка при освобождении advisory lock: {e}")
+    dispatcher_lock_state["conn"] = None
+    dispatcher_lock_state["pid"] = None
+
+def reap_expired_leases(conn):
+    """
+    Возвращает в 'active' напоминания, чья аренда истекла (экземпляр упал во время активации).
+    Строки 'in_progress' без аренды (захваченные до появления аренды) тоже считаются брошенными.
+
+    Returns:
+        list: ID возвращенных напоминаний.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE reminders
+            SET status = 'active',
+                cancellation_reason = 'Аренда истекла: экземпляр ' || COALESCE(lease_owner, 'неизвестен') || ' не завершил активацию',
+                lease_owner = NULL,
+                lease_expires_at = NULL
+            WHERE status = 'in_progress'
+              AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+            RETURNING id
+        """)
+        reclaimed_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+
+    if reclaimed_ids:
+        logging.warning(f"REAPER: Возвращено в 'active' {len(reclaimed_ids)} напоминаний с истекшей арендой: {reclaimed_ids}")
+    return reclaimed_ids
+
+def renew_reminder_leases(conn, reminder_ids):
+    """
+    Продлевает аренду напоминаний текущего экземпляра перед отправкой активации.
+
+    Напоминание, которое reaper уже вернул в 'active' (и, возможно, захватил другой экземпляр),
+    в результат не попадает: отправлять его этому экземпляру нельзя.
+
+    Returns:
+        list: ID напоминаний с продленной арендой в исходном порядке.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE reminders
+            SET lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE id = ANY(%s::int[]) AND status = 'in_progress' AND lease_owner = %s
+            RETURNING id
+        """, (REMINDER_LEASE_SECONDS, reminder_ids, get_instance_id()))
+        renewed = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    lost_ids = [reminder_id for reminder_id in reminder_ids if reminder_id not in renewed]
+    if lost_ids:
+        logging.warning(f"АРЕНДА: Экземпляр {get_instance_id()} потерял аренду напоминаний {lost_ids}, активация по ним пропущена.")
+    return [reminder_id for reminder_id in reminder_ids if reminder_id in renewed]
+
+def claim_due_reminders(conn, limit=CLAIM_BATCH_SIZE):
+    """
+    Атомарно захватывает созревшие напоминания в аренду текущего экземпляра.
+
+    Выборка и перевод в 'in_progress' выполняются одним UPDATE ... RETURNING, а FOR UPDATE SKIP LOCKED
+    гарантирует, что строку, которую уже захватывает другая транзакция, мы пропустим, а не заберем повторно.
+
+    Returns:
+        list: Захваченные напоминания (DictRow), отсортированные по conv_id и времени.
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute("""
+            UPDATE reminders
+            SET status = 'in_progress',
+                lease_owner = %s,
+                lease_expires_at = NOW() + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM reminders
+                WHERE status = 'active' AND reminder_datetime <= NOW()
+                ORDER BY reminder_datetime
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, conv_id, reminder_datetime, reminder_context_summary,
+                      created_at, client_timezone
+        """, (get_instance_id(), REMINDER_LEASE_SECONDS, limit))
+        claimed = cur.fetchall()
+    conn.commit()
+
+    # RETURNING не гарантирует порядок, а groupby требует сортировки по conv_id
+    claimed.sort(key=lambda r: (r['conv_id'], r['reminder_datetime']))
+    return claimed
+
+@timed("reminder_scheduler_check")
 def check_and_activate_reminders():
     """
     Проверяет и активирует созревшие напоминания, группируя их по пользователям.
     Активирует все напоминания без дополнительной ИИ-проверки.
+
+    Безопасна при нескольких экземплярах сервиса: проверку выполняет только диспетчер,
+    выбранный через advisory lock, а напоминания захватываются атомарно и с арендой.
     """
+    if not acquire_dispatcher_lock():
+        return
+
     conn = None
     try:
         conn = get_db_connection()
-        
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            # Получаем созревшие напоминания
-            cur.execute("""
-                SELECT id, conv_id, reminder_datetime, reminder_context_summary,
-                       created_at, client_timezone
-                FROM reminders 
-                WHERE status = 'active' AND reminder_datetime <= NOW()
-                ORDER BY conv_id, reminder_datetime
-            """)
-            
-            reminders = cur.fetchall()
-            
-            if not reminders:
-                logging.debug("Нет созревших напоминаний")
-                return
-            
-            logging.info(f"Найдено {len(reminders)} созревших напоминаний. Группируем по пользователям.")
 
-            # Группируем напоминания по conv_id
-            reminders_by_user = {k: list(g) for k, g in groupby(reminders, itemgetter('conv_id'))}
+        # Сначала возвращаем напоминания, брошенные упавшими экземплярами
+        reap_expired_leases(conn)
+
+        # Атомарно захватываем созревшие напоминания
+        reminders = claim_due_reminders(conn)
+
+        if not reminders:
+            logging.debug("Нет созревших напоминаний")
+            return
+
+        logging.info(f"Захвачено {len(reminders)} созревших напоминаний (аренда: {get_instance_id()}). Группируем по пользователям.")
+
+        # Группируем напоминания по conv_id
+        reminders_by_user = {k: list(g) for k, g in groupby(reminders, itemgetter('conv_id'))}
+
+        for conv_id, user_reminders in reminders_by_user.items():
+            try:
+                # Выбираем, как обрабатывать: по одному или пачкой
+                if len(user_reminders) == 1:
+                    target_func = process_single_reminder
+                    args = (user_reminders[0],)
+                else:
+                    target_func = process_reminder_batch
+                    args = (user_reminders,)
+
+                # Обрабатываем в отдельном потоке
+                thread = threading.Thread(target=target_func, args=args, daemon=True)
+                thread.start()
+
+            except Exception as e:
+                logging.error(f"Ошибка при обработке пачки напоминаний для conv_id={conv_id}: {e}")
+                _revert_reminder_statuses([r['id'] for r in user_reminders], f"ошибка запуска обработки: {e}")
 
-            for conv_id, user_reminders in reminders_by_user.items():
-                try:
-                    # Блокируем все напоминания для этого пользователя
-                    reminder_ids = [r['id'] for r in user_reminders]
-                    cur.execute(
-                        "UPDATE reminders SET status = 'in_progress' WHERE id = ANY(%s::int[])",
-                        (reminder_ids,)
-                    )
-                    conn.commit()
-                    
-                    # Выбираем, как обрабатывать: по одному или пачкой
-                    if len(user_reminders) == 1:
-                        target_func = process_single_reminder
-                        args = (user_reminders[0],)
-                    else:
-                        target_func = process_reminder_batch
-                        args = (user_reminders,)
-                    
-                    # Обрабатываем в отдельном потоке
-                    thread = threading.Thread(target=target_func, args=args, daemon=True)
-                    thread.start()
-                    
-                except Exception as e:
-                    logging.error(f"Ошибка при обработке пачки напоминаний для conv_id={conv_id}: {e}")
-                    conn.rollback()
-                    
     except Exception as e:
         logging.error(f"Ошибка при проверке напоминаний: {e}", exc_info=True)
+        if conn:
+            conn.rollback()
     finally:
         if conn:
             conn.close()
 
+@timed("reminder_scheduler_activate")
 def process_single_reminder(reminder):
     """
     Обрабатывает одно напоминание - активирует его напрямую без ИИ-проверки.
@@ -1497,6 +1669,10 @@ def process_single_reminder(reminder):
         logging.info(f"ПРЯМАЯ АКТИВАЦИЯ ID={reminder['id']}: Начинаю процесс активации без ИИ-проверки.")
         
         with conn.cursor() as cur:
+            # Аренда могла истечь, пока напоминание ждало потока: тогда его уже вернул reaper
+            if not renew_reminder_leases(conn, [reminder['id']]):
+                return
+
             # Активируем напоминание напрямую
             try:
                 # Формируем внутренний URL для вызова внутри того же контейнера
@@ -1518,9 +1694,14 @@ def process_single_reminder(reminder):
                 # Помечаем как выполненное
                 logging.info(f"ПРЯМАЯ АКТИВАЦИЯ ID={reminder['id']}: Обновляю статус в БД на 'done'.")
                 cur.execute(
-                    "UPDATE reminders SET status = 'done' WHERE id = %s",
-                    (reminder['id'],)
+                    """
+                    UPDATE reminders SET status = 'done', lease_owner = NULL, lease_expires_at = NULL
+                    WHERE id = %s AND status = 'in_progress' AND lease_owner = %s
+                    """,
+                    (reminder['id'], get_instance_id())
                 )
+                if cur.rowcount == 0:
+                    logging.warning(f"ПРЯМАЯ АКТИВАЦИЯ ID={reminder['id']}: Аренда потеряна во время активации, статус не изменен.")
                 
                 # Очищаем счетчик ошибок при успешной активации
                 clear_activation_success(reminder['id'])
@@ -1539,10 +1720,6 @@ def process_single_reminder(reminder):
             conn.commit()
             logging.info(f"ID={reminder['id']}: Транзакция успешно завершена.")
             
-            # ВАЖНО: После успешной активации очищаем все просроченные напоминания  
-            logging.info(f"ПРЯМАЯ АКТИВАЦИЯ ID={reminder['id']}: Запускаю очистку просроченных напоминаний...")
-            cleanup_expired_reminders()
-            
     except Exception as e:
         error_message = f"Критическая ошибка: {e}"
         logging.error(f"КРИТИЧЕСКАЯ ОШИБКА ID={reminder['id']}: Произошла непредвиденная ошибка. Откатываю транзакцию. Статус будет возвращен в 'active'. Ошибка: {e}", exc_info=True)
@@ -1556,9 +1733,14 @@ def process_single_reminder(reminder):
             try:
                 with conn.cursor() as cur:
                     cur.execute(
-                        "UPDATE reminders SET status = 'active' WHERE id = %s",
-                        (reminder['id'],)
+                        """
+                        UPDATE reminders SET status = 'active', lease_owner = NULL, lease_expires_at = NULL
+                        WHERE id = %s AND status = 'in_progress' AND lease_owner = %s
+                        """,
+                        (reminder['id'], get_instance_id())
                     )
+                    if cur.rowcount == 0:
+                        logging.warning(f"ID={reminder['id']}: Аренда уже не принадлежит {get_instance_id()}, статус не возвращен в 'active'.")
                     conn.commit()
             except:
                 pass
@@ -1566,43 +1748,6 @@ def process_single_reminder(reminder):
         if conn:
             conn.close()
 
-def cleanup_expired_reminders():
-    """
-    Очищает просроченные напоминания - переводит из статуса 'active' в 'done'
-    все напоминания, время которых уже прошло.
-    """
-    conn = None
-    try:
-        conn = get_db_connection()
-        
-        with conn.cursor() as cur:
-            # Находим все активные напоминания, время которых уже прошло
-            cur.execute("""
-                UPDATE reminders 
-                SET status = 'done', 
-                    cancellation_reason = 'Автоматически завершено как просроченное'
-                WHERE status = 'active' AND reminder_datetime <= NOW()
-                RETURNING id, conv_id, reminder_datetime, reminder_context_summary
-            """)
-            
-            updated_reminders = cur.fetchall()
-            conn.commit()
-            
-            if updated_reminders:
-                logging.info(f"ОЧИСТКА ПРОСРОЧЕННЫХ: Переведено в статус 'done' {len(updated_reminders)} просроченных напоминаний:")
-                for reminder in updated_reminders:
-                    logging.info(f"  - ID={reminder[0]}, conv_id={reminder[1]}, время={reminder[2]}, описание='{reminder[3]}'")
-            else:
-                logging.debug("ОЧИСТКА ПРОСРОЧЕННЫХ: Просроченных активных напоминаний не найдено")
-                
-    except Exception as e:
-        logging.error(f"Ошибка при очистке просроченных напоминаний: {e}", exc_info=True)
-        if conn:
-            conn.rollback()
-    finally:
-        if conn:
-            conn.close()
-
 # Функция collect_client_context удалена, так как больше не нужна без ИИ-проверки актуальности
 
 # --- ПЛАНИРОВЩИК ---
@@ -1638,9 +1783,51 @@ def stop_scheduler():
     if scheduler:
         scheduler.shutdown()
         logging.info("Планировщик остановлен.")
+    release_dispatcher_lock()
+
+# Показатели планировщика и анализа напоминаний для /metrics (metrics.py)
+register_gauge("reminder_analyses_in_progress", "Диалоги, по которым сейчас идет анализ напоминаний",
+               lambda: len(reminder_creation_locks))
+register_gauge("reminder_scheduler_running", "Планировщик напоминаний запущен в этом процессе",
+               lambda: bool(scheduler and scheduler.running))
+register_gauge("reminder_dispatcher", "Процесс удерживает блокировку диспетчера напоминаний",
+               lambda: dispatcher_lock_state["conn"] is not None and dispatcher_lock_state["pid"] == os.getpid())
+register_gauge("reminder_failed_activations", "Напоминания с неудачными попытками активации",
+               lambda: len(failed_activation_attempts))
 
 # --- ФУНКЦИЯ ДЛЯ ВЫЗОВА ИЗ MAIN.PY ---
 
+def needs_reminder_analysis(conn, conv_id):
+    """
+    Локальный пред-фильтр перед вызовом Gemini: проверяет свежие сообщения на временные
+    выражения, просьбы напомнить и отмены. Если сигналов нет и у клиента нет активных
+    напоминаний, анализ диалога моделью не нужен.
+
+    Returns:
+        bool: True, если нужно вызывать analyze_dialogue_for_reminders.
+    """
+    # Администратор ставит напоминания командами, для него фильтр не применяем
+    if conv_id == ADMIN_CONV_ID:
+        return True
+
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT message
+            FROM dialogues
+            WHERE conv_id = %s
+            ORDER BY created_at DESC
+            LIMIT %s
+        """, (conv_id, PREFILTER_MESSAGES_TO_SCAN))
+        recent_messages = [row[0] for row in cur.fetchall()]
+
+        cur.execute(
+            "SELECT COUNT(*) FROM reminders WHERE conv_id = %s AND status = 'active'",
+            (conv_id,)
+        )
+        active_reminders_count = cur.fetchone()[0]
+
+    return should_analyze_for_reminders(recent_messages, active_reminders_count)
+
 def process_new_message(conv_id):
     """
     Обрабатывает новое сообщение для поиска договоренностей о напоминании.
@@ -1656,6 +1843,13 @@ def process_new_message(conv_id):
     
     conn = None
     try:
+        conn = get_db_connection()
+        
+        # Дешевая локальная проверка: без временных выражений и активных напоминаний Gemini не вызываем
+        if not needs_reminder_analysis(conn, conv_id):
+            logging.info(f"ПРЕ-ФИЛЬТР: В свежих сообщениях conv_id={conv_id} нет временных выражений и активных напоминаний. Анализ пропущен.")
+            return
+        
         # Инициализация модели
         credentials_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
         if not credentials_path:
@@ -1666,8 +1860,6 @@ def process_new_message(conv_id):
         vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
         model = GenerativeModel(MODEL_NAME)
         
-        conn = get_db_connection()
-        
         # Анализируем диалог. Теперь reminders_data - это список.
         reminders_data = analyze_dialogue_for_reminders(conn, conv_id, model)
         
@@ -0,0 +1,155 @@
+# --- Описание ---
+# Оценка схожести описаний напоминаний для дедупликации (reminder_service.py).
+# Текст нормализуется (нижний регистр, без пунктуации и стоп-слов, легкий стемминг),
+# разбивается на символьные шинглы, по которым строится MinHash-сигнатура.
+# Сигнатура делится на полосы (LSH): ключи полос хранятся в reminders.lsh_bands
+# с GIN-индексом, поэтому у клиента с большим числом активных напоминаний поиск кандидатов —
+# это индексный запрос `lsh_bands && ...`, а не перебор. LSH пропускает часть дубликатов
+# у порога, поэтому при небольшом числе активных напоминаний сравниваются все.
+# --- Конец описания ---
+
+import hashlib
+import random
+import re
+
+# Порог схожести, при котором напоминания считаются дубликатами (как и раньше — 60%)
+SIMILARITY_THRESHOLD = 0.6
+
+SHINGLE_SIZE = 4       # Длина символьного шингла
+NUM_PERMUTATIONS = 64  # Длина MinHash-сигнатуры
+# 16 полос по 4 значения: пара становится кандидатом с вероятностью 1 - (1 - s^4)^16 —
+# ~0.89 при схожести 0.6 (порог), ~0.99 при 0.7. Ключи полос хранятся в БД: при смене
+# LSH_BANDS сигнатуры существующих напоминаний нужно пересчитать.
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+
+# До стольких активных напоминаний клиента сравниваются все, без отбора по LSH-ключам
+EXHAUSTIVE_COMPARE_LIMIT = 50
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20250901)  # Фиксированное зерно: сигнатуры хранятся в БД и должны быть стабильны
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+_NON_WORD = re.compile(r'[^\w\s]+|_')
+_WHITESPACE = re.compile(r'\s+')
+
+STOP_WORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было
+вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас
+нибудь опять уж вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их
+чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой
+совсем ним здесь этом один почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при
+наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве три
+эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно
+всю между клиент клиента клиенту клиентом
+""".split())
+
+# Окончания для легкого стемминга (от длинных к коротким)
+_ENDINGS = sorted("""
+иями ями ами ого его ому ему ыми ими ать ять ить еть ться тся ешь ете ишь ите ует уют ают яют
+ая яя ое ее ые ие ой ей ий ый ом ем ам ям ах ях ов ев ию ью ия ья ую юю ть ет ит ут ют ат ят
+а я о е ы и у ю ь
+""".split(), key=len, reverse=True)
+_MIN_STEM_LENGTH = 3
+
+
+def _stem(token):
+    """Отрезает типичное окончание, оставляя основу не короче _MIN_STEM_LENGTH символов."""
+    for ending in _ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= _MIN_STEM_LENGTH:
+            return token[:-len(ending)]
+    return token
+
+
+def normalize_tokens(text):
+    """
+    Нормализует текст напоминания в список основ слов.
+
+    Args:
+        text (str): Описание напоминания.
+
+    Returns:
+        list: Основы слов без пунктуации и стоп-слов.
+    """
+    if not text:
+        return []
+    text = _NON_WORD.sub(' ', text.lower().replace('ё', 'е'))
+    return [_stem(token) for token in _WHITESPACE.split(text) if token and token not in STOP_WORDS]
+
+
+def get_shingles(text):
+    """Возвращает множество символьных шинглов нормализованного текста."""
+    normalized = ' '.join(normalize_tokens(text))
+    if not normalized:
+        return set()
+    if len(normalized) <= SHINGLE_SIZE:
+        return {normalized}
+    return {normalized[i:i + SHINGLE_SIZE] for i in range(len(normalized) - SHINGLE_SIZE + 1)}
+
+
+def _hash64(value):
+    """Стабильный (не зависящий от PYTHONHASHSEED) 64-битный хеш строки."""
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def compute_signature(text):
+    """
+    Строит MinHash-сигнатуру описания напоминания.
+
+    Args:
+        text (str): Описание напоминания.
+
+    Returns:
+        list: NUM_PERMUTATIONS целых чисел или пустой список для пустого текста.
+    """
+    shingle_hashes = [_hash64(shingle) for shingle in get_shingles(text)]
+    if not shingle_hashes:
+        return []
+    return [
+        min((a * h + b) % _MERSENNE_PRIME for h in shingle_hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def compute_lsh_bands(signature):
+    """
+    Делит сигнатуру на полосы и возвращает ключ каждой полосы.
+    Номер полосы входит в ключ, поэтому ключи разных полос не пересекаются,
+    и их можно хранить в одной колонке BIGINT[].
+
+    Args:
+        signature (list): MinHash-сигнатура.
+
+    Returns:
+        list: LSH_BANDS знаковых 64-битных ключей (помещаются в BIGINT).
+    """
+    if not signature:
+        return []
+    bands = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        key = f"{band}:" + ','.join(map(str, rows))
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        bands.append(int.from_bytes(digest, 'big', signed=True))
+    return bands
+
+
+def estimate_similarity(signature_a, signature_b):
+    """
+    Оценивает коэффициент Жаккара по двум MinHash-сигнатурам.
+
+    Returns:
+        float: Доля совпавших позиций (0.0, если одна из сигнатур пустая).
+    """
+    if not signature_a or not signature_b or len(signature_a) != len(signature_b):
+        return 0.0
+    matches = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+    return matches / len(signature_a)
+
+
+def is_duplicate(similarity):
+    """Проверяет, превышает ли схожесть порог дедупликации."""
+    return similarity > SIMILARITY_THRESHOLD
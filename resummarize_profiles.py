@@ -0,0 +1,313 @@
+# =======================================================================================
+#               ПАКЕТНОЕ ПЕРЕСОЗДАНИЕ САММАРИ И ФАКТОВ ПО ВСЕМ ПРОФИЛЯМ
+# =======================================================================================
+#
+# ЧТО ДЕЛАЕТ ЭТОТ СКРИПТ:
+#
+# После изменения PROMPT_INCREMENTAL_SUMMARY / PROMPT_EXTRACT_NEW_FACTS заново прогоняет
+# конвейер summary_updater (саммари + факты + слияние профиля) по всем профилям:
+#
+# 1. conv_id читаются потоком из серверного курсора (весь список в память не грузится).
+# 2. Профили обрабатываются параллельно (--concurrency) с общим лимитом запросов
+#    к Gemini в минуту (--rpm).
+# 3. Результаты записываются пакетами (--batch-size) в одной транзакции вместе
+#    с отметками в таблице контрольных точек resummarize_checkpoints (миграция 9 в db_migrations.py).
+# 4. По умолчанию в промпт идут последние NUM_MESSAGES_TO_FETCH сообщений независимо от
+#    водяного знака саммари: summary_updater держит знаки актуальными, и иначе после смены
+#    промптов почти все профили были бы пропущены. --full-history строит саммари заново по всей
+#    истории, --after-watermark берет только сообщения после знака (как в summary_updater)
+#    и пропускает профили без новых сообщений.
+# 5. После падения повторный запуск с тем же --run продолжает с необработанных профилей.
+#    По умолчанию имя запуска — хеш текущих промптов: после их изменения начинается новый проход.
+#
+# В лог регулярно выводятся скорость, количество ошибок и оставшееся время.
+#
+# КАК ЗАПУСКАТЬ:
+#    python resummarize_profiles.py --concurrency 8 --rpm 120
+#    python resummarize_profiles.py --run prompts-2025-09 --full-history
+#    python resummarize_profiles.py --retry-errors
+#    python resummarize_profiles.py --run catch-up --after-watermark
+#
+# =======================================================================================
+
+import sys
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import psycopg2
+import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
+
+import summary_updater
+from summary_updater import (
+    PROMPT_INCREMENTAL_SUMMARY, PROMPT_EXTRACT_NEW_FACTS, MESSAGES_AFTER_WATERMARK_QUERY,
+    format_messages_for_prompt, generate_summary_and_facts, merge_profiles, update_profile_in_database,
+    watermark_params
+)
+from dialogue_retention import get_full_history
+from batch_pipeline import RateLimiter, ProgressReporter
+
+# --- НАСТРОЙКИ ---
+CHECKPOINT_TABLE = "resummarize_checkpoints"
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RPM = 60
+DEFAULT_BATCH_SIZE = 20
+STREAM_FETCH_SIZE = 500            # Строк серверного курсора за одно обращение
+FULL_HISTORY_MAX_MESSAGES = 200    # Ограничение истории в режиме --full-history
+
+# Какие сообщения идут в промпт
+HISTORY_RECENT = "recent"                    # Последние NUM_MESSAGES_TO_FETCH (по умолчанию)
+HISTORY_FULL = "full"                        # Вся история с архивом (--full-history)
+HISTORY_AFTER_WATERMARK = "after_watermark"  # Только после водяного знака (--after-watermark)
+
+
+def default_run_name():
+    """Имя прохода по умолчанию: хеш текущих промптов."""
+    digest = hashlib.sha1((PROMPT_INCREMENTAL_SUMMARY + PROMPT_EXTRACT_NEW_FACTS).encode('utf-8')).hexdigest()
+    return f"prompts-{digest[:12]}"
+
+
+def _pending_filter(retry_errors):
+    """Условие «профиль еще не обработан в этом проходе»."""
+    statuses = "('done')" if retry_errors else "('done', 'error')"
+    return f"""
+        NOT EXISTS (
+            SELECT 1 FROM {CHECKPOINT_TABLE} c
+            WHERE c.run_name = %s AND c.conv_id = up.conv_id AND c.status IN {statuses}
+        )
+    """
+
+
+def count_pending(conn, run_name, retry_errors):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM user_profiles up WHERE {_pending_filter(retry_errors)}", (run_name,))
+        return cur.fetchone()[0]
+
+
+def stream_pending_conv_ids(conn, run_name, retry_errors):
+    """Выдает conv_id необработанных профилей из серверного (именованного) курсора."""
+    with conn.cursor(name="resummarize_conv_ids") as cur:
+        cur.itersize = STREAM_FETCH_SIZE
+        cur.execute(f"""
+            SELECT up.conv_id FROM user_profiles up
+            WHERE {_pending_filter(retry_errors)}
+            ORDER BY up.conv_id
+        """, (run_name,))
+        for (conv_id,) in cur:
+            yield conv_id
+
+
+def process_profile(db_pool, model, limiter, conv_id, history, combined):
+    """
+    Готовит новое саммари и факты для одного профиля (чтение из БД и вызовы Gemini, без записи).
+    Ошибки чтения и вызовов Gemini возвращаются результатом, а не исключением: один профиль
+    не должен останавливать проход.
+
+    Returns:
+        dict: conv_id, new_summary, new_facts, watermark, watermark_id — или conv_id и error.
+    """
+    conn = None
+    try:
+        conn = db_pool.getconn()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute(
+                "SELECT dialogue_summary, summary_watermark, summary_watermark_id FROM user_profiles WHERE conv_id = %s",
+                (conv_id,)
+            )
+            row = cur.fetchone()
+            if history == HISTORY_FULL:
+                # Саммари строится заново по всей истории, включая архив
+                existing_summary = 'Саммари еще не создано.'
+                messages = get_full_history(conn, conv_id, columns="id, role, message, created_at")[-FULL_HISTORY_MAX_MESSAGES:]
+            else:
+                # Последние сообщения; с --after-watermark — только после водяного знака, как в summary_updater
+                existing_summary = (row['dialogue_summary'] if row else None) or 'Саммари еще не создано.'
+                profile = row if history == HISTORY_AFTER_WATERMARK else None
+                cur.execute(MESSAGES_AFTER_WATERMARK_QUERY, watermark_params(profile, conv_id))
+                messages = [dict(message) for message in cur.fetchall()]
+        conn.rollback()
+    except Exception as e:
+        return {'conv_id': conv_id, 'error': f"Ошибка чтения из БД: {e}"[:500]}
+    finally:
+        if conn is not None:
+            db_pool.putconn(conn)
+
+    if not messages:
+        return {'conv_id': conv_id, 'skipped': True}
+
+    try:
+        # Объединенный режим — один запрос к Gemini, раздельный — два
+        limiter.acquire(1 if combined else 2)
+        new_summary, new_facts, _ = generate_summary_and_facts(
+            model, existing_summary, format_messages_for_prompt(messages), combined=combined
+        )
+    except Exception as e:
+        return {'conv_id': conv_id, 'error': str(e)[:500]}
+
+    return {
+        'conv_id': conv_id,
+        'new_summary': new_summary,
+        'new_facts': new_facts,
+        'watermark': messages[-1]['created_at'],
+        'watermark_id': messages[-1]['id'],
+    }
+
+
+def write_results(conn, run_name, results):
+    """
+    Записывает пакет результатов и отметки контрольных точек одной транзакцией.
+    Если транзакция не удалась, пакет записывается по одному профилю, чтобы ошибка одного
+    не отменила остальные.
+    """
+    def write_one(cur, result):
+        conv_id = result['conv_id']
+        if 'error' in result:
+            status, error = 'error', result['error']
+        elif result.get('skipped'):
+            status, error = 'skipped', None
+        else:
+            cur.execute("SELECT * FROM user_profiles WHERE conv_id = %s FOR UPDATE", (conv_id,))
+            current_profile = cur.fetchone()
+            if current_profile is None:
+                status, error = 'error', 'Профиль удален во время прохода'
+            else:
+                updated_profile = merge_profiles(dict(current_profile), result['new_facts'], result['new_summary'])
+                updated_profile['conv_id'] = conv_id
+                updated_profile['summary_watermark'] = result['watermark']
+                updated_profile['summary_watermark_id'] = result['watermark_id']
+                update_profile_in_database(conv_id, updated_profile, result['new_facts'], cur)
+                status, error = 'done', None
+        cur.execute(f"""
+            INSERT INTO {CHECKPOINT_TABLE} (run_name, conv_id, status, error)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (run_name, conv_id)
+            DO UPDATE SET status = EXCLUDED.status, error = EXCLUDED.error, processed_at = NOW()
+        """, (run_name, conv_id, status, error))
+        return status
+
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            statuses = [write_one(cur, result) for result in results]
+        conn.commit()
+        return statuses
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"Ошибка записи пакета из {len(results)} профилей, записываем по одному: {e}")
+
+    statuses = []
+    for result in results:
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                statuses.append(write_one(cur, result))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            statuses.append('error')
+            logging.error(f"{result['conv_id']} - Ошибка записи профиля: {e}")
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f"""
+                        INSERT INTO {CHECKPOINT_TABLE} (run_name, conv_id, status, error)
+                        VALUES (%s, %s, 'error', %s)
+                        ON CONFLICT (run_name, conv_id)
+                        DO UPDATE SET status = 'error', error = EXCLUDED.error, processed_at = NOW()
+                    """, (run_name, result['conv_id'], str(e)[:500]))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+    return statuses
+
+
+def run(args):
+    dsn = summary_updater.DATABASE_URL
+    if not dsn:
+        raise ConnectionError("Переменная окружения DATABASE_URL не установлена!")
+
+    model = summary_updater.create_model()
+    combined = summary_updater.SUMMARY_COMBINED_MODE if args.combined is None else args.combined
+    limiter = RateLimiter(args.rpm)
+
+    stream_conn = psycopg2.connect(dsn)
+    write_conn = psycopg2.connect(dsn)
+    db_pool = ThreadedConnectionPool(1, args.concurrency, dsn)
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="Resummarize")
+    try:
+        total = count_pending(write_conn, args.run, args.retry_errors)
+        logging.info(f"Проход '{args.run}': к обработке {total} профилей, параллельно {args.concurrency}, "
+                     f"лимит {args.rpm} запросов/мин, режим {'объединенный' if combined else 'раздельный'}, "
+                     f"история: {args.history}")
+        progress = ProgressReporter(total, f"Проход '{args.run}'")
+
+        in_flight = set()
+        pending_writes = []
+        max_in_flight = args.concurrency * 2
+
+        def collect(done_futures):
+            for future in done_futures:
+                in_flight.discard(future)
+                pending_writes.append(future.result())
+            if len(pending_writes) >= args.batch_size:
+                flush()
+
+        def flush():
+            if not pending_writes:
+                return
+            statuses = write_results(write_conn, args.run, pending_writes)
+            for status in statuses:
+                progress.record(ok=status != 'error')
+            pending_writes.clear()
+
+        for conv_id in stream_pending_conv_ids(stream_conn, args.run, args.retry_errors):
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(
+                process_profile, db_pool, model, limiter, conv_id, args.history, combined
+            ))
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+        flush()
+
+        logging.info(f"Готово. {progress.summary()}")
+    finally:
+        executor.shutdown(wait=True)
+        db_pool.closeall()
+        stream_conn.close()
+        write_conn.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Пакетное пересоздание саммари и фактов по всем профилям.")
+    parser.add_argument("--run", default=default_run_name(), help="Имя прохода (по умолчанию — хеш текущих промптов).")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Профилей обрабатывается одновременно.")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM, help="Лимит запросов к Gemini в минуту.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Профилей в одной транзакции записи.")
+    history = parser.add_mutually_exclusive_group()
+    history.add_argument("--full-history", dest="history", action="store_const", const=HISTORY_FULL, default=HISTORY_RECENT,
+                         help="Строить саммари заново по всей истории (с архивом).")
+    history.add_argument("--after-watermark", dest="history", action="store_const", const=HISTORY_AFTER_WATERMARK,
+                         help="Только сообщения после водяного знака саммари; профили без новых пропускаются.")
+    parser.add_argument("--retry-errors", action="store_true", help="Повторить профили, завершившиеся ошибкой.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--combined", dest="combined", action="store_true", default=None, help="Один структурированный запрос.")
+    mode.add_argument("--split", dest="combined", action="store_false", help="Два параллельных запроса.")
+    args = parser.parse_args()
+
+    try:
+        run(args)
+    except KeyboardInterrupt:
+        logging.warning("Прервано пользователем. Повторный запуск с тем же --run продолжит с места остановки.")
+        sys.exit(130)
+    except Exception as e:
+        logging.critical(f"Проход прерван: {e}", exc_info=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
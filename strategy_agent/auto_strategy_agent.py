@@ -7,7 +7,10 @@
 
 import os
 import sys
+import queue
 import logging
+import argparse
+import threading
 import importlib.util
 from datetime import datetime
 from pathlib import Path
@@ -19,11 +22,18 @@ os.environ['VERTEX_AI_LOCATION'] = 'us-central1'
 
 # Добавляем текущую директорию в путь Python
 sys.path.insert(0, str(Path(__file__).parent))
+# Корень проекта: общие части пакетных задач (batch_pipeline.py)
+sys.path.append(str(Path(__file__).parent.parent))
 
 # Импорты модулей
 try:
     from search_people import PeopleSearcher
+    from search_results import SearchResultsWriter, load_latest_results
     from client_card_analyzer import ClientCardAnalyzer
+    from reminder_slot_allocator import ReminderSlotAllocator
+    from strategy_run_manifest import load_finished_conv_ids, record_results
+    from batch_pipeline import RateLimiter, ProgressReporter
+    from structured_output import structured_output_stats
 except ImportError as e:
     print(f"[ОШИБКА] Не удалось импортировать модули: {e}")
     sys.exit(1)
@@ -39,6 +49,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Настройки пакетного запуска (переопределяются аргументами командной строки)
+STRATEGY_CONCURRENCY = int(os.environ.get("STRATEGY_CONCURRENCY", "4"))  # Параллельных запросов к Gemini
+STRATEGY_RPM = int(os.environ.get("STRATEGY_RPM", "20"))                  # Лимит запросов к Gemini в минуту
+STRATEGY_BATCH_SIZE = 10                                                  # Клиентов в одном пакете записи
+STRATEGY_LOAD_CHUNK_SIZE = 50                                             # Клиентов в одной пакетной загрузке из БД
+
+# Сигнал AI-воркеру, что клиентов больше не будет
+_END_OF_STREAM = None
+
 def setup_environment():
     """Настройка окружения"""
     logger.info("=== НАСТРОЙКА ОКРУЖЕНИЯ ===")
@@ -77,14 +96,26 @@ def setup_environment():
     return True
 
 def load_latest_search_results():
-    """Загружает последние результаты поиска клиентов"""
+    """
+    Загружает последние результаты поиска клиентов: по указателю founded_people_latest.json,
+    а если его нет — из последнего файла founded_people_*.py прежнего формата.
+
+    Returns:
+        tuple: (имя файла результатов без расширения — имя запуска по умолчанию, список conv_id)
+    """
     try:
+        latest = load_latest_results()
+        if latest:
+            run_name, client_list, _stats = latest
+            logger.info(f"Загружено {len(client_list)} клиентов для обработки")
+            return run_name, client_list
+        
         # Ищем последний файл founded_people_*.py
         import glob
         search_files = glob.glob('founded_people_*.py')
         if not search_files:
             logger.error("Не найден файл с результатами поиска клиентов")
-            return []
+            return None, []
         
         # Берём последний по времени
         latest_file = max(search_files, key=os.path.getctime)
@@ -100,81 +131,338 @@ def load_latest_search_results():
         if hasattr(module, 'PRIORITIZED_CONV_IDS'):
             client_list = module.PRIORITIZED_CONV_IDS
             logger.info(f"Загружено {len(client_list)} клиентов для обработки")
-            return client_list
+            return module_name, client_list
         else:
             logger.error(f"Не найден PRIORITIZED_CONV_IDS в {latest_file}")
-            return []
+            return module_name, []
             
     except Exception as e:
         logger.error(f"Ошибка загрузки результатов поиска: {e}")
-        return []
+        return None, []
+
+def load_scored_clients(top_k, weight_args=None):
+    """
+    Отбирает клиентов многофакторной оценкой (lead_scoring.py) вместо файла founded_people_*.py.
+
+    Args:
+        top_k (int): Сколько клиентов отобрать.
+        weight_args (list): Переопределения весов вида "признак=вес".
+
+    Returns:
+        tuple: (имя запуска по умолчанию, список conv_id по убыванию оценки)
+    """
+    # NumPy нужен только этому режиму, поэтому импорт здесь
+    from lead_scoring import select_top_leads, parse_weights
+
+    conn = None
+    try:
+        conn = PeopleSearcher().get_db_connection()
+        client_list = select_top_leads(conn, top_k, parse_weights(weight_args))
+        logger.info(f"Отобрано оценкой {len(client_list)} клиентов для обработки")
+        return f"scored_{datetime.now().strftime('%Y%m%d')}", client_list
+    except Exception as e:
+        logger.error(f"Ошибка отбора клиентов оценкой: {e}")
+        return None, []
+    finally:
+        if conn:
+            conn.close()
+
+def _pending_clients(client_list, finished):
+    """Клиенты, которых еще нужно обработать: без повторов и без уже обработанных в запуске."""
+    seen = set(finished)
+    for conv_id in client_list:
+        if conv_id not in seen:
+            seen.add(conv_id)
+            yield conv_id
+
+def _chunks(conv_ids, size):
+    """
+    Разбивает поток conv_id на пакеты; пакет отдается, как только набран (или поток кончился).
+    Сбой источника (например, поиска клиентов) завершает поток: уже полученные клиенты
+    уходят последним пакетом.
+    """
+    chunk = []
+    try:
+        for conv_id in conv_ids:
+            chunk.append(conv_id)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    except Exception as e:
+        logger.error(f"[ERROR] Ошибка получения списка клиентов: {e}")
+    if chunk:
+        yield chunk
+
+def _load_stage(analyzer, conv_ids, analysis_queue, results_queue, stop_event, workers_count):
+    """
+    Этап 1: загружает данные клиентов из БД пакетами (load_clients_data_bulk) и передает их
+    AI-воркерам через ограниченную очередь. conv_ids может быть потоком (поиск еще идет):
+    пакеты берутся по мере поступления. В конце в очередь результатов уходит
+    (_END_OF_STREAM, число клиентов), чтобы этап записи знал, сколько результатов ждать.
+    """
+    total = 0
+    try:
+        for chunk in _chunks(conv_ids, STRATEGY_LOAD_CHUNK_SIZE):
+            if stop_event.is_set():
+                break
+            total += _load_chunk(analyzer, chunk, analysis_queue, results_queue)
+    except Exception as e:
+        logger.error(f"[ERROR] Сбой этапа загрузки клиентов: {e}")
+    finally:
+        for _ in range(workers_count):
+            analysis_queue.put(_END_OF_STREAM)
+        results_queue.put((_END_OF_STREAM, total))
+
+def _load_chunk(analyzer, chunk, analysis_queue, results_queue):
+    """
+    Загружает пакет клиентов; при ошибке пакета догружает клиентов по одному.
+
+    Returns:
+        int: Сколько клиентов передано дальше (в анализ или сразу с ошибкой в запись).
+    """
+    loaded = set()
+    dispatched = 0
+    try:
+        for client_data in analyzer.load_clients_data_bulk(chunk):
+            loaded.add(client_data['conv_id'])
+            # Блокируется, пока воркеры не разберут очередь: загрузка не убегает вперед анализа
+            analysis_queue.put(client_data)
+            dispatched += 1
+    except Exception as e:
+        # Ошибка пакета не должна стоить всех его клиентов: догружаем их по одному
+        logger.error(f"[ERROR] Ошибка пакетной загрузки клиентов {chunk[0]}..{chunk[-1]}: {e}")
+        for conv_id in chunk:
+            if conv_id in loaded:
+                continue
+            try:
+                client_data = analyzer.load_client_data_from_db(conv_id)
+            except Exception as client_error:
+                logger.error(f"[ERROR] Ошибка загрузки клиента {conv_id}: {client_error}")
+                results_queue.put((conv_id, None, 'error', str(client_error)[:500]))
+            else:
+                analysis_queue.put(client_data)
+            dispatched += 1
+    return dispatched
+
+
+def _analysis_stage(analyzer, analysis_queue, results_queue, stop_event):
+    """Этап 2: AI анализ карточки клиента (несколько воркеров, общий лимит запросов в минуту)."""
+    while True:
+        client_data = analysis_queue.get()
+        if client_data is _END_OF_STREAM or stop_event.is_set():
+            break
+        # Этап записи ждет ровно по одному результату на клиента, поэтому результат отдается
+        # всегда, даже для некорректного элемента очереди; воркер при этом не останавливается
+        conv_id = None
+        result = (conv_id, None, 'error', 'Сбой этапа AI анализа')
+        try:
+            conv_id = client_data['conv_id']
+            try:
+                result = (conv_id, analyzer.analyze_client_card(client_data), 'normal', None)
+            except Exception as analysis_error:
+                logger.warning(f"AI анализ провалился для {conv_id}: {analysis_error}")
+                result = (conv_id, analyzer._create_fallback_analysis(client_data), 'fallback', None)
+        except Exception as e:
+            logger.error(f"[ERROR] Сбой AI воркера на клиенте {conv_id}: {e}")
+            result = (conv_id, None, 'error', str(e)[:500])
+        finally:
+            results_queue.put(result)
+
 
-def analyze_clients(client_list):
-    """Анализ клиентов с помощью AI"""
+def _commit_batch(analyzer, slot_allocator, run_name, manifest_rows):
+    """
+    Вставляет напоминания пакета и отметки манифеста одной транзакцией.
+
+    Returns:
+        int: Количество созданных напоминаний.
+    """
+    conn = analyzer.get_db_connection()
+    try:
+        if run_name:
+            record_results(conn, run_name, manifest_rows)
+        created = slot_allocator.flush(conn)
+        # Если в пакете не было напоминаний, flush не выполняет commit
+        conn.commit()
+        return len(created)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def analyze_clients(client_list, run_name=None, concurrency=STRATEGY_CONCURRENCY, rpm=STRATEGY_RPM,
+                    batch_size=STRATEGY_BATCH_SIZE, retry_failed=False, expected_total=None):
+    """
+    Анализ клиентов с помощью AI.
+
+    Конвейер из трех этапов: поток загрузки из БД -> concurrency AI-воркеров (не больше rpm
+    запросов к Gemini в минуту) -> запись профилей и напоминаний пакетами по batch_size
+    в основном потоке. Если задан run_name, обработанные клиенты отмечаются в манифесте
+    запуска и при повторном запуске пропускаются.
+
+    client_list может быть списком или потоком conv_id (PeopleSearcher.stream_conv_ids):
+    поток читается по мере поступления, expected_total — оценка его длины для прогресса.
+    """
     logger.info("=== AI АНАЛИЗ КЛИЕНТОВ ===")
     
     if not client_list:
         logger.warning("Список клиентов пуст")
         return False
     
-    logger.info(f"Обрабатываем {len(client_list)} клиентов")
-    print(f"\n⚙️  НАЧИНАЕМ ОБРАБОТКУ {len(client_list)} КЛИЕНТОВ")
-    print("\u2139️  Можно остановить обработку нажав Ctrl+C")
+    analyzer = ClientCardAnalyzer()
+    analyzer.rate_limiter = RateLimiter(rpm)
+    # Общий аллокатор слотов: занятые минуты грузятся один раз, напоминания вставляются пакетами
+    slot_allocator = ReminderSlotAllocator()
+    
+    finished = set()
+    if run_name:
+        conn = analyzer.get_db_connection()
+        try:
+            finished = load_finished_conv_ids(conn, run_name, retry_failed)
+        finally:
+            conn.close()
+        if finished:
+            logger.info(f"Запуск '{run_name}': {len(finished)} клиентов уже обработаны, пропускаем")
+    
+    # Каждый клиент обрабатывается один раз, даже если повторяется в списке
+    if isinstance(client_list, (list, tuple)):
+        pending = list(_pending_clients(client_list, finished))
+        if not pending:
+            logger.info("Все клиенты этого запуска уже обработаны")
+            return True
+        expected_total = len(pending)
+    else:
+        pending = _pending_clients(client_list, finished)
+    total_label = expected_total if expected_total is not None else "?"
+    
+    logger.info(f"Обрабатываем {total_label} клиентов: {concurrency} AI-воркеров, лимит {rpm} запросов/мин, пакет {batch_size}")
+    print(f"\n⚙️  НАЧИНАЕМ ОБРАБОТКУ {total_label} КЛИЕНТОВ")
+    print("ℹ️  Можно остановить обработку нажав Ctrl+C (повторный запуск продолжит с места остановки)")
     print("="*80)
     
-    try:
-        analyzer = ClientCardAnalyzer()
-        
-        success_count = 0
-        error_count = 0
-        
-        for i, conv_id in enumerate(client_list, 1):
-            logger.info(f"[{i}/{len(client_list)}] Анализируем клиента {conv_id}")
+    analysis_queue = queue.Queue(maxsize=concurrency * 2)
+    results_queue = queue.Queue()
+    stop_event = threading.Event()
+    threads = [threading.Thread(
+        target=_load_stage, name="StrategyLoader", daemon=True,
+        args=(analyzer, pending, analysis_queue, results_queue, stop_event, concurrency)
+    )]
+    threads += [threading.Thread(
+        target=_analysis_stage, name=f"StrategyWorker-{i + 1}", daemon=True,
+        args=(analyzer, analysis_queue, results_queue, stop_event)
+    ) for i in range(concurrency)]
+    
+    progress = ProgressReporter(expected_total or 0, "AI анализ клиентов")
+    success_count = 0
+    error_count = 0
+    reminders_created = 0
+    batch = []
+    # Отметки манифеста, ожидающие записи вместе с напоминаниями своего пакета
+    manifest_rows = []
+    
+    def write_batch():
+        """Этап 3: обновляет профили, распределяет слоты напоминаний и фиксирует пакет."""
+        nonlocal success_count, error_count, reminders_created
+        for conv_id, analysis_result, analysis_status, error in batch:
+            if analysis_status == 'error':
+                error_count += 1
+                # Элемент без conv_id отметить в манифесте нельзя, он только считается ошибкой
+                if conv_id is not None:
+                    manifest_rows.append((conv_id, 'error', False, error))
+                progress.record(ok=False)
+                continue
             
-            try:
-                # Загружаем данные клиента
-                client_data = analyzer.load_client_data_from_db(conv_id)
-                
-                # Проводим анализ
-                try:
-                    analysis_result = analyzer.analyze_client_card(client_data)
-                    analysis_status = 'normal'
-                except Exception as analysis_error:
-                    logger.warning(f"AI анализ провалился для {conv_id}: {analysis_error}")
-                    analysis_result = analyzer._create_fallback_analysis(client_data)
-                    analysis_status = 'fallback'
-                
-                # Обновляем профиль
-                profile_updated = analyzer.update_client_profile(conv_id, analysis_result)
-                
-                # Создаём напоминание только для качественного анализа
-                reminder_created = False
-                if analysis_status == 'normal':
-                    reminder_created = analyzer.create_strategic_reminder(conv_id, analysis_result)
-                else:
-                    logger.info(f"Fallback анализ для {conv_id} - напоминание не создаём")
-                
-                if profile_updated:
-                    success_count += 1
-                    logger.info(f"[OK] Клиент {conv_id} обработан успешно")
-                else:
-                    error_count += 1
-                    logger.warning(f"[WARN] Проблемы с обработкой клиента {conv_id}")
-                    
-            except Exception as e:
+            profile_updated = analyzer.update_client_profile(conv_id, analysis_result)
+            
+            # Создаём напоминание только для качественного анализа
+            reminder_created = False
+            if analysis_status == 'normal':
+                reminder_created = analyzer.create_strategic_reminder(conv_id, analysis_result, slot_allocator)
+            else:
+                logger.info(f"Fallback анализ для {conv_id} - напоминание не создаём")
+            
+            if profile_updated:
+                success_count += 1
+                logger.info(f"[OK] Клиент {conv_id} обработан успешно")
+            else:
                 error_count += 1
-                logger.error(f"[ERROR] Ошибка обработки клиента {conv_id}: {e}")
+                logger.warning(f"[WARN] Проблемы с обработкой клиента {conv_id}")
+            
+            metadata = analysis_result.get('analysis_metadata') or {}
+            if not profile_updated:
+                status = 'error'
+            elif analysis_status == 'fallback' or metadata.get('analysis_status') == 'fallback_analysis':
+                status = 'fallback'
+            else:
+                status = 'done'
+            manifest_rows.append((conv_id, status, reminder_created, None if profile_updated else 'Профиль не обновлен'))
+            progress.record(ok=profile_updated)
+        batch.clear()
+        
+        try:
+            reminders_created += _commit_batch(analyzer, slot_allocator, run_name, manifest_rows)
+            manifest_rows.clear()
+        except Exception as e:
+            # Напоминания и отметки остаются в очереди и уйдут со следующим пакетом
+            logger.error(f"Ошибка записи пакета напоминаний и манифеста: {e}")
+    
+    try:
+        for thread in threads:
+            thread.start()
+        
+        # Сколько результатов ждать, становится известно, когда этап загрузки дочитает поток
+        received, total = 0, None
+        while total is None or received < total:
+            result = results_queue.get()
+            if result[0] is _END_OF_STREAM:
+                total = result[1]
                 continue
+            received += 1
+            batch.append(result)
+            if len(batch) >= batch_size:
+                write_batch()
+        write_batch()
+        
+        if total == 0:
+            logger.info("Новых клиентов для обработки нет: все уже обработаны в этом запуске")
+            return True
         
-        logger.info(f"Анализ завершён: {success_count} успешно, {error_count} с ошибками")
+        logger.info(progress.summary())
+        logger.info(f"Анализ завершён: {success_count} успешно, {error_count} с ошибками, напоминаний создано: {reminders_created}, "
+                    f"статистика слотов: {slot_allocator.stats}")
+        logger.info(f"Разбор ответов ИИ по точкам вызова: {structured_output_stats()}")
         return success_count > 0
         
+    except KeyboardInterrupt:
+        # Сохраняем уже проанализированных клиентов и их напоминания
+        stop_event.set()
+        write_batch()
+        logger.info(progress.summary())
+        raise
     except Exception as e:
+        stop_event.set()
         logger.error(f"Критическая ошибка анализа: {e}")
         return False
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Автоматический стратегический агент MuzVideo2")
+    parser.add_argument("--run", help="Имя запуска для манифеста (по умолчанию — имя файла результатов поиска)")
+    parser.add_argument("--concurrency", type=int, default=STRATEGY_CONCURRENCY, help="Параллельных запросов к Gemini")
+    parser.add_argument("--rpm", type=int, default=STRATEGY_RPM, help="Лимит запросов к Gemini в минуту")
+    parser.add_argument("--batch-size", type=int, default=STRATEGY_BATCH_SIZE, help="Клиентов в одном пакете записи")
+    parser.add_argument("--retry-failed", action="store_true", help="Повторить клиентов, получивших fallback анализ")
+    parser.add_argument("--search", type=int, nargs="?", const=500, metavar="LIMIT",
+                        help="Запустить поиск клиентов (search_people.py) и анализировать их по мере отбора")
+    parser.add_argument("--scored-top", type=int, metavar="K",
+                        help="Отобрать K клиентов многофакторной оценкой (lead_scoring.py) вместо founded_people_*.py")
+    parser.add_argument("--weight", action="append", metavar="ПРИЗНАК=ВЕС",
+                        help="Вес признака оценки для --scored-top (можно повторять)")
+    return parser.parse_args()
+
 def main():
     """Главная функция автоматического запуска"""
+    args = parse_args()
     start_time = datetime.now()
     
     print("=" * 60)
@@ -189,8 +477,19 @@ def main():
     
     # 2. Загрузка результатов поиска
     logger.info("ЭТАП 1/1: Загрузка результатов поиска клиентов")
+    expected_total = None
     try:
-        client_list = load_latest_search_results()
+        if args.search:
+            # Поиск и анализ идут одновременно: первые клиенты уходят в анализ сразу после отбора,
+            # результат поиска пишется в founded_people_<ts>.ndjson
+            writer = SearchResultsWriter()
+            search_run_name = writer.run_name
+            client_list = PeopleSearcher().stream_conv_ids(writer, args.search)
+            expected_total = args.search
+        elif args.scored_top:
+            search_run_name, client_list = load_scored_clients(args.scored_top, args.weight)
+        else:
+            search_run_name, client_list = load_latest_search_results()
         if not client_list:
             logger.error("Не удалось загрузить список клиентов")
             print("⚠️  ОШИБКА: Не найдено клиентов для обработки")
@@ -203,7 +502,16 @@ def main():
     # 3. Анализ клиентов
     logger.info("ЭТАП 1/1: AI анализ и постановка напоминаний")
     try:
-        success = analyze_clients(client_list)  # Обрабатываем всех найденных клиентов
+        # Обрабатываем всех найденных клиентов
+        success = analyze_clients(
+            client_list,
+            run_name=args.run or search_run_name,
+            concurrency=args.concurrency,
+            rpm=args.rpm,
+            batch_size=args.batch_size,
+            retry_failed=args.retry_failed,
+            expected_total=expected_total,
+        )
         if not success:
             logger.error("Анализ клиентов завершился неудачно")
             return 1
@@ -12,13 +12,21 @@ import re
 import psycopg2
 import psycopg2.extras
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Optional, Any, Tuple
+from typing import Dict, Iterator, List, Optional, Any, Tuple
 import vertexai
 from vertexai.generative_models import GenerativeModel, GenerationConfig, HarmCategory, HarmBlockThreshold
 from google.oauth2 import service_account
+import sys
 import time
-import threading
-from functools import wraps
+from pathlib import Path
+
+from reminder_slot_allocator import ReminderSlotAllocator
+
+# Корень проекта: общий исполнитель вызовов LLM (llm_executor.py)
+sys.path.append(str(Path(__file__).parent.parent))
+from llm_executor import LLMExecutor, DeadlineExceeded
+from structured_output import json_generation_params, parse_json_response, record_retry, StructuredOutputError
+import llm_ledger
 
 # Загружаем переменные окружения из .env файла
 from dotenv import load_dotenv
@@ -34,42 +42,6 @@ logging.basicConfig(
     ]
 )
 
-class TimeoutError(Exception):
-    """Исключение для тайм-аута"""
-    pass
-
-def with_timeout(timeout_seconds):
-    """Декоратор для ограничения времени выполнения функции (работает на Windows)"""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            result = [None]  # type: List[Any]
-            exception = [None]  # type: List[Optional[Exception]]
-            
-            def target():
-                try:
-                    result[0] = func(*args, **kwargs)
-                except Exception as e:
-                    exception[0] = e
-            
-            thread = threading.Thread(target=target)
-            thread.daemon = True
-            thread.start()
-            thread.join(timeout_seconds)
-            
-            if thread.is_alive():
-                # Поток все еще работает - произошел тайм-аут
-                logging.error(f"[TIMEOUT] Функция {func.__name__} превысила лимит времени {timeout_seconds} секунд")
-                raise TimeoutError(f"Операция превысила лимит времени {timeout_seconds} секунд")
-            
-            if exception[0] is not None:
-                raise exception[0]
-            
-            return result[0]
-        
-        return wrapper
-    return decorator
-
 # Константы
 PROJECT_ID = "muzvideo2"
 LOCATION = "us-central1"
@@ -81,6 +53,66 @@ GEMINI_TIMEOUT_SECONDS = 180  # 3 минуты максимум на один з
 MAX_RETRIES = 2  # Максимум 2 повторные попытки
 RETRY_DELAY_SECONDS = 30  # Задержка между попытками
 
+# Общий пул для вызовов Gemini: не больше GEMINI_EXECUTOR_WORKERS одновременных (в том числе зависших) запросов
+GEMINI_EXECUTOR_WORKERS = int(os.environ.get("GEMINI_EXECUTOR_WORKERS", "8"))
+GEMINI_EXECUTOR = LLMExecutor(GEMINI_EXECUTOR_WORKERS, name="StrategyGemini")
+
+# Сообщений диалога в данных клиента для анализа
+DIALOGUE_HISTORY_LIMIT = 20
+
+# Параметры генерации анализа карточки: низкая температура для стабильности, ответ — JSON по схеме
+CARD_GENERATION_PARAMS = {
+    "temperature": 0.1,
+    "top_p": 0.8,
+    "top_k": 40,
+    "max_output_tokens": 8192,  # Достаточно для JSON
+}
+
+_STRING_LIST = {"type": "ARRAY", "items": {"type": "STRING"}}
+
+# Схема ответа анализа карточки (формат ответа из CARD_ANALYSIS_PROMPT).
+# Поля mandatory_reminder не обязательны: при восстановлении обрезанного ответа
+# пустые значения не должны превращаться в напоминание.
+CARD_ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "profile_updates": {
+            "type": "OBJECT",
+            "properties": {
+                "lead_qualification": _STRING_LIST,
+                "funnel_stage": {"type": "STRING"},
+                "client_level": _STRING_LIST,
+                "learning_goals": _STRING_LIST,
+                "client_pains": _STRING_LIST,
+                "email": _STRING_LIST,
+                "purchased_products": _STRING_LIST,
+                "client_activity": {"type": "STRING"},
+            },
+        },
+        "strategic_analysis": {
+            "type": "OBJECT",
+            "properties": {
+                "psychological_profile": {"type": "STRING"},
+                "comfort_level": {"type": "INTEGER"},
+                "comfort_issues": {"type": "STRING"},
+                "short_term_strategy": {"type": "STRING"},
+                "long_term_strategy": {"type": "STRING"},
+                "next_action": {"type": "STRING"},
+            },
+        },
+        "mandatory_reminder": {
+            "type": "OBJECT",
+            "properties": {
+                "contact_in_days": {"type": "INTEGER"},
+                "optimal_utc_hour": {"type": "INTEGER"},
+                "activity_analysis": {"type": "STRING"},
+                "reminder_context": {"type": "STRING"},
+            },
+        },
+    },
+    "required": ["profile_updates", "strategic_analysis", "mandatory_reminder"],
+}
+
 # Промпт для стратегического анализа карточки клиента
 CARD_ANALYSIS_PROMPT = """
 Ты — ИИ-стратег онлайн-школы фортепиано MuzVideo2.ru с глубоким пониманием психологии клиентов и продаж.
@@ -482,6 +514,8 @@ class ClientCardAnalyzer:
     def __init__(self):
         """Инициализация анализатора"""
         self.model = None
+        # Общий лимит запросов в минуту (batch_pipeline.RateLimiter) при параллельном пакетном запуске
+        self.rate_limiter = None
         self._initialize_vertex_ai()
     
     def _initialize_vertex_ai(self):
@@ -517,12 +551,9 @@ class ClientCardAnalyzer:
             
             logging.info(f"[VERTEX_AI] Создаём модель: {MODEL_NAME}")
             
-            # Настройки генерации
+            # Настройки генерации: JSON-ответ по схеме CARD_ANALYSIS_RESPONSE_SCHEMA
             generation_config = GenerationConfig(
-                temperature=0.1,  # Низкая температура для стабильности
-                top_p=0.8,
-                top_k=40,
-                max_output_tokens=8192,  # Достаточно для JSON
+                **json_generation_params(CARD_ANALYSIS_RESPONSE_SCHEMA, **CARD_GENERATION_PARAMS)
             )
             
             # Настройки безопасности - отключаем все фильтры
@@ -687,8 +718,8 @@ class ClientCardAnalyzer:
                         FROM dialogues 
                         WHERE conv_id = %s 
                         ORDER BY created_at DESC 
-                        LIMIT 20
-                    """, (conv_id,))
+                        LIMIT %s
+                    """, (conv_id, DIALOGUE_HISTORY_LIMIT))
                     messages = cur.fetchall()
                     client_data["dialogue_history"] = [dict(msg) for msg in reversed(messages)]
                     
@@ -759,12 +790,186 @@ class ClientCardAnalyzer:
             logging.error(f"Ошибка загрузки данных клиента {conv_id}: {e}")
             raise
     
-    @with_timeout(GEMINI_TIMEOUT_SECONDS)
-    def _call_gemini_with_timeout(self, prompt: str):
-        """Вызов Gemini API с тайм-аутом"""
+    def load_clients_data_bulk(self, conv_ids: List[int]) -> Iterator[Dict[str, Any]]:
+        """
+        Пакетная загрузка данных клиентов для пакетных запусков.
+
+        Вместо отдельных соединений и запросов на каждого клиента (load_client_data_from_db)
+        все данные пакета читаются несколькими запросами с conv_id = ANY(%s) через одно соединение:
+        профили, последние DIALOGUE_HISTORY_LIMIT сообщений (оконной функцией), покупки,
+        активные напоминания и покупки по email из переписки. Email в профиле и связывание
+        покупок с клиентом выполняются так же, как в load_client_data_from_db.
+
+        Args:
+            conv_ids (List[int]): ID клиентов (порядок выдачи сохраняется).
+
+        Yields:
+            Dict[str, Any]: Данные клиента в том же формате, что у load_client_data_from_db.
+        """
+        if not conv_ids:
+            return
+
+        clients = {
+            conv_id: {
+                "conv_id": conv_id,
+                "profile": {},
+                "dialogue_history": [],
+                "purchases": [],
+                "email_purchases": [],  # Покупки найденные по email
+                "active_reminders": []
+            }
+            for conv_id in conv_ids
+        }
+        conv_id_list = list(clients)
+
+        conn = self.get_db_connection()
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute("SELECT * FROM user_profiles WHERE conv_id = ANY(%s)", (conv_id_list,))
+                for profile in cur.fetchall():
+                    clients[profile['conv_id']]["profile"] = dict(profile)
+
+                # Последние сообщения каждого диалога одним запросом
+                cur.execute("""
+                    SELECT conv_id, role, message, created_at FROM (
+                        SELECT conv_id, role, message, created_at,
+                               row_number() OVER (PARTITION BY conv_id ORDER BY created_at DESC) AS position
+                        FROM dialogues
+                        WHERE conv_id = ANY(%s)
+                    ) latest
+                    WHERE position <= %s
+                    ORDER BY conv_id, created_at ASC
+                """, (conv_id_list, DIALOGUE_HISTORY_LIMIT))
+                for message in cur.fetchall():
+                    message = dict(message)
+                    clients[message.pop('conv_id')]["dialogue_history"].append(message)
+
+                self._fill_purchases_bulk(cur, clients, conv_id_list)
+
+                cur.execute("""
+                    SELECT conv_id, reminder_datetime, reminder_context_summary, created_at
+                    FROM reminders
+                    WHERE conv_id = ANY(%s) AND status = 'active'
+                    ORDER BY conv_id, reminder_datetime
+                """, (conv_id_list,))
+                for reminder in cur.fetchall():
+                    reminder = dict(reminder)
+                    clients[reminder.pop('conv_id')]["active_reminders"].append(reminder)
+
+                # Email из переписки и покупки по ним — один запрос на весь пакет
+                emails_by_client = {
+                    conv_id: self._extract_emails_from_dialogue(client_data["dialogue_history"])
+                    for conv_id, client_data in clients.items()
+                }
+                all_emails = {email.lower() for emails in emails_by_client.values() for email in emails}
+                purchases_by_email = {}
+                if all_emails:
+                    cur.execute("""
+                        SELECT product_name, purchase_date, amount, email, conv_id
+                        FROM client_purchases
+                        WHERE LOWER(email) = ANY(%s)
+                        ORDER BY purchase_date DESC
+                    """, (list(all_emails),))
+                    for purchase in cur.fetchall():
+                        purchases_by_email.setdefault(purchase['email'].lower(), []).append(dict(purchase))
+            conn.commit()
+
+            linked_conv_ids = []
+            for conv_id, emails in emails_by_client.items():
+                if not emails:
+                    continue
+                email_purchases = [
+                    dict(purchase, found_via_email=email)  # Отмечаем, как нашли
+                    for email in emails
+                    for purchase in purchases_by_email.get(email.lower(), [])
+                ]
+                if not email_purchases:
+                    continue
+                logging.info(f"Найдено {len(email_purchases)} покупок по email {emails} для клиента {conv_id}")
+                clients[conv_id]["email_purchases"] = email_purchases
+                self._update_profile_email_in_transaction(conn, conv_id, emails)
+                self._link_purchases_in_transaction(conn, conv_id, email_purchases)
+                linked_conv_ids.append(conv_id)
+
+            # Перечитываем покупки клиентов, с которыми только что связали покупки по email
+            if linked_conv_ids:
+                with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                    for conv_id in linked_conv_ids:
+                        clients[conv_id]["purchases"] = []
+                    self._fill_purchases_bulk(cur, clients, linked_conv_ids)
+                conn.commit()
+        finally:
+            conn.close()
+
+        logging.info(f"Пакетно загружены данные {len(clients)} клиентов, покупки по email найдены у {len(linked_conv_ids)}")
+        for conv_id in conv_id_list:
+            yield clients[conv_id]
+
+    def _fill_purchases_bulk(self, cur, clients: Dict[int, Dict[str, Any]], conv_ids: List[int]) -> None:
+        """Раскладывает покупки клиентов пакета по их данным (одним запросом)."""
+        cur.execute("""
+            SELECT conv_id, product_name, purchase_date, amount, email
+            FROM client_purchases
+            WHERE conv_id = ANY(%s)
+            ORDER BY conv_id, purchase_date DESC
+        """, (conv_ids,))
+        for purchase in cur.fetchall():
+            purchase = dict(purchase)
+            clients[purchase.pop('conv_id')]["purchases"].append(purchase)
+
+    def _update_profile_email_in_transaction(self, conn, conv_id: int, emails: List[str]) -> None:
+        """То же, что _update_profile_email, но в переданном соединении (ошибка не прерывает пакет)."""
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT email FROM user_profiles WHERE conv_id = %s", (conv_id,))
+                result = cur.fetchone()
+                if result:
+                    existing_emails = result[0] if result[0] else []
+                    # Объединяем существующие и новые email
+                    all_emails = list(set(existing_emails + emails))
+                    cur.execute("""
+                        UPDATE user_profiles 
+                        SET email = %s, updated_at = CURRENT_TIMESTAMP
+                        WHERE conv_id = %s
+                    """, (all_emails, conv_id))
+                    logging.info(f"Обновлен email для клиента {conv_id}: {all_emails}")
+                else:
+                    logging.warning(f"Профиль клиента {conv_id} не найден для обновления email")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Ошибка обновления email в профиле: {e}")
+
+    def _link_purchases_in_transaction(self, conn, conv_id: int, email_purchases: List[Dict]) -> None:
+        """То же, что _link_purchases_to_client, но в переданном соединении (ошибка не прерывает пакет)."""
+        try:
+            with conn.cursor() as cur:
+                for purchase in email_purchases:
+                    email = purchase.get('found_via_email')
+                    if email and purchase.get('conv_id') != conv_id:
+                        cur.execute("""
+                            UPDATE client_purchases 
+                            SET conv_id = %s
+                            WHERE email = %s AND conv_id IS DISTINCT FROM %s
+                        """, (conv_id, email, conv_id))
+                        if cur.rowcount > 0:
+                            logging.info(f"Обновлено {cur.rowcount} покупок для клиента {conv_id} по email {email}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logging.error(f"Ошибка связывания покупок с клиентом: {e}")
+
+    def _call_gemini_with_timeout(self, prompt: str, attempt: int = 0):
+        """
+        Вызов Gemini API с тайм-аутом через общий пул GEMINI_EXECUTOR.
+        Vertex AI SDK не принимает тайм-аут отдельного запроса, поэтому срок соблюдает пул:
+        по истечении GEMINI_TIMEOUT_SECONDS выбрасывается DeadlineExceeded, а зависший вызов
+        продолжает занимать один из GEMINI_EXECUTOR_WORKERS потоков (новые потоки не создаются).
+        Вызов пишется в журнал LLM (llm_ledger) из потока пула, когда он завершится.
+        """
         if self.model is None:
             raise RuntimeError("Model not initialized")
-        return self.model.generate_content(prompt)
+        return GEMINI_EXECUTOR.call(GEMINI_TIMEOUT_SECONDS, llm_ledger.generate, self.model, prompt, "card_analysis", attempt)
     
     def analyze_client_card(self, client_data: Dict[str, Any]) -> Dict[str, Any]:
         """Анализ карточки клиента с помощью AI с максимально надёжным парсингом"""
@@ -794,12 +999,16 @@ class ClientCardAnalyzer:
             for attempt in range(MAX_RETRIES + 1):
                 try:
                     logging.info(f"Отправка запроса к Gemini для анализа клиента {conv_id} (попытка {attempt + 1}/{MAX_RETRIES + 1})")
+                    if attempt > 0:
+                        record_retry("card_analysis")
                     logging.info(f"[DEBUG] Длина промпта: {len(prompt)} символов")
                     logging.info(f"[DEBUG] Первые 200 символов промпта: {prompt[:200]}")
                     logging.info(f"[TIMEOUT] Используем тайм-аут {GEMINI_TIMEOUT_SECONDS} секунд")
                     
-                    # Вызов с тайм-аутом
-                    response = self._call_gemini_with_timeout(prompt)
+                    # Вызов с тайм-аутом; каждая попытка учитывается в лимите запросов
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.acquire()
+                    response = self._call_gemini_with_timeout(prompt, attempt)
                     logging.info(f"[GEMINI] Ответ получен успешно")
                     
                     # Проверяем, что response не None
@@ -826,7 +1035,7 @@ class ClientCardAnalyzer:
                     # Успешное получение ответа - выходим из цикла
                     break
                     
-                except (TimeoutError, Exception) as api_error:
+                except (DeadlineExceeded, Exception) as api_error:
                     logging.error(f"[GEMINI API ERROR] Попытка {attempt + 1}: {api_error}")
                     logging.error(f"[GEMINI API ERROR] Тип ошибки: {type(api_error)}")
                     
@@ -858,83 +1067,20 @@ class ClientCardAnalyzer:
             return self._create_fallback_analysis(client_data)
     
     def _extract_json_from_response(self, response_text: str, conv_id: str) -> Dict[str, Any]:
-        """Супер-надёжное извлечение JSON из ответа ИИ"""
-        import re
-        
-        # Стратегия 1: Поиск JSON в markdown блоках
-        json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', response_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group(1).strip()
-            logging.info(f"[JSON-1] Найден JSON в markdown блоке для клиента {conv_id}")
-            result = self._try_parse_json(json_str, "markdown", conv_id)
-            if result:
-                return result
-        
-        # Стратегия 2: Поиск JSON по фигурным скобкам
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1
-        if json_start != -1 and json_end > json_start:
-            json_str = response_text[json_start:json_end].strip()
-            logging.info(f"[JSON-2] Найден JSON в тексте {json_start}-{json_end} для клиента {conv_id}")
-            result = self._try_parse_json(json_str, "brackets", conv_id)
-            if result:
-                return result
-        
-        # Стратегия 3: Поиск JSON через регулярные выражения (более агрессивный подход)
-        json_patterns = [
-            r'\{[\s\S]*?\}',  # Любой текст между { и }
-            r'"[^"]*":\s*\{[\s\S]*?\}',  # Объект с ключом
-            r'\{[\s\S]*?"[^"]*"[\s\S]*?\}',  # Объект с ключами
-        ]
-        
-        for i, pattern in enumerate(json_patterns):
-            matches = re.findall(pattern, response_text, re.MULTILINE)
-            for j, match in enumerate(matches):
-                logging.info(f"[JSON-3.{i}.{j}] Пробуем паттерн {i+1}, вариант {j+1} для клиента {conv_id}")
-                result = self._try_parse_json(match.strip(), f"pattern_{i}_{j}", conv_id)
-                if result:
-                    return result
-        
-        # Стратегия 4: Очистка от мусорных символов
-        cleaned_text = re.sub(r'^[^{]*', '', response_text)  # Убираем всё до первой {
-        cleaned_text = re.sub(r'[^}]*$', '', cleaned_text)   # Убираем всё после последней }
-        if cleaned_text:
-            logging.info(f"[JSON-4] Очищенный текст для клиента {conv_id}")
-            result = self._try_parse_json(cleaned_text, "cleaned", conv_id)
-            if result:
-                return result
-        
-        # Если ничего не получилось - логируем детали и возвращаем fallback
-        logging.error(f"[JSON-FAIL] НЕ УДАЛОСЬ извлечь JSON для клиента {conv_id}")
-        logging.error(f"[JSON-FAIL] Первые 500 символов ответа: {response_text[:500]}")
-        logging.error(f"[JSON-FAIL] Последние 200 символов ответа: {response_text[-200:]}")
-        
-        raise ValueError(f"Не удалось извлечь валидный JSON из ответа ИИ для клиента {conv_id}")
-    
-    def _try_parse_json(self, json_str: str, method: str, conv_id: str) -> Optional[Dict[str, Any]]:
-        """Попытка парсинга JSON с различными методами очистки"""
-        attempts = [
-            json_str,  # Как есть
-            json_str.strip(),  # Убираем пробелы
-            json_str.replace('\n', '').replace('\r', '').strip(),  # Убираем переносы
-            json_str.replace('\\"', '"'),  # Убираем экранирование кавычек
-            re.sub(r'^"', '', re.sub(r'"$', '', json_str.strip())),  # Убираем внешние кавычки
-            re.sub(r'[\x00-\x1f\x7f-\x9f]', '', json_str),  # Убираем управляющие символы
-        ]
-        
-        for i, attempt in enumerate(attempts):
-            try:
-                result = json.loads(attempt)
-                logging.info(f"[JSON-OK] Успешный парсинг методом {method}, попытка {i+1} для клиента {conv_id}")
-                return result
-            except json.JSONDecodeError as e:
-                logging.debug(f"[JSON-TRY] Метод {method}, попытка {i+1} провалилась для клиента {conv_id}: {e}")
-                continue
-            except Exception as e:
-                logging.debug(f"[JSON-ERR] Метод {method}, попытка {i+1}, неожиданная ошибка для клиента {conv_id}: {e}")
-                continue
-        
-        return None
+        """
+        Разбор JSON-ответа анализа по CARD_ANALYSIS_RESPONSE_SCHEMA.
+        Обрезанный ответ восстанавливается без повторного запроса (structured_output).
+        """
+        try:
+            result = parse_json_response(response_text, CARD_ANALYSIS_RESPONSE_SCHEMA, "card_analysis")
+        except StructuredOutputError:
+            logging.error(f"[JSON-FAIL] НЕ УДАЛОСЬ извлечь JSON для клиента {conv_id}")
+            logging.error(f"[JSON-FAIL] Первые 500 символов ответа: {response_text[:500]}")
+            logging.error(f"[JSON-FAIL] Последние 200 символов ответа: {response_text[-200:]}")
+            raise ValueError(f"Не удалось извлечь валидный JSON из ответа ИИ для клиента {conv_id}")
+        if not isinstance(result, dict):
+            raise ValueError(f"Ответ ИИ для клиента {conv_id} не является JSON-объектом")
+        return result
     
     def _create_fallback_analysis(self, client_data: Dict[str, Any]) -> Dict[str, Any]:
         """Создание базового анализа в случае сбоя ИИ (чтобы скрипт НЕ упал)"""
@@ -1117,8 +1263,15 @@ class ClientCardAnalyzer:
             logging.error(f"Ошибка обновления профиля клиента {conv_id}: {e}")
             return False
     
-    def create_strategic_reminder(self, conv_id: int, analysis_result: Dict[str, Any]) -> bool:
-        """Создание обязательного стратегического напоминания с распределением по минутам"""
+    def create_strategic_reminder(self, conv_id: int, analysis_result: Dict[str, Any],
+                                  slot_allocator: Optional[ReminderSlotAllocator] = None) -> bool:
+        """
+        Создание обязательного стратегического напоминания с распределением по минутам.
+
+        Если передан slot_allocator (пакетный запуск), напоминание только ставится в очередь
+        аллокатора и будет вставлено при slot_allocator.flush(). Без аллокатора напоминание
+        создается сразу.
+        """
         try:
             reminder_data = analysis_result.get('mandatory_reminder', {})
             
@@ -1130,60 +1283,53 @@ class ClientCardAnalyzer:
             optimal_utc_hour = reminder_data.get('optimal_utc_hour', 12)
             reminder_context = reminder_data.get('reminder_context', 'Стратегическое взаимодействие')
             
+            batch_mode = slot_allocator is not None
+            if not batch_mode:
+                slot_allocator = ReminderSlotAllocator()
+            
             with self.get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    # Находим свободное время (макс 1 напоминание в минуту)
-                    target_date = datetime.now(timezone.utc).date() + timedelta(days=contact_in_days)
-                    base_time = datetime.combine(target_date, datetime.min.time()).replace(tzinfo=timezone.utc, hour=optimal_utc_hour)
-                    
-                    # Проверяем свободные минуты в течение часа
-                    for minute_offset in range(60):
-                        candidate_time = base_time + timedelta(minutes=minute_offset)
-                        
-                        # Проверяем, свободна ли эта минута
-                        cur.execute("""
-                            SELECT COUNT(*) FROM reminders 
-                            WHERE status = 'active'
-                            AND reminder_datetime BETWEEN %s AND %s
-                        """, (
-                            candidate_time,
-                            candidate_time + timedelta(seconds=59)
-                        ))
-                        
-                        result = cur.fetchone()
-                        if result and result[0] == 0:  # Минута свободна
-                            reminder_datetime = candidate_time
-                            break
-                    else:
-                        # Если в текущем часу нет места, переносим на следующий час
-                        reminder_datetime = base_time + timedelta(hours=1)
-                        logging.warning(f"Час {optimal_utc_hour}:00 занят, переносим на {optimal_utc_hour+1}:00")
-                    
-                    # Создаем напоминание
-                    cur.execute("""
-                        INSERT INTO reminders (
-                            conv_id, reminder_datetime, reminder_context_summary,
-                            created_by_conv_id, client_timezone, status
-                        ) VALUES (%s, %s, %s, %s, %s, 'active')
-                        RETURNING id
-                    """, (
-                        conv_id, reminder_datetime, reminder_context, None, 'UTC'
-                    ))
-                    
-                    result = cur.fetchone()
-                    if result:
-                        reminder_id = result[0]
-                        conn.commit()
-                        logging.info(f"✅ Напоминание ID={reminder_id} для {conv_id} на {reminder_datetime}")
-                        return True
-                    else:
-                        logging.error(f"Ошибка: не удалось создать напоминание")
-                        return False
+                # Находим свободное время (макс 1 напоминание в минуту)
+                target_date = datetime.now(timezone.utc).date() + timedelta(days=contact_in_days)
+                reminder_datetime = slot_allocator.allocate(conn, target_date, optimal_utc_hour)
+                
+                if reminder_datetime is None:
+                    logging.error(f"Нет свободного времени для напоминания клиенту {conv_id}")
+                    return False
+                
+                slot_allocator.add_pending(conv_id, reminder_datetime, reminder_context)
+                
+                if batch_mode:
+                    logging.info(f"Напоминание для {conv_id} на {reminder_datetime} поставлено в очередь пакетной вставки")
+                    return True
+                
+                created = slot_allocator.flush(conn)
+                if created:
+                    logging.info(f"✅ Напоминание ID={created[0][0]} для {conv_id} на {reminder_datetime}")
+                    return True
+                else:
+                    logging.error(f"Ошибка: не удалось создать напоминание")
+                    return False
                     
         except Exception as e:
             logging.error(f"Ошибка создания напоминания: {e}")
             return False
 
+    def flush_strategic_reminders(self, slot_allocator: ReminderSlotAllocator) -> int:
+        """
+        Вставляет все напоминания, накопленные аллокатором за пакетный запуск, одним запросом.
+
+        Returns:
+            int: Количество созданных напоминаний.
+        """
+        try:
+            with self.get_db_connection() as conn:
+                created = slot_allocator.flush(conn)
+            logging.info(f"Создано {len(created)} стратегических напоминаний, статистика слотов: {slot_allocator.stats}")
+            return len(created)
+        except Exception as e:
+            logging.error(f"Ошибка пакетного создания напоминаний: {e}")
+            return 0
+
     def create_reminder_if_needed(self, conv_id: int, analysis_result: Dict[str, Any]) -> bool:
         """Создание напоминания на основе анализа (старый метод для совместимости)"""
         try:
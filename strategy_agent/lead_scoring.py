@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Многофакторная оценка клиентов для отбора в стратегический агент.
+
+Вместо CASE по lead_qualification и funnel_stage в SQL (search_people.py) все профили
+один раз выгружаются в компактный столбцовый снимок (по массиву NumPy на признак),
+а оценка считается векторно:
+
+    score = Σ вес_признака * нормированный_признак
+
+Признаки: теплота и этап воронки (те же баллы, что prospect_warmth_score и
+prospect_funnel_score, миграция 11), давность последнего сообщения с экспоненциальным
+затуханием (период полураспада RECENCY_HALF_LIFE_DAYS), число сообщений клиента,
+число и сумма покупок. Счетчики сглаживаются log1p и делятся на максимум по базе.
+Клиенты с активными напоминаниями и покупатели премиум-наборов исключаются, как и
+в search_people.py. Топ-K выбирается через np.argpartition без полной сортировки.
+
+Сообщения считаются по таблице dialogues (без архива dialogues_archive): для
+активности важны недавние сообщения, а они в архив не попадают.
+
+Запуск: python lead_scoring.py --top 500
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from typing import Dict, List, Optional
+
+import numpy as np
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Веса признаков (каждый признак нормирован в [0, 1])
+DEFAULT_WEIGHTS = {
+    'warmth': 4.0,
+    'funnel': 6.0,
+    'recency': 3.0,
+    'activity': 1.5,
+    'purchase_count': 1.0,
+    'purchase_total': 1.0,
+}
+
+RECENCY_HALF_LIFE_DAYS = 14.0  # Через сколько дней вклад давности падает вдвое
+
+# Максимумы баллов prospect_warmth_score и prospect_funnel_score
+MAX_WARMTH_SCORE = 4
+MAX_FUNNEL_SCORE = 6
+
+SECONDS_PER_DAY = 86400.0
+
+SNAPSHOT_QUERY = """
+    WITH activity AS (
+        SELECT conv_id,
+               EXTRACT(EPOCH FROM MAX(created_at)) AS last_message_ts,
+               COUNT(*) FILTER (WHERE role = 'user') AS user_messages
+        FROM dialogues
+        GROUP BY conv_id
+    ),
+    purchases AS (
+        SELECT conv_id, COUNT(*) AS purchase_count, COALESCE(SUM(amount), 0) AS purchase_total
+        FROM client_purchases
+        WHERE conv_id IS NOT NULL
+        GROUP BY conv_id
+    )
+    SELECT up.conv_id,
+           prospect_warmth_score(up.lead_qualification),
+           prospect_funnel_score(up.funnel_stage),
+           COALESCE(a.last_message_ts, 0),
+           COALESCE(a.user_messages, 0),
+           COALESCE(p.purchase_count, 0),
+           COALESCE(p.purchase_total, 0)
+    FROM user_profiles up
+    LEFT JOIN activity a ON a.conv_id = up.conv_id
+    LEFT JOIN purchases p ON p.conv_id = up.conv_id
+    WHERE up.conv_id IS NOT NULL
+      AND NOT EXISTS (
+          SELECT 1 FROM reminders r
+          WHERE r.conv_id = up.conv_id AND r.status = 'active'
+      )
+      AND NOT EXISTS (
+          SELECT 1 FROM premium_buyers pb
+          WHERE pb.conv_id = up.conv_id
+      )
+"""
+
+# Порядок столбцов снимка, совпадает с SELECT в SNAPSHOT_QUERY (кроме conv_id)
+SNAPSHOT_COLUMNS = ('warmth', 'funnel', 'last_message_ts', 'user_messages', 'purchase_count', 'purchase_total')
+
+
+class LeadSnapshot:
+    """Столбцовый снимок профилей: conv_ids (int64) и по массиву float64 на признак."""
+
+    def __init__(self, conv_ids: np.ndarray, columns: Dict[str, np.ndarray], taken_at: float):
+        self.conv_ids = conv_ids
+        self.columns = columns
+        self.taken_at = taken_at
+
+    def __len__(self):
+        return len(self.conv_ids)
+
+    @classmethod
+    def from_rows(cls, rows, taken_at: Optional[float] = None) -> "LeadSnapshot":
+        """Собирает снимок из строк (conv_id, *SNAPSHOT_COLUMNS)."""
+        taken_at = time.time() if taken_at is None else taken_at
+        if not rows:
+            empty = np.empty(0, dtype=np.float64)
+            return cls(np.empty(0, dtype=np.int64), {name: empty for name in SNAPSHOT_COLUMNS}, taken_at)
+        matrix = np.array(rows, dtype=np.float64)
+        conv_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        columns = {name: np.ascontiguousarray(matrix[:, index + 1]) for index, name in enumerate(SNAPSHOT_COLUMNS)}
+        return cls(conv_ids, columns, taken_at)
+
+    @classmethod
+    def load(cls, conn) -> "LeadSnapshot":
+        """Выгружает снимок одним запросом (нужны миграции 11-12 из db_migrations.py)."""
+        started = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(SNAPSHOT_QUERY)
+            rows = cur.fetchall()
+        snapshot = cls.from_rows(rows)
+        logger.info(f"СКОРИНГ: Снимок {len(snapshot)} профилей загружен за {time.perf_counter() - started:.2f} с")
+        return snapshot
+
+
+def _log_normalized(values: np.ndarray) -> np.ndarray:
+    """log1p и деление на максимум: счетчики с длинным хвостом -> [0, 1]."""
+    logged = np.log1p(np.maximum(values, 0.0))
+    peak = logged.max() if len(logged) else 0.0
+    return logged / peak if peak > 0 else np.zeros_like(logged)
+
+
+class LeadScorer:
+    """Векторная оценка клиентов по снимку с настраиваемыми весами."""
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, half_life_days: float = RECENCY_HALF_LIFE_DAYS):
+        unknown = set(weights or {}) - set(DEFAULT_WEIGHTS)
+        if unknown:
+            raise ValueError(f"Неизвестные признаки в весах: {sorted(unknown)}")
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.half_life_days = half_life_days
+
+    def features(self, snapshot: LeadSnapshot) -> Dict[str, np.ndarray]:
+        """Нормированные признаки снимка, каждый в [0, 1]."""
+        columns = snapshot.columns
+        last_message_ts = columns['last_message_ts']
+        age_days = np.maximum(snapshot.taken_at - last_message_ts, 0.0) / SECONDS_PER_DAY
+        # Клиенты без сообщений получают нулевой вклад давности
+        recency = np.where(last_message_ts > 0, np.exp2(-age_days / self.half_life_days), 0.0)
+        return {
+            'warmth': columns['warmth'] / MAX_WARMTH_SCORE,
+            'funnel': columns['funnel'] / MAX_FUNNEL_SCORE,
+            'recency': recency,
+            'activity': _log_normalized(columns['user_messages']),
+            'purchase_count': _log_normalized(columns['purchase_count']),
+            'purchase_total': _log_normalized(columns['purchase_total']),
+        }
+
+    def score(self, snapshot: LeadSnapshot) -> np.ndarray:
+        """Итоговая оценка каждого профиля снимка."""
+        scores = np.zeros(len(snapshot), dtype=np.float64)
+        for name, values in self.features(snapshot).items():
+            weight = self.weights[name]
+            if weight:
+                scores += weight * values
+        return scores
+
+    def top_k(self, snapshot: LeadSnapshot, k: int) -> List[Dict[str, float]]:
+        """
+        K лучших профилей по убыванию оценки.
+
+        Returns:
+            Список словарей {'conv_id', 'score'}.
+        """
+        scores = self.score(snapshot)
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        # Сортируем только K кандидатов; при равной оценке — по conv_id для воспроизводимости
+        order = candidates[np.lexsort((snapshot.conv_ids[candidates], -scores[candidates]))]
+        return [{'conv_id': int(snapshot.conv_ids[i]), 'score': round(float(scores[i]), 4)} for i in order]
+
+
+def select_top_leads(conn, k: int, weights: Optional[Dict[str, float]] = None) -> List[int]:
+    """
+    Выгружает снимок, оценивает всех клиентов и возвращает conv_id топ-K.
+    Результат можно сразу передать в auto_strategy_agent.analyze_clients.
+    """
+    snapshot = LeadSnapshot.load(conn)
+    started = time.perf_counter()
+    top = LeadScorer(weights).top_k(snapshot, k)
+    logger.info(
+        f"СКОРИНГ: Оценено {len(snapshot)} профилей, отобрано {len(top)} "
+        f"за {(time.perf_counter() - started) * 1000:.1f} мс"
+    )
+    return [lead['conv_id'] for lead in top]
+
+
+def parse_weights(items: List[str]) -> Dict[str, float]:
+    """Разбирает веса из аргументов вида признак=вес."""
+    weights = {}
+    for item in items or []:
+        name, _, value = item.partition('=')
+        weights[name.strip()] = float(value)
+    return weights
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Многофакторная оценка клиентов")
+    parser.add_argument("--top", type=int, default=500, help="Сколько клиентов отобрать")
+    parser.add_argument("--weight", action="append", metavar="ПРИЗНАК=ВЕС",
+                        help=f"Переопределить вес признака ({', '.join(DEFAULT_WEIGHTS)})")
+    args = parser.parse_args()
+
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        logger.error("DATABASE_URL не установлен в переменных окружения")
+        return 1
+
+    conn = None
+    try:
+        conn = psycopg2.connect(database_url)
+        snapshot = LeadSnapshot.load(conn)
+        top = LeadScorer(parse_weights(args.weight)).top_k(snapshot, args.top)
+        for position, lead in enumerate(top, 1):
+            print(f"{position:4d}. conv_id={lead['conv_id']} score={lead['score']}")
+        return 0
+    except Exception as e:
+        logger.error(f"Ошибка скоринга: {e}")
+        return 1
+    finally:
+        if conn:
+            conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Распределитель минутных слотов для стратегических напоминаний.
+
+Правило школы: не больше одного активного напоминания в минуту, чтобы активации
+не шли пачкой. Раньше свободная минута искалась отдельным COUNT-запросом на каждую
+минуту часа (до 60 запросов на клиента). Теперь занятые минуты окна загружаются
+одним запросом в битовые маски (одно целое на пару день+час, бит = минута),
+свободная минута находится за O(1), а все новые напоминания вставляются одним
+INSERT в конце пакета.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone, date
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2.extras
+
+from reminder_similarity import compute_signature, compute_lsh_bands
+
+MINUTES_IN_HOUR = 60
+FULL_HOUR_MASK = (1 << MINUTES_IN_HOUR) - 1
+
+# Политика переноса при заполненном часе: сначала соседние часы того же дня
+# (+1, -1, +2, -2, ...), затем тот же час следующих дней.
+SPILLOVER_HOUR_OFFSETS = (0, 1, -1, 2, -2, 3, -3)
+MAX_SPILLOVER_DAYS = 7
+
+# Часы (UTC), в которые допустимо ставить стратегические напоминания: 08:00-21:59 по Москве
+ALLOWED_UTC_HOURS = range(5, 19)
+
+
+class ReminderSlotAllocator:
+    """Выдает свободные минуты для напоминаний и копит их для пакетной вставки."""
+
+    def __init__(self):
+        # (день, час) -> битовая маска занятых минут
+        self.occupied: Dict[Tuple[date, int], int] = {}
+        self.loaded_days = set()
+        # Напоминания, ожидающие вставки: (conv_id, reminder_datetime, reminder_context)
+        self.pending: List[Tuple[int, datetime, str]] = []
+        self.stats = {'allocated': 0, 'spilled': 0, 'exhausted': 0, 'load_queries': 0}
+
+    def preload(self, conn, first_day: date, last_day: date):
+        """
+        Загружает занятые минуты за период [first_day, last_day] одним запросом.
+
+        Args:
+            conn: Соединение с БД.
+            first_day (date): Первый день окна (UTC).
+            last_day (date): Последний день окна включительно (UTC).
+        """
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        days = [day for day in days if day not in self.loaded_days]
+        if not days:
+            return
+
+        window_start = datetime.combine(days[0], datetime.min.time(), tzinfo=timezone.utc)
+        window_end = datetime.combine(days[-1] + timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
+
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT DISTINCT date_trunc('minute', reminder_datetime AT TIME ZONE 'UTC')
+                FROM reminders
+                WHERE status = 'active'
+                  AND reminder_datetime >= %s AND reminder_datetime < %s
+            """, (window_start, window_end))
+            rows = cur.fetchall()
+        self.stats['load_queries'] += 1
+
+        for (minute_start,) in rows:
+            key = (minute_start.date(), minute_start.hour)
+            self.occupied[key] = self.occupied.get(key, 0) | (1 << minute_start.minute)
+        self.loaded_days.update(days)
+
+        logging.info(f"СЛОТЫ: Загружено {len(rows)} занятых минут за {days[0]} - {days[-1]}")
+
+    def _blocked_mask(self, day: date, hour: int, now: datetime) -> int:
+        """Маска минут, недоступных для записи: занятые и уже прошедшие."""
+        mask = self.occupied.get((day, hour), 0)
+        if day < now.date() or (day == now.date() and hour < now.hour):
+            return FULL_HOUR_MASK
+        if day == now.date() and hour == now.hour:
+            mask |= (1 << (now.minute + 1)) - 1
+        return mask
+
+    def _take_minute(self, day: date, hour: int, now: datetime) -> Optional[int]:
+        """Занимает первую свободную минуту часа и возвращает ее номер (или None)."""
+        free = ~self._blocked_mask(day, hour, now) & FULL_HOUR_MASK
+        if not free:
+            return None
+        minute = (free & -free).bit_length() - 1
+        key = (day, hour)
+        self.occupied[key] = self.occupied.get(key, 0) | (1 << minute)
+        return minute
+
+    def allocate(self, conn, target_day: date, target_hour: int) -> Optional[datetime]:
+        """
+        Находит свободную минуту, начиная с желаемого часа, по политике переноса.
+
+        Args:
+            conn: Соединение с БД (используется, только если день еще не загружен).
+            target_day (date): Желаемый день (UTC).
+            target_hour (int): Желаемый час (UTC).
+
+        Returns:
+            datetime: Время слота в UTC или None, если все допустимые слоты заняты.
+        """
+        now = datetime.now(timezone.utc)
+        self.preload(conn, target_day, target_day + timedelta(days=MAX_SPILLOVER_DAYS))
+
+        for day_offset in range(MAX_SPILLOVER_DAYS + 1):
+            day = target_day + timedelta(days=day_offset)
+            for hour_offset in SPILLOVER_HOUR_OFFSETS:
+                hour = target_hour + hour_offset
+                if hour not in ALLOWED_UTC_HOURS and not (hour_offset == 0 and 0 <= hour < 24):
+                    continue
+                minute = self._take_minute(day, hour, now)
+                if minute is None:
+                    continue
+
+                slot = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc).replace(hour=hour, minute=minute)
+                self.stats['allocated'] += 1
+                if day_offset or hour_offset:
+                    self.stats['spilled'] += 1
+                    logging.info(f"СЛОТЫ: Час {target_day} {target_hour}:00 UTC занят, перенос на {slot}")
+                return slot
+
+        self.stats['exhausted'] += 1
+        logging.warning(f"СЛОТЫ: Нет свободных минут для {target_day} {target_hour}:00 UTC в пределах {MAX_SPILLOVER_DAYS} дней")
+        return None
+
+    def add_pending(self, conv_id: int, reminder_datetime: datetime, reminder_context: str):
+        """Добавляет напоминание в очередь пакетной вставки."""
+        self.pending.append((conv_id, reminder_datetime, reminder_context))
+
+    def flush(self, conn) -> List[Tuple[int, int, datetime]]:
+        """
+        Вставляет все накопленные напоминания одним INSERT вместе с MinHash-сигнатурой
+        и LSH-ключами, чтобы дедупликация reminder_service находила их через индекс.
+
+        Returns:
+            list: Кортежи (id, conv_id, reminder_datetime) созданных напоминаний.
+        """
+        if not self.pending:
+            return []
+
+        rows = []
+        for conv_id, reminder_datetime, reminder_context in self.pending:
+            signature = compute_signature(reminder_context)
+            rows.append((conv_id, reminder_datetime, reminder_context, None, 'UTC', 'active',
+                         signature, compute_lsh_bands(signature)))
+        with conn.cursor() as cur:
+            created = psycopg2.extras.execute_values(cur, """
+                INSERT INTO reminders (
+                    conv_id, reminder_datetime, reminder_context_summary,
+                    created_by_conv_id, client_timezone, status,
+                    minhash_signature, lsh_bands
+                ) VALUES %s
+                RETURNING id, conv_id, reminder_datetime
+            """, rows, page_size=len(rows), fetch=True)
+        conn.commit()
+
+        self.pending = []
+        logging.info(f"СЛОТЫ: Пакетно создано {len(created)} напоминаний")
+        return created
@@ -3,6 +3,14 @@
 """
 Скрипт для выборки 500 conv_id из базы данных с приоритизацией
 Исключает пользователей с активными напоминаниями и покупателей премиум-наборов
+
+Покупатели премиум-наборов хранятся в таблице premium_buyers, которую пополняют
+триггеры на client_purchases и purchased_products (миграция 11 в db_migrations.py).
+Топ-K читается из индекса idx_user_profiles_prospect_priority (миграция 12).
+
+Результат сохраняется в founded_people_<ts>.ndjson (формат search_results.py).
+auto_strategy_agent.py --search запускает поиск сам и начинает анализ с первых
+отобранных клиентов (PeopleSearcher.stream_conv_ids).
 """
 
 import os
@@ -11,10 +19,11 @@ import json
 import logging
 import psycopg2
 import psycopg2.extras
-from datetime import datetime
-from typing import Dict, List, Tuple, Any
+from typing import Dict, List, Tuple, Any, Iterator
 from dotenv import load_dotenv
 
+from search_results import SearchResultsWriter
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -29,7 +38,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Константы для системы баллов
+# Константы для системы баллов.
+# В SQL те же баллы считают функции prospect_warmth_score и prospect_funnel_score
+# (миграция 11 в db_migrations.py) — при изменении правьте оба места.
 WARMTH_SCORES = {
     'горячий': 4,
     'клиент': 3, 
@@ -46,8 +57,58 @@ FUNNEL_SCORES = {
     'предложение по продуктам ещё не сделано, покупка совершена': 1
 }
 
-# Исключаемые продукты (фразы для поиска)
-EXCLUDED_PRODUCTS = ['всё включено', '6 шагов']
+# Исключаемые продукты ('все включено', '6 шагов') определяет функция is_premium_product
+# в БД (миграция 11 в db_migrations.py): покупатели попадают в premium_buyers триггером.
+
+# Таблица, которую должны создать миграции перед поиском
+PREMIUM_BUYERS_TABLE = "premium_buyers"
+
+# Топ-K по индексу idx_user_profiles_prospect_priority: строки читаются
+# в порядке убывания приоритета, каждое исключение — точечный поиск
+# по индексу (idx_reminders_active_conv_id, первичный ключ premium_buyers).
+# Выражение ORDER BY должно совпадать с выражением индекса.
+PRIORITIZED_QUERY = f"""
+SELECT
+    up.conv_id,
+    up.first_name,
+    up.last_name,
+    up.lead_qualification,
+    up.funnel_stage,
+    up.dialogue_summary,
+    prospect_warmth_score(up.lead_qualification) AS warmth_score,
+    prospect_funnel_score(up.funnel_stage) AS funnel_score
+FROM user_profiles up
+WHERE
+    -- Исключаем пользователей с пустым conv_id
+    up.conv_id IS NOT NULL
+    -- Исключаем пользователей с активными напоминаниями
+    AND NOT EXISTS (
+        SELECT 1 FROM reminders r
+        WHERE r.conv_id = up.conv_id AND r.status = 'active'
+    )
+    -- Исключаем покупателей премиум-наборов
+    AND NOT EXISTS (
+        SELECT 1 FROM {PREMIUM_BUYERS_TABLE} pb
+        WHERE pb.conv_id = up.conv_id
+    )
+ORDER BY prospect_warmth_score(up.lead_qualification) + prospect_funnel_score(up.funnel_stage) DESC
+LIMIT %s
+"""
+
+# Строк, которые серверный курсор забирает за раз при потоковом поиске
+STREAM_FETCH_SIZE = 50
+
+
+def _artifact_record(user: Dict[str, Any]) -> Dict[str, Any]:
+    """Поля пользователя, которые попадают в файл результатов (без саммари диалога)"""
+    return {
+        'conv_id': user['conv_id'],
+        'total_score': user['total_score'],
+        'warmth_score': user['warmth_score'],
+        'funnel_score': user['funnel_score'],
+        'warmth_category': user['warmth_category'],
+        'funnel_stage': user['funnel_stage'],
+    }
 
 class PeopleSearcher:
     """Класс для поиска и приоритизации пользователей"""
@@ -100,221 +161,159 @@ class PeopleSearcher:
         # Если точного совпадения нет, возвращаем 0
         return 0
     
+    def _ensure_premium_buyers_table(self, cur):
+        """Проверяет, что миграции 11-12 применены и множество premium_buyers существует"""
+        cur.execute("SELECT to_regclass(%s)", (PREMIUM_BUYERS_TABLE,))
+        if cur.fetchone()[0] is None:
+            raise RuntimeError(
+                f"Таблица {PREMIUM_BUYERS_TABLE} не найдена: примените миграции (python db_migrations.py migrate)"
+            )
+
     def _is_premium_buyer(self, conv_id: int) -> bool:
         """Проверка, покупал ли пользователь премиум-наборы"""
         try:
             with self.get_db_connection() as conn:
                 with conn.cursor() as cur:
-                    # Проверяем в purchased_products
-                    for product_phrase in EXCLUDED_PRODUCTS:
-                        cur.execute("""
-                            SELECT COUNT(*) FROM purchased_products 
-                            WHERE conv_id = %s 
-                            AND LOWER(product_name) LIKE %s
-                        """, (conv_id, f'%{product_phrase.lower()}%'))
-                        
-                        if cur.fetchone()[0] > 0:
-                            return True
-                    
-                    # Проверяем в client_purchases
-                    for product_phrase in EXCLUDED_PRODUCTS:
-                        cur.execute("""
-                            SELECT COUNT(*) FROM client_purchases 
-                            WHERE conv_id = %s 
-                            AND LOWER(product_name) LIKE %s
-                        """, (conv_id, f'%{product_phrase.lower()}%'))
-                        
-                        if cur.fetchone()[0] > 0:
-                            return True
-                    
-                    return False
+                    cur.execute(f"SELECT 1 FROM {PREMIUM_BUYERS_TABLE} WHERE conv_id = %s", (conv_id,))
+                    return cur.fetchone() is not None
                     
         except Exception as e:
             logger.warning(f"Ошибка проверки покупок для {conv_id}: {e}")
             return False
     
-    def search_prioritized_people(self, limit: int = 500) -> List[Dict[str, Any]]:
+    def _collect_exclusion_stats(self, cur):
+        """Считает исключенных пользователей для статистики"""
+        self._ensure_premium_buyers_table(cur)
+        
+        try:
+            cur.execute("""
+                SELECT COUNT(*) FROM reminders WHERE status = 'active'
+            """)
+            result = cur.fetchone()
+            active_reminders_count = result[0] if result else 0
+            self.stats['excluded_with_reminders'] = active_reminders_count
+            logger.info(f"Исключено пользователей с активными напоминаниями: {active_reminders_count}")
+        except Exception as e:
+            logger.warning(f"Ошибка подсчета активных напоминаний: {e}")
+            self.stats['excluded_with_reminders'] = 0
+
+        # Подсчитываем покупателей премиум-наборов (множество поддерживается триггерами)
+        try:
+            cur.execute(f"SELECT COUNT(*) FROM {PREMIUM_BUYERS_TABLE}")
+            result = cur.fetchone()
+            premium_buyers_count = result[0] if result else 0
+            self.stats['excluded_premium_buyers'] = premium_buyers_count
+            logger.info(f"Исключено покупателей премиум-наборов: {premium_buyers_count}")
+        except Exception as e:
+            logger.warning(f"Ошибка подсчета премиум-покупателей: {e}")
+            self.stats['excluded_premium_buyers'] = 0
+
+    def _row_to_user(self, row) -> Dict[str, Any]:
+        """Преобразует строку выборки в словарь пользователя и обновляет статистику"""
+        # Определяем теплоту для статистики
+        warmth = 'неизвестно'
+        if row['lead_qualification']:
+            for qual in row['lead_qualification']:
+                if qual in WARMTH_SCORES:
+                    warmth = qual
+                    break
+        
+        user_data = {
+            'conv_id': row['conv_id'],
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'lead_qualification': row['lead_qualification'],
+            'funnel_stage': row['funnel_stage'],
+            'dialogue_summary': row['dialogue_summary'],
+            'warmth_score': row['warmth_score'],
+            'funnel_score': row['funnel_score'],
+            'total_score': row['warmth_score'] + row['funnel_score'],
+            'warmth_category': warmth
+        }
+        
+        # Обновляем статистику
+        self.stats['warmth_distribution'][warmth] += 1
+        funnel_stage = row['funnel_stage'] or 'неизвестно'
+        self.stats['funnel_distribution'][funnel_stage] = self.stats['funnel_distribution'].get(funnel_stage, 0) + 1
+        self.stats['total_collected'] += 1
+        return user_data
+    
+    def iter_prioritized_people(self, limit: int = 500) -> Iterator[Dict[str, Any]]:
         """
-        Поиск и приоритизация пользователей с оптимизированным SQL
+        Поиск и приоритизация пользователей потоком: строки читаются серверным курсором
+        в порядке приоритета и отдаются сразу, не дожидаясь конца выборки
         
         Args:
             limit: Максимальное количество результатов
             
-        Returns:
-            Список пользователей с приоритизацией
+        Yields:
+            Пользователи по убыванию приоритета
         """
         logger.info("Начинаем поиск приоритизированных пользователей")
         
+        conn = self.get_db_connection()
         try:
-            with self.get_db_connection() as conn:
-                with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                    # Сначала подсчитаем исключенных пользователей для статистики
-                    try:
-                        cur.execute("""
-                            SELECT COUNT(*) FROM reminders WHERE status = 'active'
-                        """)
-                        result = cur.fetchone()
-                        active_reminders_count = result[0] if result else 0
-                        self.stats['excluded_with_reminders'] = active_reminders_count
-                        logger.info(f"Исключено пользователей с активными напоминаниями: {active_reminders_count}")
-                    except Exception as e:
-                        logger.warning(f"Ошибка подсчета активных напоминаний: {e}")
-                        self.stats['excluded_with_reminders'] = 0
-                    
-                    # Подсчитываем покупателей премиум-наборов
-                    try:
-                        cur.execute("""
-                            SELECT COUNT(DISTINCT conv_id) FROM (
-                                SELECT conv_id FROM purchased_products
-                                WHERE LOWER(product_name) LIKE %s
-                                   OR LOWER(product_name) LIKE %s
-                                UNION
-                                SELECT conv_id FROM client_purchases
-                                WHERE LOWER(product_name) LIKE %s
-                                   OR LOWER(product_name) LIKE %s
-                                   AND conv_id IS NOT NULL
-                            ) AS premium_buyers
-                        """, ('%всё включено%', '%6 шагов%', '%всё включено%', '%6 шагов%'))
-                        result = cur.fetchone()
-                        premium_buyers_count = result[0] if result else 0
-                        self.stats['excluded_premium_buyers'] = premium_buyers_count
-                        logger.info(f"Исключено покупателей премиум-наборов: {premium_buyers_count}")
-                    except Exception as e:
-                        logger.warning(f"Ошибка подсчета премиум-покупателей: {e}")
-                        self.stats['excluded_premium_buyers'] = 0
-                    
-                    # Оптимизированный основной запрос с исключениями в одном SQL
-                    query = """
-                    SELECT
-                        up.conv_id,
-                        up.first_name,
-                        up.last_name,
-                        up.lead_qualification,
-                        up.funnel_stage,
-                        up.dialogue_summary,
-                        -- Расчет баллов прямо в SQL
-                        CASE
-                            WHEN %s = ANY(up.lead_qualification) THEN 4
-                            WHEN %s = ANY(up.lead_qualification) THEN 3
-                            WHEN %s = ANY(up.lead_qualification) THEN 2
-                            ELSE 1
-                        END as warmth_score,
-                        CASE up.funnel_stage
-                            WHEN %s THEN 6
-                            WHEN %s THEN 5
-                            WHEN %s THEN 4
-                            WHEN %s THEN 3
-                            WHEN %s THEN 2
-                            WHEN %s THEN 1
-                            ELSE 0
-                        END as funnel_score
-                    FROM user_profiles up
-                    WHERE
-                        -- Исключаем пользователей с активными напоминаниями
-                        up.conv_id NOT IN (
-                            SELECT conv_id FROM reminders
-                            WHERE status = 'active' AND conv_id IS NOT NULL
-                        )
-                        -- Исключаем покупателей премиум-наборов
-                        AND up.conv_id NOT IN (
-                            SELECT DISTINCT conv_id FROM purchased_products
-                            WHERE conv_id IS NOT NULL AND (
-                                LOWER(product_name) LIKE %s
-                                OR LOWER(product_name) LIKE %s
-                            )
-                        )
-                        AND up.conv_id NOT IN (
-                            SELECT DISTINCT conv_id FROM client_purchases
-                            WHERE conv_id IS NOT NULL AND (
-                                LOWER(product_name) LIKE %s
-                                OR LOWER(product_name) LIKE %s
-                            )
-                        )
-                        -- Исключаем пользователей с пустым conv_id
-                        AND up.conv_id IS NOT NULL
-                    ORDER BY (
-                        CASE
-                            WHEN %s = ANY(up.lead_qualification) THEN 4
-                            WHEN %s = ANY(up.lead_qualification) THEN 3
-                            WHEN %s = ANY(up.lead_qualification) THEN 2
-                            ELSE 1
-                        END +
-                        CASE up.funnel_stage
-                            WHEN %s THEN 6
-                            WHEN %s THEN 5
-                            WHEN %s THEN 4
-                            WHEN %s THEN 3
-                            WHEN %s THEN 2
-                            WHEN %s THEN 1
-                            ELSE 0
-                        END
-                    ) DESC
-                    LIMIT %s
-                    """
-                    
-                    query_params = (
-                        'горячий', 'клиент', 'тёплый',  # warmth_score
-                        'решение принято (ожидаем оплату)', 'клиент думает', 'у клиента есть возражения',
-                        'сделано предложение по продуктам', 'сделано новое предложение',
-                        'предложение по продуктам ещё не сделано, покупка совершена',  # funnel_score
-                        '%всё включено%', '%6 шагов%',  # purchased_products exclusion
-                        '%всё включено%', '%6 шагов%',  # client_purchases exclusion
-                        'горячий', 'клиент', 'тёплый',  # ORDER BY warmth
-                        'решение принято (ожидаем оплату)', 'клиент думает', 'у клиента есть возражения',
-                        'сделано предложение по продуктам', 'сделано новое предложение',
-                        'предложение по продуктам ещё не сделано, покупка совершена',  # ORDER BY funnel
-                        limit
-                    )
-                    
-                    cur.execute(query, query_params)
-                    results = cur.fetchall()
-                    
-                    logger.info(f"Отобрано {len(results)} приоритизированных пользователей")
-                    
-                    # Преобразуем результаты и собираем статистику
-                    prioritized_users = []
-                    
-                    for row in results:
-                        # Определяем теплоту для статистики
-                        warmth = 'неизвестно'
-                        if row['lead_qualification']:
-                            for qual in row['lead_qualification']:
-                                if qual in WARMTH_SCORES:
-                                    warmth = qual
-                                    break
-                        
-                        user_data = {
-                            'conv_id': row['conv_id'],
-                            'first_name': row['first_name'],
-                            'last_name': row['last_name'],
-                            'lead_qualification': row['lead_qualification'],
-                            'funnel_stage': row['funnel_stage'],
-                            'dialogue_summary': row['dialogue_summary'],
-                            'warmth_score': row['warmth_score'],
-                            'funnel_score': row['funnel_score'],
-                            'total_score': row['warmth_score'] + row['funnel_score'],
-                            'warmth_category': warmth
-                        }
-                        
-                        prioritized_users.append(user_data)
-                        
-                        # Обновляем статистику
-                        self.stats['warmth_distribution'][warmth] += 1
-                        funnel_stage = row['funnel_stage'] or 'неизвестно'
-                        self.stats['funnel_distribution'][funnel_stage] = self.stats['funnel_distribution'].get(funnel_stage, 0) + 1
-                    
-                    self.stats['total_collected'] = len(prioritized_users)
-                    
-                    logger.info(f"Финальный результат: {len(prioritized_users)} приоритизированных пользователей")
-                    return prioritized_users
-                    
+            with conn.cursor() as cur:
+                self._collect_exclusion_stats(cur)
+            
+            with conn.cursor(name='prioritized_people', cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.itersize = STREAM_FETCH_SIZE
+                cur.execute(PRIORITIZED_QUERY, (limit,))
+                for row in cur:
+                    yield self._row_to_user(row)
+            
+            logger.info(f"Финальный результат: {self.stats['total_collected']} приоритизированных пользователей")
         except Exception as e:
             logger.error(f"Ошибка поиска пользователей: {e}")
             raise
+        finally:
+            conn.close()
+    
+    def search_prioritized_people(self, limit: int = 500) -> List[Dict[str, Any]]:
+        """
+        Поиск и приоритизация пользователей с оптимизированным SQL
+        
+        Args:
+            limit: Максимальное количество результатов
+            
+        Returns:
+            Список пользователей с приоритизацией
+        """
+        return list(self.iter_prioritized_people(limit))
+    
+    def stream_conv_ids(self, writer: SearchResultsWriter, limit: int = 500) -> Iterator[int]:
+        """
+        Отдает conv_id отобранных пользователей по мере поиска и одновременно пишет их
+        в файл результатов. Анализ может начинаться с первого клиента.
+        Если потребитель прервал поток, файл остается незавершенным и указатель
+        на последний результат не меняется.
+        
+        Args:
+            writer: Файл результатов (SearchResultsWriter)
+            limit: Максимальное количество результатов
+        """
+        writer.open(limit=limit)
+        try:
+            for user in self.iter_prioritized_people(limit):
+                writer.write_person(_artifact_record(user))
+                yield user['conv_id']
+            path = writer.finish(self._artifact_stats())
+            logger.info(f"Результаты сохранены в файл: {path}")
+        finally:
+            writer.close()
+    
+    def _artifact_stats(self) -> Dict[str, Any]:
+        return {
+            'selected_users': self.stats['total_collected'],
+            'excluded_with_reminders': self.stats['excluded_with_reminders'],
+            'excluded_premium_buyers': self.stats['excluded_premium_buyers'],
+            'warmth_distribution': dict(self.stats['warmth_distribution']),
+            'funnel_distribution': dict(self.stats['funnel_distribution']),
+        }
     
     def save_results(self, users: List[Dict[str, Any]]) -> str:
         """
-        Сохранение результатов в файл
+        Сохранение результатов в файл NDJSON (формат search_results.py)
         
         Args:
             users: Список пользователей
@@ -322,57 +321,20 @@ class PeopleSearcher:
         Returns:
             Путь к созданному файлу
         """
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"founded_people_{timestamp}.py"
-        
-        # Подготавливаем данные для сохранения в Python-формате
-        conv_ids = [user['conv_id'] for user in users]
-        
-        content = f"""#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-\"\"\"
-Результаты поиска приоритизированных пользователей
-Создано: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-ЛОГИКА РАБОТЫ:
-1. Из базы ИСКЛЮЧЕНЫ пользователи с активными напоминаниями: {self.stats['excluded_with_reminders']}
-2. Из базы ИСКЛЮЧЕНЫ покупатели премиум-наборов: {self.stats['excluded_premium_buyers']}
-3. Из оставшихся пользователей ОТОБРАНО лучших: {len(users)}
-
-ИТОГО В СПИСКЕ: {len(users)} приоритизированных пользователей (БЕЗ исключенных)
-\"\"\"
-
-# Список conv_id приоритизированных пользователей (топ-{len(users)})
-# Отсортированы по убыванию приоритета (теплота + воронка)
-PRIORITIZED_CONV_IDS = {conv_ids}
-
-# Статистика поиска (только для выбранных {len(users)} пользователей)
-SEARCH_STATS = {{
-    'selected_users': {self.stats['total_collected']},
-    'excluded_with_reminders': {self.stats['excluded_with_reminders']},
-    'excluded_premium_buyers': {self.stats['excluded_premium_buyers']},
-    'warmth_distribution': {dict(self.stats['warmth_distribution'])},
-    'funnel_distribution': {dict(self.stats['funnel_distribution'])},
-    'search_timestamp': '{timestamp}'
-}}
-
-if __name__ == "__main__":
-    print(f"Загружено {{len(PRIORITIZED_CONV_IDS)}} приоритизированных пользователей")
-    print(f"Исключено пользователей с активными напоминаниями: {{SEARCH_STATS['excluded_with_reminders']}}")
-    print(f"Исключено покупателей премиум-наборов: {{SEARCH_STATS['excluded_premium_buyers']}}")
-    print(f"Статистика выбранных пользователей: {{SEARCH_STATS}}")
-"""
-        
+        writer = SearchResultsWriter()
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(content)
-            
-            logger.info(f"Результаты сохранены в файл: {filename}")
-            return filename
+            writer.open(limit=len(users))
+            for user in users:
+                writer.write_person(_artifact_record(user))
+            path = writer.finish(self._artifact_stats())
+            logger.info(f"Результаты сохранены в файл: {path}")
+            return str(path)
             
         except Exception as e:
             logger.error(f"Ошибка сохранения файла: {e}")
             raise
+        finally:
+            writer.close()
     
     def print_statistics(self):
         """Вывод статистики в лог"""
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Результаты поиска клиентов (search_people.py) в формате NDJSON.
+
+Файл founded_people_<ts>.ndjson — по одной JSON-записи на строку:
+    {"type": "header", "format": "founded_people", "version": 1, ...}
+    {"type": "person", "rank": 1, "conv_id": ..., "total_score": ..., ...}
+    ...
+    {"type": "stats", ...}   — последняя строка, пишется после последнего клиента
+
+Записи клиентов пишутся по мере отбора, поэтому анализ может начаться до окончания
+поиска. Файл без строки stats считается незавершенным. После завершения указатель
+founded_people_latest.json атомарно (os.replace) перезаписывается ссылкой на файл:
+последний результат находится без перебора файлов и без исполнения кода.
+"""
+
+import os
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+RESULTS_FORMAT = "founded_people"
+RESULTS_FORMAT_VERSION = 1
+LATEST_POINTER_FILE = "founded_people_latest.json"
+
+logger = logging.getLogger(__name__)
+
+
+class SearchResultsWriter:
+    """Пишет результаты поиска построчно; finish() закрывает файл и обновляет указатель."""
+
+    def __init__(self, directory: str = ".", created_at: Optional[datetime] = None):
+        self.created_at = created_at or datetime.now()
+        self.directory = Path(directory)
+        self.run_name = f"{RESULTS_FORMAT}_{self.created_at.strftime('%Y%m%d_%H%M%S')}"
+        self.path = self.directory / f"{self.run_name}.ndjson"
+        self.count = 0
+        self._file = None
+
+    def _write(self, record: Dict[str, Any]):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def open(self, **header):
+        """Создает файл и пишет заголовок с дополнительными полями header."""
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._write(dict(
+            type="header", format=RESULTS_FORMAT, version=RESULTS_FORMAT_VERSION,
+            created_at=self.created_at.isoformat(timespec="seconds"), **header
+        ))
+        return self
+
+    def write_person(self, person: Dict[str, Any]):
+        """Добавляет клиента; строка сбрасывается на диск сразу, чтобы файл отражал ход поиска."""
+        self.count += 1
+        self._write(dict(type="person", rank=self.count, **person))
+        self._file.flush()
+
+    def finish(self, stats: Dict[str, Any]) -> Path:
+        """Пишет итоговую статистику, закрывает файл и переключает указатель на него."""
+        self._write(dict(type="stats", count=self.count, **stats))
+        self.close()
+        pointer = {
+            "path": self.path.name,
+            "run_name": self.run_name,
+            "count": self.count,
+            "created_at": self.created_at.isoformat(timespec="seconds"),
+        }
+        pointer_path = self.directory / LATEST_POINTER_FILE
+        temp_path = pointer_path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(pointer, ensure_ascii=False), encoding="utf-8")
+        os.replace(temp_path, pointer_path)
+        return self.path
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def read_results(path) -> Tuple[List[int], Dict[str, Any]]:
+    """
+    Читает файл результатов.
+
+    Returns:
+        tuple: (conv_id в порядке приоритета, статистика из строки stats)
+
+    Raises:
+        ValueError: Неизвестный формат или версия, либо файл не завершен.
+    """
+    conv_ids = []
+    stats = None
+    with open(path, "r", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != RESULTS_FORMAT or header.get("version") != RESULTS_FORMAT_VERSION:
+            raise ValueError(f"{path}: неизвестный формат {header.get('format')} v{header.get('version')}")
+        for line in f:
+            record = json.loads(line)
+            if record["type"] == "person":
+                conv_ids.append(record["conv_id"])
+            elif record["type"] == "stats":
+                stats = record
+    if stats is None:
+        raise ValueError(f"{path}: поиск не завершен (нет строки stats)")
+    return conv_ids, stats
+
+
+def load_latest_results(directory: str = ".") -> Optional[Tuple[str, List[int], Dict[str, Any]]]:
+    """
+    Загружает последний завершенный результат по указателю LATEST_POINTER_FILE.
+
+    Returns:
+        tuple: (run_name, conv_id, статистика) или None, если указателя нет.
+    """
+    pointer_path = Path(directory) / LATEST_POINTER_FILE
+    if not pointer_path.exists():
+        return None
+    pointer = json.loads(pointer_path.read_text(encoding="utf-8"))
+    conv_ids, stats = read_results(Path(directory) / pointer["path"])
+    logger.info(f"Загружены результаты поиска {pointer['path']}: {len(conv_ids)} клиентов")
+    return pointer["run_name"], conv_ids, stats
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Манифест запуска стратегического агента.
+
+Для каждого запуска (run_name — по умолчанию имя файла founded_people_*.py) хранит,
+какие клиенты уже обработаны. Повторный запуск после падения или Ctrl+C пропускает
+их и продолжает с оставшихся. Отметки пишутся в той же транзакции, что и пакет
+напоминаний (ReminderSlotAllocator.flush), поэтому клиент не получит второе
+напоминание при перезапуске. Таблицу создает миграция 10 (db_migrations.py).
+"""
+
+import logging
+from typing import Iterable, List, Optional, Set, Tuple
+
+import psycopg2.extras
+
+MANIFEST_TABLE = "strategy_run_manifest"
+
+# Статусы: done — анализ и напоминание готовы, fallback — ИИ не справился,
+# сохранен базовый анализ, error — клиента обработать не удалось
+FINISHED_STATUSES = ('done', 'fallback')
+
+
+def load_finished_conv_ids(conn, run_name: str, retry_failed: bool = False) -> Set[int]:
+    """
+    Возвращает conv_id клиентов, уже обработанных в этом запуске.
+
+    Args:
+        conn: Соединение с БД.
+        run_name (str): Имя запуска.
+        retry_failed (bool): Не считать обработанными клиентов со статусом fallback.
+    """
+    statuses = ['done'] if retry_failed else list(FINISHED_STATUSES)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT conv_id FROM {MANIFEST_TABLE} WHERE run_name = %s AND status = ANY(%s)",
+            (run_name, statuses)
+        )
+        return {row[0] for row in cur.fetchall()}
+
+
+def record_results(conn, run_name: str, rows: Iterable[Tuple[int, str, bool, Optional[str]]]):
+    """
+    Записывает отметки о клиентах пакета (без commit — его выполняет вызывающий код).
+
+    Args:
+        rows: Кортежи (conv_id, status, reminder_created, error).
+    """
+    rows = [(run_name, conv_id, status, reminder_created, error) for conv_id, status, reminder_created, error in rows]
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, f"""
+            INSERT INTO {MANIFEST_TABLE} (run_name, conv_id, status, reminder_created, error)
+            VALUES %s
+            ON CONFLICT (run_name, conv_id) DO UPDATE SET
+                status = EXCLUDED.status,
+                reminder_created = EXCLUDED.reminder_created,
+                error = EXCLUDED.error,
+                processed_at = NOW()
+        """, rows, page_size=len(rows))
+    logging.info(f"МАНИФЕСТ: Отмечено {len(rows)} клиентов запуска '{run_name}'")
@@ -0,0 +1,267 @@
+# --- Описание ---
+# Структурированные ответы LLM: разбор JSON по схеме ответа вызова.
+#
+# Каждый вызов, ожидающий JSON (анализ карточки, извлечение фактов, анализ напоминаний,
+# поиск заголовков базы знаний), объявляет схему ответа и запрашивает
+# response_mime_type="application/json" (json_generation_params). Ответ разбирает
+# parse_json_response:
+# 1. Снимает markdown-обертку ```json ... ``` и текст до первой { или [.
+# 2. Если json.loads не справился (чаще всего ответ обрезан по max_output_tokens),
+#    однопроходный сканер запоминает места, где закончился очередной элемент,
+#    отрезает незаконченный хвост и закрывает открытые строки, массивы и объекты.
+#    Повторный запрос к модели для этого не нужен.
+#    Строке, которую закрыло восстановление, не доверяем (обрезанная дата "2026-10-18
+#    превратилась бы в полночь): элемент массива с такой строкой отбрасывается,
+#    необязательное поле — тоже, а обязательное поле вне массива отклоняет весь ответ.
+# 3. Проверяет результат по схеме; отсутствующие обязательные поля дополняются
+#    пустыми значениями нужного типа (объект — пустым словарем).
+#
+# Для каждой точки вызова считаются разборы без исправлений, восстановленные ответы,
+# ответы с расхождениями со схемой, ошибки разбора и повторные запросы
+# (structured_output_stats). Восстановление и расхождения считаются независимо.
+# --- Конец описания ---
+
+import json
+import logging
+import re
+import threading
+
+_MARKDOWN_FENCE = re.compile(r"```(?:json)?\s*([\s\S]*?)\s*(?:```|$)")
+
+_EMPTY_BY_TYPE = {'STRING': "", 'ARRAY': [], 'OBJECT': {}, 'INTEGER': 0, 'NUMBER': 0, 'BOOLEAN': False}
+_PYTHON_TYPES = {
+    'STRING': (str,), 'ARRAY': (list,), 'OBJECT': (dict,),
+    'INTEGER': (int,), 'NUMBER': (int, float), 'BOOLEAN': (bool,),
+}
+
+# Сколько последних точек обрезки пробовать при восстановлении ответа
+MAX_REPAIR_CUTS = 50
+# Метка в конце строки, которую закрыло восстановление (нехарактерный символ Unicode)
+_REPAIR_MARK = '\uffff'
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+class StructuredOutputError(ValueError):
+    """Ответ модели не удалось разобрать как JSON даже после восстановления."""
+
+
+class _ClosedByRepair(Exception):
+    """В значении есть строка, которую закрыло восстановление обрезанного ответа."""
+
+
+def json_generation_params(schema, **params):
+    """Параметры GenerationConfig для ответа строго в формате JSON по схеме."""
+    return dict(params, response_mime_type="application/json", response_schema=schema)
+
+
+def _site_stats(call_site):
+    return _stats.setdefault(
+        call_site, {'calls': 0, 'clean': 0, 'repaired': 0, 'schema_mismatch': 0, 'failed': 0, 'retries': 0}
+    )
+
+
+def record_retry(call_site):
+    """Учитывает повторный запрос к модели в точке вызова call_site."""
+    with _stats_lock:
+        _site_stats(call_site)['retries'] += 1
+
+
+def structured_output_stats():
+    """Счетчики и доли ошибок разбора и повторных запросов по точкам вызова."""
+    with _stats_lock:
+        report = {}
+        for call_site, counters in _stats.items():
+            calls = counters['calls'] or 1
+            report[call_site] = dict(
+                counters,
+                failure_rate=round(counters['failed'] / calls, 4),
+                repair_rate=round(counters['repaired'] / calls, 4),
+                schema_mismatch_rate=round(counters['schema_mismatch'] / calls, 4),
+                retry_rate=round(counters['retries'] / calls, 4),
+            )
+        return report
+
+
+def _strip_wrapper(text):
+    """Убирает markdown-обертку и текст перед JSON."""
+    text = text.strip()
+    if text.startswith("```"):
+        match = _MARKDOWN_FENCE.match(text)
+        if match:
+            text = match.group(1)
+    starts = [index for index in (text.find('{'), text.find('[')) if index != -1]
+    return text[min(starts):] if starts else text
+
+
+def _repair_truncated(text):
+    """
+    Восстанавливает обрезанный JSON без нового запроса к модели.
+
+    Один проход по тексту: стек открытых скобок и состояние строки. После каждого
+    завершенного элемента контейнера (перед запятой и после закрывающей скобки)
+    запоминается точка обрезки со снимком стека. Сначала пробуем закрыть текст как есть
+    (дописав к незакрытой строке _REPAIR_MARK и кавычку), затем — обрезку по последним точкам.
+    Текст, обрезанный посреди числа или литерала, как есть не закрываем: 12 вместо 125
+    разберется без ошибки.
+
+    Returns:
+        Разобранное значение или None.
+    """
+    stack = []
+    cuts = []
+    in_string = False
+    escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if not stack:
+                break
+            stack.pop()
+            cuts.append((index + 1, tuple(stack)))
+            if not stack:
+                # Корневое значение закончилось, дальше — посторонний текст
+                return _loads_or_none(text[:index + 1])
+        elif char == ',' and stack:
+            cuts.append((index, tuple(stack)))
+
+    candidates = []
+    tail = text.rstrip()
+    if in_string:
+        # Обрезана строка: отбрасываем незаконченную escape-последовательность, помечаем и закрываем
+        candidates.append((text[:-1] if escaped else text) + _REPAIR_MARK + '"' + ''.join(reversed(stack)))
+    elif tail and not (tail[-1].isalnum() or tail[-1] in '.-+'):
+        candidates.append(tail.rstrip(',') + ''.join(reversed(stack)))
+    for position, cut_stack in reversed(cuts[-MAX_REPAIR_CUTS:]):
+        candidates.append(text[:position].rstrip().rstrip(',') + ''.join(reversed(cut_stack)))
+
+    for candidate in candidates:
+        value = _loads_or_none(candidate)
+        if value is not None:
+            return value
+    return None
+
+
+def _loads_or_none(text):
+    try:
+        return json.loads(text)
+    except (json.JSONDecodeError, ValueError):
+        return None
+
+
+def _conform(value, schema, path, problems, in_array=False):
+    """
+    Проверяет значение по схеме и дополняет отсутствующие обязательные поля.
+    Несовпадения типов и значений вне enum записываются в problems, значение не меняется.
+
+    Строка, закрытая восстановлением, поднимает _ClosedByRepair до ближайшего массива
+    (элемент отбрасывается) или до необязательного поля объекта вне массива (поле
+    отбрасывается); обязательное поле вне массива доводит исключение до parse_json_response.
+    """
+    if isinstance(value, str) and value.endswith(_REPAIR_MARK):
+        raise _ClosedByRepair(path or '$')
+    schema = schema or {}
+    expected = schema.get('type')
+    type_mismatch = expected and not isinstance(value, _PYTHON_TYPES.get(expected, object))
+    if type_mismatch or (expected in ('INTEGER', 'NUMBER') and isinstance(value, bool)):
+        problems.append(f"{path or '$'}: ожидался {expected}, получено {type(value).__name__}")
+        return value
+    if 'enum' in schema and value not in schema['enum']:
+        problems.append(f"{path or '$'}: значение {value!r} вне списка допустимых")
+
+    if isinstance(value, dict):
+        properties = schema.get('properties', {})
+        required = schema.get('required', [])
+        for key in required:
+            if key not in value:
+                problems.append(f"{path}.{key}: обязательное поле отсутствует, подставлено пустое значение")
+                value[key] = _empty_value(properties.get(key, {}))
+        for key in list(value):
+            try:
+                value[key] = _conform(value[key], properties.get(key), f"{path}.{key}", problems, in_array)
+            except _ClosedByRepair:
+                if in_array or key in required:
+                    raise
+                problems.append(f"{path}.{key}: строка обрезана, поле отброшено")
+                del value[key]
+    elif isinstance(value, list):
+        item_schema = schema.get('items')
+        items = []
+        for i, item in enumerate(value):
+            try:
+                items.append(_conform(item, item_schema, f"{path}[{i}]", problems, in_array=True))
+            except _ClosedByRepair as e:
+                problems.append(f"{path}[{i}]: строка {e} обрезана, элемент отброшен")
+        value[:] = items
+    return value
+
+
+def _empty_value(schema):
+    # Отсутствующий объект заменяется пустым, без выдуманных вложенных полей:
+    # вызывающий код сам решает, что делать с неполными данными
+    empty = _EMPTY_BY_TYPE.get(schema.get('type'))
+    return empty.copy() if isinstance(empty, (list, dict)) else empty
+
+
+def parse_json_response(text, schema=None, call_site="unknown"):
+    """
+    Разбирает JSON-ответ модели, при необходимости восстанавливая обрезанный ответ.
+
+    Args:
+        text (str): Сырой текст ответа.
+        schema (dict): Схема ответа (формат response_schema Vertex AI) или None.
+        call_site (str): Точка вызова для статистики.
+
+    Returns:
+        Разобранный и дополненный по схеме ответ.
+
+    Raises:
+        StructuredOutputError: JSON не удалось получить даже после восстановления.
+    """
+    with _stats_lock:
+        _site_stats(call_site)['calls'] += 1
+
+    body = _strip_wrapper(text or "")
+    value = _loads_or_none(body)
+    repaired = False
+    if value is None:
+        value = _repair_truncated(body)
+        repaired = value is not None
+    if value is None:
+        with _stats_lock:
+            _site_stats(call_site)['failed'] += 1
+        raise StructuredOutputError(f"{call_site}: ответ модели не является JSON (длина {len(text or '')})")
+
+    problems = []
+    try:
+        value = _conform(value, schema, "", problems)
+    except _ClosedByRepair as e:
+        with _stats_lock:
+            _site_stats(call_site)['failed'] += 1
+        raise StructuredOutputError(f"{call_site}: ответ обрезан в обязательном поле {e}")
+    if problems:
+        logging.warning(f"СТРУКТУРИРОВАННЫЙ ОТВЕТ {call_site}: расхождения со схемой: {'; '.join(problems[:10])}")
+    if repaired:
+        logging.warning(f"СТРУКТУРИРОВАННЫЙ ОТВЕТ {call_site}: JSON восстановлен без повторного запроса")
+
+    with _stats_lock:
+        counters = _site_stats(call_site)
+        if repaired:
+            counters['repaired'] += 1
+        if problems:
+            counters['schema_mismatch'] += 1
+        if not repaired and not problems:
+            counters['clean'] += 1
+    return value
@@ -16,15 +16,27 @@
 # 2.  ИЗВЛЕЧЬ НОВЫЕ ФАКТЫ: Анализирует только самые свежие сообщения на предмет
 #    новых "болей" клиента, его целей, упомянутых покупок и т.д.
 #
+#    В объединенном режиме (SUMMARY_COMBINED_MODE=1) саммари и факты возвращаются одним
+#    структурированным ответом по схеме; иначе два запроса выполняются параллельно.
+#
+#    "Свежие" — это сообщения после водяного знака user_profiles (summary_watermark,
+#    summary_watermark_id) — (created_at, id) последнего сообщения, уже учтенного в саммари.
+#    Если новых сообщений нет, Gemini не вызывается вовсе.
+#
 # 3.  ОБОГАТИТЬ КАРТОЧКУ КЛИЕНТА: Аккуратно добавляет найденные факты в профиль
 #    клиента в базе данных, не перезаписывая, а дополняя существующие списки.
 #
-# 4.  ПОЧИСТИТЬ ИСТОРИЮ: Чтобы база диалогов не разрасталась до бесконечности,
-#    он удаляет все сообщения, кроме последних 30, сохраняя историю компактной.
+# 4.  ИСТОРИЯ ДИАЛОГОВ больше не чистится здесь: старые сообщения переносит в архив
+#    фоновая задача dialogue_retention.py, не занимая транзакцию саммари.
 #
 # КАК ЗАПУСКАЕТСЯ:
-# Его вызывает основной скрипт (main.py) асинхронно, передавая ему ID диалога
-# (conv_id) через стандартный ввод.
+# Основной сервис (main.py) импортирует модуль и ставит conv_id в очередь
+# SummaryWorkerPool — постоянного пула потоков внутри процесса (без запуска
+# интерпретатора, импорта vertexai и vertexai.init на каждый ответ). Запросы
+# по одному диалогу объединяются: одновременно выполняется не более одного
+# обновления и ждет не более одного повторного.
+#
+# Как отдельный скрипт он по-прежнему принимает conv_id через стандартный ввод.
 #
 # ====
 
@@ -32,23 +44,27 @@ import os
 import sys
 import json
 import logging
-import re
+import time
 import psycopg2
 import psycopg2.extras
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+from text_processing import strip_timestamp
+from llm_executor import LLMExecutor
+from metrics import span, register_gauge
+import llm_ledger
+from structured_output import json_generation_params, parse_json_response, record_retry, StructuredOutputError
+
 try:
     import vertexai
-    from vertexai.generative_models import GenerativeModel
+    from vertexai.generative_models import GenerativeModel, GenerationConfig
     from google.oauth2 import service_account
     VERTEXAI_AVAILABLE = True
 except ImportError:
     VERTEXAI_AVAILABLE = False
 
-if not VERTEXAI_AVAILABLE:
-    print("Критическая ошибка: Vertex AI SDK не доступен. Установите библиотеку 'google-cloud-aiplatform'.", file=sys.stderr)
-    sys.exit(1)
-
 DATABASE_URL = os.environ.get("DATABASE_URL")
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "hardy-technique-470816-f2")
 LOCATION = os.environ.get("GEMINI_LOCATION", "us-central1")
@@ -56,10 +72,15 @@ LOCATION = os.environ.get("GEMINI_LOCATION", "us-central1")
 MODEL_NAME = "gemini-2.5-flash"
 API_TIMEOUT = 45
 
-NUM_MESSAGES_TO_FETCH = 15
-NUM_MESSAGES_TO_KEEP = 30
+NUM_MESSAGES_TO_FETCH = 15  # Не больше стольких новых сообщений за один прогон
 LOG_FILE_NAME = "summary_updater.log"
 
+# Количество потоков пула обновления саммари внутри сервиса
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", "4"))
+
+# Объединенный режим: саммари и факты одним структурированным запросом вместо двух
+SUMMARY_COMBINED_MODE = os.environ.get("SUMMARY_COMBINED_MODE", "").lower() in ("1", "true", "yes")
+
 FUNNEL_STAGE_HIERARCHY = {
     'предложение по продуктам ещё не сделано': 1,
     'сделано предложение по продуктам': 2,
@@ -193,6 +214,82 @@ client_activity: Определи активность клиента в это
 {new_messages_text}
 """
 
+# Инструкции по полям фактов общие для раздельного и объединенного режимов
+_FACTS_FIELD_INSTRUCTIONS = PROMPT_EXTRACT_NEW_FACTS.split("ИНСТРУКЦИИ ПО ЗАПОЛНЕНИЮ ПОЛЕЙ")[1].split("--- НОВЫЕ СООБЩЕНИЯ ДЛЯ АНАЛИЗА ---")[0]
+
+PROMPT_COMBINED_SUMMARY_AND_FACTS = """
+Ты — ИИ-редактор и CRM-аналитик онлайн-школы фортепиано для взрослых.
+Тебе предоставлено СУЩЕСТВУЮЩЕЕ САММАРИ по клиенту и НОВЫЕ СООБЩЕНИЯ из его недавнего диалога. Выполни две задачи и верни один JSON-объект.
+
+1. updated_summary — инкрементально обнови саммари. ДОПОЛНИ существующее саммари новыми фактами, деталями, вопросами клиента, его возражениями, а также ответами и предложениями со стороны школы.
+КАТЕГОРИЧЕСКИ ЗАПРЕЩЕНО терять информацию из старого саммари. Верни ЕДИНОЕ, ПОЛНОЕ, ОБНОВЛЕННОЕ саммари без вступлений и заключений.
+
+2. facts — извлеки ключевую информацию ТОЛЬКО ИЗ НОВЫХ СООБЩЕНИЙ. Если для поля нет информации, верни пустой список `[]` или пустую строку `""`.
+
+ИНСТРУКЦИИ ПО ЗАПОЛНЕНИЮ ПОЛЕЙ""" + _FACTS_FIELD_INSTRUCTIONS + """--- СУЩЕСТВУЮЩЕЕ САММАРИ ---
+{existing_summary}
+
+--- НОВЫЕ СООБЩЕНИЯ ДЛЯ АНАЛИЗА ---
+{new_messages_text}
+"""
+
+_STRING_LIST = {"type": "ARRAY", "items": {"type": "STRING"}}
+
+# Схемы ответов (подмножество OpenAPI, которое принимает Vertex AI)
+FACTS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "client_level": _STRING_LIST,
+        "learning_goals": _STRING_LIST,
+        "purchased_products": _STRING_LIST,
+        "client_pains": _STRING_LIST,
+        "email": _STRING_LIST,
+        "lead_qualification": {
+            "type": "STRING",
+            "enum": ["холодный", "тёплый", "горячий", "клиент", "не определено"],
+        },
+        "funnel_stage": {"type": "STRING", "enum": list(FUNNEL_STAGE_HIERARCHY)},
+        "client_activity": {"type": "STRING", "enum": ["активен", "пассивен"]},
+    },
+    "required": [
+        "client_level", "learning_goals", "purchased_products", "client_pains",
+        "email", "lead_qualification", "funnel_stage", "client_activity",
+    ],
+}
+
+COMBINED_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "updated_summary": {"type": "STRING"},
+        "facts": FACTS_RESPONSE_SCHEMA,
+    },
+    "required": ["updated_summary", "facts"],
+}
+
+# Запросы к Gemini со сроком API_TIMEOUT (раздельный режим — по два на каждый поток пула).
+# Исполнитель создается при первом обращении, а не при импорте модуля
+SUMMARY_GEMINI_WORKERS = int(os.environ.get("SUMMARY_GEMINI_WORKERS", str(SUMMARY_WORKERS * 2)))
+_gemini_executor = None
+_gemini_executor_lock = threading.Lock()
+
+# Накопленные задержки и токены по режимам, чтобы выбрать режим для развертывания.
+# Неудачная объединенная попытка учитывается в 'combined' (failures), запасные
+# раздельные запросы после нее — в 'concurrent'
+_mode_stats_lock = threading.Lock()
+MODE_STATS = {
+    mode: {'runs': 0, 'failures': 0, 'seconds': 0.0, 'prompt_tokens': 0, 'output_tokens': 0}
+    for mode in ('combined', 'concurrent')
+}
+
+
+def get_gemini_executor():
+    """Исполнитель запросов к Gemini; создается при первом вызове."""
+    global _gemini_executor
+    with _gemini_executor_lock:
+        if _gemini_executor is None:
+            _gemini_executor = LLMExecutor(SUMMARY_GEMINI_WORKERS, name="SummaryGemini")
+        return _gemini_executor
+
 def setup_logging():
     # Делаем conv_id доступным глобально для логгера
     old_factory = logging.getLogRecordFactory()
@@ -216,6 +313,34 @@ def get_db_connection():
         raise ConnectionError("Переменная окружения DATABASE_URL не установлена!")
     return psycopg2.connect(DATABASE_URL)
 
+# Новые сообщения после водяного знака (summary_watermark, summary_watermark_id), от старых к новым.
+# Сообщения с тем же created_at, что у последнего учтенного, различаются по id; у водяного
+# знака без id (записан до миграции 15) берутся все сообщения с его created_at.
+# Условие created_at >= водяного знака задает диапазон по idx_dialogues_conv_id_created_at.
+MESSAGES_AFTER_WATERMARK_QUERY = """
+    SELECT * FROM (
+        SELECT * FROM dialogues
+        WHERE conv_id = %(conv_id)s
+          AND (%(watermark)s::timestamptz IS NULL
+               OR (created_at >= %(watermark)s
+                   AND (created_at > %(watermark)s OR id > COALESCE(%(watermark_id)s::bigint, 0))))
+        ORDER BY created_at DESC, id DESC
+        LIMIT %(limit)s
+    ) latest
+    ORDER BY created_at ASC, id ASC
+"""
+
+
+def watermark_params(profile, conv_id, limit=NUM_MESSAGES_TO_FETCH):
+    """Параметры MESSAGES_AFTER_WATERMARK_QUERY по строке профиля user_profiles."""
+    return {
+        'conv_id': conv_id,
+        'watermark': profile.get('summary_watermark') if profile else None,
+        'watermark_id': profile.get('summary_watermark_id') if profile else None,
+        'limit': limit,
+    }
+
+
 def format_messages_for_prompt(messages):
     if not messages:
         return "Нет новых сообщений."
@@ -224,47 +349,142 @@ def format_messages_for_prompt(messages):
     for msg in messages:
         role_map = {'bot': 'ассистент', 'user': 'клиент', 'operator': 'оператор'}
         role = role_map.get(msg.get('role'), msg.get('role', 'unknown'))
-        message_text = re.sub(r'^\[.*?\]\s*', '', msg.get('message', ''))
+        message_text = strip_timestamp(msg.get('message', ''))
         formatted_lines.append(f"{role.capitalize()}: {message_text}")
 
     return "\n".join(formatted_lines)
 
-def call_gemini_api(model, prompt, expect_json=False):
+def call_gemini_api(model, prompt, expect_json=False, generation_config=None, usage=None,
+                    response_schema=None, call_site="summary"):
     """
     Вызывает модель Gemini через Vertex AI SDK с обработкой ошибок.
+
+    Args:
+        expect_json (bool): Ответ — JSON; разбирается structured_output.parse_json_response.
+        generation_config: GenerationConfig запроса (например, со схемой ответа).
+        usage (dict): Если передан, в него добавляются prompt_tokens и output_tokens ответа.
+        response_schema (dict): Схема JSON-ответа; без generation_config запрос идет
+            с response_mime_type="application/json" и этой схемой.
+        call_site (str): Точка вызова для журнала LLM и статистики разбора ответов.
     """
+    if response_schema is not None and generation_config is None:
+        generation_config = GenerationConfig(**json_generation_params(response_schema))
     try:
         logging.info(f"Отправляем запрос в Gemini. Промпт (первые 200 символов): {prompt[:200]}...")
         
-        response = model.generate_content(prompt)
+        if generation_config is not None:
+            response = llm_ledger.generate(model, prompt, call_site, generation_config=generation_config)
+        else:
+            response = llm_ledger.generate(model, prompt, call_site)
+
+        if usage is not None and getattr(response, 'usage_metadata', None) is not None:
+            usage['prompt_tokens'] = usage.get('prompt_tokens', 0) + (response.usage_metadata.prompt_token_count or 0)
+            usage['output_tokens'] = usage.get('output_tokens', 0) + (response.usage_metadata.candidates_token_count or 0)
         
         raw_response = response.text
         logging.info(f"Получен ответ от Gemini (длина: {len(raw_response)} символов): {raw_response[:300]}...")
         
         if expect_json:
-            logging.info("Ожидаем JSON-ответ, начинаем парсинг.")
-            # Попытка найти JSON внутри markdown-блока
-            match = re.search(r"```(json)?\s*([\s\S]*?)\s*```", raw_response)
-            if match:
-                json_str = match.group(2)
-                logging.info(f"Найден JSON в markdown-блоке. Попытка парсинга: {json_str[:200]}")
-            else:
-                json_str = raw_response
-                logging.info(f"Markdown-блок не найден. Попытка парсинга всего ответа.")
-            
-            parsed_response = json.loads(json_str)
+            parsed_response = parse_json_response(raw_response, response_schema, call_site)
             logging.info(f"JSON успешно распарсен: {parsed_response}")
             return parsed_response
         else:
             return raw_response.strip()
 
-    except json.JSONDecodeError as je:
+    except StructuredOutputError as je:
         logging.error(f"Ошибка парсинга JSON от Gemini: {je}. Сырой ответ: {raw_response}")
         raise
     except Exception as e:
         logging.error(f"Ошибка вызова Vertex AI API или обработки ответа: {e}", exc_info=True)
         raise
 
+def generate_summary_and_facts(model, existing_summary, new_messages_text, combined=None):
+    """
+    Получает обновленное саммари и новые факты по новым сообщениям.
+
+    Args:
+        model: Модель Gemini.
+        existing_summary (str): Текущее саммари из профиля.
+        new_messages_text (str): Новые сообщения, отформатированные для промпта.
+        combined (bool): Объединенный режим; по умолчанию SUMMARY_COMBINED_MODE.
+
+    Returns:
+        tuple: (new_summary, new_facts, stats), где stats — режим, время и токены.
+    """
+    if combined is None:
+        combined = SUMMARY_COMBINED_MODE
+
+    executor = get_gemini_executor()
+    usage = {'prompt_tokens': 0, 'output_tokens': 0}
+    started = time.monotonic()
+    mode = 'combined' if combined else 'concurrent'
+
+    if combined:
+        combined_usage = {}
+        try:
+            combined_prompt = PROMPT_COMBINED_SUMMARY_AND_FACTS.format(
+                existing_summary=existing_summary, new_messages_text=new_messages_text
+            )
+            result = executor.call(API_TIMEOUT, call_gemini_api, model, combined_prompt, expect_json=True,
+                                   usage=combined_usage, response_schema=COMBINED_RESPONSE_SCHEMA,
+                                   call_site="summary_combined")
+            new_summary = (result.get('updated_summary') or '').strip()
+            new_facts = result.get('facts') or {}
+            if not new_summary:
+                raise ValueError("В объединенном ответе пустое updated_summary")
+        except Exception as e:
+            logging.warning(f"Объединенный запрос саммари и фактов не удался ({e}), выполняем два запроса параллельно")
+            record_retry("summary_combined")
+            combined = False
+            mode = 'combined_fallback'
+        _record_mode_stats('combined', time.monotonic() - started, combined_usage, failed=not combined)
+        _add_usage(usage, combined_usage)
+
+    if not combined:
+        concurrent_started = time.monotonic()
+        summary_prompt = PROMPT_INCREMENTAL_SUMMARY.format(
+            existing_summary=existing_summary, new_messages_text=new_messages_text
+        )
+        facts_prompt = PROMPT_EXTRACT_NEW_FACTS.format(new_messages_text=new_messages_text)
+        summary_usage, facts_usage = {}, {}
+        # Запросы независимы: оба строятся только по new_messages_text
+        deadline = time.monotonic() + API_TIMEOUT
+        summary_future = executor.submit_with_deadline(deadline, call_gemini_api, model, summary_prompt, False, None, summary_usage)
+        facts_future = executor.submit_with_deadline(deadline, call_gemini_api, model, facts_prompt, True, None, facts_usage,
+                                                     FACTS_RESPONSE_SCHEMA, "facts_extraction")
+        new_summary = executor.result(summary_future, deadline)
+        new_facts = executor.result(facts_future, deadline)
+        concurrent_usage = {}
+        for part in (summary_usage, facts_usage):
+            _add_usage(concurrent_usage, part)
+        _record_mode_stats('concurrent', time.monotonic() - concurrent_started, concurrent_usage)
+        _add_usage(usage, concurrent_usage)
+
+    elapsed = time.monotonic() - started
+    logging.info(f"Режим саммари '{mode}': {elapsed:.1f} с, токены вход/выход {usage['prompt_tokens']}/{usage['output_tokens']}")
+    return new_summary, new_facts, {'mode': mode, 'seconds': elapsed, **usage}
+
+
+def _add_usage(totals, part):
+    totals['prompt_tokens'] = totals.get('prompt_tokens', 0) + part.get('prompt_tokens', 0)
+    totals['output_tokens'] = totals.get('output_tokens', 0) + part.get('output_tokens', 0)
+
+
+def _record_mode_stats(mode, seconds, usage, failed=False):
+    """Добавляет прогон режима в MODE_STATS и пишет среднее время по режиму."""
+    with _mode_stats_lock:
+        totals = MODE_STATS[mode]
+        totals['runs'] += 1
+        totals['failures'] += 1 if failed else 0
+        totals['seconds'] += seconds
+        totals['prompt_tokens'] += usage.get('prompt_tokens', 0)
+        totals['output_tokens'] += usage.get('output_tokens', 0)
+        average = totals['seconds'] / totals['runs']
+        runs, failures = totals['runs'], totals['failures']
+    logging.info(f"Режим саммари '{mode}'{' (неудачно)' if failed else ''}: {seconds:.1f} с "
+                 f"(в среднем по режиму {average:.1f} с за {runs} прогонов, неудачных {failures})")
+
+
 def merge_profiles(old_profile, new_facts, new_summary):
     logging.info(f"Начинаем слияние профилей. Старый профиль: {old_profile}")
     logging.info(f"Новые факты для слияния: {new_facts}")
@@ -366,7 +586,7 @@ def merge_profiles(old_profile, new_facts, new_summary):
     logging.info(f"Результат слияния профилей: {updated_profile}")
     return updated_profile
 
-def update_and_cleanup_database(conv_id, updated_profile, new_facts, cur):
+def update_profile_in_database(conv_id, updated_profile, new_facts, cur):
     logging.info(f"Подготовка к обновлению профиля. Данные для записи: {updated_profile}")
 
     update_query = """
@@ -375,7 +595,12 @@ def update_and_cleanup_database(conv_id, updated_profile, new_facts, cur):
     funnel_stage = %(funnel_stage)s, client_level = %(client_level)s,
     learning_goals = %(learning_goals)s,
     client_pains = %(client_pains)s, email = %(email)s,
-    client_activity = %(client_activity)s, last_updated = %(last_updated)s
+    client_activity = %(client_activity)s, last_updated = %(last_updated)s,
+    summary_watermark_id = CASE WHEN summary_watermark IS NULL
+        OR (%(summary_watermark)s::timestamptz, COALESCE(%(summary_watermark_id)s::bigint, 0))
+           > (summary_watermark, COALESCE(summary_watermark_id, 0))
+        THEN %(summary_watermark_id)s ELSE summary_watermark_id END,
+    summary_watermark = GREATEST(summary_watermark, %(summary_watermark)s)
     WHERE conv_id = %(conv_id)s;
     """
     logging.info(f"Выполняем UPDATE запрос для conv_id: {conv_id}")
@@ -405,90 +630,70 @@ def update_and_cleanup_database(conv_id, updated_profile, new_facts, cur):
         else:
             logging.info("Новых купленных продуктов для добавления не найдено.")
 
-    cutoff_timestamp_query = """
-        SELECT created_at FROM dialogues
-        WHERE conv_id = %s
-        ORDER BY created_at DESC
-        LIMIT 1 OFFSET %s;
+def create_model():
     """
-    cur.execute(cutoff_timestamp_query, (conv_id, NUM_MESSAGES_TO_KEEP - 1))
-    cutoff_result = cur.fetchone()
-
-    if cutoff_result:
-        cutoff_timestamp = cutoff_result[0]
-        cleanup_query = """
-            DELETE FROM dialogues
-            WHERE conv_id = %s AND created_at < %s;
-        """
-        cur.execute(cleanup_query, (conv_id, cutoff_timestamp))
-        logging.info(f"{conv_id} - Очистка старых диалогов завершена. Удалено {cur.rowcount} сообщений.")
-    else:
-        logging.info(f"{conv_id} - Сообщений меньше {NUM_MESSAGES_TO_KEEP}, очистка не требуется.")
-
-def main():
-    setup_logging()
-
-    conv_id = 0
-    try:
-        conv_id_str = sys.stdin.read().strip()
-        if not conv_id_str.isdigit():
-            raise ValueError(f"Получен некорректный conv_id: '{conv_id_str}'")
-        conv_id = int(conv_id_str)
-        # Делаем conv_id глобальным для использования в логах
-        globals()['conv_id'] = conv_id
-    except Exception as e:
-        logging.error(f"Критическая ошибка при чтении conv_id из stdin: {e}", extra={'conv_id': 'N/A'})
-        sys.exit(1)
-
-    logging.info("Запущен процесс обновления саммари.")
+    Инициализирует Vertex AI по GOOGLE_APPLICATION_CREDENTIALS и создает модель для саммари.
+    Нужна только при запуске скрипта отдельно: в сервисе Vertex AI уже инициализирован в main.py.
+    """
+    if not VERTEXAI_AVAILABLE:
+        raise RuntimeError("Vertex AI SDK не доступен. Установите библиотеку 'google-cloud-aiplatform'.")
 
     credentials_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
     if not credentials_path:
-        logging.critical("КРИТИЧЕСКАЯ ОШИБКА: Переменная окружения 'GOOGLE_APPLICATION_CREDENTIALS' не установлена.")
-        sys.exit(1)
+        raise RuntimeError("Переменная окружения 'GOOGLE_APPLICATION_CREDENTIALS' не установлена.")
 
     credentials_path = credentials_path.strip(' "')
-    try:
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
-        model = GenerativeModel(MODEL_NAME)
-        logging.info("Учетные данные Vertex AI успешно загружены. Модель инициализирована.")
-    except Exception as e:
-        logging.critical(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось инициализировать Vertex AI. Ошибка: {e}")
-        sys.exit(1)
+    credentials = service_account.Credentials.from_service_account_file(credentials_path)
+    vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
+    return GenerativeModel(MODEL_NAME)
+
+
+def update_summary(conv_id, model):
+    """
+    Обновляет саммари и карточку клиента по последним сообщениям диалога.
+
+    Args:
+        conv_id (int): ID диалога.
+        model: Модель Gemini (GenerativeModel).
+
+    Returns:
+        bool: True, если профиль обновлен; False, если новых сообщений после водяного знака нет.
+
+    Raises:
+        Exception: Ошибки БД и Gemini пробрасываются вызывающему коду.
+    """
+    logging.info(f"{conv_id} - Запущен процесс обновления саммари.")
 
     # === ШАГ 1: Извлечение данных БЕЗ блокировки ===
     initial_profile_for_prompt = None
     messages_for_prompt = []
     conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT * FROM user_profiles WHERE conv_id = %s", (conv_id,))
-            profile_data = cur.fetchone()
-            if not profile_data:
-                raise ValueError(f"Профиль для conv_id {conv_id} не найден в user_profiles.")
-            initial_profile_for_prompt = dict(profile_data)
-
-            optimized_messages_query = """
-            WITH latest_messages AS (
-                SELECT * FROM dialogues WHERE conv_id = %s ORDER BY created_at DESC LIMIT %s
-            )
-            SELECT * FROM latest_messages ORDER BY created_at ASC;
-            """
-            cur.execute(optimized_messages_query, (conv_id, NUM_MESSAGES_TO_FETCH))
-            messages_for_prompt = cur.fetchall()
+        with span("summary_read"):
+            conn = get_db_connection()
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute("SELECT * FROM user_profiles WHERE conv_id = %s", (conv_id,))
+                profile_data = cur.fetchone()
+                if not profile_data:
+                    raise ValueError(f"Профиль для conv_id {conv_id} не найден в user_profiles.")
+                initial_profile_for_prompt = dict(profile_data)
+
+                # Только сообщения, которых еще нет в саммари; без водяного знака — последние N, как раньше
+                cur.execute(MESSAGES_AFTER_WATERMARK_QUERY, watermark_params(initial_profile_for_prompt, conv_id))
+                messages_for_prompt = cur.fetchall()
 
     except Exception as e:
         logging.error(f"{conv_id} - Ошибка на этапе чтения данных из БД: {e}", exc_info=True)
-        sys.exit(1)
+        raise
     finally:
         if conn:
             conn.close()
 
     if not messages_for_prompt:
-        logging.info(f"{conv_id} - Нет сообщений для анализа. Процесс завершен.")
-        return
+        logging.info(f"{conv_id} - Нет новых сообщений после водяного знака, вызов Gemini пропущен.")
+        return False
+
+    logging.info(f"{conv_id} - Новых сообщений для саммари: {len(messages_for_prompt)}")
 
     # === ШАГ 2: Все долгие сетевые операции ===
     new_summary = ""
@@ -496,21 +701,19 @@ def main():
     try:
         new_messages_text = format_messages_for_prompt(messages_for_prompt)
 
-        summary_prompt = PROMPT_INCREMENTAL_SUMMARY.format(
-            existing_summary=initial_profile_for_prompt.get('dialogue_summary', 'Саммари еще не создано.'),
-            new_messages_text=new_messages_text
-        )
-        new_summary = call_gemini_api(model, summary_prompt, expect_json=False)
-        logging.info("Новое инкрементальное саммари успешно сгенерировано.")
-        logging.info(f"Новое саммари (первые 200 символов): {new_summary[:200]}...")
-
         # ЛОГИРУЕМ АНАЛИЗИРУЕМЫЕ СООБЩЕНИЯ
         logging.info(f"=== АНАЛИЗ НОВЫХ СООБЩЕНИЙ ДЛЯ ОПРЕДЕЛЕНИЯ ТЕПЛОТЫ ===")
         logging.info(f"Сообщения для анализа:\n{new_messages_text}")
         logging.info(f"Длина текста сообщений: {len(new_messages_text)} символов")
-        
-        facts_prompt = PROMPT_EXTRACT_NEW_FACTS.format(new_messages_text=new_messages_text)
-        new_facts = call_gemini_api(model, facts_prompt, expect_json=True)
+
+        with span("summary_gemini"):
+            new_summary, new_facts, _ = generate_summary_and_facts(
+                model,
+                initial_profile_for_prompt.get('dialogue_summary') or 'Саммари еще не создано.',
+                new_messages_text
+            )
+        logging.info("Новое инкрементальное саммари успешно сгенерировано.")
+        logging.info(f"Новое саммари (первые 200 символов): {new_summary[:200]}...")
         logging.info("Новые факты успешно извлечены.")
         logging.info(f"Извлеченные факты: {json.dumps(new_facts, ensure_ascii=False, indent=2)}")
         
@@ -522,34 +725,221 @@ def main():
         logging.info(f"=== КОНЕЦ АНАЛИЗА НОВЫХ СООБЩЕНИЙ ===\n")
 
     except Exception as e:
-        logging.error(f"Критическая ошибка во время вызова Gemini API: {e}", exc_info=True)
-        sys.exit(1)
+        logging.error(f"{conv_id} - Критическая ошибка во время вызова Gemini API: {e}", exc_info=True)
+        raise
 
     # === ШАГ 3: Короткая атомарная транзакция для записи данных ===
     conn = None
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            cur.execute("SELECT * FROM user_profiles WHERE conv_id = %s FOR UPDATE", (conv_id,))
-            current_profile_in_db = dict(cur.fetchone())
-
-            updated_profile = merge_profiles(current_profile_in_db, new_facts, new_summary)
-            updated_profile['conv_id'] = conv_id
+        with span("summary_write"):
+            conn = get_db_connection()
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute("SELECT * FROM user_profiles WHERE conv_id = %s FOR UPDATE", (conv_id,))
+                current_profile_in_db = dict(cur.fetchone())
+
+                updated_profile = merge_profiles(current_profile_in_db, new_facts, new_summary)
+                updated_profile['conv_id'] = conv_id
+                updated_profile['summary_watermark'] = messages_for_prompt[-1]['created_at']
+                updated_profile['summary_watermark_id'] = messages_for_prompt[-1]['id']
             
-            update_and_cleanup_database(conv_id, updated_profile, new_facts, cur)
+                update_profile_in_database(conv_id, updated_profile, new_facts, cur)
             
-            conn.commit()
-            logging.info(f"{conv_id} - Транзакция обновления и очистки успешно завершена.")
+                conn.commit()
+                logging.info(f"{conv_id} - Транзакция обновления профиля успешно завершена.")
 
     except Exception as e:
         logging.error(f"{conv_id} - Ошибка на этапе записи в БД. Транзакция будет отменена: {e}", exc_info=True)
         if conn:
             conn.rollback()
             logging.info(f"{conv_id} - Транзакция отменена из-за ошибки.")
-        sys.exit(1)
+        raise
+    finally:
+        if conn:
+            conn.close()
+
+    return True
+
+
+def compare_modes(conv_id, model):
+    """
+    Прогоняет оба режима (объединенный и параллельный) на последних сообщениях диалога
+    без записи в БД и печатает задержку и токены каждого режима.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute("SELECT dialogue_summary FROM user_profiles WHERE conv_id = %s", (conv_id,))
+            row = cur.fetchone()
+            existing_summary = (row['dialogue_summary'] if row else None) or 'Саммари еще не создано.'
+            cur.execute("""
+                SELECT * FROM (
+                    SELECT * FROM dialogues WHERE conv_id = %s ORDER BY created_at DESC LIMIT %s
+                ) latest ORDER BY created_at ASC
+            """, (conv_id, NUM_MESSAGES_TO_FETCH))
+            messages = cur.fetchall()
     finally:
         if conn:
             conn.close()
 
+    new_messages_text = format_messages_for_prompt(messages)
+    print(f"conv_id {conv_id}: {len(messages)} сообщений, {len(new_messages_text)} символов")
+    for combined in (False, True):
+        _, facts, stats = generate_summary_and_facts(model, existing_summary, new_messages_text, combined=combined)
+        print(f"  {stats['mode']:<18} {stats['seconds']:6.1f} с   токены вход {stats['prompt_tokens']:>6}  "
+              f"выход {stats['output_tokens']:>5}   теплота: {facts.get('lead_qualification')}, "
+              f"этап: {facts.get('funnel_stage')}")
+
+
+class SummaryWorkerPool:
+    """
+    Постоянный пул потоков для обновления саммари внутри сервиса.
+
+    Запросы по одному conv_id объединяются: пока обновление выполняется, новые запросы
+    только помечают диалог как «ожидающий», и после завершения выполняется ровно один
+    повторный прогон по свежим данным из БД. Поэтому 5 быстрых сообщений клиента дают
+    не более двух прогонов, и они не конкурируют за SELECT ... FOR UPDATE профиля.
+    """
+
+    def __init__(self, model, max_workers=SUMMARY_WORKERS):
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="SummaryUpdater")
+        self.lock = threading.Lock()
+        self.running = set()   # conv_id, по которым сейчас идет обновление
+        self.pending = set()   # conv_id, для которых нужен повторный прогон
+        self.stats = {'submitted': 0, 'coalesced': 0, 'completed': 0, 'failed': 0}
+
+    def queue_depth(self):
+        """Сколько обновлений ждут свободного потока (внутренняя очередь ThreadPoolExecutor)."""
+        return self.executor._work_queue.qsize()
+
+    def register_metrics(self):
+        """Публикует в /metrics (metrics.py) очередь, выполняющиеся обновления и счетчики пула."""
+        register_gauge("summary_pool_queued", "Обновления саммари в очереди пула", self.queue_depth)
+        register_gauge("summary_pool_running", "Диалоги, по которым идет обновление саммари", lambda: len(self.running))
+        register_gauge("summary_pool_pending", "Диалоги, ожидающие повторного прогона", lambda: len(self.pending))
+        register_gauge("summary_pool_requests_total", "Запросы на обновление саммари по исходу",
+                       lambda: dict(self.stats), label="outcome", kind="counter")
+
+    def submit(self, conv_id):
+        """
+        Ставит обновление саммари в очередь.
+
+        Returns:
+            bool: True, если запущен новый прогон; False, если запрос объединен с текущим.
+        """
+        with self.lock:
+            self.stats['submitted'] += 1
+            if conv_id in self.running:
+                self.pending.add(conv_id)
+                self.stats['coalesced'] += 1
+                logging.info(f"Summary Updater для conv_id {conv_id} уже выполняется, повторный прогон запланирован")
+                return False
+            self.running.add(conv_id)
+
+        try:
+            self.executor.submit(self._run, conv_id)
+        except Exception:
+            # Пул не принял задачу (например, после shutdown): иначе conv_id навсегда остался бы
+            # в running, и следующие обновления этого диалога только копились бы в pending
+            with self.lock:
+                self.running.discard(conv_id)
+                self.pending.discard(conv_id)
+            raise
+        return True
+
+    def _run(self, conv_id):
+        """Выполняет обновление и, если за это время пришли новые запросы, повторяет его один раз."""
+        while True:
+            try:
+                with span("summary_update"):
+                    update_summary(conv_id, self.model)
+                with self.lock:
+                    self.stats['completed'] += 1
+                logging.info(f"Summary Updater успешно обработал conv_id {conv_id}")
+            except Exception as e:
+                with self.lock:
+                    self.stats['failed'] += 1
+                logging.error(f"Ошибка Summary Updater для conv_id {conv_id}: {e}")
+
+            with self.lock:
+                if conv_id in self.pending:
+                    self.pending.discard(conv_id)
+                    continue
+                self.running.discard(conv_id)
+                return
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_worker_pool = None
+
+
+def init_worker_pool(model, max_workers=SUMMARY_WORKERS):
+    """
+    Создает пул обновления саммари. Вызывается один раз после vertexai.init в main.py.
+
+    Args:
+        model: Модель Gemini для саммари (обычно GenerativeModel(MODEL_NAME)).
+        max_workers (int): Количество потоков.
+    """
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = SummaryWorkerPool(model, max_workers=max_workers)
+        _worker_pool.register_metrics()
+        get_gemini_executor().register_metrics()
+        logging.info(f"Пул Summary Updater запущен: {max_workers} потоков, модель {MODEL_NAME}")
+    return _worker_pool
+
+
+def submit_summary_update(conv_id):
+    """
+    Ставит conv_id в очередь обновления саммари.
+
+    Returns:
+        bool: True, если запущен новый прогон; False, если объединен с текущим или пул не запущен.
+    """
+    if _worker_pool is None:
+        logging.error(f"Пул Summary Updater не инициализирован, саммари для conv_id {conv_id} не обновлено")
+        return False
+    return _worker_pool.submit(conv_id)
+
+
+def main():
+    """
+    Запуск отдельным процессом: conv_id читается из стандартного ввода.
+    С флагом --compare-modes сравнивает режимы запросов к Gemini без записи в БД.
+    """
+    setup_logging()
+
+    conv_id = 0
+    try:
+        conv_id_str = sys.stdin.read().strip()
+        if not conv_id_str.isdigit():
+            raise ValueError(f"Получен некорректный conv_id: '{conv_id_str}'")
+        conv_id = int(conv_id_str)
+        # Делаем conv_id глобальным для использования в логах
+        globals()['conv_id'] = conv_id
+    except Exception as e:
+        logging.error(f"Критическая ошибка при чтении conv_id из stdin: {e}", extra={'conv_id': 'N/A'})
+        sys.exit(1)
+
+    try:
+        model = create_model()
+        logging.info("Учетные данные Vertex AI успешно загружены. Модель инициализирована.")
+    except Exception as e:
+        logging.critical(f"КРИТИЧЕСКАЯ ОШИБКА: Не удалось инициализировать Vertex AI. Ошибка: {e}")
+        sys.exit(1)
+
+    if "--compare-modes" in sys.argv[1:]:
+        compare_modes(conv_id, model)
+        return
+
+    try:
+        update_summary(conv_id, model)
+    except Exception:
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
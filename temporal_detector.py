@@ -0,0 +1,122 @@
+# --- Описание ---
+# Локальный детектор временных выражений на русском языке.
+# Используется сервисом напоминаний (reminder_service.py) как дешевый пред-фильтр:
+# если в свежих сообщениях нет ни одного временного выражения, просьбы напомнить
+# или отмены договоренности, а активных напоминаний у клиента нет — вызов Gemini
+# для поиска договоренностей не нужен.
+# Детектор намеренно настроен на полноту (recall): пропущенная договоренность стоит
+# дороже, чем лишний вызов модели.
+# --- Конец описания ---
+
+import re
+
+from text_processing import TIMEZONE_PATTERNS, strip_timestamp
+
+_WEEKDAYS = r'понедельник\w*|вторник\w*|сред[уеы]|четверг\w*|пятниц\w*|суббот\w*|воскресень\w*'
+_MONTHS = (r'январ\w*|феврал\w*|март\w*|апрел\w*|ма[йя]|июн\w*|июл\w*|август\w*|'
+           r'сентябр\w*|октябр\w*|ноябр\w*|декабр\w*')
+_UNITS = r'минут\w*|час\w*|дн[яейь]\w*|день|сутки|недел\w*|месяц\w*|год\w*|лет'
+_NUMERALS = (r'\d+|пару|пар[ыу]|несколько|полчаса|полгода|одн\w+|дв[ae]|тр[иёе]\w*|четыр\w*|'
+             r'пят\w*|шест\w*|сем\w*|восем\w*|девят\w*|десят\w*')
+
+# Категории сигналов. Порядок важен только для читаемости отчета detect_temporal_signals.
+SIGNAL_PATTERNS = {
+    # "завтра", "послезавтра", "сегодня вечером", "на выходных"
+    'relative_day': re.compile(
+        r'\b(?:после)?завтра\w*|\bсегодня\s+(?:вечер\w*|ночь\w*|попозже|позже|днем)|'
+        r'\bна\s+(?:выходных|праздниках|каникулах)|\bвечером\b|\bутром\b'
+    ),
+    # "через неделю", "через 2 часа", "через пару дней", "через месяц"
+    'relative_offset': re.compile(
+        rf'\bчерез\s+(?:(?:{_NUMERALS})\s+)?(?:{_UNITS})\b|\bчерез\s+(?:полчаса|полгода)\b'
+    ),
+    # "в пятницу", "к понедельнику", "на следующей неделе", "в начале месяца"
+    'calendar': re.compile(
+        rf'\b(?:в|во|к|до|на|с|по|после)\s+(?:{_WEEKDAYS})\b|'
+        r'\b(?:на\s+)?(?:следующ|эт|будущ)\w*\s+(?:недел|месяц|год)\w*|'
+        r'\bв\s+(?:начале|конце|середине)\s+(?:недели|месяца|года|' + _MONTHS + r')\b|'
+        rf'\b\d{{1,2}}(?:-?(?:го|е|ое|ого))?\s+(?:числа|{_MONTHS})\b|'
+        r'\bпосле\s+\d{1,2}(?:-?(?:го|е|ого))?\b|'
+        r'\b(?:0?[1-9]|[12]\d|3[01])[./](?:0[1-9]|1[0-2])(?:[./]\d{2,4})?\b'
+    ),
+    # "в 18:00", "в 9 утра", "к 10 часам", "около семи вечера"
+    'clock_time': re.compile(
+        r'\b(?:в|к|до|после|около|с)\s+\d{1,2}\s*(?:час\w*|утра|дня|вечера|ночи)\b|'
+        r'\b(?:[01]?\d|2[0-3])[:.][0-5]\d\b|'
+        r'\b\d{1,2}\s*(?:утра|вечера|дня|ночи)\b'
+    ),
+    # "после зарплаты", "позже", "вернусь к этому", "не сейчас"
+    'deferral': re.compile(
+        r'\bпосле\s+(?:зарплат\w*|аванс\w*|отпуск\w*|переезд\w*|праздник\w*|ремонт\w*|сесси\w*|экзамен\w*|'
+        r'выходных|получк\w*|пенси\w*|операци\w*|болезн\w*)|'
+        r'\b(?:по)?позже\b|\bвернусь\b|\bвернемся\b|\bвернёмся\b|\bне\s+сейчас\b|\bкак[\s-]нибудь\s+потом\b|'
+        r'\bсвяжемся\b|\bсвяжусь\b|\bспишемся\b|\bна\s+связи\b|\bпродолжим\b|\bотложу\b|\bотложить\b|'
+        r'\bподумаю\b|\bподумать\b|\bв\s+друг(?:ой|ие)\s+(?:день|раз|дни)\b'
+    ),
+    # "напомните", "напомню", "поставил напоминание"
+    'reminder_request': re.compile(r'\bнапомн\w*|\bнапоминан\w*|\bнапоминалк\w*'),
+    # "отмените напоминание", "не надо напоминать", "передумал"
+    'cancellation': re.compile(
+        r'\bотмен\w*|\bне\s+(?:надо|нужно|стоит)\s+(?:напомин\w*|писать|беспокоить)|\bне\s+напоминай\w*|'
+        r'\bне\s+пишите\b|\bпередумал\w*|\bперенес\w*|\bперенести\b|\bотписа\w*'
+    ),
+    'timezone': re.compile('|'.join(pattern.pattern for pattern, _ in TIMEZONE_PATTERNS)),
+}
+
+# Все категории одним проходом — для быстрой проверки "есть ли хоть что-то"
+_ANY_SIGNAL = re.compile('|'.join(f'(?:{p.pattern})' for p in SIGNAL_PATTERNS.values()))
+
+
+def _normalize(message_text):
+    """Приводит сообщение к нижнему регистру и убирает внутреннюю временную метку."""
+    if not message_text:
+        return ''
+    return strip_timestamp(message_text).lower().replace('ё', 'е')
+
+
+def has_temporal_signal(message_text):
+    """
+    Быстро проверяет, есть ли в сообщении временное выражение, просьба напомнить или отмена.
+
+    Args:
+        message_text (str): Текст сообщения (может содержать временную метку в начале).
+
+    Returns:
+        bool: True, если найден хотя бы один сигнал.
+    """
+    return _ANY_SIGNAL.search(_normalize(message_text)) is not None
+
+
+def detect_temporal_signals(message_text):
+    """
+    Находит все сигналы в сообщении с разбивкой по категориям (для логов и отладки).
+
+    Args:
+        message_text (str): Текст сообщения.
+
+    Returns:
+        dict: {категория: [найденные фрагменты]}, только непустые категории.
+    """
+    text = _normalize(message_text)
+    found = {}
+    for category, pattern in SIGNAL_PATTERNS.items():
+        matches = [m.group(0).strip() for m in pattern.finditer(text)]
+        if matches:
+            found[category] = matches
+    return found
+
+
+def should_analyze_for_reminders(messages, active_reminders_count):
+    """
+    Решает, нужен ли дорогой вызов Gemini для поиска договоренностей о напоминании.
+
+    Args:
+        messages (list): Тексты свежих сообщений диалога (клиента и ассистента).
+        active_reminders_count (int): Количество активных напоминаний клиента.
+
+    Returns:
+        bool: False, только если нет активных напоминаний и ни одного сигнала в сообщениях.
+    """
+    if active_reminders_count > 0:
+        return True
+    return any(has_temporal_signal(message) for message in messages)
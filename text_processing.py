@@ -0,0 +1,141 @@
+# --- Описание ---
+# Общие функции обработки текста сообщений с заранее скомпилированными регулярными выражениями.
+# Используется в main.py, reminder_service.py, summary_updater.py и temporal_detector.py.
+# Там, где к одному тексту применялось несколько шаблонов подряд, они объединены в одну
+# альтернативу, и текст просматривается один раз.
+# --- Конец описания ---
+
+import re
+
+# --- ВРЕМЕННЫЕ МЕТКИ СООБЩЕНИЙ ---
+# Каждое сообщение в dialogues хранится с префиксом вида [2025-01-01_12-00-00];
+# убирается любой префикс в квадратных скобках, как и прежним re.sub(r'^\[.*?\]\s*', '', ...)
+_TIMESTAMP_PREFIX = re.compile(r'\[.*?\]\s*')
+
+# --- ВНУТРЕННИЕ РАЗМЫШЛЕНИЯ БОТА ---
+# <internal>...</internal> и <internal_analysis>...</internal_analysis> одним проходом
+_INTERNAL_TAGS = re.compile(r'<(internal|internal_analysis)>.*?</\1>', re.DOTALL | re.IGNORECASE)
+_BLANK_LINES = re.compile(r'\n\s*\n')
+
+# --- ВИДЕО VK ---
+# Идентификатор видео в формате цифры_цифры
+_VK_VIDEO_ID = re.compile(r'\b(\d+_\d+)\b')
+
+# --- ДЕНЬ РОЖДЕНИЯ ---
+RUSSIAN_MONTHS_GENITIVE = {
+    "января": 1, "февраля": 2, "марта": 3, "апреля": 4,
+    "мая": 5, "июня": 6, "июля": 7, "августа": 8,
+    "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12
+}
+# Новый формат "Дата рождения: 30 августа" и старый "Дата рождения: 30.8" одним шаблоном
+_BIRTHDAY = re.compile(
+    r'Дата рождения: (\d+)(?: (' + '|'.join(RUSSIAN_MONTHS_GENITIVE) + r')|\.(\d+))'
+)
+
+# --- ЧАСОВЫЕ ПОЯСА ---
+# Явные упоминания часового пояса в сообщении (текст ожидается в нижнем регистре)
+TIMEZONE_PATTERNS = [
+    (re.compile(r'по\s+москве|московское\s+время|мск'), 'Europe/Moscow'),
+    (re.compile(r'по\s+питеру|по\s+спб|питерское\s+время'), 'Europe/Moscow'),
+    (re.compile(r'по\s+екатеринбургу|екатеринбургское\s+время'), 'Asia/Yekaterinburg'),
+    (re.compile(r'по\s+новосибирску|новосибирское\s+время'), 'Asia/Novosibirsk'),
+    (re.compile(r'по\s+владивостоку|владивостокское\s+время'), 'Asia/Vladivostok'),
+    (re.compile(r'utc|гринвич'), 'UTC'),
+    (re.compile(r'по\s+киеву|киевское\s+время'), 'Europe/Kiev'),
+    (re.compile(r'по\s+минску|минское\s+время'), 'Europe/Minsk'),
+    (re.compile(r'по\s+алматы'), 'Asia/Almaty'),
+]
+# Все часовые пояса одной альтернативой без групп: на большинстве сообщений (без упоминаний)
+# это единственный проход по тексту. Именованные группы здесь в разы замедляют поиск.
+# Какой пояс вернуть, решает порядок TIMEZONE_PATTERNS, а не позиция упоминания в тексте.
+_TIMEZONE_ANY = re.compile('|'.join(pattern.pattern for pattern, _ in TIMEZONE_PATTERNS))
+
+
+def strip_timestamp(message_text):
+    """
+    Убирает внутреннюю временную метку [ГГГГ-ММ-ДД_чч-мм-сс] (любой префикс [...]) в начале сообщения.
+
+    Args:
+        message_text (str): Текст сообщения из таблицы dialogues.
+
+    Returns:
+        str: Текст без временной метки.
+    """
+    if not message_text or message_text[0] != '[':
+        return message_text or ''
+    match = _TIMESTAMP_PREFIX.match(message_text)
+    return message_text[match.end():] if match else message_text
+
+
+def remove_internal_tags(message):
+    """
+    Удаляет внутренние размышления бота, ограниченные тегами <internal> и <internal_analysis>,
+    и лишние пустые строки.
+    """
+    if '<' in message:
+        message = _INTERNAL_TAGS.sub('', message)
+    message = _BLANK_LINES.sub('\n', message)
+    return message.strip()
+
+
+def vkvideo_add(message_text):
+    """
+    Проверяет сообщение на наличие идентификаторов видео VK и вырезает их.
+    Также удаляет двойные звездочки, которые не отображаются как жирный текст в VK.
+
+    Args:
+        message_text (str): Текст сообщения
+
+    Returns:
+        tuple: (очищенный_текст_сообщения, список_идентификаторов_видео)
+    """
+    message_text = message_text.replace('**', '')
+
+    video_ids = []
+
+    def _collect(match):
+        video_ids.append(match.group(1))
+        return ''
+
+    # Поиск и удаление за один проход; форматирование текста не меняем
+    cleaned_message = _VK_VIDEO_ID.sub(_collect, message_text)
+    return cleaned_message, video_ids
+
+
+def find_birthday(context_text):
+    """
+    Находит дату рождения в контексте клиента (новый формат "30 августа" или старый "30.8").
+
+    Args:
+        context_text (str): Текст контекста от context builder.
+
+    Returns:
+        tuple: (birth_day, birth_month) или (None, None), если дата не найдена.
+    """
+    match = _BIRTHDAY.search(context_text)
+    if not match:
+        return None, None
+    birth_day = int(match.group(1))
+    if match.group(2):
+        return birth_day, RUSSIAN_MONTHS_GENITIVE[match.group(2)]
+    return birth_day, int(match.group(3))
+
+
+def detect_timezone(message_text):
+    """
+    Определяет, указан ли в сообщении конкретный часовой пояс.
+
+    Args:
+        message_text (str): Текст сообщения.
+
+    Returns:
+        str: Имя часового пояса (например, 'Europe/Moscow') или None.
+    """
+    message_lower = message_text.lower()
+    if not _TIMEZONE_ANY.search(message_lower):
+        return None
+    # Упоминание есть: первый по порядку TIMEZONE_PATTERNS пояс, как и прежде
+    for pattern, timezone_name in TIMEZONE_PATTERNS:
+        if pattern.search(message_lower):
+            return timezone_name
+    return None